@@ -8,6 +8,7 @@ from astropy.cosmology import Planck15 as cosmo
 from astropy import units as u
 import numpy as N
 import pylab as P
+from pzmassfitter import pdzfile_utils
 from . import utils as cutils
 
 
@@ -44,28 +45,224 @@ def color_mag_plot(mags):
     P.show()
 
 
-def fit_red_sequence(color, mag, **kwargs):
-    r"""
-    Fit red sequence (RS) band in galaxy color plots, i.e m(i)-m(j) vs. m(k).
+def emg_model(p, z):
+    """Gaussian (red sequence) plus Exponentially Modified Gaussian (background) model.
 
-    :param list color: A list of color mag_i - mag_j (ordinate)
-    :param list mag: List of magnitude (abciss)
-    :param \*\*kwargs:
+    :param p: The 7 parameters of the model, or an array of shape (nfits, 7)
+    :param z: Points where the model is computed, or an array of shape (nfits, npoints)
+    """
+    p = N.asarray(p)
+    if p.ndim == 2:
+        p = p.T[..., None]
+    return p[0] * N.exp(-(p[1] - z)**2 / (2 * p[2]**2)) + \
+        p[6] * p[5] * N.exp(0.5 * p[5] * (2 * p[3] + p[5] * p[4]**2 - 2 * z)) * \
+        special.erfc((p[3] + p[5] * p[4] ** 2 - z) / (math.sqrt(2) * p[4]))
 
-     - minc (float): lower cut on the color axis: color > minc (1.0)
-     - maxc (float): upper cut of the color axis: color < maxc  (2.0)
-     - minm (float): lower cut on the mag axis: mag > minm (20.0)
-     - maxm (float): upper cut of the mag axis: mag < maxm  (23.5)
-     - islope (float): first guess for the red sequence band slope (-0.04)
-     - nbins (int): Number of bins used in the fits (40)
-     - plot (bool): if True plot stuff
-     - verbose (bool): if True print information to screen
-    :return:
 
-     - slope of the red sequence band,
-     - ordinate at the origin of the red sequence band +/- 1.5 sigma
+def emg_residuals(p, z, y):
+    """Weighted residuals of the fit of `emg_model` on an histogram y."""
+    return (emg_model(p, z) - y) / (N.sqrt(y) + 1.)
 
-    fitRedSequence is also producing some control plots
+
+def fit_emg(x, y, p0):
+    """Fit `emg_model` on one histogram (see `emg_residuals`).
+
+    :return: the fitted parameters and the sum of the squared residuals
+    """
+    p1, cov, infodict, mesg, ier = optimize.leastsq(emg_residuals, p0[:], args=(x, y),
+                                                    full_output=True)
+    return p1, (infodict['fvec']**2).sum()
+
+
+def _lm_parameter(eigval, proj, delta, par):
+    """Levenberg-Marquardt parameter of a stack of scaled problems, as MINPACK lmpar.
+
+    With S = V diag(eigval) V^T the scaled normal matrix and proj = V^T s the projected
+    scaled gradient of each fit, the step q(par) = -(S + par I)^-1 s has the norm
+    sqrt(sum(proj^2 / (eigval + par)^2)). The returned par is 0 when the Gauss-Newton
+    step is within 1.1 delta, and otherwise such that the step norm is within 10% of
+    delta.
+
+    :return: par, the eigen components of the scaled step, and its norm
+    """
+    dwarf = N.finfo('float64').tiny
+    rank = eigval > N.finfo('float64').eps * eigval.max(axis=1, keepdims=True)
+    full = rank.all(axis=1)
+    safe = N.where(rank, eigval, 1.)
+    step = N.where(rank, -proj / safe, 0.)
+    dxnorm = N.sqrt((step**2).sum(axis=1))
+    fp = dxnorm - delta
+    search = fp > 0.1 * delta
+    # lower bound from a Newton step at par=0 (full rank only), upper bound
+    parl = N.where(full, fp / delta * dxnorm**2 /
+                   N.maximum((proj**2 / safe**3).sum(axis=1), dwarf), 0.)
+    gnorm = N.sqrt((proj**2).sum(axis=1))
+    paru = gnorm / delta
+    paru = N.where(paru == 0, dwarf / min(delta.min(), 0.1), paru)
+    par = N.minimum(N.maximum(par, parl), paru)
+    par = N.where(par == 0, gnorm / N.maximum(dxnorm, dwarf), par)
+    par = N.where(search, par, 0.)
+    for _ in range(10):
+        if not search.any():
+            break
+        par = N.where(search & (par == 0), N.maximum(dwarf, 0.001 * paru), par)
+        shifted = eigval + par[:, None]
+        newstep = -proj / shifted
+        newnorm = N.sqrt((newstep**2).sum(axis=1))
+        step = N.where(search[:, None], newstep, step)
+        dxnorm = N.where(search, newnorm, dxnorm)
+        previous, fp = fp, dxnorm - delta
+        search &= ~((N.abs(fp) <= 0.1 * delta) |
+                    ((parl == 0) & (fp <= previous) & (previous < 0)))
+        parc = fp / delta * dxnorm**2 / (proj**2 / shifted**3).sum(axis=1)
+        parl = N.where(search & (fp > 0), N.maximum(parl, par), parl)
+        paru = N.where(search & (fp < 0), N.minimum(paru, par), paru)
+        par = N.where(search, N.maximum(parl, par + parc), par)
+    return par, step, dxnorm
+
+
+def fit_emg_batch(x, y, p0, maxfev=1600, ftol=1.49012e-08, xtol=1.49012e-08, factor=100.):
+    """Fit `emg_model` on several histograms at once.
+
+    The same Levenberg-Marquardt minimization of `emg_residuals` as `fit_emg` (MINPACK
+    lmdif, with its scaling, trust region and convergence tests), run on all the
+    histograms in parallel: the residuals and the (forward difference) jacobians of all
+    the fits are computed as arrays, and the 7x7 scaled normal equations are solved
+    through a stack of eigen decompositions.
+
+    :param x: bin centers, of shape (nfits, nbins)
+    :param y: histograms, of shape (nfits, nbins)
+    :param p0: initial parameters, of shape (7,) or (nfits, 7)
+    :param int maxfev: Maximal number of evaluations of the model per fit
+    :return: the fitted parameters (nfits, 7) and the sums of the squared residuals (nfits)
+    """
+    nfits = len(y)
+    p = N.array(N.broadcast_to(p0, (nfits, 7)), dtype='float64')
+    eps = N.sqrt(N.finfo('float64').eps)
+    # diverging trial steps are rejected: do not warn about their overflows
+    with N.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        resid = emg_residuals(p, x, y)
+        fnorm = N.sqrt((resid**2).sum(axis=1))
+        active = N.isfinite(fnorm)
+        nfev = N.ones(nfits, dtype='int64')
+        first = N.ones(nfits, dtype=bool)
+        newjac = active.copy()
+        diag, delta, par = N.ones((nfits, 7)), N.zeros(nfits), N.zeros(nfits)
+        eigval, eigvec, proj = N.zeros((nfits, 7)), N.zeros((nfits, 7, 7)), N.zeros((nfits, 7))
+        while active.any():
+            rows = N.flatnonzero(newjac & active)
+            if len(rows):
+                # forward difference jacobian, one parameter at a time for all the fits
+                pa, ra, xa, ya = p[rows], resid[rows], x[rows], y[rows]
+                step = eps * N.where(pa == 0, 1., N.abs(pa))
+                jac = N.empty(ra.shape + (7,))
+                for k in range(7):
+                    dp = pa.copy()
+                    dp[:, k] += step[:, k]
+                    jac[..., k] = (emg_residuals(dp, xa, ya) - ra) / step[:, k, None]
+                jac = N.nan_to_num(jac, posinf=0., neginf=0.)
+                nfev[rows] += 7
+                acnorm = N.sqrt((jac**2).sum(axis=1))
+                init = first[rows]
+                diag[rows] = N.where(init[:, None], N.where(acnorm == 0, 1., acnorm),
+                                     N.maximum(diag[rows], acnorm))
+                xnorm = N.sqrt(((diag[rows] * pa)**2).sum(axis=1))
+                delta[rows] = N.where(init, N.where(xnorm == 0, factor, factor * xnorm),
+                                      delta[rows])
+                scaled = jac / diag[rows][:, None, :]
+                eigval[rows], eigvec[rows] = N.linalg.eigh(
+                    N.einsum('fik,fil->fkl', scaled, scaled))
+                eigval[rows] = N.maximum(eigval[rows], 0.)
+                proj[rows] = N.einsum('fkl,fk->fl', eigvec[rows],
+                                      N.einsum('fik,fi->fk', scaled, ra))
+                newjac[rows] = False
+
+            rows = N.flatnonzero(active)
+            par[rows], qstep, pnorm = _lm_parameter(eigval[rows], proj[rows], delta[rows],
+                                                    par[rows])
+            delta[rows] = N.where(first[rows], N.minimum(delta[rows], pnorm), delta[rows])
+            newp = p[rows] + N.einsum('fkl,fl->fk', eigvec[rows], qstep) / diag[rows]
+            newresid = emg_residuals(newp, x[rows], y[rows])
+            # as the MINPACK norm: nan with a nan or several infinite residuals, so that
+            # such steps shrink the trust region less than a merely too large cost
+            fnorm1 = N.sqrt((newresid**2).sum(axis=1))
+            fnorm1[((~N.isfinite(newresid)).sum(axis=1) > 1) |
+                   N.isnan(newresid).any(axis=1)] = N.nan
+            nfev[rows] += 1
+            fn = fnorm[rows]
+            actred = N.where(0.1 * fnorm1 < fn, 1 - (fnorm1 / fn)**2, -1.)
+            temp1 = (eigval[rows] * qstep**2).sum(axis=1) / fn**2
+            temp2 = par[rows] * pnorm**2 / fn**2
+            prered = temp1 + 2 * temp2
+            dirder = -(temp1 + temp2)
+            ratio = N.where(prered != 0, actred / N.where(prered != 0, prered, 1.), 0.)
+
+            # update of the trust region
+            shrink = ratio <= 0.25
+            temp = N.where(actred >= 0, 0.5, 0.5 * dirder / (dirder + 0.5 * actred))
+            temp = N.where((0.1 * fnorm1 >= fn) | (temp < 0.1), 0.1, temp)
+            grow = ~shrink & ((par[rows] == 0) | (ratio >= 0.75))
+            delta[rows] = N.where(shrink, temp * N.minimum(delta[rows], pnorm / 0.1),
+                                  N.where(grow, pnorm / 0.5, delta[rows]))
+            par[rows] = N.where(shrink, par[rows] / temp,
+                                N.where(grow, 0.5 * par[rows], par[rows]))
+
+            accept = ratio >= 1e-4
+            good = rows[accept]
+            p[good], resid[good], fnorm[good] = newp[accept], newresid[accept], fnorm1[accept]
+            first[good], newjac[good] = False, True
+            xnorm = N.sqrt(((diag[rows] * p[rows])**2).sum(axis=1))
+
+            # convergence tests of MINPACK (ftol, xtol, maxfev, machine precision)
+            done = (N.abs(actred) <= ftol) & (prered <= ftol) & (0.5 * ratio <= 1)
+            done |= delta[rows] <= xtol * xnorm
+            done |= nfev[rows] >= maxfev
+            done |= (N.abs(actred) <= N.finfo('float64').eps) & \
+                (prered <= N.finfo('float64').eps) & (0.5 * ratio <= 1)
+            done |= delta[rows] <= N.finfo('float64').eps * xnorm
+            active[rows[done]] = False
+    return p, fnorm**2
+
+
+def histogram_rows(values, nbins):
+    """Histogram each row of a 2D array, as numpy.histogram(row, bins=nbins) would.
+
+    :return: the counts (nrows, nbins) and the bin edges (nrows, nbins + 1)
+    """
+    values = N.asarray(values, dtype='float64')
+    first, last = values.min(axis=1), values.max(axis=1)
+    same = first == last
+    first, last = N.where(same, first - 0.5, first), N.where(same, last + 0.5, last)
+    edges = N.linspace(first, last, nbins + 1, axis=1)
+    index = ((values - first[:, None]) * (nbins / (last - first))[:, None]).astype(N.intp)
+    index[index == nbins] -= 1
+    # same rounding corrections as numpy.histogram
+    rows = N.arange(len(values))[:, None]
+    index[values < edges[rows, index]] -= 1
+    index[(values >= edges[rows, index + 1]) & (index != nbins - 1)] += 1
+    counts = N.bincount((index + rows * nbins).ravel(), minlength=len(values) * nbins)
+    return counts.reshape(len(values), nbins), edges
+
+
+def project_colors(color, mag, slopes, magref, diffref):
+    """Project the colors on the axes perpendicular to red sequences of several slopes.
+
+    :return: an array of shape (nslopes, ngalaxies), or (ngalaxies) for a single slope
+    """
+    slopes = N.asarray(slopes, dtype='float64')
+    cosalpha = N.cos(N.arctan(slopes))[..., None]
+    return cosalpha * ((magref - N.asarray(mag)) * slopes[..., None] + N.asarray(color) - diffref)
+
+
+def red_sequence_fit(color, mag, **kwargs):
+    r"""
+    Fit red sequence (RS) band in galaxy color plots, i.e m(i)-m(j) vs. m(k).
+
+    See `fit_red_sequence` for the parameters. Nothing is plotted: the intermediate
+    results are returned for `plot_red_sequence`.
+
+    :return: a dictionnary with the 'params' returned by `fit_red_sequence`, and the
+     intermediate results of the fit.
     """
     # Set the default
     minc = kwargs.get('minc', 1.0)
@@ -74,121 +271,52 @@ def fit_red_sequence(color, mag, **kwargs):
     maxm = kwargs.get('maxm', 23.5)
     islope = kwargs.get('islope', -0.04)
     nbins = kwargs.get('nbins', 40)
-    plot = kwargs.get('plot', False)
     verb = kwargs.get('verbose', False)
 
+    color, mag = N.asarray(color), N.asarray(mag)
     magref = minm  # Arbitrary reference magnitude for projection
     # Arbitrary reference ordinate for projection
     diffref = 0.5 * (minc + maxc)
+    idx = (color > minc) & (color < maxc) & (mag < maxm) & (mag > minm)
+    color, mag = color[idx], mag[idx]
 
     # Project color on an axis perpendicular to the RS band and at an
     # arbitrary magnitude (magref)
     # The idea is that the projection of the RS band on this axis is a gaussian
     # over some background represented by an Exponentially Modified Gaussian
-
-    alpha = math.atan(islope)
-    dy = N.cos(alpha) * ((N.asarray(magref) - mag) * islope + color - diffref)
-
-    idx = N.where((color > minc) & (color < maxc)
-                  & (mag < maxm) & (mag > minm))
-    fig, (ax0) = P.subplots(ncols=1)
-    n, bins, patches = ax0.hist(dy[idx], bins=nbins, color='b')
-
-    x = N.asarray([0.5 * (bins[i + 1] - bins[i]) + bins[i]
-                   for i in range(len(n))])
+    n, bins = N.histogram(project_colors(color, mag, islope, magref, diffref), bins=nbins)
+    x = 0.5 * (bins[1:] + bins[:-1])
 
     # Fit a gaussian for the RS projection plus an Exponentially Modified
     # Gaussian distribution for the background
-    def func(p, z):
-        """Function to fit."""
-        return p[0] * N.exp(-(p[1] - z)**2 / (2 * p[2]**2)) + \
-            p[6] * p[5] * N.exp(0.5 * p[5] * (2 * p[3] + p[5] * p[4]**2 - 2 * z)) * \
-            special.erfc((p[3] + p[5] * p[4] ** 2 - z) / (math.sqrt(2) * p[4]))
-
-    def dist(p, z, y):
-        return (func(p, z) - y) / (N.sqrt(y) + 1.)
-
     p0 = [n.max(), 0.2, 0.1, -3.0, 1., 1., 40.]  # Initial parameter values
-    p2, cov, infodict, mesg, ier = optimize.leastsq(
-        dist, p0[:], args=(x, n), full_output=True)
-    ss_err = (infodict['fvec']**2).sum()
-
+    p2, ss_err = fit_emg(x, n, p0)
     if verb:
         print("mean %f - sigma %f" % (p2[1], p2[2]))
         print("Reduced chi2 = ", ss_err / (nbins + 6 - 1))
         print(p2)
-    # Superimpose fitted curve over color projection
-    ax0.plot(bins, func(p2, bins), color='g')
-    ax0.tick_params(labelsize=20)
-    ax0.set_xlabel("Projected red sequence")
+    fit = {'initial': (n, bins, p2)}
 
     # Minimize the width of the gaussian by varying the RS slope around the
-    # initial guess
-
+    # initial guess: all the slopes are projected, histogrammed and fitted at once,
+    # starting from the parameters of the initial fit
     nsteps = 80
     step = 0.001
-    slope = islope - 0.5 * nsteps * step
-
-    val = []
-    sigma = []
-    sigmamin = 999.0
-
-    def lfunc(p, z):
-        return p[0] * N.exp(-(p[1] - z) ** 2 / (2 * p[2] ** 2)) + \
-            p[6] * p[5] * N.exp(0.5 * p[5] * (2 * p[3] + p[5] * p[4] ** 2 - 2 * z)) * \
-            special.erfc((p[3] + p[5] * p[4] ** 2 - z) / (math.sqrt(2) * p[4]))
-
-    def ldist(p, z, y):
-        return (lfunc(p, z) - y) / (N.sqrt(y) + 1.)
-
-    for i in range(nsteps):
-        slope += step
-        # RS slope is always negative
-        if slope > 0.0:
-            break
-        alpha = math.atan(slope)
-        dy = N.cos(alpha) * ((magref - mag) * slope + color - diffref)
-        idx = N.where((color > minc) & (color < maxc)
-                      & (mag < maxm) & (mag > minm))
-        n, bins, = N.histogram(dy[idx], bins=nbins)
-
-        x = N.asarray([0.5 * (bins[i + 1] - bins[i]) + bins[i]
-                       for i in range(len(n))])
-        p0 = p2  # Start fit with parameters fitted at the previous step
-        p1, cov, infodict, mesg, ier = optimize.leastsq(
-            ldist, p0[:], args=(x, n), full_output=True)
-        val.append(slope)
-        sigma.append(p1[2])
-        if p1[2] < sigmamin:
-            sigmamin = p1[2]
-            param = p1
-
-    fig, (ax0) = P.subplots(ncols=1)
-    ax0.scatter(val, sigma, s=5, color='b')
-    bestslope = val[N.argmin(N.asarray(sigma))]
+    # (successive additions of step, as a loop would do)
+    val = N.cumsum(N.concatenate([[islope - 0.5 * nsteps * step], N.full(nsteps, step)]))[1:]
+    val = val[val <= 0.0]  # RS slope is always negative
+    n, bins = histogram_rows(project_colors(color, mag, val, magref, diffref), nbins)
+    params = fit_emg_batch(0.5 * (bins[:, 1:] + bins[:, :-1]), n, p2)[0]
+    sigma = params[:, 2]
+    param = params[N.argmin(sigma)]
+    bestslope = val[N.argmin(sigma)]
 
     # Fit a parabola on the (slope, sigma) distribution to find the RS slope
     # corresponding to the minimum sigma
-    def parabola(p, z):
-        return p[0] * z * z + p[1] * z + p[2]
-
-    def pdist(p, z, y):
-        return parabola(p, z) - y
-
-    p0 = [1., 1., 1.]
-    p1, cov, infodict1, mesg, ier = optimize.leastsq(pdist, p0[:],
-                                                     args=(N.asarray(val),
-                                                           N.asarray(sigma)),
-                                                     full_output=True)
-    fitslope = -0.5 * p1[1] / p1[0]
-
-    ax0.plot(N.asarray(val), parabola(p1, N.asarray(val)), color='r')
-    ax0.tick_params(labelsize=20)
-    ax0.set_xlabel("Red sequence slope")
-    ax0.set_ylabel("Sigma")
-
-    ss_err = (infodict1['fvec']**2).sum()
-    ss_tot = ((N.asarray(sigma) - N.asarray(sigma).mean())**2).sum()
+    parabola = N.polyfit(val, sigma, 2)
+    fitslope = -0.5 * parabola[1] / parabola[0]
+    ss_err = ((N.polyval(parabola, val) - sigma)**2).sum()
+    ss_tot = ((sigma - sigma.mean())**2).sum()
     rsquared = 1 - (ss_err / ss_tot)
     if verb:
         print("R^2 = ", rsquared)
@@ -198,38 +326,19 @@ def fit_red_sequence(color, mag, **kwargs):
         fitslope = bestslope
     if verb:
         print("Fitted minimum: %f" % fitslope)
+    fit['scan'] = (val, sigma, parabola)
 
-    # Plot RS projection corresponding to the optimal slope
-    alpha = math.atan(slope)
-    dy = N.cos(alpha) * ((magref - mag) * fitslope + color - diffref)
-    idx = N.where((color > minc) & (color < maxc)
-                  & (mag < maxm) & (mag > minm))
-    fig, (ax2) = P.subplots(ncols=1)
-    n, bins, patches = ax2.hist(dy[idx], bins=nbins, color='b')
-    x = N.asarray([0.5 * (bins[i + 1] - bins[i]) + bins[i]
-                   for i in range(len(n))])
-
-    def hfunc(p, z):
-        """Function to fit."""
-        return p[0] * N.exp(-(p[1] - z) ** 2 / (2 * p[2] ** 2)) + \
-            p[6] * p[5] * N.exp(0.5 * p[5] * (2 * p[3] + p[5] * p[4] ** 2 - 2 * z)) * \
-            special.erfc((p[3] + p[5] * p[4] ** 2 - z) / (math.sqrt(2) * p[4]))
-
-    def hdist(p, z, y):
-        return (hfunc(p, z) - y) / (N.sqrt(y) + 1.)
-
-    p0 = param
-    p1, cov, infodict, mesg, ier = optimize.leastsq(
-        hdist, p0[:], args=(x, n), full_output=True)
-    ss_err = (infodict['fvec']**2).sum()
+    # RS projection corresponding to the optimal slope
+    n, bins = N.histogram(project_colors(color, mag, fitslope, magref, diffref), bins=nbins)
+    x = 0.5 * (bins[1:] + bins[:-1])
+    p1, ss_err = fit_emg(x, n, param)
     ss_tot = ((n - n.mean()) ** 2).sum()
     rsquared = 1 - (ss_err / ss_tot)
     if verb:
         print("mean %f - sigma %f" % (p1[1], p1[2]))
         print("Reduced chi2 = %f - R^2 = %f" %
               (ss_err / (nbins + 6 - 1), rsquared))
-    ax2.plot(bins, hfunc(p1, bins), color='r')
-    ax2.tick_params(labelsize=20)
+    fit['final'] = (n, bins, p1)
 
     # Compute the ordinates at origin corresponding to a +/- 1.5 sigma
     # interval around the best gaussian mean value
@@ -242,24 +351,80 @@ def fit_red_sequence(color, mag, **kwargs):
         print("Ordinate at origin of the RS band - middle : %f, lower : %f, upper : %f" %
               (b0, b1, b2))
 
+    fit['band'] = (fitslope, b0, b1, b2)
+    fit['limits'] = (minc, maxc, minm, maxm)
+    fit['params'] = [[fitslope, b1], [fitslope, b2]]
+    return fit
+
+
+def plot_red_sequence(fit, color, mag):
+    """Control plots of a red sequence fit (see `red_sequence_fit`)."""
+    # Color projections with the initial slope, and fitted curve
+    n, bins, p2 = fit['initial']
+    fig, (ax0) = P.subplots(ncols=1)
+    ax0.hist(bins[:-1], bins=bins, weights=n, color='b')
+    ax0.plot(bins, emg_model(p2, bins), color='g')
+    ax0.tick_params(labelsize=20)
+    ax0.set_xlabel("Projected red sequence")
+
+    # Width of the red sequence as a function of its slope
+    val, sigma, parabola = fit['scan']
+    fig, (ax0) = P.subplots(ncols=1)
+    ax0.scatter(val, sigma, s=5, color='b')
+    ax0.plot(val, N.polyval(parabola, val), color='r')
+    ax0.tick_params(labelsize=20)
+    ax0.set_xlabel("Red sequence slope")
+    ax0.set_ylabel("Sigma")
+
+    # RS projection corresponding to the optimal slope
+    n, bins, p1 = fit['final']
+    fig, (ax2) = P.subplots(ncols=1)
+    ax2.hist(bins[:-1], bins=bins, weights=n, color='b')
+    ax2.plot(bins, emg_model(p1, bins), color='r')
+    ax2.tick_params(labelsize=20)
+
     # plot fitted RS band over color plot
+    fitslope, b0, b1, b2 = fit['band']
+    minc, maxc, minm, maxm = fit['limits']
     fig, (ax3) = P.subplots(ncols=1)
     ax3.scatter(mag, color, s=1, color='b')
     ax3.set_xlim([minm - 3.0, maxm + 3.0])
     ax3.set_ylim([minc - 1.5, maxc + 0.5])
     x = N.linspace(minm - 3.0, maxm + 3.0)
-    ymin = fitslope * x + b1
-    ymax = fitslope * x + b2
-    ymid = fitslope * x + b0
-    ax3.plot(x, ymin, color='r')
-    ax3.plot(x, ymax, color='r')
-    ax3.plot(x, ymid, color='g')
-
-    if plot is True:
-        P.show()
+    ax3.plot(x, fitslope * x + b1, color='r')
+    ax3.plot(x, fitslope * x + b2, color='r')
+    ax3.plot(x, fitslope * x + b0, color='g')
+
+
+def fit_red_sequence(color, mag, **kwargs):
+    r"""
+    Fit red sequence (RS) band in galaxy color plots, i.e m(i)-m(j) vs. m(k).
+
+    :param list color: A list of color mag_i - mag_j (ordinate)
+    :param list mag: List of magnitude (abciss)
+    :param \*\*kwargs:
+
+     - minc (float): lower cut on the color axis: color > minc (1.0)
+     - maxc (float): upper cut of the color axis: color < maxc  (2.0)
+     - minm (float): lower cut on the mag axis: mag > minm (20.0)
+     - maxm (float): upper cut of the mag axis: mag < maxm  (23.5)
+     - islope (float): first guess for the red sequence band slope (-0.04)
+     - nbins (int): Number of bins used in the fits (40)
+     - plot (bool): if True plot stuff
+     - verbose (bool): if True print information to screen
+    :return:
 
-    params = [[fitslope, b1], [fitslope, b2]]
-    return params
+     - slope of the red sequence band,
+     - ordinate at the origin of the red sequence band +/- 1.5 sigma
+
+    The fit itself is done by `red_sequence_fit`, and the control plots (only made if
+    plot is True) by `plot_red_sequence`.
+    """
+    fit = red_sequence_fit(color, mag, **kwargs)
+    if kwargs.get('plot', False) is True:
+        plot_red_sequence(fit, color, mag)
+        P.show()
+    return fit['params']
 
 
 def zphot_cut(zclust, zdata, **kwargs):
@@ -277,18 +442,13 @@ def zphot_cut(zclust, zdata, **kwargs):
     zmin = kwargs.get('zmin')
     zmax = kwargs.get('zmax')
     zbest = zdata['Z_BEST']
-    pdz = zdata['pdz']
-    zbins = zdata['zbins'][0]  # all objects have same zbins, take 0th.
+    zbins, cdf = pdzfile_utils.read_pdz_cdf(zdata)
 
     # WtGIII hard cuts
     filt1 = (zbest > zmin) & (zbest < zmax)
 
-    # pdz_based cut
-    cut = (zbins < zclust + 0.1)
-
-    # probability for the cluster to be located below zclust + 0.1
-    filt2 = N.array([N.trapz(pdzi[cut], zbins[cut])
-                     * 100. < thresh for pdzi in pdz])
+    # pdz_based cut: probability for the galaxy to be located below zclust + 0.1
+    filt2 = pdzfile_utils.prob_below(cdf, zbins, zclust + 0.1) * 100. < thresh
 
     if plot:
         fig = P.figure()
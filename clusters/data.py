@@ -4,10 +4,9 @@ import sys
 import glob
 import numpy
 from astropy.wcs import WCS
-from astropy.coordinates import SkyCoord, Angle
 from astropy.table import Table, Column
-from astropy.units import Quantity
 from termcolor import colored
+from pzmassfitter import join
 from . import utils as cutils
 #import plots
 import IPython
@@ -504,8 +503,8 @@ class DRPCatalogs(DRPLoader):
                       len(self.catalogs['forced_src']))
                 coaddid = 'id' if 'id' in self.catalogs[deepcoadd[0]].keys(
                 ) else 'objectId'
-                filt = numpy.where(numpy.in1d(self.catalogs['forced_src']['objectId'],
-                                        self.catalogs[deepcoadd[0]][coaddid]))[0]
+                filt = numpy.where(join.isin(self.catalogs['forced_src']['objectId'],
+                                             self.catalogs[deepcoadd[0]][coaddid]))[0]
                 self.catalogs['forced_src'] = self.catalogs['forced_src'][filt]
                 print("  - %i sources in the forced-src catalog after selection" %
                       len(self.catalogs['forced_src']))
@@ -531,38 +530,15 @@ class DRPCatalogs(DRPLoader):
             columns = []
             # Add magnitudes
             if self.from_butler['getmag'] is not None:
-                kfluxes = [
-                    k for k in self.catalogs[catalog].columns if k.endswith('_instFlux')]
-                ksigmas = [k + 'Err' for k in kfluxes]
-                print("    -> getting magnitudes")
-
-                for kflux, ksigma in zip(kfluxes, ksigmas):
-                    if kflux.replace('_instFlux', '_mag') in self.catalogs[catalog].keys():
-                        continue
-
-                    if ksigma in self.catalogs[catalog].keys():
-                        mag, dmag = self.from_butler['getmag'](numpy.array(self.catalogs[catalog][kflux],
-                                                                        dtype='float'),
-                                                               numpy.array(self.catalogs[catalog][ksigma],
-                                                                        dtype='float'))
-
-                        print("-> new param : magnitudes : ",catalog," add param ",kflux.replace('_instFlux', '_mag'))
-                        print("-> new param : magnitudes : ",catalog," add param ",ksigma.replace('_instFlux', '_mag'))
-
-                        columns.append(Column(name=kflux.replace('_instFlux', '_mag'),
-                                          data=mag, description='Magnitude', unit='mag'))
-                   
-                        columns.append(Column(name=ksigma.replace('_instFluxErr', '_magErr'),
-                                          data=dmag, description='Magnitude error', unit='mag'))
+                columns.extend(self._get_magnitudes(catalog))
             if 'x_Src' in self.catalogs[catalog].keys():
                 return
-            ra = Quantity(self.catalogs[catalog]["coord_ra"].tolist(), 'rad')
-            dec = Quantity(self.catalogs[catalog]["coord_dec"].tolist(), 'rad')
+            ra = numpy.asarray(self.catalogs[catalog]["coord_ra"], dtype='float64')
+            dec = numpy.asarray(self.catalogs[catalog]["coord_dec"], dtype='float64')
             # Get the x / y position in pixel
             if self.from_butler['wcs'] is not None:
                 print("    -> getting pixel coordinates")
-                xsrc, ysrc = SkyCoord(ra, dec).to_pixel(
-                    self.from_butler['wcs'])
+                xsrc, ysrc = cutils.radec_to_pixel(ra, dec, self.from_butler['wcs'])
 
                 print("-> new param : pixel coord : ",catalog," add param x_Src uSrc")
 
@@ -576,9 +552,9 @@ class DRPCatalogs(DRPLoader):
             # Get coordinates in degree
             print("    -> getting degree coordinates")
             print("-> new param : deg coord : ",catalog," add coord_ra_deg coord_dec_deg")
-            columns.append(Column(name='coord_ra_deg', data=Angle(ra).degree,
+            columns.append(Column(name='coord_ra_deg', data=numpy.degrees(ra),
                                   description='RA coordinate', unit='degree'))
-            columns.append(Column(name='coord_dec_deg', data=Angle(dec).degree,
+            columns.append(Column(name='coord_dec_deg', data=numpy.degrees(dec),
                                   description='DEC coordinate', unit='degree'))
 
             # Adding all new columns
@@ -587,6 +563,33 @@ class DRPCatalogs(DRPLoader):
             # Clean memory before going further
             # gc.collect()
 
+    def _get_magnitudes(self, catalog):
+        """Compute the magnitudes and errors of all the fluxes of a table in one pass.
+
+        All the flux (and flux error) columns are concatenated and given at once to the
+        magnitude function of the butler, then split back into one column per flux.
+        """
+        table = self.catalogs[catalog]
+        kfluxes = [k for k in table.columns if k.endswith('_instFlux') and
+                   k + 'Err' in table.keys() and
+                   k.replace('_instFlux', '_mag') not in table.keys()]
+        if not len(kfluxes):
+            return []
+        print("    -> getting magnitudes for %i fluxes" % len(kfluxes))
+        fluxes = numpy.concatenate([numpy.asarray(table[k], dtype='float') for k in kfluxes])
+        sigmas = numpy.concatenate([numpy.asarray(table[k + 'Err'], dtype='float')
+                                    for k in kfluxes])
+        mags, dmags = self.from_butler['getmag'](fluxes, sigmas)
+        mags = numpy.asarray(mags).reshape(len(kfluxes), len(table))
+        dmags = numpy.asarray(dmags).reshape(len(kfluxes), len(table))
+        columns = []
+        for kflux, mag, dmag in zip(kfluxes, mags, dmags):
+            columns.append(Column(name=kflux.replace('_instFlux', '_mag'),
+                                  data=mag, description='Magnitude', unit='mag'))
+            columns.append(Column(name=kflux.replace('_instFlux', '_magErr'),
+                                  data=dmag, description='Magnitude error', unit='mag'))
+        return columns
+
     def _load_calexp(self, calcat='deepCoadd_calexp', **kwargs):
         """Load the deepCoadd_calexp info in order to get the WCS and the magnitudes."""
 
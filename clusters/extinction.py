@@ -1,7 +1,14 @@
 """Converting tools for extinction."""
 
+from __future__ import print_function
+import os
+import hashlib
 import pylab as P
 import numpy as N
+try:
+    import healpy
+except ImportError:
+    print("WARNING: optional module healpy cannot be imported.")
 
 
 def from_ebv_sfd_to_sdss_albd(ebv):
@@ -27,6 +34,122 @@ def from_ebv_sfd_to_megacam_albd(ebv):
     return from_sdss_albd_to_megacam_albd(from_ebv_sfd_to_sdss_albd(ebv))
 
 
+def unique_positions(ra, dec):
+    """Return the unique (ra, dec) positions and the indices to broadcast them back.
+
+    :param list ra: right ascensions
+    :param list dec: declinations
+    :return: unique ra, unique dec, and the inverse indices such that
+     ``ura[inverse] == ra`` and ``udec[inverse] == dec``
+    """
+    coords = N.column_stack([N.asarray(ra, dtype='float64'), N.asarray(dec, dtype='float64')])
+    ucoords, inverse = N.unique(coords, axis=0, return_inverse=True)
+    return ucoords[:, 0], ucoords[:, 1], N.asarray(inverse).ravel()
+
+
+class EBVCache(object):
+
+    """On-disk cache of the dust map values, per (dustmap file, HEALPix pixel)."""
+
+    def __init__(self, cachedir=None):
+        """Cache of the dust map pixel values already read.
+
+        :param str cachedir: Directory where the cache files are stored. Default is
+         $HOME/.extinction/cache/, next to the default maps directory of `extinctions`.
+        """
+        if cachedir is None:
+            cachedir = os.path.join(os.getenv('HOME'), '.extinction', 'cache')
+        self.cachedir = cachedir
+
+    def _path(self, dustmap, mapfile):
+        """Cache file of a dust map, keyed by the path, size and modification time of the
+        map file, so that a changed or moved map is not served from a stale cache."""
+        mapfile = os.path.abspath(mapfile)
+        stat = os.stat(mapfile)
+        key = hashlib.sha1(('%s:%i:%r' % (mapfile, stat.st_size, stat.st_mtime)).encode())
+        return os.path.join(self.cachedir, 'ebv_%s_%s.npz' % (dustmap, key.hexdigest()[:16]))
+
+    def load(self, dustmap, mapfile):
+        """Return the cached (nside, pixels, values) of a dust map file, or None."""
+        path = self._path(dustmap, mapfile)
+        if not os.path.exists(path):
+            return None
+        cache = N.load(path)
+        return int(cache['nside']), cache['pixels'], cache['values']
+
+    def save(self, dustmap, mapfile, nside, pixels, values):
+        """Merge new pixel values into the cache file of a dust map file (atomic write)."""
+        cached = self.load(dustmap, mapfile)
+        if cached is not None and cached[0] == nside:
+            pixels = N.concatenate([cached[1], pixels])
+            values = N.concatenate([cached[2], values])
+        pixels, idx = N.unique(pixels, return_index=True)
+        values = values[idx]
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        path = self._path(dustmap, mapfile)
+        tmp = path + '.%i.tmp.npz' % os.getpid()
+        N.savez(tmp, nside=nside, pixels=pixels, values=values)
+        os.rename(tmp, path)
+
+
+def dustmap_file(red, dustmap):
+    """Path of the local file of a dust map of a `reddening.Reddening` object."""
+    return os.path.join(red.map_dir, os.path.basename(red.maps[dustmap]['url']))
+
+
+def _load_dustmap(red, dustmap):
+    """Load a local dust map of a `reddening.Reddening` object and return it."""
+    if dustmap not in red.loaded_maps or 'map' not in red.loaded_maps[dustmap]:
+        red._load_maps(dustmap)
+    if dustmap not in red.loaded_maps:
+        raise IOError("Dust map %s is not available locally" % dustmap)
+    return red.loaded_maps[dustmap]['map']
+
+
+def query_local_map(red, dustmap='sfd', cache=None):
+    """Get the E(B-V) values of a local dust map for the positions of a Reddening object.
+
+    Same result as ``red.query_local_map(dustmap)`` (bilinear HEALPix interpolation),
+    but the map pixels entering the interpolation are looked up in an on-disk cache
+    first. The map itself is only read for the pixels missing from the cache. The cache
+    is specific to the map file (path, size and modification time).
+
+    :param red: a `extinctions.reddening.Reddening` object
+    :param str dustmap: sfd, planck, schlafly or green
+    :param cache: an `EBVCache` object. No cache is used if None.
+    :return: E(B-V) for all positions
+    """
+    if cache is None:
+        return red.query_local_map(dustmap=dustmap)
+    nest = dustmap in ['green']  # as in Reddening.query_local_map
+    mapfile = dustmap_file(red, dustmap)
+    if not os.path.exists(mapfile):
+        raise IOError("Dust map %s is not available locally (%s)" % (dustmap, mapfile))
+    cached = cache.load(dustmap, mapfile)
+    if cached is None:
+        nside = healpy.npix2nside(len(_load_dustmap(red, dustmap)))
+        pixels, values = N.array([], dtype='int64'), N.array([], dtype='float64')
+    else:
+        nside, pixels, values = cached
+    pix, weights = healpy.get_interp_weights(nside, red.theta, red.phi, nest=nest)
+    needed = N.unique(pix)
+    known = N.isin(needed, pixels, assume_unique=True)
+    if not known.all():
+        missing = needed[~known]
+        print("INFO: Reading %i new pixels from the %s map (%i already cached)" %
+              (len(missing), dustmap, known.sum()))
+        newvalues = N.asarray(_load_dustmap(red, dustmap)[missing], dtype='float64')
+        cache.save(dustmap, mapfile, nside, missing, newvalues)
+        pixels = N.concatenate([pixels, missing])
+        values = N.concatenate([values, newvalues])
+        order = N.argsort(pixels)
+        pixels, values = pixels[order], values[order]
+    else:
+        print("INFO: All %i pixels of the %s map found in cache" % (len(needed), dustmap))
+    return N.sum(values[N.searchsorted(pixels, pix)] * weights, axis=0)
+
+
 def plots(ra, dec, ebv, albd, title=None, figname=""):
     """Plot the extinction sky-map."""
     fig = P.figure()
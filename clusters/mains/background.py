@@ -35,6 +35,8 @@ def getbackground(argv=None):
                         action='store_true', help="Make some plots")
     parser.add_argument("--overwrite", default=False, action='store_true',
                         help="Overwrite the paths in the output file if they exist already")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of zphot configurations flagged at the same time")
     parser.add_argument("--rs", default=False, action='store_true',
                         help="Also slect galaxy based on red sequence")
 
@@ -61,8 +63,9 @@ def getbackground(argv=None):
     if not 'zphot' in config:
         config['zphot'] = {'zphot_ref': {}}
 
-    # Loop over all zphot configurations found in config.yaml file
-    for k in config['zphot'].keys():
+    # Flag the galaxies for all zphot configurations found in config.yaml file,
+    # at most args.workers at the same time (plots are only made serially)
+    def flag_config(k):
         z_config = config['zphot'][k]
         z_flag1, z_flag2 = cbackground.get_zphot_background(config, zdata[k],
                                                             zmin=args.zmin,
@@ -78,6 +81,9 @@ def getbackground(argv=None):
         cutils.overwrite_or_append(
             args.output, 'flag_' + k, new_tab, overwrite=args.overwrite)
 
+    cutils.run_configs(flag_config, config['zphot'].keys(),
+                       workers=1 if args.plot else args.workers)
+
     if args.rs:
         rs_flag = cbackground.get_rs_background(
             config, data['deepCoadd_forced_src'])
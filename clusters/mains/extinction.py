@@ -30,6 +30,10 @@ def extinction(argv=None):
                         " following list: sfd, planck, schlafly, green. Comma separated for"
                         " multplie maps. Overwrites the 'dustmap' key of the config file if any"
                         "Default map will be SFD")
+    parser.add_argument("--cachedir", help="Directory of the local E(B-V) cache (per dust map"
+                        " and HEALPix pixel). Default is $HOME/.extinction/cache/")
+    parser.add_argument("--nocache", action='store_true', default=False,
+                        help="Do not use (nor update) the local E(B-V) cache")
     args = parser.parse_args(argv)
 
     config = cutils.load_config(args.config)
@@ -44,10 +48,14 @@ def extinction(argv=None):
     print("INFO: Loading data from ", args.input)
     data = cutils.read_hdf5(args.input, path='deepCoadd_meas', dic=False)
 
-    # Query for E(b-v) and compute the extinction
+    # Query for E(b-v) and compute the extinction. The table has one row per filter:
+    # only query the unique positions and broadcast the results back to all rows
     print("INFO: Loading the coordinates")
-    red = reddening.Reddening(
-        data['coord_ra_deg'].tolist(), data['coord_dec_deg'].tolist())
+    ura, udec, inverse = cextinction.unique_positions(data['coord_ra_deg'],
+                                                      data['coord_dec_deg'])
+    print("INFO: %i unique positions for %i entries" % (len(ura), len(data)))
+    red = reddening.Reddening(ura.tolist(), udec.tolist())
+    cache = None if args.nocache else cextinction.EBVCache(args.cachedir)
     if args.dustmap is not None:
         dustmap = args.dustmap.split(',')
     elif "dustmap" in config:
@@ -58,7 +66,8 @@ def extinction(argv=None):
     ebmv = {}
     print("INFO: Getting the dust maps and the corresponding color excesses")
     for dustm in dustmap:
-        ebmv['ebv_%s' % dustm] = red.query_local_map(dustmap=dustm)
+        ebmv['ebv_%s' % dustm] = cextinction.query_local_map(red, dustmap=dustm,
+                                                             cache=cache)[inverse]
 
     print("INFO: Computing the extinction using the loaded dust maps for all filters")
     albds = {}
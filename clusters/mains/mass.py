@@ -27,9 +27,41 @@ def mass(argv=None):
                         help="Make some plots")
     parser.add_argument("--nsamples", default=10000, type=int,
                         help="Number of sample to run")
+    parser.add_argument("--mode", choices=['mcmc', 'map'], default='mcmc',
+                        help="'map' gives quick-look masses without a MCMC chain: the maximum of "
+                        "the posterior and its Laplace (gaussian) approximation, checked by "
+                        "importance sampling")
+    parser.add_argument("--reweight", metavar='CHAIN',
+                        help="Reweight the chain of a previous run (its .chain.pkl file) to the "
+                        "priors and shear calibration of this run, by importance sampling, "
+                        "instead of running the MCMC")
     parser.add_argument("--testing", action="store_true", default=False,
                         help="Simplify model for testing purposes")
+    parser.add_argument("--flat", action="store_true", default=False,
+                        help="Sample a flat log-posterior (plain functions of the parameter "
+                        "array) instead of the pymc model nodes")
+    parser.add_argument("--sampler", choices=['slice', 'nuts'], default='slice',
+                        help="MCMC updater. 'nuts' (No-U-Turn sampler) follows the analytic "
+                        "gradient of the log-posterior, and implies --flat")
+    parser.add_argument("--grid",
+                        help="Per-galaxy likelihood grid file (npz). Computed for all the "
+                        "galaxies the first time, then reused: changing the cuts (rmin, rmax, "
+                        "zcut, zmax) only costs a masked sum over the saved grid. Gives a mass "
+                        "scan instead of a MCMC chain.")
+    parser.add_argument("--resample", choices=['bootstrap', 'jackknife'],
+                        help="Bootstrap or jackknife mass uncertainties, from the per-galaxy "
+                        "likelihood grid (see --grid)")
+    parser.add_argument("--nresamples", default=500, type=int,
+                        help="Number of bootstrap resamples")
+    parser.add_argument("--npatches", type=int,
+                        help="Jackknife on this number of spatial patches, instead of leaving "
+                        "out one galaxy at a time")
     args = parser.parse_args(argv)
+    use_grid = (args.grid is not None or args.resample is not None) and not args.testing
+    use_map = args.mode == 'map' and not args.testing
+    use_reweight = args.reweight is not None and not args.testing
+    if use_map + use_grid + use_reweight > 1:
+        parser.error("--mode map, --reweight and --grid (or --resample) cannot be combined")
 
     config = cutils.load_config(args.config)
 
@@ -73,6 +105,7 @@ def mass(argv=None):
     masslow = 1.e13 if 'mmin'  not in mconfig else float(config['mass']['mmin'])
     masshigh = 1.e16 if 'mmax'  not in mconfig else float(config['mass']['mmax'])
     concentration = None if 'concentration'  not in mconfig else config['mass']['concentration']
+    concwidth = 0.116 if 'cwidth' not in mconfig else config['mass']['cwidth']
     delta = 200 if 'delta'  not in mconfig else config['mass']['delta']
     #    
 
@@ -95,7 +128,14 @@ def mass(argv=None):
                                                                   args=cmdargs)
 
     else:
-        masscontroller = dmstackdriver.controller
+        if use_map:
+            masscontroller = dmstackdriver.makeMAPController()
+        elif use_reweight:
+            masscontroller = dmstackdriver.makeReweightController()
+        elif use_grid:
+            masscontroller = dmstackdriver.makeGridController(resample=args.resample is not None)
+        else:
+            masscontroller = dmstackdriver.controller
 #        options, cmdargs = masscontroller.modelbuilder.createOptions()
         options, cmdargs = masscontroller.modelbuilder.createOptions(logprior=logprior,
                                                                      masslow=masslow,
@@ -104,13 +144,41 @@ def mass(argv=None):
                                                                      radhigh=radhigh,
                                                                      zcut=zcut,
                                                                      zbhigh=zbhigh,
-                                                                     concentration=concentration)
+                                                                     concentration=concentration,
+                                                                     concwidth=concwidth)
         
-        options, cmdargs = masscontroller.runmethod.createOptions(outputFile=args.output,
-                                                                  nsamples=args.nsamples,
-                                                                  burn=2000,
-                                                                  options=options,
-                                                                  args=cmdargs)
+        if use_map:
+            options, cmdargs = masscontroller.runmethod.createOptions(outputFile=args.output,
+                                                                      nsamples=args.nsamples,
+                                                                      options=options,
+                                                                      args=cmdargs)
+        elif use_reweight:
+            options, cmdargs = masscontroller.runmethod.createOptions(outputFile=args.output,
+                                                                      chainFile=args.reweight,
+                                                                      burn=2000,
+                                                                      options=options,
+                                                                      args=cmdargs)
+        elif not use_grid:
+            options, cmdargs = masscontroller.runmethod.createOptions(outputFile=args.output,
+                                                                      nsamples=args.nsamples,
+                                                                      burn=2000,
+                                                                      flat=args.flat,
+                                                                      sampler=args.sampler,
+                                                                      options=options,
+                                                                      args=cmdargs)
+        elif args.resample is None:
+            options, cmdargs = masscontroller.runmethod.createOptions(outputFile=args.output,
+                                                                      gridFile=args.grid,
+                                                                      options=options,
+                                                                      args=cmdargs)
+        else:
+            options, cmdargs = masscontroller.runmethod.createOptions(outputFile=args.output,
+                                                                      gridFile=args.grid,
+                                                                      resampling=args.resample,
+                                                                      nresamples=args.nresamples,
+                                                                      npatches=args.npatches,
+                                                                      options=options,
+                                                                      args=cmdargs)
 
     options, cmdargs = masscontroller.filehandler.createOptions(cluster=cluster,
                                                                 zcluster=zcluster,
@@ -124,7 +192,7 @@ def mass(argv=None):
                                                                 args=cmdargs)#,
 #                                                                logprior=logprior)
 
-    masscontroller.load(options, args)
+    masscontroller.load(options, args, modelcuts=not use_grid)
     masscontroller.run()
     masscontroller.dump()
     masscontroller.finalize()
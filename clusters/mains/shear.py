@@ -46,9 +46,5 @@ def shear(argv=None):
     # Load the data
     data = cutils.read_hdf5(args.input)
     meas = data['deepCoadd_meas']
-    # converts astropy Table to the right wcs format
-    wcs = cutils.load_wcs(data['wcs'])
-    xclust, yclust = cutils.skycoord_to_pixel(
-        [config['ra'], config['dec']], wcs)
-    cshear.analysis(meas, float(xclust), float(yclust),
+    cshear.analysis(meas, config['ra'], config['dec'],
                     config=config, datafile=args.input, step=args.step)
@@ -6,6 +6,7 @@ import numpy as N
 from astropy.table import Table
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
+from pzmassfitter import pdzfile_utils
 from .. import zphot as czphot
 from .. import utils as cutils
 
@@ -31,6 +32,24 @@ def photometric_redshift(argv=None):
     parser.add_argument("--zeropoints", type=str,
                         help="Input file with zero points for some or all filters"
                         ". A three columns file: # filt zp zp_err")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Split the catalog in this number of shards, and run the photoz "
+                        "code on them in parallel")
+    parser.add_argument("--retries", type=int, default=1,
+                        help="Number of times a failed shard is run again (with --jobs > 1)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of zphot configurations run at the same time")
+    parser.add_argument("--cachedir", help="Directory of the photoz results cache. "
+                        "Default is $HOME/.clusters/zphot_cache/")
+    parser.add_argument("--cachesize", type=float, default=2000.,
+                        help="Maximal size of the photoz results cache, in MB")
+    parser.add_argument("--pdz-format", dest="pdz_format", default='float32',
+                        choices=['float64', 'float32', 'uint16'],
+                        help="Storage type of the pdz (uint16 are scaled to each pdz maximum)")
+    parser.add_argument("--no-pdz-cdf", dest="pdz_cdf", action="store_false", default=True,
+                        help="Do not store the cumulative pdzs (uint16) along with the pdzs")
+    parser.add_argument("--nocache", action="store_true", default=False,
+                        help="Do not use (nor update) the photoz results cache")
     args = parser.parse_args(argv)
 
     config = cutils.load_config(args.config)
@@ -85,8 +104,12 @@ def photometric_redshift(argv=None):
 
     if not config['sim']['flag']:  # we're not dealing with simulation data
 
-        # Loop over all zphot configurations present in the config.yaml file
-        for zconfig in config['zphot'].keys():
+        cache = None if args.nocache else czphot.ZPHOTCache(args.cachedir,
+                                                            maxsize=args.cachesize)
+
+        # Run all zphot configurations present in the config.yaml file, at most
+        # args.workers at the same time (they share the input data, read-only)
+        def run_config(zconfig):
             zcode = config['zphot'][zconfig]['code'] \
                 if 'code' in config['zphot'][zconfig].keys() else 'lephare'
 
@@ -97,7 +120,10 @@ def photometric_redshift(argv=None):
                 if 'zpara' in config['zphot'][zconfig] else None
             spectro_file = config['zphot'][zconfig]['zspectro_file'] if 'zspectro_file' \
                            in config['zphot'][zconfig] else None
-            kwargs = {'basename': config['cluster'],
+            # parallel runs of the external codes must not share their files
+            basename = config['cluster'] if args.workers <= 1 \
+                else "%s_%s" % (config['cluster'], zconfig)
+            kwargs = {'basename': basename,
                       'filters': [f for f in config['filter'] if f in
                                   [filt.decode() for filt in set(data['filter'].tolist())]],
                       'ra': data['coord_ra_deg'][data['filter'] == config['filter'][0]],
@@ -108,24 +134,21 @@ def photometric_redshift(argv=None):
             print("INFO: Running", zcode,
                   "using configuration from", zpara, spectro_file)
 
-            if zcode == 'bpz':  # Run BPZ
-                zphot = czphot.BPZ([data[args.mag][data['filter'] == f] for f in kwargs['filters']],
-                                   [data[args.mag.replace("_extcorr", "") +
-                                         "Err"][data['filter'] == f]
-                                    for f in kwargs['filters']],
-                                   zpara=zpara, spectro_file=spectro_file, **kwargs)
-
-            if zcode == 'lephare':  # Run LEPHARE
-                zphot = czphot.LEPHARE([data[args.mag][data['filter'] == f]
-                                        for f in kwargs['filters']],
-                                       [data[args.mag.replace("_extcorr", "") +
-                                             "Err"][data['filter'] == f]
-                                        for f in kwargs['filters']],
-                                       zpara=zpara, spectro_file=spectro_file, **kwargs)
-                zphot.check_config()
-
-        zphot.run()
-        zphot.data_out.save_zphot(args.output, path, overwrite=args.overwrite)
+            zcode_class = {'bpz': czphot.BPZ,
+                           'templatefit': czphot.TEMPLATEFIT}.get(zcode, czphot.LEPHARE)
+            zphot = czphot.run_cached(zcode_class,
+                                      [data[args.mag][data['filter'] == f]
+                                       for f in kwargs['filters']],
+                                      [data[args.mag.replace("_extcorr", "") +
+                                            "Err"][data['filter'] == f]
+                                       for f in kwargs['filters']],
+                                      cache, zpara=zpara, spectro_file=spectro_file,
+                                      jobs=args.jobs, retries=args.retries,
+                                      check_config=zcode == 'lephare', **kwargs)
+            zphot.save_zphot(args.output, path, overwrite=args.overwrite,
+                             pdz_format=args.pdz_format, cdf=args.pdz_cdf)
+
+        cutils.run_configs(run_config, config['zphot'].keys(), workers=args.workers)
 
     else:
         # we are dealing with simulated data --> make fake p(z) from real z.
@@ -142,15 +165,14 @@ def photometric_redshift(argv=None):
         zrange = N.arange(min_pdz, max_pdz, pdz_step)
         id_sim = data_z_sim[0]
         z_sim = data_z_sim[1]
-        zbinsgrid = N.vstack(len(id_sim) * [zrange])
-        pdz = [N.zeros(len(zrange))]
-        for i, z in enumerate(z_sim):
-            pdz_tmp = N.zeros(len(zrange))
-            # normalised so that int_zmin^zmax pdz = 1
-            pdz_tmp[N.digitize(z, zrange)] = 1 / pdz_step
-            pdz = pdz_tmp if i == 0 else N.vstack((pdz, pdz_tmp))
-
-        pdz_values = Table([id_sim, z_sim, pdz, zbinsgrid],
-                           names=('objectId', 'Z_BEST', 'pdz', 'zbins'))
+        # one-hot pdzs, stored as a bin index and value per object,
+        # normalised so that int_zmin^zmax pdz = 1
+        pdz = pdzfile_utils.DeltaPDZ.from_redshifts(z_sim, zrange)
+        columns, meta = pdzfile_utils.pdz_columns(pdz, zrange)
+
+        pdz_values = Table([id_sim, z_sim], names=('objectId', 'Z_BEST'))
+        for name in sorted(columns):
+            pdz_values[name] = columns[name]
+        pdz_values.meta.update(meta)
         cutils.overwrite_or_append(
             args.output, path, pdz_values, overwrite=True)
@@ -20,19 +20,18 @@ from . import shear
 def build_table(config='MACSJ2243.3-0935.yaml', datafile='MACSJ2243.3-0935_filtered_data.hdf5'):
     """Load data and write an ascii file containing enough info to run Yves mass estimator."""
     table = data.read_hdf5(datafile, path='deepCoadd_meas', dic=False)
-    xclust, yclust = shear.xy_clust(data.load_config(config),
-                                    data.load_wcs(data.read_hdf5(datafile, path='wcs', dic=False)))
+    config = data.load_config(config)
     e1i = table["ext_shapeHSM_HsmShapeRegauss_e1"][table['filter'] == 'i']
     e2i = table["ext_shapeHSM_HsmShapeRegauss_e2"][table['filter'] == 'i']
     sigmai = table["ext_shapeHSM_HsmShapeRegauss_sigma"][table['filter'] == 'i']
-    distx = table["x_Src"][table['filter'] == 'r'] - xclust
-    disty = table["y_Src"][table['filter'] == 'r'] - yclust
+    ra = table["coord_ra_deg"][table['filter'] == 'r']
+    dec = table["coord_dec_deg"][table['filter'] == 'r']
     objectid = table['id'][table['filter'] == 'i']
 
     # Apply cuts
-    e1i, e2i, distx, disty, objectid, sigmai = [x[quality_cuts(table)] for x in [e1i, e2i, distx,
-                                                                                 disty, objectid,
-                                                                                 sigmai]]
+    e1i, e2i, ra, dec, objectid, sigmai = [x[quality_cuts(table)] for x in [e1i, e2i, ra, dec,
+                                                                           objectid, sigmai]]
+    tshear, cshear, _ = shear.compute_shear_sky(e1i, e2i, ra, dec, config['ra'], config['dec'])
 
     params = data.read_hdf5("MACSJ2243.3-0935_filtered_data_zphot.hdf5",
                             path='bpz', dic=False)['coord_ra_deg', 'coord_dec_deg', 'Z_B',
@@ -40,9 +39,8 @@ def build_table(config='MACSJ2243.3-0935.yaml', datafile='MACSJ2243.3-0935_filte
 
     params = params[[i for i, oid in enumerate(
         params['objectId']) if oid in objectid]]
-    params.add_columns([Column(data=shear.compute_shear(e1i, e2i, distx, disty)[0], name='Tshear'),
-                        Column(data=shear.compute_shear(
-                            e1i, e2i, distx, disty)[1], name='Cshear'),
+    params.add_columns([Column(data=tshear, name='Tshear'),
+                        Column(data=cshear, name='Cshear'),
                         Column(data=e1i, name='Ell-1-ir'),
                         Column(data=e2i, name='Ell-2-i'),
                         Column(data=sigmai, name='Sigma-ell')])
@@ -85,6 +83,9 @@ def from_mass_to_mass(chain, config, radius=None, delta=None, init_delta=200):
     """
     Mass convertion from the pipeline output (M200) to an other unit (M500 or M in a given radius).
 
+    All the samples of the chain are converted at once (see the vectorized nfwutils
+    conversions).
+
     :param file/dict chain: Chain file or dictionnary, output of the pzmassfitter code
     :param file/dict config: Configuration file or dictionnary
     :param float radius: Radius in which you want the mass (Mpc)
@@ -96,16 +97,15 @@ def from_mass_to_mass(chain, config, radius=None, delta=None, init_delta=200):
         chain = pickle.load(open(chain))
     if isinstance(config, str):
         config = yaml.load(open(config))
-    # scale radius in mpc
-    scale_radius = [nfwutils.rscaleConstM(mdelta, cdelta, config['redshift'], init_delta)
-                    for mdelta, cdelta in zip(chain['mdelta'], chain['cdelta'])]
+    mdelta = np.asarray(chain['mdelta'], dtype=np.float64)
+    cdelta = np.asarray(chain['cdelta'], dtype=np.float64)
+    # scale radius in mpc, for all the samples at once
+    scale_radius = nfwutils.rscaleConstM(mdelta, cdelta, config['redshift'], init_delta)
     # mass in a radius of XXX Mpc
     if radius is not None:
-        masses = [nfwutils.massInsideR(sr, cdelta, config['redshift'], radius)
-                  for sr, cdelta in zip(scale_radius, chain['cdelta'])]
+        masses = nfwutils.massInsideR(scale_radius, cdelta, config['redshift'], radius)
     elif delta is not None:
-        masses = [nfwutils.Mdelta(sr, cdelta, config['redshift'], delta)
-                  for sr, cdelta in zip(scale_radius, chain['cdelta'])]
+        masses = nfwutils.Mdelta(scale_radius, cdelta, config['redshift'], delta)
     else:
         print("WARNING: you should give a radius (in Mpc) or a delta (200, 500, etc)")
-    return np.array(masses)
+    return np.asarray(masses)
@@ -8,6 +8,7 @@ import seaborn
 from astropy.table import Table, Column
 from . import utils as cutils
 from . import kappa as ckappa
+from pzmassfitter import spheregeometry
 
 
 def compute_shear(e1, e2, distx, disty):
@@ -19,9 +20,27 @@ def compute_shear(e1, e2, distx, disty):
     return gamt, gamc, dist
 
 
-def analysis(table, xclust, yclust, e1='ext_shapeHSM_HsmShapeRegauss_e1',
+def compute_shear_sky(e1, e2, ra, dec, ra_clust, dec_clust):
+    """Compute the shear from sky coordinates (spherical geometry).
+
+    :param e1: first ellipticity component
+    :param e2: second ellipticity component
+    :param ra: right ascensions of the sources, in degrees
+    :param dec: declinations of the sources, in degrees
+    :param ra_clust: right ascension of the cluster center, in degrees. An array of
+     centers can be given, in which case the outputs are of shape (ncenter, nsource).
+    :param dec_clust: declination of the cluster center, in degrees
+    :return: tangential shear, cross shear, and distance to the center in arcmin
+    """
+    dist, cos2phi, sin2phi = spheregeometry.shear_kernel(ra, dec, ra_clust, dec_clust)
+    gamt, gamc = spheregeometry.tangential_shear(numpy.asarray(e1), numpy.asarray(e2),
+                                                 cos2phi, sin2phi)
+    return gamt, gamc, numpy.degrees(dist) * 60.
+
+
+def analysis(table, ra_clust, dec_clust, e1='ext_shapeHSM_HsmShapeRegauss_e1',
              e2='ext_shapeHSM_HsmShapeRegauss_e2', config=None, datafile=None, step=200):
-    """Computethe shear.
+    """Computethe shear around the cluster center (ra_clust, dec_clust), in degrees.
 
     :param string data_file: Name of the hdf5 file to load
     :param string path: Path (key) of the table to load
@@ -35,9 +54,9 @@ def analysis(table, xclust, yclust, e1='ext_shapeHSM_HsmShapeRegauss_e1',
     e2r = table[e2][table['filter'] == 'r']
     e1i = table[e1][(table['filter']=='i') | (table['filter']=='i2')] #changed to work with "i2" or "i"
     e2i = table[e2][(table['filter']=='i') | (table['filter']=='i2')]
-    distx = table["x_Src"][table['filter'] == 'r'] - xclust
-    disty = table["y_Src"][table['filter'] == 'r'] - yclust
-    
+    ra = table["coord_ra_deg"][table['filter'] == 'r']
+    dec = table["coord_dec_deg"][table['filter'] == 'r']
+
     # Quality cuts
     # magnitude cut
     filt = table['modelfit_CModel_mag'][table['filter'] == 'r'] < 23.5
@@ -49,10 +68,10 @@ def analysis(table, xclust, yclust, e1='ext_shapeHSM_HsmShapeRegauss_e1',
     filt &= (abs(e1r - e1i) < 0.5) & (abs(e2r - e2i) < 0.5)
 
     # Apply cuts
-    e1i, e2i, distx, disty = [x[filt] for x in [e1i, e2i, distx, disty]]
+    e1i, e2i, ra, dec = [x[filt] for x in [e1i, e2i, ra, dec]]
 
     # Comput the shear
-    gamt, gamc, dist = compute_shear(e1i, e2i, distx, disty)
+    gamt, gamc, dist = compute_shear_sky(e1i, e2i, ra, dec, ra_clust, dec_clust)
 
     # Make some plots
     plot_shear(gamt, gamc, dist)
@@ -73,7 +92,7 @@ def xy_clust(config, wcs):
     return cutils.skycoord_to_pixel([config['ra'], config['dec']], wcs)
 
 
-def compare_shear(catalogs, xclust, yclust, qcut=None, param='Tshear'):
+def compare_shear(catalogs, ra_clust, dec_clust, qcut=None, param='Tshear'):
     """Compare shear mesured on the coadd and shear measured on indivial ccd.
 
     For now, do:
@@ -81,8 +100,8 @@ def compare_shear(catalogs, xclust, yclust, qcut=None, param='Tshear'):
     from clusters import shear
     config = data.load_config('MACSJ2243.3-0935.yaml')
     catalogs = data.read_hdf5('test_data2.hdf5')
-    xc, yc = shear.xy_clust(config, data.load_wcs(catalogs['wcs']))
-    tables = shear.compare_shear([catalogs['deepCoadd_meas'], catalogs['forced_src']], xc, yc)
+    tables = shear.compare_shear([catalogs['deepCoadd_meas'], catalogs['forced_src']],
+                                 config['ra'], config['dec'])
     """
     # Compute shear and distance for all srouces in both catalogs
     # And add that info into the tables
@@ -99,8 +118,8 @@ def compare_shear(catalogs, xclust, yclust, qcut=None, param='Tshear'):
         e2i = cat["ext_shapeHSM_HsmShapeRegauss_e2"][filti]
         e1r = cat["ext_shapeHSM_HsmShapeRegauss_e1"][filtr]
         e2r = cat["ext_shapeHSM_HsmShapeRegauss_e2"][filtr]
-        distx = cat["x_Src"][filti] - xclust
-        disty = cat["y_Src"][filti] - yclust
+        ra = cat["coord_ra_deg"][filti]
+        dec = cat["coord_dec_deg"][filti]
 
         # Quality cuts
         # resolution cut
@@ -138,17 +157,16 @@ def compare_shear(catalogs, xclust, yclust, qcut=None, param='Tshear'):
             filt &= (abs(e1r - e1i) < 0.5) & (abs(e2r - e2i) < 0.5)
 
         # Apply cuts
-        e1i, e2i, distx, disty, objectids = [x[filt]
-                                             for x in [e1i, e2i, distx, disty, objectids]]
+        e1i, e2i, ra, dec, objectids = [x[filt] for x in [e1i, e2i, ra, dec, objectids]]
         filters.append(filt)
 
-        tshear, cshear, dist = compute_shear(e1i, e2i, distx, disty)
+        tshear, cshear, dist = compute_shear_sky(e1i, e2i, ra, dec, ra_clust, dec_clust)
 
         tables.append(Table([Column(name='Tshear', data=tshear, description='Tangential shear'),
                              Column(name='Cshear', data=cshear,
                                     description='Cross shear'),
                              Column(name='Distance', data=dist,
-                                    description='Distance to center'),
+                                    description='Distance to center (arcmin)'),
                              Column(name='objectId', data=objectids,
                                     description='Object ID'),
                              Column(name='e1i', data=e1i,
@@ -226,8 +244,8 @@ def compare_shear(catalogs, xclust, yclust, qcut=None, param='Tshear'):
     return tables
 
 
-def plot_shear(gamt, gamc, dist, drange=(0, 8500), nbins=8):
-    """Plot shear."""
+def plot_shear(gamt, gamc, dist, drange=(0, 26), nbins=8):
+    """Plot shear, as a function of the distance to the cluster center (arcmin)."""
     dval, step = numpy.linspace(drange[0], drange[1], nbins, retstep=True)
 
     plot_hist([gamt, gamc], ['Gamt', 'Gamc'])
@@ -245,10 +263,10 @@ def plot_shear(gamt, gamc, dist, drange=(0, 8500), nbins=8):
                for mask in masks]
 
     plot_scatter([dval, dval], [tshear, cshear],
-                 ['Distance to cluster center (px)',
-                  'Distance to cluster center (px)'],
+                 ['Distance to cluster center (arcmin)',
+                  'Distance to cluster center (arcmin)'],
                  ['Tangential shear', 'Cross shear'], yerrs=[tsheare, csheare],
-                 xarange=(-500, 9000), yarange=(-0.06, 0.08))
+                 xarange=(-1.5, 27.5), yarange=(-0.06, 0.08))
 
 
 def plot_hist(xs, labels, nbins=200, xarange=(-2, 2)):
@@ -3,6 +3,8 @@
 
 from __future__ import print_function
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import h5py
 from astropy.wcs import WCS, utils
@@ -11,6 +13,7 @@ from astropy.table import Table, Column, vstack
 from astropy.units import Quantity
 from progressbar import Bar, ProgressBar, Percentage, ETA
 import yaml
+from pzmassfitter import join
 
 
 def progressbar(maxnumber, prefix='loading'):
@@ -72,6 +75,68 @@ def pixel_to_skycoord(xsrc, ysrc, wcs):
     return utils.pixel_to_skycoord(xsrc, ysrc, wcs)
 
 
+def is_simple_tan(wcs):
+    """Check if a wcs is a plain ICRS TAN projection (no distortion, default pole).
+
+    :param wcs: an astropy.wcs.WCS object
+    :return: True if `radec_to_pixel` can use its vectorized projection for this wcs
+    """
+    ctype = list(wcs.wcs.ctype)
+    radesys = wcs.wcs.radesys.strip()
+    return (ctype == ['RA---TAN', 'DEC--TAN'] and
+            wcs.sip is None and wcs.cpdis1 is None and wcs.cpdis2 is None and
+            wcs.det2im1 is None and wcs.det2im2 is None and
+            wcs.wcs.lonpole == 180. and
+            (radesys == 'ICRS' or (radesys == '' and np.isnan(wcs.wcs.equinox))))
+
+
+def _tan_project(ra, dec, crval, cdinv, crpix):
+    """Gnomonic projection of (ra, dec) in radians into 0-based pixel coordinates."""
+    ra0, dec0 = np.radians(crval)
+    cosdec, sindec = np.cos(dec), np.sin(dec)
+    dra = ra - ra0
+    cosdra = np.cos(dra)
+    cosc = np.sin(dec0) * sindec + np.cos(dec0) * cosdec * cosdra
+    xi = np.degrees(cosdec * np.sin(dra) / cosc)
+    eta = np.degrees((np.cos(dec0) * sindec - np.sin(dec0) * cosdec * cosdra) / cosc)
+    xpix = cdinv[0, 0] * xi + cdinv[0, 1] * eta + crpix[0] - 1
+    ypix = cdinv[1, 0] * xi + cdinv[1, 1] * eta + crpix[1] - 1
+    return xpix, ypix
+
+
+def radec_to_pixel(ra, dec, wcs, nthreads=4, chunksize=1000000):
+    """Transform sky coordinates in radians to 0-based pixel coordinates given a wcs.
+
+    Same result as ``SkyCoord(ra, dec).to_pixel(wcs)``, without building python lists
+    or SkyCoord objects for plain TAN projections: the projection is then computed
+    directly on the arrays, by chunks processed in a pool of threads. Other
+    projections (or distortions) fall back on astropy.
+
+    :param ra: right ascensions, in radians (array like)
+    :param dec: declinations, in radians (array like)
+    :param wcs: an astropy.wcs.WCS object
+    :param int nthreads: Number of threads used for the vectorized projection
+    :param int chunksize: Number of sources per chunk
+    :return: x and y arrays, in pixel units
+    """
+    ra = np.asarray(ra, dtype='float64')
+    dec = np.asarray(dec, dtype='float64')
+    if not is_simple_tan(wcs):
+        return SkyCoord(Quantity(ra, 'rad'), Quantity(dec, 'rad')).to_pixel(wcs)
+    crval, crpix = wcs.wcs.crval, wcs.wcs.crpix
+    cdinv = np.linalg.inv(wcs.pixel_scale_matrix)
+    xpix, ypix = np.empty_like(ra), np.empty_like(dec)
+
+    def project(start):
+        stop = start + chunksize
+        xpix[start:stop], ypix[start:stop] = _tan_project(ra[start:stop], dec[start:stop],
+                                                          crval, cdinv, crpix)
+
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        list(executor.map(project, range(0, len(ra), chunksize)))
+    return xpix, ypix
+
+
 def read_hdf5(hdf5_file, path=None, dic=True):
     """Read astropy tables from an hdf5 file.
 
@@ -133,7 +198,9 @@ def hdf5_paths(hdf5_file):
     :return: The available list of paths in the input hdf5 file
     """
     hdf5_content = h5py.File(hdf5_file, 'r')
-    paths = list(hdf5_content.keys())
+    # skip the metadata written along with the tables (serialize_meta)
+    paths = [path for path in hdf5_content.keys()
+             if not path.endswith('.__table_column_meta__')]
     hdf5_content.close()
     return paths
 
@@ -183,8 +250,8 @@ def filter_table(cats):
     if "forced_src" not in cats.keys():
         return output
 
-    filt = np.where(np.in1d(cats['forced_src']['objectId'],
-                            output['deepCoadd_meas']['id']))[0]
+    filt = np.where(join.isin(cats['forced_src']['objectId'],
+                              output['deepCoadd_meas']['id']))[0]
     output['forced_src'] = cats['forced_src'][filt]
 
     return output
@@ -322,6 +389,16 @@ def plot_patches(catalog, clust_coords=None):
     pylab.show()
 
 
+_HDF5_LOCKS = {}
+_HDF5_LOCKS_LOCK = threading.Lock()
+
+
+def _hdf5_lock(filename):
+    """Return the lock serializing the writes to an hdf5 file within this process."""
+    with _HDF5_LOCKS_LOCK:
+        return _HDF5_LOCKS.setdefault(os.path.realpath(filename), threading.Lock())
+
+
 def overwrite_or_append(filename, path, table, overwrite=False):
     """
     Overwrites or append new path/table to existing file or creates new file
@@ -329,28 +406,58 @@ def overwrite_or_append(filename, path, table, overwrite=False):
     The overwrite keyword of data.write(file,path) does not overwrites
     only the data in path, but the whole file, i.e. (we lose all other
     paths in the process) --> need to do it by hand
+
+    The table is first written in a temporary file, then copied in the file under a
+    temporary name and renamed into `path` (replacing the former `path` and its
+    metadata, if any), the other paths being left untouched. Several threads can thus
+    write different paths of the same file at the same time.
+    """
+    tmp = "%s.%i.%i.%s.tmp" % (filename, os.getpid(), threading.get_ident(),
+                               path.replace('/', '_'))
+    table.write(tmp, path=path, format='hdf5', compression=True, serialize_meta=True)
+    try:
+        with _hdf5_lock(filename):
+            if not os.path.isfile(filename):
+                print("Creating", filename)
+                os.replace(tmp, filename)
+                return
+            with h5py.File(filename, 'a') as target, h5py.File(tmp, 'r') as source:
+                if path in target:
+                    if not overwrite:
+                        raise IOError(
+                            "Path already exists in hdf5 file. Use --overwrite to overwrite.")
+                    print("Overwriting path =", path, " in", filename)
+                else:
+                    print("Adding", path, " to", filename)
+                for name in source:
+                    target.copy(source[name], name + '.__tmp__')
+                for name in source:
+                    if name in target:
+                        del target[name]
+                    target.move(name + '.__tmp__', name)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def run_configs(function, zconfigs, workers=1):
+    """Call function(zconfig) for each configuration, with at most `workers` at once.
+
+    The configurations run in threads of the same process, and thus share the
+    (read-only) input catalogs. Exceptions are raised again in the calling thread.
+
+    :param function: Function to call on each configuration
+    :param list zconfigs: Configuration names (e.g. the keys of config['zphot'])
+    :param int workers: Number of configurations run at the same time
+    :return: The list of the results, in the order of `zconfigs`
     """
+    zconfigs = list(zconfigs)
+    if workers <= 1 or len(zconfigs) <= 1:
+        return [function(zconfig) for zconfig in zconfigs]
+    print("INFO: Running %i configurations, %i at a time" % (len(zconfigs), workers))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(function, zconfigs))
 
-    if not os.path.isfile(filename):
-        print("Creating", filename)
-        table.write(filename, path=path, compression=True, serialize_meta=True)
-    else:
-        data = read_hdf5(filename)
-        if path in data.keys():
-            if overwrite:
-                print("Overwriting path =", path, " in", filename)
-                data[path] = table  # update the table with new values
-                os.remove(filename)  # delete file
-                for p in data.keys():  # rewrite all paths/tables to file
-                    data[p].write(filename, path=p, compression=True, serialize_meta=True,
-                                  append=True)
-            else:
-                raise IOError(
-                    "Path already exists in hdf5 file. Use --overwrite to overwrite.")
-        else:
-            print("Adding", path, " to", filename)
-            table.write(filename, path=path, compression=True, serialize_meta=True,
-                        append=True)
 
 def shorten(doc):
     """Hack to go around an astropy/hdf5 bug. Cut in half words longer than 18 chars."""
@@ -1,4 +1,5 @@
-"""Photometric redshift analysis. Includes a wrapper to LEPHARE and BPZ.
+"""Photometric redshift analysis. Includes a wrapper to LEPHARE and BPZ, and an in-process
+template fitting code (TEMPLATEFIT).
 
 - LEPHARE: http://www.cfht.hawaii.edu/~arnouts/LEPHARE/lephare.html
 - BPZ: http://www.stsci.edu/~dcoe/BPZ
@@ -7,13 +8,22 @@
 from __future__ import print_function
 import os
 import sys
+import shutil
+import hashlib
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as N
 import pylab as P
 from scipy.optimize import curve_fit
 from astropy.io import ascii
 from astropy.table import Table, hstack
+from astropy import units as u
 from astropy.coordinates import SkyCoord
+from pzmassfitter import join
+from pzmassfitter import util
+from pzmassfitter import pdzfile_utils
+from pzmassfitter import spheregeometry
 from . import utils as cutils
 
 
@@ -49,17 +59,7 @@ class LEPHARE(object):
             "/config/zphot_megacam.para" if zpara is None else zpara
 
         self.spectro_file = spectro_file
-        # Name of created files?
-        prefix = ""
-        if 'basename' in kwargs:
-            prefix = kwargs['basename'] + "_"
-        elif 'cname' in kwargs:
-            prefix = kwargs['cname'] + "_"
-        self.files = {}
-        self.files['input'] = prefix + "zphot.in"
-        self.files['output'] = prefix + "zphot.out"
-        self.files['pdz_output'] = prefix + "zphot"
-        self.files['all_input'] = self.files['input'].replace('.in', '.all')
+        self.files = self.file_names(**kwargs)
 
         # Initialize lephare output variables
         self.lephare_out = None
@@ -67,6 +67,22 @@ class LEPHARE(object):
 
         self.write_input()
 
+    @staticmethod
+    def file_names(**kwargs):
+        """Return the names of the files created for a LEPHARE run."""
+        prefix = ""
+        if 'basename' in kwargs:
+            prefix = kwargs['basename'] + "_"
+        elif 'cname' in kwargs:
+            prefix = kwargs['cname'] + "_"
+        files = {}
+        files['input'] = prefix + "zphot.in"
+        files['output'] = prefix + "zphot.out"
+        files['pdz_output'] = prefix + "zphot"
+        files['all_input'] = files['input'].replace('.in', '.all')
+        files['zspec_match'] = prefix + "zphot_zspec_match.npz"
+        return files
+
     def write_input(self):
         """
         Create and write files needed to run LEPHARE.
@@ -82,9 +98,9 @@ class LEPHARE(object):
                 f.write("# id " + " ".join(["mag_%s" % filt for filt in self.kwargs['filters']]) +
                         " " + " ".join(["err_mag_%s" % filt for filt in self.kwargs['filters']]) +
                         "\n")
-                for i, mags in enumerate(N.concatenate([self.data['mag'], self.data['err']]).T):
-                    f.write("%i %s\n" %
-                            (i, " ".join(["%.3f" % m for m in mags])))
+                mags = list(self.data['mag']) + list(self.data['err'])
+                write_rows(f, "%i" + " %.3f" * len(mags) + "\n",
+                           [N.arange(len(mags[0]))] + mags)
 
                 f.close()
                 print("INFO: Input data saved in", self.files['input'])
@@ -94,14 +110,11 @@ class LEPHARE(object):
             # i.e with 'context' and 'spectroz' of matching galaxies
             zspec = ZSPEC(self.spectro_file, names=[
                           'object', 'ra', 'dec', 'zspec'])
-            zspec.skycoords = SkyCoord(
-                zspec.data['ra'], zspec.data['dec'], unit='deg')
-            skycoords_cat = SkyCoord(
-                self.kwargs['ra'], self.kwargs['dec'], unit='deg')
-            idx, d2d, d3d = skycoords_cat.match_to_catalog_sky(zspec.skycoords)
+            idx, d2d = zspec.match_catalog(self.kwargs['ra'], self.kwargs['dec'],
+                                           match_file=self.files['zspec_match'])
             zp = zspec.data['zspec'][idx]
             # identify galaxies with bad match, i.e. dist > 300 mas
-            bad = N.where(d2d.mas > 300)
+            bad = N.where(d2d > 300)
             zp[bad] = -99
             print("INFO: Using " + str(len(idx) - N.size(bad)) +
                   " galaxies for spectroz training")
@@ -111,9 +124,10 @@ class LEPHARE(object):
                         " context" + " zspec" + "\n")
                 # tells LePhare to run using the u, g, r, i and z bands.
                 context = 31
-                for i, mags in enumerate(N.concatenate([self.data['mag'], self.data['err']]).T):
-                    f.write("%i %s %s\n" % (i, " ".join(["%.3f" % m for m in mags]),
-                                            " ".join(("%i" % context, "%.3f" % zp[i]))))
+                mags = list(self.data['mag']) + list(self.data['err'])
+                write_rows(f, "%i" + " %.3f" * len(mags) + " %i %.3f\n",
+                           [N.arange(len(mags[0]))] + mags +
+                           [N.full(len(mags[0]), context), zp])
                 f.close()
         if 'ra' in self.kwargs:
             f = open(self.files['all_input'], 'w')
@@ -122,10 +136,10 @@ class LEPHARE(object):
                         " ".join(["mag_%s" % filt for filt in self.kwargs['filters']]) + " " +
                         " ".join(["err_mag_%s" % filt for filt in self.kwargs['filters']]) +
                         "\n")
-            for i, mags in enumerate(N.concatenate([self.data['mag'], self.data['err']]).T):
-                f.write("%i %i %f %f %s\n" % (i, self.kwargs['id'][i],
-                                              self.kwargs['ra'][i], self.kwargs['dec'][i],
-                                              " ".join(["%.3f" % m for m in mags])))
+            mags = list(self.data['mag']) + list(self.data['err'])
+            write_rows(f, "%i %i %f %f" + " %.3f" * len(mags) + "\n",
+                       [N.arange(len(mags[0])), self.kwargs['id'],
+                        self.kwargs['ra'], self.kwargs['dec']] + mags)
             f.close()
             print("INFO: All data saved in", self.files['all_input'])
 
@@ -178,12 +192,32 @@ class LEPHARE(object):
                   (path_to_filt + filt_ref, libs))
             sys.exit()
 
-    def run(self, config=None):
+    executable = "zphota"
+
+    def command(self):
+        """Return the LEPHARE command line."""
+        cmd = self.executable
+        cmd += " -c " + self.config
+        cmd += " -CAT_IN " + self.files['input']
+        cmd += " -CAT_OUT " + self.files['output']
+        cmd += " -PDZ_OUT " + self.files['pdz_output']
+        return cmd
+
+    def read_output(self):
+        """Read the LEPHARE output files."""
+        self.data_out = ZPHOTO(self.files['output'], self.files['pdz_output'], zcode_name='lephare',
+                               all_input=self.files['all_input'], **self.kwargs)
+
+    def run(self, config=None, jobs=1, retries=1):
         """
         Run LEPHARE.
 
         Default config file is $LEPHAREDIR/config/zphot_megacam.para.
         Can be overwritten with the config argument
+
+        :param int jobs: If > 1, split the catalog in `jobs` shards run in parallel
+         (see `run_sharded`)
+        :param int retries: Number of times a failed shard is run again
         """
         if config is not None:
             if os.path.exists(config):
@@ -191,12 +225,12 @@ class LEPHARE(object):
             else:
                 raise ValueError("%s does not exist" % config)
 
+        if jobs > 1:
+            run_sharded(self, jobs, retries=retries)
+            return
+
         # build command line
-        cmd = "zphota"
-        cmd += " -c " + self.config
-        cmd += " -CAT_IN " + self.files['input']
-        cmd += " -CAT_OUT " + self.files['output']
-        cmd += " -PDZ_OUT " + self.files['pdz_output']
+        cmd = self.command()
         print("INFO: Will run '%s'" % cmd)
 
         self.lephare_out = subprocess.check_output(
@@ -205,8 +239,7 @@ class LEPHARE(object):
         #print(
         #    "\n".join(["   " + zo for zo in self.lephare_out.split("\n")[-6:]])) #commented because it bugs with python3
 
-        self.data_out = ZPHOTO(self.files['output'], self.files['pdz_output'], zcode_name='lephare',
-                               all_input=self.files['all_input'], **self.kwargs)
+        self.read_output()
 
 
 class BPZ(object):
@@ -238,20 +271,7 @@ class BPZ(object):
         self.kwargs = kwargs
         self.config = zpara
         self.spectro_file = spectro_file
-
-        # Name of created files?
-        prefix = ""
-        if 'basename' in kwargs:
-            prefix = kwargs['basename'] + "_"
-        elif 'cname' in kwargs:
-            prefix = kwargs['cname'] + "_"
-        self.files = {}
-        self.files['input'] = prefix + "bpz.in"
-        self.files['flux_comparison'] = prefix + "bpz.flux_comparison"
-        self.files['output'] = prefix + "bpz.bpz"
-        self.files['pdz_output'] = prefix + "bpz.probs"
-        self.files['columns'] = prefix + "bpz.columns"
-        self.files['all_input'] = self.files['input'].replace('.in', '.all')
+        self.files = self.file_names(**kwargs)
 
         # Initialize BPZ output variables
         self.bpz_out = None
@@ -260,6 +280,23 @@ class BPZ(object):
         self.write_input()
         self.build_columns_file()
 
+    @staticmethod
+    def file_names(**kwargs):
+        """Return the names of the files created for a BPZ run."""
+        prefix = ""
+        if 'basename' in kwargs:
+            prefix = kwargs['basename'] + "_"
+        elif 'cname' in kwargs:
+            prefix = kwargs['cname'] + "_"
+        files = {}
+        files['input'] = prefix + "bpz.in"
+        files['flux_comparison'] = prefix + "bpz.flux_comparison"
+        files['output'] = prefix + "bpz.bpz"
+        files['pdz_output'] = prefix + "bpz.probs"
+        files['columns'] = prefix + "bpz.columns"
+        files['all_input'] = files['input'].replace('.in', '.all')
+        return files
+
     def write_input(self):
         """
         Create and write files needed to run BPZ.
@@ -272,8 +309,9 @@ class BPZ(object):
             f.write("# id " + " ".join(["mag_%s" % filt for filt in self.kwargs['filters']]) +
                     " " + " ".join(["err_mag_%s" % filt for filt in self.kwargs['filters']]) +
                     "\n")
-            for i, mags in enumerate(N.concatenate([self.data['mag'], self.data['err']]).T):
-                f.write("%i %s\n" % (i, " ".join(["%.3f" % m for m in mags])))
+            mags = list(self.data['mag']) + list(self.data['err'])
+            write_rows(f, "%i" + " %.3f" * len(mags) + "\n",
+                       [N.arange(len(mags[0]))] + mags)
 
             f.close()
             print("INFO: Input data saved in", self.files['input'])
@@ -284,10 +322,10 @@ class BPZ(object):
                         " ".join(["mag_%s" % filt for filt in self.kwargs['filters']]) + " " +
                         " ".join(["err_mag_%s" % filt for filt in self.kwargs['filters']]) +
                         "\n")
-            for i, mags in enumerate(N.concatenate([self.data['mag'], self.data['err']]).T):
-                f.write("%i %i %f %f %s\n" % (i, self.kwargs['id'][i],
-                                              self.kwargs['ra'][i], self.kwargs['dec'][i],
-                                              " ".join(["%.3f" % m for m in mags])))
+            mags = list(self.data['mag']) + list(self.data['err'])
+            write_rows(f, "%i %i %f %f" + " %.3f" * len(mags) + "\n",
+                       [N.arange(len(mags[0])), self.kwargs['id'],
+                        self.kwargs['ra'], self.kwargs['dec']] + mags)
             f.close()
             print("INFO: All data saved in", self.files['all_input'])
 
@@ -314,12 +352,38 @@ class BPZ(object):
         f.write("ID                    1\n")
         f.close()
 
-    def run(self):
+    executable = "bpz_run.py"
+
+    def command(self):
+        """Return the BPZ command line, with the options of the parameter file."""
+        # build command line options from param file
+        if self.config is not None:
+            opt_arr = N.genfromtxt(self.config, dtype=None)
+            option = ['-' + opt_arr[i, 0].decode() + ' ' + opt_arr[i, 1].decode()
+                      for i in N.arange(len(opt_arr))]
+            options = ' '.join(e for e in option)
+        else:
+            options = ''
+
+#        cmd = "python $BPZPATH/bpz.py %s " % self.files['input'] + options
+        return "%s %s " % (self.executable, self.files['input']) + options
+
+    def read_output(self):
+        """Read the BPZ output files."""
+        self.data_out = ZPHOTO(self.files['output'], self.files['pdz_output'],
+                               zcode_name='bpz', all_input=self.files['all_input'],
+                               **self.kwargs)
+
+    def run(self, jobs=1, retries=1):
         """
         Run BPZ.
 
         Configuration file must exist in the current directory.
 
+        :param int jobs: If > 1, split the catalog in `jobs` shards run in parallel
+         (see `run_sharded`)
+        :param int retries: Number of times a failed shard is run again
+
         .. todo:: Build the configuration file on the fly (the .columns)
         """
         if not os.getenv('BPZPATH'):
@@ -330,18 +394,12 @@ class BPZ(object):
         if not os.path.exists(self.files['columns']):
             raise IOError("%s does not exist" % self.files['columns'])
 
-        # build command line options from param file
-        if self.config is not None:
-            opt_arr = N.genfromtxt(self.config, dtype=None)
-            option = ['-' + opt_arr[i, 0].decode() + ' ' + opt_arr[i, 1].decode()
-                      for i in N.arange(len(opt_arr))]
-            options = ' '.join(e for e in option)
-        else:
-            options = ''
+        if jobs > 1:
+            run_sharded(self, jobs, retries=retries)
+            return
 
         # build command line
-#        cmd = "python $BPZPATH/bpz.py %s " % self.files['input'] + options
-        cmd = "bpz_run.py %s " % self.files['input'] + options
+        cmd = self.command()
         print("INFO: Will run '%s'" % cmd)
 
         self.bpz_out = subprocess.check_output(
@@ -349,9 +407,444 @@ class BPZ(object):
         print("INFO: BPZ output summary (full output in self.bpz_out)")
 #        print("\n".join(["   " + zo for zo in self.bpz_out.split("\n")[:20]]))
 
-        self.data_out = ZPHOTO(self.files['output'], self.files['pdz_output'],
-                               zcode_name='bpz', all_input=self.files['all_input'],
-                               **self.kwargs)
+        self.read_output()
+
+
+def load_template_grid(filename, filters=None):
+    """Load a grid of template fluxes from a numpy (npz) file.
+
+    The file must contain:
+
+    - 'zbins': the redshift grid, of length nz
+    - 'fluxes': the fluxes of the templates, of shape (ntemplates, nz, nfilters), in any
+      unit (the normalization of each template at each redshift is fitted)
+    - 'filters': the names of the filters, of length nfilters
+
+    and optionally 'prior', the prior on the redshift of shape (nz,), or on the redshift
+    and template of shape (ntemplates, nz).
+
+    :param str filename: Name of the npz file
+    :param list filters: If given, the filters to keep, in this order
+    :return: a dictionnary with 'zbins', 'fluxes', 'filters' and 'prior' (None if absent)
+    """
+    with N.load(filename) as content:
+        grid = {'zbins': N.asarray(content['zbins'], dtype='float64'),
+                'fluxes': N.asarray(content['fluxes'], dtype='float64'),
+                'filters': [str(f) for f in content['filters']],
+                'prior': N.asarray(content['prior'], dtype='float64')
+                         if 'prior' in content.files else None}
+    if grid['fluxes'].shape[1:] != (len(grid['zbins']), len(grid['filters'])):
+        raise ValueError("The template fluxes of %s must be of shape (ntemplates, %i, %i)" %
+                         (filename, len(grid['zbins']), len(grid['filters'])))
+    if filters is not None:
+        missing = [f for f in filters if f not in grid['filters']]
+        if missing:
+            raise ValueError("Filters %s are not in the template grid %s" % (missing, filename))
+        grid['fluxes'] = grid['fluxes'][..., [grid['filters'].index(f) for f in filters]]
+        grid['filters'] = list(filters)
+    return grid
+
+
+class TEMPLATEFIT(object):
+
+    """Template-fitting photometric redshifts, computed in memory.
+
+    The chi^2 of each galaxy is computed against a grid of template fluxes
+    (templates x redshifts x filters, see `load_template_grid`), the normalization of each
+    template being fitted analytically. This is done for blocks of galaxies at once, as
+    matrix products. The pdz is the sum over the templates of exp(-chi^2 / 2), times the
+    prior of the grid if any.
+    """
+
+    executable = None  # no external code
+    version = "1"  # to be changed if the results change for a given input
+
+    def __init__(self, magnitudes, errors, zpara=None, spectro_file=None, **kwargs):
+        """
+        Prepare the template fit.
+
+        :param list magnitudes: Magnitudes. A list of list (one per filter). Objects with
+         a non finite magnitude or error, or a null error, in a filter do not use it.
+        :param list errors: Error on magnitudes. Same shape as the magnitude list.
+        :param string zpara: Template grid file (see `load_template_grid`)
+        :param spectro_file: Not used
+
+        Kwargs include the following list of possible parameters
+
+        :param string filters: filter list, which must be in the template grid
+        :param list ra: list of ra
+        :param list dec: list of dec
+        :param list id: list of ID
+        :param int chunksize: Number of galaxies fitted at once (default is to keep the
+         arrays of a block below ~100 MB)
+        """
+        if zpara is None:
+            raise ValueError("TEMPLATEFIT needs a template grid file (zpara)")
+        self.data = {'mag': magnitudes, 'err': errors}
+        self.chunksize = kwargs.pop('chunksize', None)
+        self.kwargs = kwargs
+        self.config = zpara
+        self.spectro_file = spectro_file
+        self.files = self.file_names(**kwargs)
+        self.grid = load_template_grid(zpara, filters=kwargs.get('filters'))
+        self.data_out = None
+
+    @staticmethod
+    def file_names(**kwargs):
+        """No file is created for a TEMPLATEFIT run."""
+        return {}
+
+    def fluxes(self):
+        """Return the fluxes and their inverse variances, of shape (nobjects, nfilters)."""
+        mag = N.column_stack([N.asarray(m, dtype='float64') for m in self.data['mag']])
+        err = N.column_stack([N.asarray(e, dtype='float64') for e in self.data['err']])
+        good = N.isfinite(mag) & N.isfinite(err) & (err > 0) & (N.abs(mag) < 90)
+        flux = N.where(good, 10**(-0.4 * N.where(good, mag, 0.)), 0.)
+        flux_err = 0.4 * N.log(10.) * flux * N.where(good, err, 1.)
+        ivar = N.where(good, 1. / N.where(good, flux_err, 1.)**2, 0.)
+        return flux, ivar
+
+    def fit(self, flux, ivar):
+        """Fit a block of galaxies.
+
+        :return: the chi^2 (nobjects, ntemplates, nz) and the pdz (nobjects, nz)
+        """
+        model = self.grid['fluxes'].reshape(-1, self.grid['fluxes'].shape[-1])
+        # chi^2 = sum w f^2 - (sum w f F)^2 / sum w F^2, at the best normalization
+        cross = N.dot(ivar * flux, model.T)
+        norm = N.dot(ivar, (model**2).T)
+        with N.errstate(divide='ignore', invalid='ignore'):
+            chi2 = N.sum(ivar * flux**2, axis=1)[:, None] - N.where(norm > 0, cross**2 / norm, 0.)
+        chi2 = N.maximum(chi2, 0.).reshape((len(flux),) + self.grid['fluxes'].shape[:2])
+        like = N.exp(-0.5 * (chi2 - chi2.min(axis=(1, 2))[:, None, None]))
+        if self.grid['prior'] is not None:
+            like *= self.grid['prior']
+        return chi2, like.sum(axis=1)
+
+    def run(self, jobs=1, retries=1):
+        """
+        Run the template fit.
+
+        :param int jobs: Number of blocks of galaxies fitted in parallel (threads)
+        :param int retries: Not used
+        """
+        flux, ivar = self.fluxes()
+        ntemplates, nz = self.grid['fluxes'].shape[:2]
+        # ~4 float64 arrays of (chunksize, ntemplates, nz) per block
+        chunksize = self.chunksize or max(1, int(1e8 / (8 * 4 * ntemplates * nz)))
+        zbins = self.grid['zbins']
+        print("INFO: Fitting %i templates at %i redshifts to %i objects" %
+              (ntemplates, nz, len(flux)))
+
+        def fit_block(start):
+            chi2, pdz = self.fit(flux[start:start + chunksize], ivar[start:start + chunksize])
+            best = N.argmin(chi2.reshape(len(chi2), -1), axis=1)
+            return {'Z_BEST': zbins[best % nz], 'MOD_BEST': best // nz + 1,
+                    'CHI_BEST': chi2.reshape(len(chi2), -1)[N.arange(len(chi2)), best],
+                    'Z_ML': zbins[N.argmax(pdz, axis=1)]}, pdz
+
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:  # BLAS releases the GIL
+            blocks = list(executor.map(fit_block, range(0, len(flux), chunksize)))
+
+        data_dict = {'IDENT': N.arange(len(flux)),
+                     'NBAND_USED': N.sum(ivar > 0, axis=1)}
+        for key in ['Z_BEST', 'Z_ML', 'CHI_BEST', 'MOD_BEST']:
+            data_dict[key] = N.concatenate([block[0][key] for block in blocks])
+        pdz = N.concatenate([block[1] for block in blocks]) if blocks else N.zeros((0, nz))
+        self.data_out = ZPHOTO.from_arrays('templatefit', data_dict, zbins, pdz.T,
+                                           files=self.files, **self.kwargs)
+
+
+def _check_output(cmd, retries=1):
+    """Run a command, running it again up to `retries` times if it fails."""
+    for attempt in range(retries + 1):
+        try:
+            return subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
+        except subprocess.CalledProcessError as error:
+            print("WARNING: '%s' failed (attempt %i/%i)" % (cmd, attempt + 1, retries + 1))
+            if attempt == retries:
+                raise error
+
+
+def run_sharded(zcode, jobs, retries=1):
+    """Run a LEPHARE or BPZ object by splitting its catalog into shards.
+
+    Each shard gets its own input, output and pdz files (suffix '_shard<i>' added to the
+    base name), and the external codes run concurrently, at most `jobs` of them at the
+    same time. The outputs are merged back in the original order into `zcode.data_out`.
+
+    :param zcode: A LEPHARE or BPZ object
+    :param int jobs: Number of shards, and of external processes run in parallel
+    :param int retries: Number of times a failed shard is run again
+    """
+    nsources = len(zcode.data['mag'][0])
+    nshards = max(1, min(jobs, nsources // 2))  # at least 2 sources per shard
+    bounds = N.linspace(0, nsources, nshards + 1).astype(int)
+    basename = zcode.kwargs.get('basename', zcode.kwargs.get('cname', 'zphot'))
+    shards = []
+    for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        kwargs = dict(zcode.kwargs)
+        kwargs.pop('cname', None)
+        kwargs['basename'] = "%s_shard%i" % (basename, i)
+        for key in ['ra', 'dec', 'id']:
+            if key in kwargs:
+                kwargs[key] = kwargs[key][start:stop]
+        shards.append(zcode.__class__([mag[start:stop] for mag in zcode.data['mag']],
+                                      [err[start:stop] for err in zcode.data['err']],
+                                      zpara=zcode.config, spectro_file=zcode.spectro_file,
+                                      **kwargs))
+
+    print("INFO: Running %i shards, %i at a time" % (nshards, jobs))
+    # The external codes do the work: threads are enough to keep `jobs` of them running
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        outputs = [executor.submit(_check_output, shard.command(), retries) for shard in shards]
+        outputs = [output.result() for output in outputs]
+
+    for shard in shards:
+        shard.read_output()
+    zcode.data_out = ZPHOTO.merge([shard.data_out for shard in shards],
+                                  offsets=bounds[:-1], **zcode.kwargs)
+    zcode.data_out.files = {'output': zcode.files['output'],
+                            'pdz_output': zcode.files['pdz_output'],
+                            'input': zcode.files['all_input']}
+    if isinstance(zcode, LEPHARE):
+        zcode.lephare_out = outputs
+    else:
+        zcode.bpz_out = outputs
+
+
+def write_rows(fileobj, fmt, columns, chunksize=100000):
+    """Write columns of data as text lines, formatting blocks of lines at once.
+
+    :param fileobj: An open file
+    :param str fmt: Format of one line, e.g. "%i %.3f\\n"
+    :param list columns: One array per field of the format
+    :param int chunksize: Number of lines formatted at once
+    """
+    nrows = len(columns[0])
+    for start in range(0, nrows, chunksize):
+        stop = min(start + chunksize, nrows)
+        block = N.empty((stop - start, len(columns)), dtype=object)
+        for j, column in enumerate(columns):
+            block[:, j] = N.asarray(column[start:stop]).tolist()
+        fileobj.write((fmt * (stop - start)) % tuple(block.ravel().tolist()))
+
+
+def read_header(filename):
+    """Return the comment lines ('#') at the top of a text file."""
+    header = []
+    with open(filename) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            header.append(line)
+    return header
+
+
+CACHE_VERSION = "2"  # to be changed if the cached results change for a given input
+
+
+def object_hashes(magnitudes, errors):
+    """Return a 64 bits hash of the magnitudes and errors of each object.
+
+    :param list magnitudes: Magnitudes, a list of arrays (one per filter)
+    :param list errors: Errors on the magnitudes. Same shape as magnitudes.
+    :return: An int64 array, one hash per object
+    """
+    rows = N.ascontiguousarray(N.column_stack([N.asarray(m, dtype='float64') for m in
+                                               list(magnitudes) + list(errors)]))
+    return N.array([int.from_bytes(hashlib.blake2b(row.tobytes(), digest_size=8).digest(),
+                                   'little', signed=True) for row in rows], dtype='int64')
+
+
+class ZPHOTCache(object):
+
+    """Content-addressed cache of the photoz results, per object.
+
+    The results are stored in one file per photoz configuration, identified by a hash
+    of the code name and version, the filter list, and the content of the configuration
+    files. Inside a file, objects are identified by a hash of their magnitudes and errors.
+    Files are evicted, least recently used first, when the cache gets larger than
+    `maxsize` (in MB).
+    """
+
+    def __init__(self, cachedir=None, maxsize=2000.):
+        """Photoz cache.
+
+        :param str cachedir: Cache directory. Default is $HOME/.clusters/zphot_cache/
+        :param float maxsize: Maximal size of the cache, in MB
+        """
+        if cachedir is None:
+            cachedir = os.path.join(os.getenv('HOME'), '.clusters', 'zphot_cache')
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def code_version(zcode_class):
+        """Identify the version of the external code with its path, size and date."""
+        if zcode_class.executable is None:  # in-process code
+            return "%s:%s" % (zcode_class.__name__, zcode_class.version)
+        executable = zcode_class.executable.split()[0]
+        path = shutil.which(executable)
+        if path is None:
+            return executable
+        stat = os.stat(path)
+        return "%s:%i:%i" % (os.path.realpath(path), stat.st_size, stat.st_mtime)
+
+    def config_key(self, zcode_class, filters, files=(), hashes=None):
+        """Return the hash identifying a photoz configuration.
+
+        :param zcode_class: LEPHARE, BPZ or TEMPLATEFIT
+        :param list filters: Filter list
+        :param list files: Configuration files entering the run (zpara, spectro file, ...)
+        :param hashes: Object hashes of the whole catalog (see `object_hashes`), to be given
+         when the result of each object depends on the whole catalog (spectroscopic sample)
+        """
+        key = hashlib.sha1()
+        key.update(CACHE_VERSION.encode())
+        key.update(zcode_class.__name__.encode())
+        key.update(self.code_version(zcode_class).encode())
+        key.update(" ".join(filters).encode())
+        for cfile in files:
+            if cfile is not None:
+                with open(cfile, 'rb') as fcontent:
+                    key.update(fcontent.read())
+        if hashes is not None:
+            key.update(N.sort(N.asarray(hashes, dtype='int64')).tobytes())
+        return key.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cachedir, key + '.npz')
+
+    def load(self, key):
+        """Return the cached results of a configuration as a dictionnary, or None."""
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        with N.load(path) as cached:
+            entry = {k: cached[k] for k in cached.files}
+        os.utime(path, None)  # used recently
+        return entry
+
+    def save(self, key, hashes, zphoto):
+        """Add the results of a ZPHOTO object to the cache of a configuration.
+
+        Cached results of objects with the same hashes are replaced by the new ones. Each
+        variable is stored in its own array (``data_<name>``) to keep its type.
+
+        :param str key: Configuration hash (see `config_key`)
+        :param hashes: Object hashes (see `object_hashes`), in the ZPHOTO object order
+        :param zphoto: ZPHOTO object
+        """
+        # configurations may be run (and saved) by parallel threads
+        with self._lock:
+            variables = list(zphoto.data_dict)
+            entry = {'hashes': N.asarray(hashes, dtype='int64'),
+                     'zbins': zphoto.pdz_zbins,
+                     'pdz': N.atleast_2d(zphoto.pdz_val.T),
+                     'variables': N.array(variables), 'code': N.array(zphoto.code),
+                     'header': N.array(zphoto.header)}
+            for v in variables:
+                entry['data_' + v] = N.atleast_1d(zphoto.data_dict[v])
+            cached = self.load(key)
+            if cached is not None and list(cached['variables']) == variables and \
+               N.allclose(cached['zbins'], entry['zbins']):
+                keep = ~N.isin(cached['hashes'], entry['hashes'])
+                for k in ['hashes', 'pdz'] + ['data_' + v for v in variables]:
+                    entry[k] = N.concatenate([cached[k][keep], entry[k]])
+            if not os.path.isdir(self.cachedir):
+                os.makedirs(self.cachedir)
+            tmp = self._path(key) + '.%i.tmp.npz' % os.getpid()
+            N.savez(tmp, **entry)
+            os.replace(tmp, self._path(key))
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used files until the cache is smaller than maxsize."""
+        files = [os.path.join(self.cachedir, f) for f in os.listdir(self.cachedir)
+                 if f.endswith('.npz') and '.tmp.' not in f]
+        files.sort(key=os.path.getmtime)
+        sizes = [os.path.getsize(f) for f in files]
+        while len(files) > 1 and sum(sizes) > self.maxsize * 1e6:
+            print("INFO: Removing %s from the photoz cache" % files[0])
+            os.remove(files.pop(0))
+            sizes.pop(0)
+
+
+def run_cached(zcode_class, magnitudes, errors, cache, zpara=None, spectro_file=None,
+               jobs=1, retries=1, check_config=False, **kwargs):
+    """Run LEPHARE, BPZ or TEMPLATEFIT, reusing the results of the cache when possible.
+
+    Objects already in the cache (same configuration, same magnitudes and errors) are not
+    run again: only the missing ones are given to the external code, and the new results
+    are added to the cache. When a spectroscopic sample is used, the results of all objects
+    depend on the whole catalog, which then enters the configuration hash: only a complete
+    hit is reused.
+
+    :param zcode_class: LEPHARE, BPZ or TEMPLATEFIT
+    :param list magnitudes: Magnitudes. A list of list
+    :param list errors: Error on magnitudes. Same shape as the magnitude list.
+    :param cache: A ZPHOTCache object. If None, the code is simply run.
+    :param bool check_config: Check the LEPHARE configuration before running it
+    :param kwargs: see LEPHARE and BPZ
+    :return: a ZPHOTO object for the whole catalog
+    """
+    def run(mags, errs, **kws):
+        zcode = zcode_class(mags, errs, zpara=zpara, spectro_file=spectro_file, **kws)
+        if check_config:
+            zcode.check_config()
+        zcode.run(jobs=jobs, retries=retries)
+        return zcode.data_out
+
+    if cache is None:
+        return run(magnitudes, errors, **kwargs)
+
+    config = zpara
+    if config is None and zcode_class is LEPHARE:
+        config = os.environ["LEPHAREDIR"] + "/config/zphot_megacam.para"
+    hashes = object_hashes(magnitudes, errors)
+    catalog = None
+    if spectro_file is not None:  # positions enter the match to the spectroz sample
+        catalog = object_hashes(list(magnitudes) + [kwargs[k] for k in ['ra', 'dec']
+                                                    if k in kwargs], errors)
+    key = cache.config_key(zcode_class, kwargs.get('filters', []), [config, spectro_file],
+                           hashes=catalog)
+    cached = cache.load(key)
+    rows = N.full(len(hashes), -1, dtype='int64') if cached is None else \
+        join.left_join(cached['hashes'], hashes)
+    missing = N.flatnonzero(rows < 0)
+    if len(missing) and spectro_file is not None:
+        missing = N.arange(len(hashes))
+    print("INFO: %i objects found in the photoz cache, %i to run" %
+          (len(hashes) - len(missing), len(missing)))
+
+    if len(missing) == len(hashes):
+        zphoto = run(magnitudes, errors, **kwargs)
+        cache.save(key, hashes, zphoto)
+        return zphoto
+
+    if len(missing):
+        skwargs = dict(kwargs)
+        for k in ['ra', 'dec', 'id']:
+            if k in skwargs:
+                skwargs[k] = N.asarray(skwargs[k])[missing]
+        new = run([N.asarray(m)[missing] for m in magnitudes],
+                  [N.asarray(e)[missing] for e in errors], **skwargs)
+        cache.save(key, hashes[missing], new)
+        cached = cache.load(key)
+        rows = join.left_join(cached['hashes'], hashes)
+
+    variables = [str(v) for v in cached['variables']]
+    data_dict = {v: cached['data_' + v][rows] for v in variables}
+    for v in ['IDENT', 'ID']:  # running number of the objects
+        if v in data_dict:
+            data_dict[v] = N.arange(len(hashes), dtype=data_dict[v].dtype)
+    files = zcode_class.file_names(**kwargs)
+    return ZPHOTO.from_arrays(str(cached['code']), data_dict, cached['zbins'],
+                              cached['pdz'][rows].T, header=list(cached['header']),
+                              files={k: files[k] for k in ['output', 'pdz_output']
+                                     if k in files}, **kwargs)
 
 
 class ZPHOTO(object):
@@ -371,13 +864,16 @@ class ZPHOTO(object):
         self.read()
 
     def read(self):
-        """Read the output."""
-        f = open(self.files['output'], 'r')
-        self.data_array = N.loadtxt(self.files['output'], unpack=True)
+        """Read the output.
+
+        The text outputs are parsed once, then read back from their binary
+        sidecar files (see pzmassfitter.util.read_numeric_table).
+        """
+        header = read_header(self.files['output'])
+        self.data_array = util.read_numeric_table(self.files['output']).T
 
         if self.code == 'lephare':
-            self.header = [l for l in f if l.startswith('#')]
-            f.close()
+            self.header = header
            # self.variables = N.loadtxt(os.getenv('LEPHAREDIR') +
            #                           "/config/zphot_output.para", dtype='string') #changed because it was not working with python 3
             self.variables = N.loadtxt(os.getenv('LEPHAREDIR') +
@@ -385,54 +881,111 @@ class ZPHOTO(object):
             self.data_dict = {v: a for v, a in zip(
                 self.variables, self.data_array)}
             self.nsources = len(self.data_dict['Z_BEST'])
-            self.pdz_zbins = N.loadtxt(
-                self.files['pdz_output'] + '.zph', unpack=True)
-            self.pdz_val = N.loadtxt(
-                self.files['pdz_output'] + '.pdz', unpack=True)
+            self.pdz_zbins = N.squeeze(util.read_numeric_table(
+                self.files['pdz_output'] + '.zph').T)
+            self.pdz_val = util.read_numeric_table(self.files['pdz_output'] + '.pdz').T
 
         elif self.code == 'bpz':
-            self.header = [l for l in f if l.startswith('##')]
-            f.seek(0)
+            self.header = [l for l in header if l.startswith('##')]
             self.variables = [l[4:].replace(' ', '').split(
-                '\n')[0] for l in f if l.startswith('# ')]
-            f.seek(0)
+                '\n')[0] for l in header if l.startswith('# ')]
             # BPZ does not provide a zbins file.
             # Needs to create it from zmin, zmax and dz specified in output file
             zmin = float([line.split('=')[1]
-                          for line in f if 'ZMIN' in line][0])
-            f.seek(0)
+                          for line in header if 'ZMIN' in line][0])
             zmax = float([line.split('=')[1]
-                          for line in f if 'ZMAX' in line][0])
-            f.seek(0)
-            dz = float([line.split('=')[1] for line in f if 'DZ' in line][0])
-            f.close()
+                          for line in header if 'ZMAX' in line][0])
+            dz = float([line.split('=')[1] for line in header if 'DZ' in line][0])
 
             self.data_dict = {v: a for v, a in zip(
                 self.variables, self.data_array)}
             self.nsources = len(self.data_dict['Z_B'])
             self.pdz_zbins = N.arange(zmin, zmax + dz, dz)
-            self.pdz_val = N.loadtxt(self.files['pdz_output'], unpack=True,
-                                     usecols=N.arange(1, len(self.pdz_zbins) + 1))
-
-    def save_zphot(self, file_out, path_output, overwrite=False):
-        """Save the output of photoz code (z_best, chi^2, pdz) into astropy table."""
-        # Duplicates the zbins vector for each object.
-        # It is redundant information but astropy tables need each field to have the
-        # same size. Or maybe I'm missing something.
-        zbins = N.tile(self.pdz_zbins, (len(self.kwargs['id']), 1))
-
+            self.pdz_val = util.read_numeric_table(
+                self.files['pdz_output'], usecols=N.arange(1, len(self.pdz_zbins) + 1)).T
+
+    @classmethod
+    def from_arrays(cls, code, data_dict, pdz_zbins, pdz_val, header=None, files=None,
+                    **kwargs):
+        """Build a ZPHOTO object from already loaded outputs.
+
+        :param str code: 'lephare' or 'bpz'
+        :param dict data_dict: Output variables (one array per variable)
+        :param pdz_zbins: Redshift bins of the pdz
+        :param pdz_val: pdz values, of shape (nbins, nsources)
+        :param kwargs: The kwargs (id, ra, dec, ...) of the catalog
+        """
+        zphoto = cls.__new__(cls)
+        zphoto.files = {} if files is None else files
+        zphoto.kwargs = kwargs
+        zphoto.code = code
+        zphoto.header = [] if header is None else header
+        zphoto.variables = list(data_dict)
+        zphoto.data_dict = data_dict
+        zphoto.nsources = len(pdz_val.T)
+        zphoto.pdz_zbins = pdz_zbins
+        zphoto.pdz_val = pdz_val
+        return zphoto
+
+    @classmethod
+    def merge(cls, zphotos, offsets=None, **kwargs):
+        """Merge the outputs of several runs on consecutive parts of a catalog.
+
+        :param list zphotos: ZPHOTO objects, in the catalog order
+        :param list offsets: Index of the first source of each part in the full catalog,
+         used to shift the running source numbers (IDENT for LePhare, ID for BPZ)
+        :param kwargs: The kwargs (id, ra, dec, ...) of the full catalog
+        """
+        first = zphotos[0]
+        for zphoto in zphotos[1:]:
+            if not N.allclose(zphoto.pdz_zbins, first.pdz_zbins):
+                raise ValueError("All the outputs to merge must share the same redshift bins")
+        merged = cls.__new__(cls)
+        merged.files = dict(first.files)
+        merged.kwargs = kwargs
+        merged.code = first.code
+        merged.header = first.header
+        merged.variables = first.variables
+        merged.data_dict = {v: N.concatenate([N.atleast_1d(z.data_dict[v]) for z in zphotos])
+                            for v in first.data_dict}
+        if offsets is not None:
+            for v in ['IDENT', 'ID']:
+                if v in merged.data_dict:
+                    merged.data_dict[v] = N.concatenate(
+                        [N.atleast_1d(z.data_dict[v]) + offset
+                         for z, offset in zip(zphotos, offsets)])
+        merged.nsources = sum([z.nsources for z in zphotos])
+        merged.pdz_zbins = first.pdz_zbins
+        merged.pdz_val = N.hstack([N.atleast_2d(z.pdz_val.T).T for z in zphotos])
+        if hasattr(first, 'input_data'):
+            merged.input_data = {k: N.concatenate([N.atleast_1d(z.input_data[k])
+                                                   for z in zphotos])
+                                 for k in first.input_data}
+        return merged
+
+    def save_zphot(self, file_out, path_output, overwrite=False, pdz_format='float32',
+                   cdf=True):
+        """Save the output of photoz code (z_best, chi^2, pdz) into astropy table.
+
+        The redshift grid is saved once, in the metadata of the table ('zbins'), and the
+        normalized pdzs as float64, float32 or scaled uint16 (see `pdz_format`). Use
+        pzmassfitter.pdzfile_utils.read_pdz to read them back.
+
+        :param str pdz_format: float64, float32 or uint16
+        :param bool cdf: Also store the cumulative pdzs, as uint16 (see
+         pzmassfitter.pdzfile_utils.read_pdz_cdf)
+        """
         # Converts LePhare or BPZ likelihood to actual probability density
-        for i in N.arange(len(self.pdz_val.T)):
-            norm = N.trapz(self.pdz_val[:, i], self.pdz_zbins)
-            new_pdz_val = self.pdz_val[:, i] / norm
-            self.pdz_val[:, i] = new_pdz_val
+        self.pdz_val = pdzfile_utils.normalize_pdz(self.pdz_val.T, self.pdz_zbins).T
+        columns, meta = pdzfile_utils.pdz_columns(self.pdz_val.T, self.pdz_zbins,
+                                                  pdz_format=pdz_format, cdf=cdf)
 
         # Creates astropy table to be saved in path_output of file_out
         new_tab = hstack([Table([self.kwargs['id']]), Table([self.kwargs['ra']]),
                           Table([self.kwargs['dec']]), Table(self.data_dict),
-                          Table([zbins], names=['zbins']),
-                          Table([self.pdz_val.T], names=['pdz'])],
+                          Table(columns, names=sorted(columns))],
                          join_type='inner')
+        new_tab.meta.update(meta)
 
         # Rename BPZ Z_B to Z_BEST to match LePhare
         if 'Z_B' in new_tab.keys():
@@ -448,11 +1001,9 @@ class ZPHOTO(object):
 
     def read_input(self):
         """Read the input."""
-        data = N.loadtxt(self.files['input'], unpack=True)
-        f = open(self.files['input'], 'r')
-        l = f.readlines()[0]
+        data = util.read_numeric_table(self.files['input']).T
+        l = read_header(self.files['input'])[0]
         self.input_data = {k: d for k, d in zip(l[2:-1].split(), data)}
-        f.close()
 
     def hist(self, param, **kwargs):
         """Plot histograms.
@@ -569,7 +1120,7 @@ class ZSPEC(object):
 
     """Compare spectroscopic and photometric redshifts."""
 
-    def __init__(self, sfile, names, unit='deg'):
+    def __init__(self, sfile, names, unit='deg', precision=1e-3):
         """Read the input data file and organize the data.
 
         :param str sfile: File containing the spectroscopic redshift
@@ -577,6 +1128,8 @@ class ZSPEC(object):
          for the coordinates.
         :param str unit: Unit of the given coordinates ('deg', 'rad'). Should be understandable by
          astropy.coordinates.SkyCoord
+        :param float precision: Galaxies closer than this precision (in arcsec) are
+         considered as duplicates, and merged
 
         The spectroscopic redshift must be named 'zspec'.
         """
@@ -589,21 +1142,58 @@ class ZSPEC(object):
         elif 'zspec' not in self.data.keys():
             raise IOError("Spectroscopic reshift must be 'zspec'")
 
-        # Check whether duplicate galaxies exist in the spectroz sample
-        # and remove them. Ideally would average out the various occurances.
-        # (To be done later)
-        ra = ['{:.20}'.format(x) for x in self.data['ra']]
-        dec = ['{:.20}'.format(x) for x in self.data['dec']]
-        radec = N.core.defchararray.add(ra, dec)
-        unique_radec, good = N.unique(radec, return_index=True)
-        if len(unique_radec) < len(radec):
-            print("INFO: There are " + str(len(radec) - len(unique_radec)) +
-                  " duplicate galaxies in spectroz sample. They are removed.")
-        bad = N.delete(N.arange(len(self.data)), good)
-        self.data.remove_rows(bad)
-
+        # Merge the duplicate galaxies of the spectroz sample (closer than `precision`):
+        # their float columns (coordinates, redshift) are averaged
+        ra, dec = self.data['ra'], self.data['dec']
+        if unit != 'deg':
+            ra = (ra * u.Unit(unit)).to_value('deg')
+            dec = (dec * u.Unit(unit)).to_value('deg')
+        groups = spheregeometry.duplicate_groups(ra, dec, precision=precision)
+        first = N.unique(groups, return_index=True)[1]
+        if len(first) < len(groups):
+            print("INFO: There are " + str(len(groups) - len(first)) +
+                  " duplicate galaxies in spectroz sample. They are averaged.")
+            counts = N.bincount(groups)
+            data = self.data[first]
+            for name in data.colnames:
+                if data[name].dtype.kind != 'f':
+                    continue
+                values = N.asarray(self.data[name], dtype='float64')
+                if name == 'ra':  # average the RA around the first entry of each group
+                    turn = (360 * u.deg).to_value(unit)
+                    origin = values[first][groups]
+                    values = origin + (values - origin + turn / 2.) % turn - turn / 2.
+                mean = N.bincount(groups, weights=values, minlength=len(data)) / counts
+                data[name] = mean % turn if name == 'ra' else mean
+            self.data = data
+
+        self.unit = unit
         self.skycoords = SkyCoord(self.data['ra'], self.data['dec'], unit=unit)
         self.zphot = self.skycoords_phot = self.match = None
+        self._index = None
+
+    @property
+    def index(self):
+        """Sky index (`pzmassfitter.spheregeometry.SkyIndex`) of the spectroz sample."""
+        if self._index is None:
+            self._index = spheregeometry.SkyIndex(self.skycoords.ra.deg,
+                                                  self.skycoords.dec.deg)
+        return self._index
+
+    def match_catalog(self, ra, dec, unit='deg', match_file=None):
+        """Find the closest spectroz galaxy of each galaxy of a photometric catalog.
+
+        :param list ra: List of RA coordinates of the photometric catalog
+        :param list dec: List of DEC coordinates of the photometric catalog
+        :param str unit: Unit of the given coordinates
+        :param str match_file: Optional numpy (npz) file in which the match is cached. It
+         is reused as long as both catalogs are unchanged.
+        :return: indices into the spectroz sample, and on-sky separations (in mas)
+        """
+        coords = SkyCoord(ra, dec, unit=unit)
+        idx, d2d, _ = spheregeometry.sky_match(self.index, coords.ra.deg, coords.dec.deg,
+                                               match_file=match_file)
+        return idx, d2d * 3.6e6
 
     def load_zphot(self, ra, dec, zphot, unit='deg'):
         """Load the photometric informations and match them to the spectro ones.
@@ -618,9 +1208,10 @@ class ZSPEC(object):
         assert len(ra) == len(dec) == len(zphot)
         self.zphot = Table([ra, dec, zphot], names=['ra', 'dec', 'zphot'])
         self.skycoords_phot = SkyCoord(ra, dec, unit=unit)
-        idx, d2d, d3d = self.skycoords.match_to_catalog_sky(
-            self.skycoords_phot)
-        self.match = Table([idx, d2d.marcsec, d3d], names=['idx', 'd2d', 'd3d'],
+        index = spheregeometry.SkyIndex(self.skycoords_phot.ra.deg,
+                                        self.skycoords_phot.dec.deg)
+        idx, d2d, d3d = index.match(self.skycoords.ra.deg, self.skycoords.dec.deg)
+        self.match = Table([idx, d2d * 3.6e6, d3d], names=['idx', 'd2d', 'd3d'],
                            meta={'description': ['Indices into first catalog.',
                                                  'On-sky separation between the '
                                                  'closest match for each element',
@@ -6,12 +6,12 @@ Assumes that all relevant cuts have been applied to the file already.
 
 from __future__ import print_function
 import numpy as np
-import astropy.io.fits as pyfits
-from astropy import coordinates as coord
-from astropy import units as u
 from . import util
+from . import join
 from . import nfwutils
 from . import ldac
+from . import spheregeometry
+from . import pdzfile_utils
 
 class AstropyTableFilehandler(object):
 
@@ -84,28 +84,29 @@ class AstropyTableFilehandler(object):
                 'lensingcat', manager.lensingcat[manager.lensingcat["filter"] == 'i'])
 
         # 2. match galaxies in lensing cat, redshift cat and flag cat
-        if 'objectId' in manager.zcat.keys():
-            manager.matched_zcat = util.matchById(manager.zcat, manager.lensingcat, 'id', 'objectId' )
-        else:
-            manager.matched_zcat = util.matchById(manager.zcat, manager.lensingcat, 'id', 'id')
+        #    (on the sorted IDs of each catalog, see join.py)
+        lensingids = join.as_ids(manager.lensingcat['id'])
+        zid = 'objectId' if 'objectId' in manager.zcat.keys() else 'id'
+        manager.matched_zcat = join.gather(manager.zcat, manager.zcat[zid], lensingids)
 
 
         # area normalized, ie density function
-        manager.pz = manager.matched_zcat['pdz']
+        # 3. all objects have same zbins (stored in the table metadata)
+        # (delta pdzs of simulations are kept in their sparse form, see DeltaPDZ)
+        manager.pdzrange, manager.pz = pdzfile_utils.read_pdz(manager.matched_zcat,
+                                                              dense=False)
+        manager.pz_cdf = pdzfile_utils.read_pdz_cdf(manager.matched_zcat)[1]
         z_b = manager.matched_zcat['Z_BEST']
-            
-        # 3. all objects have same zbins, take the first one
-        manager.pdzrange = manager.zcat['zbins'][0]
+
         manager.replace('pdzrange', lambda: manager.pdzrange)
 
         # 4. only keep background galaxies in lensing cat and redshift cat
         if 'flag_' + options.mconfig['zconfig'] in options.cat.keys():
 
             manager.flagcat = options.cat['flag_'+options.mconfig['zconfig']]
-            if 'objectId' in manager.flagcat.keys():
-                manager.matched_flagcat = util.matchById(manager.flagcat, manager.lensingcat, 'id', 'objectId' )
-            else:
-                manager.matched_flagcat = util.matchById(manager.flagcat, manager.lensingcat, 'id', 'id')
+            flagid = 'objectId' if 'objectId' in manager.flagcat.keys() else 'id'
+            manager.matched_flagcat = join.gather(manager.flagcat, manager.flagcat[flagid],
+                                                  lensingids)
 
             if 'zflagconfig' in options.mconfig:
                 
@@ -120,6 +121,7 @@ class AstropyTableFilehandler(object):
 
                 manager.replace('lensingcat', manager.lensingcat[bck_gal])
                 manager.replace('pz',  manager.pz[bck_gal])
+                manager.replace('pz_cdf', manager.pz_cdf[bck_gal])
                 z_b = z_b[bck_gal]
 
         r_arcmin, E, B = compute_shear(cat=manager.lensingcat,
@@ -139,23 +141,19 @@ class AstropyTableFilehandler(object):
             snratio = manager.lensingcat[options.snratioCol]
 
  
+        # columns kept as they are (native dtypes, no copy; see ldac.ColumnCat)
+        cols = [('SeqNr', manager.lensingcat['id']),
+                ('r_mpc', r_mpc),
+                ('ra', manager.lensingcat[options.raCol]),
+                ('dec', manager.lensingcat[options.decCol])]
         if manager.wtg_shearcal:
-            cols = [pyfits.Column(name='SeqNr', format='J', array=manager.lensingcat['id']),
-                    pyfits.Column(name='r_mpc', format='E', array=r_mpc),
-                    pyfits.Column(name='size', format='E', array=size),
-                    pyfits.Column(name='snratio', format='E', array=snratio),
-                    pyfits.Column(name='z_b', format='E', array=z_b),
-                    pyfits.Column(name='ghats', format='E', array=E),
-                    pyfits.Column(name='B', format='E', array=B)]
-        else:
-            cols = [pyfits.Column(name='SeqNr', format='J', array=manager.lensingcat['id']),
-                    pyfits.Column(name='r_mpc', format='E', array=r_mpc),
-                    pyfits.Column(name='z_b', format='E', array=z_b),
-                    pyfits.Column(name='ghats', format='E', array=E),
-                    pyfits.Column(name='B', format='E', array=B)]
-
-        manager.store('inputcat',
-                      ldac.LDACCat(pyfits.BinTableHDU.from_columns(pyfits.ColDefs(cols))))
+            cols += [('size', size),
+                     ('snratio', snratio)]
+        cols += [('z_b', z_b),
+                 ('ghats', E),
+                 ('B', B)]
+
+        manager.store('inputcat', ldac.ColumnCat(cols))
 
 def compute_shear(cat, center, raCol, decCol, g1Col, g2Col):
     """Compute the radial and tangential shear."""
@@ -165,33 +163,12 @@ def compute_shear(cat, center, raCol, decCol, g1Col, g2Col):
     e1 = cat[g1Col]
     e2 = cat[g2Col]
 
-#    posangle = (np.pi / 2.) - sphereGeometry.positionAngle(ra, dec, cluster_ra, cluster_dec)
-
-#    Given this implementation, we need a minus sign to get the right position angle from ra, dec.
-#    posangle = -((np.pi / 2.) - sphereGeometry.positionAngle(ra,
-#                                                             dec, cluster_ra, cluster_dec))
-#    r_arcmin = sphereGeometry.greatCircleDistance(
-#        ra, dec, cluster_ra, cluster_dec) * 60
-
-#   Using standard astropy coordinates rather than sphereGeometry.
-#   sphereGeometry.posangle --> returns angle on [-pi, pi]
-#   astropy.coordinates.position_angle [0, 2pi]
-#   sphereGeometry.posangle = astropy.coordinates.position_angle if astropy.coordinates.position_angle < pi
-#   sphereGeometry.posangle = astropy.coordinates.position_angle - 2pi otherwise
-#   These angles are only unsed in cos(2phi) and sin(2phi), so that the difference above does not matter
-
-    coord_cl = coord.SkyCoord(cluster_ra * u.deg, cluster_dec * u.deg)
-#    coord_gal = coord.SkyCoord(ra * u.deg, dec * u.deg)
-    coord_gal = coord.SkyCoord(ra, dec)
-
-    posangle = -((np.pi / 2.) - coord_gal.position_angle(coord_cl).rad)
-
-    r_arcmin = coord_gal.separation(coord_cl).arcmin
-
-    cos2phi = np.cos(2 * posangle)
-    sin2phi = np.sin(2 * posangle)
+#   Spherical geometry on the raw RA/Dec arrays, same result as astropy's
+#   coord_gal.position_angle(coord_cl) and coord_gal.separation(coord_cl)
+    r, cos2phi, sin2phi = spheregeometry.shear_kernel(np.asarray(ra), np.asarray(dec),
+                                                      cluster_ra, cluster_dec)
+    r_arcmin = np.degrees(r) * 60.
 
-    E = -(e1 * cos2phi + e2 * sin2phi)
-    B = e1 * sin2phi - e2 * cos2phi
+    E, B = spheregeometry.tangential_shear(e1, e2, cos2phi, sin2phi)
 
     return r_arcmin, E, B
@@ -7,6 +7,7 @@ import scipy.integrate as integrate
 import scipy.interpolate as interpolate
 import scipy.optimize as optimize
 import scipy.ndimage
+from . import mass_summary
 
 
 def measureConfidenceInterval(dist, bins=50, interval=0.68):
@@ -47,88 +48,19 @@ def measureConfidenceInterval(dist, bins=50, interval=0.68):
 
 
 def maxDensityConfidenceRegion(dist, interval=.68, bins=None, range=None):
+    """Mode of the histogram of `dist`, and the shortest interval containing a fraction
+    `interval` of the samples and the mode (see mass_summary.max_density_region)."""
 
-    if bins is None:
-        bins = optimalHistogram(dist)
-        print('Using %d bins' % bins)
+    return mass_summary.max_density_region(np.sort(dist, axis=None), interval=interval,
+                                           bins=bins, range=range)
 
-    counts, edges = np.histogram(dist, bins=bins, range=range)
-    center = (edges[0:-1] + edges[1:]) / 2.
-    maxl = center[counts == np.max(counts)]
-    try:
-        if len(maxl) > 1:
-            maxl = np.mean(maxl)
-    except:
-        pass
 
-    maxl = float(maxl)
-    x = np.sort(dist)
+def optimalHistogram(samples, bins=mass_summary.HISTOGRAM_BINS,
+                     alphas=mass_summary.HISTOGRAM_ALPHAS):
+    """Most probable number of bins of a histogram of `samples` (see
+    mass_summary.optimal_bins)."""
 
-    # Initialize interval
-    min_int = [None, None]
-
-    try:
-        # Number of elements in trace
-        n = len(x)
-
-        # Start at far left
-        start, end = 0, int(n * interval)
-        hi, lo = x[end], x[start]
-
-        # Initialize minimum width to large value
-        min_width = np.inf
-
-        while end < n and lo <= maxl:
-            # Endpoints of interval
-            hi, lo = x[end], x[start]
-
-            if lo <= maxl <= hi:
-                # Width of interval
-                width = hi - lo
-
-                # Check to see if width is narrower than minimum
-                if width < min_width:
-                    min_width = width
-                    min_int = [lo, hi]
-
-            # Increment endpoints
-            start += 1
-            end += 1
-    except IndexError:
-        print('Too few elements for interval calculation')
-        raise IndexError
-
-    err = np.array([maxl - min_int[0], min_int[1] - maxl])
-
-    return maxl, err
-
-
-def optimalHistogram(samples, bins=np.array([25, 50, 100, 200, 400, 800, 1600]),
-                     alphas=np.array([10, 1, 0.1, 0.01])):
-
-    def likelihood(alpha, nbin):
-
-        counts, edges = np.histogram(samples, nbin)
-        widths = edges[1:] - edges[:-1]
-        nonzero = counts > 0
-        loglikes = counts[nonzero] * (np.log(counts[nonzero] + alpha - 1) -
-                                      np.log(widths[nonzero] * (np.sum(counts + alpha) - 1)))
-        loglike = np.sum(loglikes)
-        return loglike
-
-    alphagrid, bingrid = np.meshgrid(alphas, bins)
-    logprobs = np.zeros_like(alphagrid)
-
-    assert alphagrid.shape == (len(bins), len(alphas))
-
-    for i in range(len(bins)):
-        for j in range(len(alphas)):
-            logprobs[i, j] = likelihood(alphagrid[i, j], bingrid[i, j])
-
-    probs = np.exp(logprobs - np.max(logprobs))
-    binprobs = np.sum(probs, axis=1) / np.sum(probs)
-
-    return bins[np.argmax(binprobs)]
+    return mass_summary.optimal_bins(np.sort(samples, axis=None), bins=bins, alphas=alphas)
 
 
 def Confidence2D(histogram, xedges, yedges, problevel, smooth=None):
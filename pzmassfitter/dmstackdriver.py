@@ -20,6 +20,30 @@ def makeController():
                             runmethod=maxlike_masses.SampleModelToFile())
 
 
+# Mass scan through a per-galaxy likelihood grid, reusable for any cut
+# (and bootstrap/jackknife uncertainties with resample=True)
+def makeGridController(resample=False):
+    runmethod = maxlike_masses.ResampleGridToFile() if resample \
+        else maxlike_masses.GridModelToFile()
+    return mcont.Controller(modelbuilder=maxlike_bentstep_voigt.BentVoigtShapedistro(),
+                            filehandler=atf.AstropyTableFilehandler(),
+                            runmethod=runmethod)
+
+
+# Quick-look masses: maximum of the posterior and its Laplace approximation, no MCMC chain
+def makeMAPController():
+    return mcont.Controller(modelbuilder=maxlike_bentstep_voigt.BentVoigtShapedistro(),
+                            filehandler=atf.AstropyTableFilehandler(),
+                            runmethod=maxlike_masses.MAPModelToFile())
+
+
+# Reweighting of an existing chain to new priors or shear calibration, no MCMC run
+def makeReweightController():
+    return mcont.Controller(modelbuilder=maxlike_bentstep_voigt.BentVoigtShapedistro(),
+                            filehandler=atf.AstropyTableFilehandler(),
+                            runmethod=maxlike_masses.ReweightChainToFile())
+
+
 # Use definition below [BentVoigt3Shapedistro()] to enable STEP2 shear calibration
 # Obsolete: now flag in BentVoigtShapedistro() to use or not STEP2 shear calibration
 #def makeController_sc():
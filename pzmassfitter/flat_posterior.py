@@ -0,0 +1,181 @@
+"""Flat log-posterior of the mass models: one function of a parameter array.
+
+The model builders of maxlike_masses and maxlike_bentstep_voigt describe their priors and
+likelihood as pymc nodes. Evaluating them through pymc goes through its value setters,
+caches and exceptions for each parameter update. A `FlatPosterior` holds the same priors and
+likelihood as plain functions of a parameter vector, with all the constants (data arrays,
+masks, normalizations) computed once, and is sampled by mymc directly (see
+pymc_mymcmc_adapter.wrapFlatModel).
+
+The prior functions carry their gradient (`logp.grad`) and the bounds of their support
+(`logp.bounds`), so that gradient based samplers can use the gradient of the log-posterior
+when the likelihood provides its own (`FlatPosterior.log_like_grad`). They also accept
+arrays of samples (see `FlatPosterior.log_prior_samples`).
+"""
+
+
+from __future__ import print_function
+import numpy as np
+from scipy.special import ndtr
+
+
+LOG_SQRT_2PI = 0.5 * np.log(2 * np.pi)
+
+
+def uniform_logp(lower, upper):
+    """Log-density of a uniform prior (pymc.Uniform)."""
+    norm = -np.log(upper - lower)
+
+    def logp(x):
+        if np.ndim(x):
+            return np.where((lower <= x) & (x <= upper), norm, -np.inf)
+        return norm if lower <= x <= upper else -np.inf
+    logp.grad = lambda x: 0.
+    logp.bounds = (lower, upper)
+    return logp
+
+
+def normal_logp(mu, sigma):
+    """Log-density of a normal prior (pymc.Normal, of precision 1 / sigma**2)."""
+    norm = -np.log(sigma) - LOG_SQRT_2PI
+
+    def logp(x):
+        return norm - 0.5 * ((x - mu) / sigma)**2
+    logp.grad = lambda x: -(x - mu) / sigma**2
+    return logp
+
+
+def truncated_normal_logp(mu, sigma, lower, upper):
+    """Log-density of a truncated normal prior (pymc.TruncatedNormal)."""
+    norm = -np.log(sigma) - LOG_SQRT_2PI - \
+        np.log(ndtr((upper - mu) / sigma) - ndtr((lower - mu) / sigma))
+
+    def logp(x):
+        if np.ndim(x):
+            return np.where((lower <= x) & (x <= upper), norm - 0.5 * ((x - mu) / sigma)**2,
+                            -np.inf)
+        if not lower <= x <= upper:
+            return -np.inf
+        return norm - 0.5 * ((x - mu) / sigma)**2
+    logp.grad = lambda x: -(x - mu) / sigma**2
+    logp.bounds = (lower, upper)
+    return logp
+
+
+def mvnormal_logp(mu, cov):
+    """Log-density of a multivariate normal prior (pymc.MvNormalCov)."""
+    mu = np.asarray(mu, dtype=np.float64)
+    icov = np.linalg.inv(cov)
+    norm = -0.5 * np.linalg.slogdet(cov)[1] - len(mu) * LOG_SQRT_2PI
+
+    def logp(x):
+        delta = x - mu
+        return norm - 0.5 * np.sum(np.dot(delta, icov) * delta, axis=-1)
+    logp.grad = lambda x: -np.dot(icov, x - mu)
+    return logp
+
+
+class FlatPosterior(object):
+    """Log-posterior as a function of a flat parameter array.
+
+    Parameters are added one by one (or as blocks for multivariate priors) with their prior.
+    The likelihood and the derived quantities (mdelta, cdelta, ...) are functions of the
+    parameter array. `log_like_grad`, if set, returns the log-likelihood and its gradient.
+    """
+
+    def __init__(self):
+
+        self.names = []
+        self.theta = np.zeros(0)
+        self.priors = []
+        self.derived = []
+        self.log_like = None
+        self.log_like_grad = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def add_parameter(self, name, value, log_prior):
+        """Add a parameter and its prior; return its index in the parameter array."""
+        index = len(self.names)
+        self.names.append(name)
+        self.theta = np.append(self.theta, float(value))
+        self.priors.append((index, log_prior))
+        return index
+
+    def add_block(self, name, values, log_prior):
+        """Add a vector of parameters sharing one prior; return their slice in the array.
+
+        The parameters are named name_0, name_1, ..., as pymc_mymcmc_adapter names the
+        components of vector nodes.
+        """
+        start = len(self.names)
+        block = slice(start, start + len(values))
+        self.names.extend(['%s_%d' % (name, i) for i in range(len(values))])
+        self.theta = np.append(self.theta, np.asarray(values, dtype=np.float64))
+        self.priors.append((block, log_prior))
+        return block
+
+    def add_derived(self, name, function):
+        """Add a quantity derived from the parameter array, kept in the chains."""
+        self.derived.append((name, function))
+
+    def index(self, name):
+        """Index of a parameter in the parameter array."""
+        return self.names.index(name)
+
+    def log_prior(self, theta):
+        """Sum of the log-priors."""
+        logp = 0.
+        for index, prior in self.priors:
+            logp += prior(theta[index])
+            if logp == -np.inf:
+                break
+        return logp
+
+    def log_prior_samples(self, thetas):
+        """Sum of the log-priors of each of the parameter arrays of `thetas`, of shape
+        (nsamples, npar)."""
+        logp = np.zeros(len(thetas))
+        for index, prior in self.priors:
+            logp += prior(thetas[:, index])
+        return logp
+
+    def bounds(self):
+        """Lower and upper bounds of the support of each parameter (arrays)."""
+        lower = np.full(len(self.names), -np.inf)
+        upper = np.full(len(self.names), np.inf)
+        for index, prior in self.priors:
+            if hasattr(prior, 'bounds'):
+                lower[index], upper[index] = prior.bounds
+        return lower, upper
+
+    def log_prior_grad(self, theta):
+        """Gradient of the sum of the log-priors (inside their support)."""
+        grad = np.zeros(len(theta))
+        for index, prior in self.priors:
+            grad[index] += prior.grad(theta[index])
+        return grad
+
+    def log_post(self, theta):
+        """Log-posterior, -inf outside the support of the priors."""
+        logp = self.log_prior(theta)
+        if logp == -np.inf:
+            return logp
+        logl = self.log_like(theta)
+        if np.isnan(logl):
+            return -np.inf
+        return logp + logl
+
+    def __call__(self, theta):
+        return self.log_post(theta)
+
+    def log_post_grad(self, theta):
+        """Log-posterior and its gradient; (-inf, zeros) outside the support of the priors."""
+        logp = self.log_prior(theta)
+        if logp == -np.inf:
+            return logp, np.zeros(len(theta))
+        logl, grad = self.log_like_grad(theta)
+        if np.isnan(logl) or not np.all(np.isfinite(grad)):
+            return -np.inf, np.zeros(len(theta))
+        return logp + logl, grad + self.log_prior_grad(theta)
@@ -0,0 +1,131 @@
+"""Join/match catalogs on integer IDs, using a sorted index (argsort + searchsorted)."""
+
+
+from __future__ import print_function
+import os
+import numpy as np
+
+
+def as_ids(ids):
+    """Return the IDs as a contiguous int64 array."""
+    return np.ascontiguousarray(np.asarray(ids).astype('int64', copy=False))
+
+
+class SortedIndex(object):
+    """Sorted index over the ID column of a table.
+
+    Duplicated IDs resolve to their last occurrence in the table, as a dictionary
+    built on the ID column would do.
+    """
+
+    def __init__(self, ids, order=None):
+        """Build the index.
+
+        :param ids: ID column of the table (array like, cast into int64)
+        :param order: Already known stable sorting order of the IDs (see `load`)
+        """
+        self.ids = as_ids(ids)
+        self.order = np.argsort(self.ids, kind='stable') if order is None else order
+        self.sorted_ids = self.ids[self.order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, keys):
+        """Return the row number of each key in the table, -1 for keys not found."""
+        keys = as_ids(keys)
+        pos = np.searchsorted(self.sorted_ids, keys, side='right') - 1
+        found = (pos >= 0)
+        found[found] = self.sorted_ids[pos[found]] == keys[found]
+        rows = np.full(len(keys), -1, dtype='int64')
+        rows[found] = self.order[pos[found]]
+        return rows
+
+    def contains(self, keys):
+        """Return a boolean array telling which keys are in the table."""
+        return self.lookup(keys) >= 0
+
+    def save(self, filename):
+        """Save the sorting order of the index in a numpy (npz) file."""
+        np.savez(filename, ids=self.ids, order=self.order)
+
+    @classmethod
+    def load(cls, filename, ids=None):
+        """Load an index saved with `save`.
+
+        :param str filename: Name of the npz file
+        :param ids: If given, the ID column the index must correspond to. None is
+         returned if the saved index does not match these IDs.
+        """
+        saved = np.load(filename)
+        if ids is not None:
+            ids = as_ids(ids)
+            if len(ids) != len(saved['ids']) or not np.array_equal(ids, saved['ids']):
+                return None
+        return cls(saved['ids'], order=saved['order'])
+
+
+def get_index(ids, index_file=None):
+    """Return a `SortedIndex` over some IDs, optionally persisted in a file.
+
+    :param ids: ID column of the table
+    :param str index_file: If given, the index is loaded from this file when it matches
+     the IDs, and built then saved in this file otherwise.
+    """
+    if isinstance(ids, SortedIndex):
+        return ids
+    if index_file is not None and os.path.exists(index_file):
+        index = SortedIndex.load(index_file, ids)
+        if index is not None:
+            return index
+    index = SortedIndex(ids)
+    if index_file is not None:
+        index.save(index_file)
+    return index
+
+
+def report(nmatched, nunmatched, what='galaxies'):
+    """Print the number of matched and unmatched entries."""
+    print("INFO: %i matched %s kept (%i unmatched)" % (nmatched, what, nunmatched))
+
+
+def left_join(ids, otherids, index_file=None):
+    """For each entry of `otherids`, get the corresponding row in the table of `ids`.
+
+    :param ids: ID column of the table to gather rows from (or its `SortedIndex`)
+    :param otherids: IDs to look for
+    :param str index_file: Optional persisted index of `ids` (see `get_index`)
+    :return: row numbers, -1 where the ID is not found
+    """
+    return get_index(ids, index_file).lookup(otherids)
+
+
+def inner_join(ids, otherids, index_file=None):
+    """Match two ID columns.
+
+    :return: row numbers in both tables of the matched pairs, ordered as `otherids`
+    """
+    rows = left_join(ids, otherids, index_file=index_file)
+    otherrows = np.flatnonzero(rows >= 0)
+    return rows[otherrows], otherrows
+
+
+def gather(table, ids, otherids, index_file=None, verbose=True):
+    """Return the rows of a table matching a list of IDs, in the same order.
+
+    IDs not found in the table are dropped.
+
+    :param table: Table to take the rows from (anything indexable by an integer array)
+    :param ids: ID column of this table (or its `SortedIndex`)
+    :param otherids: IDs to gather
+    :param str index_file: Optional persisted index of `ids` (see `get_index`)
+    """
+    rows, otherrows = inner_join(ids, otherids, index_file=index_file)
+    if verbose:
+        report(len(rows), len(otherids) - len(rows))
+    return table[rows]
+
+
+def isin(ids, otherids, index_file=None):
+    """Return a boolean array telling which entries of `ids` are in `otherids`."""
+    return get_index(otherids, index_file).contains(ids)
@@ -0,0 +1,189 @@
+"""Laplace (gaussian) approximation of a posterior around its maximum.
+
+A quick look at the mass posterior, without a MCMC chain: the posterior is maximized
+(mymc.ParameterSpace.maximize) and approximated by the gaussian whose covariance is minus the
+inverse of the Hessian of the log-posterior at the maximum (mymc.ParameterSpace.hessian).
+Samples drawn from this gaussian are summarized as a chain would be.
+
+The approximation is made in the unconstrained coordinates of the parameters (see
+`unconstrained_space`), so that its samples stay within the bounds of the priors, and a
+parameter piled up against a bound (e.g. the lorentzian width of the voigt shape
+distribution) does not spoil it.
+
+It is checked by importance sampling: the log-posterior is evaluated on a subset of the
+gaussian samples, and the effective sample size of the weights posterior / gaussian measures
+how well the gaussian matches the posterior (see `LaplaceApproximation.diagnose`).
+"""
+
+
+from __future__ import print_function
+import numpy as np
+from . import mymc
+
+
+# Threshold of the diagnostic (see LaplaceApproximation.diagnose)
+MIN_ESS_FRACTION = 0.5
+
+
+def importance_weights(logw):
+    """Normalized importance weights from their logarithms (-inf for a null weight)."""
+    logw = np.asarray(logw, dtype=np.float64)
+    finite = np.isfinite(logw)
+    weights = np.zeros(len(logw))
+    if finite.any():
+        weights[finite] = np.exp(logw[finite] - np.max(logw[finite]))
+        weights /= np.sum(weights)
+    return weights
+
+
+def effective_sample_size(weights):
+    """Kish effective sample size of a set of importance weights, (sum w)**2 / sum w**2."""
+    weights = np.asarray(weights, dtype=np.float64)
+    sumw2 = np.sum(weights**2)
+    return np.sum(weights)**2 / sumw2 if sumw2 > 0 else 0.
+
+
+def unconstrained_space(space):
+    """Parameter space of the unconstrained coordinates of the parameters of `space`.
+
+    The coordinates are the logit (or log) transforms of the parameters within their bounds
+    (see mymc.unconstrain), starting from the current values of the parameters. Their
+    log-posterior is the one of `space` plus the log-Jacobian of the transform, with its
+    gradient if `space` has one.
+
+    :param space: mymc.ParameterSpace, with a log_posterior
+    :return: mymc.ParameterSpace, whose `constrain` attribute maps unconstrained coordinates
+     (array of shape (npar,) or (n, npar)) to the parameters of `space`
+    """
+    lower, upper = space.bounds()
+    y0 = mymc.unconstrain([p() for p in space], lower, upper)
+    dxdy = mymc.constrain(y0, lower, upper)[1]
+    parameters = [mymc.Parameter(yi, p.width / abs(d) if p.width else 1.0, p.name)
+                  for p, yi, d in zip(space, y0, dxdy)]
+
+    def setpars():
+        x, dxdy, logj, dlogj = mymc.constrain([p() for p in parameters], lower, upper)
+        for p, xi in zip(space, x):
+            p.set(xi)
+        return dxdy, logj, dlogj
+
+    def log_posterior(struct):
+        logj = setpars()[1]
+        return space.log_posterior(struct) + logj
+
+    def grad_log_posterior(struct):
+        dxdy, logj, dlogj = setpars()
+        logP, grad = space.grad_log_posterior(struct)
+        return logP + logj, np.asarray(grad, dtype=np.float64) * dxdy + dlogj
+
+    uspace = mymc.ParameterSpace(parameters, log_posterior,
+                                 grad_log_posterior if space.grad_log_posterior else None)
+    uspace.constrain = lambda y: mymc.constrain(y, lower, upper)[0]
+    return uspace
+
+
+class LaplaceApproximation(object):
+    """Gaussian approximation of a posterior, centered on its maximum.
+
+    The covariance is the inverse of minus the Hessian of the log-posterior. If the Hessian
+    is not negative definite (not a maximum, or a too flat direction), its eigenvalues are
+    replaced by minus their absolute value, and `negative_definite` is False.
+    """
+
+    def __init__(self, mode, hessian, names=None, constrain=None):
+        """
+        :param mode: Maximum of the posterior (array)
+        :param hessian: Hessian matrix of the log-posterior at the maximum
+        :param names: Names of the parameters, for the reports
+        :param constrain: Function mapping the coordinates of the gaussian to the parameters
+         (see `unconstrained_space`), for the reports
+        """
+        self.mode = np.asarray(mode, dtype=np.float64)
+        self.names = ['p%d' % i for i in range(len(self.mode))] if names is None \
+            else list(names)
+        self.constrain = constrain
+
+        eigvals, eigvecs = np.linalg.eigh(-np.asarray(hessian, dtype=np.float64))
+        self.negative_definite = bool(np.all(eigvals > 0))
+        eigvals = np.abs(eigvals)
+        eigvals[eigvals == 0] = np.finfo(np.float64).tiny
+        self.covariance = np.dot(eigvecs / eigvals, eigvecs.T)
+        self.chol = np.linalg.cholesky(self.covariance)
+        self.logdet = -np.sum(np.log(eigvals))
+
+    @property
+    def stddev(self):
+        """Standard deviations of the coordinates."""
+        return np.sqrt(np.diag(self.covariance))
+
+    def logpdf(self, samples):
+        """Log-density of the gaussian at samples of shape (n, npar)."""
+        z = np.linalg.solve(self.chol, (np.atleast_2d(samples) - self.mode).T)
+        return -0.5 * (np.sum(z**2, axis=0) + self.logdet + len(self.mode) * np.log(2 * np.pi))
+
+    def sample(self, nsamples, random_state=None):
+        """Draw samples of the gaussian.
+
+        :param int nsamples: Number of samples
+        :param random_state: numpy RandomState, or seed of one
+        :return: array of shape (nsamples, npar)
+        """
+        if not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
+        return self.mode + np.dot(random_state.standard_normal((nsamples, len(self.mode))),
+                                  self.chol.T)
+
+    def diagnose(self, log_post, samples):
+        """Check the gaussian against the posterior, by importance sampling.
+
+        The approximation is flagged as poor if
+
+        - the Hessian is not negative definite at the maximum (`hessian` flag);
+        - the effective sample size of the importance weights posterior / gaussian, on the
+          given samples, is less than MIN_ESS_FRACTION of their number (`ess` flag: the
+          posterior is skewed, or wider or narrower than the gaussian).
+
+        :param log_post: Log-posterior, function of the coordinates (up to a constant)
+        :param samples: Samples of the gaussian (see `sample`), of shape (n, npar)
+        :return: dictionary with the effective sample size fraction (`ess_fraction`), the
+         importance weights (`weights`), the list of the failed checks (`flags`) and `good`
+        """
+        samples = np.atleast_2d(samples)
+        logp = np.array([log_post(sample) for sample in samples])
+        weights = importance_weights(logp - self.logpdf(samples))
+        ess_fraction = effective_sample_size(weights) / len(samples)
+
+        flags = []
+        if not self.negative_definite:
+            flags.append('hessian')
+        if ess_fraction < MIN_ESS_FRACTION:
+            flags.append('ess')
+
+        return {'ess_fraction': ess_fraction,
+                'negative_definite': self.negative_definite,
+                'nevaluations': len(samples),
+                'weights': weights,
+                'flags': flags,
+                'good': not flags}
+
+    def report(self, diagnostic=None, samples=None):
+        """Text summary of the approximation and of its diagnostic (see `diagnose`).
+
+        :param samples: Samples of the gaussian, whose median and 68% interval are given
+         for each parameter
+        """
+        constrain = self.constrain if self.constrain is not None else lambda y: y
+        lines = ['# parameter\tmode\tQ15.9\tQ50\tQ84.1']
+        percentiles = np.percentile(constrain(samples), [15.9, 50, 84.1], axis=0) \
+            if samples is not None else np.full((3, len(self.mode)), np.nan)
+        for name, mode, (low, median, high) in zip(self.names, constrain(self.mode),
+                                                   percentiles.T):
+            lines.append('%s\t%e\t%e\t%e\t%e' % (name, mode, low, median, high))
+        if diagnostic is not None:
+            lines.append('ESS fraction\t%f\t(%d samples)' % (diagnostic['ess_fraction'],
+                                                            diagnostic['nevaluations']))
+            lines.append('Hessian\t%s' % ('ok' if diagnostic['negative_definite']
+                                          else 'not negative definite'))
+            lines.append('Laplace\t%s' % ('good' if diagnostic['good'] else
+                                          'POOR (%s)' % ', '.join(diagnostic['flags'])))
+        return '\n'.join(lines) + '\n'
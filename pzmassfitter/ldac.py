@@ -9,9 +9,10 @@
 
 from __future__ import with_statement
 import unittest
+import collections
 import numpy
 import astropy.io.fits as pyfits
-from . import util
+from . import join
 
 #######################
 
@@ -80,7 +81,7 @@ class LDACCat(object):
         return None
 
     def saveas(self, cfile, clobber=False):
-        self.hdu.writeto(cfile, clobber=clobber)
+        self.hdu.writeto(cfile, overwrite=clobber)
         self.sourcefile = cfile
 
     def append(self, othercat):
@@ -106,7 +107,90 @@ class LDACCat(object):
         return newcat
 
     def matchById(self, othercat, otherid='SeqNr', selfid='SeqNr'):
-        return util.matchById(self, othercat, otherid=otherid, selfid=selfid)
+        rows, _ = join.inner_join(self[selfid], othercat[otherid])
+        join.report(len(rows), len(othercat[otherid]) - len(rows))
+        return self.filter(rows)
+
+
+class ColumnCat(object):
+    """In-memory catalog of named columns, with the interface of LDACCat.
+
+    The columns are kept as the given arrays, with their own dtype and memory layout:
+    unlike a BinTableHDU, nothing is copied or converted to the FITS column formats.
+    Filtering a catalog indexes each column.
+    """
+
+    def __init__(self, columns):
+        """
+        :param columns: (name, array) pairs, or a dictionary of arrays of the same length
+        """
+        items = columns.items() if hasattr(columns, 'items') else columns
+        self.columns = collections.OrderedDict((name, numpy.asarray(array))
+                                               for name, array in items)
+        lengths = set(len(array) for array in self.columns.values())
+        if len(lengths) > 1:
+            raise ValueError("The columns have different lengths: %s" % sorted(lengths))
+        self.sourcefile = None
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __getitem__(self, key):
+
+        if isinstance(key, str):
+            return self.columns[key]
+
+        if isinstance(key, int):
+            return tuple(array[key] for array in self.columns.values())
+
+        if isinstance(key, slice):
+            return self.filter(key)
+
+        raise TypeError
+
+    def __setitem__(self, key, val):
+        raise NotImplementedError
+
+    def __delitem__(self, key):
+        raise NotImplementedError
+
+    def keys(self):
+        return list(self.columns.keys())
+
+    def __iter__(self):
+        return zip(*self.columns.values())
+
+    def __contains__(self, item):
+        return item in self.columns
+
+    def has_key(self, key):
+        return self.__contains__(key)
+
+    def filter(self, mask):
+        newcat = ColumnCat((name, array[mask]) for name, array in self.columns.items())
+        newcat.sourcefile = self.sourcefile
+        return newcat
+
+    def append(self, othercat):
+
+        if sorted(self.keys()) != sorted(othercat.keys()):
+            raise MismatchedKeysException((self.keys(), othercat.keys()))
+        return ColumnCat((key, numpy.hstack([self[key], othercat[key]]))
+                         for key in self.keys())
+
+    def matchById(self, othercat, otherid='SeqNr', selfid='SeqNr'):
+        rows, _ = join.inner_join(self[selfid], othercat[otherid])
+        join.report(len(rows), len(othercat[otherid]) - len(rows))
+        return self.filter(rows)
+
+    def toLDACCat(self):
+        """The catalog as an LDACCat (BinTableHDU of the native column formats)."""
+        data = numpy.rec.fromarrays(list(self.columns.values()), names=self.keys())
+        return LDACCat(pyfits.BinTableHDU(data=data))
+
+    def saveas(self, cfile, clobber=False):
+        self.toLDACCat().saveas(cfile, clobber=clobber)
+        self.sourcefile = cfile
 
 
 def openObjects(hdulist, table='OBJECTS'):
@@ -136,21 +220,9 @@ def openObjectFile(filename, table='OBJECTS'):
 
 def matchCommonSubsets(cat1, cat2, cat1id='SeqNr', cat2id='SeqNr'):
 
-    cat1order = {}
-    for i, x in enumerate(cat1[cat1id]):
-        cat1order[x] = i
-
-    cat1keeporder = []
-    cat2keep = []
-    for x in cat2[cat2id]:
-        if x in cat1order:
-            cat1keeporder.append(cat1order[x])
-            cat2keep.append(True)
-        else:
-            cat2keep.append(False)
-
-    cat1keep = numpy.array(cat1keeporder)
-    cat2keep = numpy.array(cat2keep)
+    cat1index = join.get_index(cat1[cat1id])
+    cat1keep, _ = join.inner_join(cat1index, cat2[cat2id])
+    cat2keep = join.isin(cat2[cat2id], cat1index)
     cat1matched = cat1.filter(cat1keep)
     cat2matched = cat2.filter(cat2keep)
     return cat1matched, cat2matched
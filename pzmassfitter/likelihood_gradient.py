@@ -0,0 +1,236 @@
+"""Log-likelihood of the NFW shear model together with its gradient.
+
+nfwmodeltools.gauss_like and bentvoigt_like only return the value of the log-likelihood.
+Gradient based samplers (see mymc.NUTSUpdater) also need its derivatives with respect to
+the mass, the concentration, the parameters of the shape distribution and the shear
+calibration. They are computed analytically, in the same pass over the galaxies and the
+redshift bins as the value.
+"""
+
+
+from __future__ import print_function
+import numpy as np
+from scipy.special import wofz
+from . import pdzfile_utils
+
+
+SQRT2 = np.sqrt(2.)
+SQRT2PI = np.sqrt(2 * np.pi)
+
+# Series of the convergence kernel f(x) in u = x**2 - 1, used for |u| < NFW_SERIES_RANGE
+NFW_SERIES_RANGE = 0.1
+NFW_SERIES_ORDER = 16
+
+
+def nfw_kernels(x):
+    """Dimensionless NFW convergence and shear profiles, and their derivatives.
+
+    The convergence is 2 A f(x) and the shear A G(x), where A = rs delta_c rho_c / sigma_c
+    and x = r / rs (see nfwmodeltools.NFWKappa and NFWShear)::
+
+        f(x) = (1 - F(x)) / (x**2 - 1)
+        G(x) = 4 (log(x / 2) + F(x)) / x**2 - 2 f(x)
+
+    with F(x) = arccosh(1 / x) / sqrt(1 - x**2) below 1 and arccos(1 / x) / sqrt(x**2 - 1)
+    above. Around x = 1, f is computed from its series in u = x**2 - 1,
+    f = sum_k (-u)**k / (2k + 3), which avoids the cancellations of the closed form.
+
+    :param x: radii in units of the scale radius (array)
+    :return: f, df/dx, G and dG/dx
+    """
+    x = np.asarray(x, dtype=np.float64)
+    u = x**2 - 1
+    f = np.empty_like(x)
+    dfdx = np.empty_like(x)
+
+    near = np.abs(u) < NFW_SERIES_RANGE
+    k = np.arange(NFW_SERIES_ORDER)
+    coefs = (-1.)**k / (2 * k + 3)
+    f[near] = np.polyval(coefs[::-1], u[near])
+    dfdx[near] = 2 * x[near] * np.polyval((k * coefs)[:0:-1], u[near])
+
+    below, above, far = ~near & (u < 0), ~near & (u > 0), ~near
+    F = np.empty_like(x)
+    F[below] = np.arccosh(1 / x[below]) / np.sqrt(-u[below])
+    F[above] = np.arccos(1 / x[above]) / np.sqrt(u[above])
+    xf, uf, Ff = x[far], u[far], F[far]
+    f[far] = (1 - Ff) / uf
+    dFdx = (1 - xf**2 * Ff) / (xf * uf)
+    dfdx[far] = -(dFdx + 2 * xf * f[far]) / uf
+
+    # mean convergence inside x: 4 A h(x) / x**2, with dh/dx = x f(x)
+    h = np.log(x / 2) + 1 - u * f
+    G = 4 * h / x**2 - 2 * f
+    dGdx = 4 * f / x - 8 * h / x**3 - 2 * dfdx
+    return f, dfdx, G, dGdx
+
+
+def nfw_profiles_grad(mdelta, cdelta, r_mpc, rho_c, rho_c_over_sigma_c, massdelta):
+    """Shear and convergence of an NFW halo, as likelihood_grid.nfw_profiles, with their
+    derivatives with respect to mdelta and cdelta.
+
+    :return: gamma_inf, kappa_inf, (dgamma/dmdelta, dgamma/dcdelta) and
+     (dkappa/dmdelta, dkappa/dcdelta)
+    """
+    r_mpc = np.asarray(r_mpc, dtype=np.float64)
+    if mdelta == 0:
+        zeros = np.zeros(len(r_mpc))
+        return zeros, zeros, (zeros, zeros), (zeros, zeros)
+
+    mass = abs(mdelta)
+    rdelta = (3 * mass / (4 * massdelta * np.pi * rho_c))**(1. / 3.)
+    rscale = rdelta / cdelta
+    mc = np.log(1 + cdelta) - cdelta / (1 + cdelta)
+    delta_c = (massdelta / 3.) * cdelta**3 / mc
+    amp = rscale * delta_c * rho_c_over_sigma_c
+
+    x = r_mpc / rscale
+    f, dfdx, G, dGdx = nfw_kernels(x)
+    gamma_inf = amp * G
+    kappa_inf = 2 * amp * f
+
+    # A ~ M**(1/3), x ~ M**(-1/3) c; dlog(delta_c)/dc = 3 / c - (c / (1 + c)**2) / mc
+    dlogamp_dc = 2. / cdelta - cdelta / (1 + cdelta)**2 / mc
+    dx_dm, dx_dc = -x / (3 * mass), x / cdelta
+    dgamma = (gamma_inf / (3 * mass) + amp * dGdx * dx_dm,
+              gamma_inf * dlogamp_dc + amp * dGdx * dx_dc)
+    dkappa = (kappa_inf / (3 * mass) + 2 * amp * dfdx * dx_dm,
+              kappa_inf * dlogamp_dc + 2 * amp * dfdx * dx_dc)
+
+    if mdelta < 0.:
+        # gamma(M) = -gamma(|M|) and kappa(M) = kappa(|M|)
+        gamma_inf = -gamma_inf
+        dgamma = (dgamma[0], -dgamma[1])
+        dkappa = (-dkappa[0], dkappa[1])
+    return gamma_inf, kappa_inf, dgamma, dkappa
+
+
+def gauss_shape_grad(sigma):
+    """Gaussian shape distribution of width `sigma` (likelihood_grid.gauss_shape), with its
+    derivatives.
+
+    :return: function of the shear residuals returning the density, its derivative with
+     respect to the residuals, and the list of its derivatives with respect to (sigma,)
+    """
+    def shape_grad(delta):
+        chi = delta / sigma
+        prob = np.exp(-0.5 * chi**2) / (SQRT2PI * sigma)
+        return prob, -chi / sigma * prob, [prob * (chi**2 - 1) / sigma]
+    return shape_grad
+
+
+def voigt_shape_grad(sigma, gamma):
+    """Voigt shape distribution of nfwmodeltools.bentvoigt_like, with its derivatives.
+
+    The Voigt profile of voigt.c (gaussian width sigma, lorentzian full width gamma) is
+    Re[w(z)] / (sigma sqrt(2 pi)), with w the Faddeeva function and
+    z = (delta + i gamma / 2) / (sigma sqrt(2)). Its derivatives follow from
+    w'(z) = -2 z w(z) + 2 i / sqrt(pi).
+
+    :return: function of the shear residuals returning the density, its derivative with
+     respect to the residuals, and the list of its derivatives with respect to
+     (sigma, gamma)
+    """
+    scale = sigma * SQRT2
+    norm = 1. / (sigma * SQRT2PI)
+
+    def shape_grad(delta):
+        z = (delta + 0.5j * gamma) / scale
+        w = wofz(z)
+        dw = -2 * z * w + 2j / np.sqrt(np.pi)
+        prob = norm * w.real
+        ddelta = norm * dw.real / scale
+        dsigma = -norm * (dw * z).real / sigma - prob / sigma
+        dgamma = -0.5 * norm * dw.imag / scale
+        return prob, ddelta, [dsigma, dgamma]
+    return shape_grad
+
+
+def loglike_grad(mdelta, cdelta, r_mpc, ghats, zs, betas, pz, m, c, shape_grad,
+                 rho_c, rho_c_over_sigma_c, massdelta, chunksize=10000):
+    """Log-likelihood of nfwmodeltools.gauss_like/bentvoigt_like and its derivatives.
+
+    :param pz: Pdzs of the galaxies, dense array of shape (ngal, nz), or a
+     pdzfile_utils.DeltaPDZ
+    :param m: Multiplicative shear calibration of each galaxy (array)
+    :param c: Additive shear calibration of each galaxy (array)
+    :param shape_grad: Shape distribution and its derivatives (see `gauss_shape_grad` and
+     `voigt_shape_grad`)
+    :param int chunksize: Number of galaxies integrated at once over the dense pdzs
+    :return: the log-likelihood; its gradient with respect to mdelta, cdelta and the
+     parameters of the shape distribution (array); and its derivatives with respect to
+     the shear calibrations m and c of each galaxy (two arrays)
+    """
+    gamma_inf, kappa_inf, dgamma, dkappa = nfw_profiles_grad(mdelta, cdelta, r_mpc, rho_c,
+                                                             rho_c_over_sigma_c, massdelta)
+    ngal = len(r_mpc)
+    m = np.broadcast_to(m, ngal)
+    c = np.broadcast_to(c, ngal)
+
+    if isinstance(pz, pdzfile_utils.DeltaPDZ):
+        # one beta per galaxy: the integral reduces to the integrand in the bin of the galaxy
+        chunksize = max(ngal, 1)
+        galbetas = betas[pz.bins][:, None]
+        weights = np.where(pz.weights > 1e-6, pz.integrals(), 0.)[:, None]
+
+        def integrate(integrand):
+            return integrand[:, 0]
+    else:
+        def integrate(integrand):
+            return pdzfile_utils.trapz_pdz(integrand, zs)
+
+    logp = 0.
+    grad = None
+    dm = np.empty(ngal)
+    dc = np.empty(ngal)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, ngal, chunksize):
+            chunk = slice(start, start + chunksize)
+            if isinstance(pz, pdzfile_utils.DeltaPDZ):
+                beta, pzchunk = galbetas, weights
+            else:
+                beta = betas
+                pzchunk = np.where(pz[chunk] > 1e-6, pz[chunk], 0.)
+
+            lens = 1 - beta * kappa_inf[chunk, None]
+            g = beta * gamma_inf[chunk, None] / lens
+            dg = [beta * (dgam[chunk, None] + g * dkap[chunk, None]) / lens
+                  for dgam, dkap in zip(dgamma, dkappa)]
+            calib = 1 + m[chunk, None]
+            delta = ghats[chunk, None] - calib * g - c[chunk, None]
+
+            prob, ddelta, dshape = shape_grad(delta)
+            galprob = integrate(pzchunk * prob)
+            logp += np.sum(np.log(galprob))
+
+            # d log(galProb) = integral(pz dprob) / galProb
+            pzddelta = pzchunk * ddelta
+            chunkgrad = [-np.sum(integrate(pzddelta * calib * dgi) / galprob) for dgi in dg]
+            chunkgrad += [np.sum(integrate(pzchunk * dshapei) / galprob) for dshapei in dshape]
+            grad = np.array(chunkgrad) if grad is None else grad + chunkgrad
+            dm[chunk] = -integrate(pzddelta * g) / galprob
+            dc[chunk] = -integrate(pzddelta) / galprob
+
+    if grad is None:
+        grad = np.zeros(2 + len(shape_grad(np.zeros(1))[2]))
+    return logp, grad, dm, dc
+
+
+def gauss_like_grad(mdelta, cdelta, r_mpc, ghats, zs, betas, pz, m, c, sigma,
+                    rho_c, rho_c_over_sigma_c, massdelta):
+    """Value of nfwmodeltools.gauss_like, and its gradient with respect to
+    (mdelta, cdelta, sigma)."""
+    logp, grad = loglike_grad(mdelta, cdelta, r_mpc, ghats, zs, betas, pz, m, c,
+                              gauss_shape_grad(sigma), rho_c, rho_c_over_sigma_c,
+                              massdelta)[:2]
+    return logp, grad
+
+
+def bentvoigt_like_grad(mdelta, cdelta, r_mpc, ghats, zs, betas, pz, m, c, sigma, gamma,
+                        rho_c, rho_c_over_sigma_c, massdelta):
+    """Value of nfwmodeltools.bentvoigt_like, and its gradient with respect to
+    (mdelta, cdelta, sigma, gamma)."""
+    logp, grad = loglike_grad(mdelta, cdelta, r_mpc, ghats, zs, betas, pz, m, c,
+                              voigt_shape_grad(sigma, gamma), rho_c, rho_c_over_sigma_c,
+                              massdelta)[:2]
+    return logp, grad
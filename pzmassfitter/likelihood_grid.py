@@ -0,0 +1,387 @@
+"""Per-galaxy log-likelihood of the NFW shear model, tabulated on a mass (and concentration)
+grid.
+
+Each galaxy contributes independently to the likelihood. Once the per-galaxy
+log-likelihoods L_i(M[, c]) are tabulated, the likelihood of any selection of the galaxies
+(radial range, redshift cuts, ...) is a masked sum over the galaxy axis.
+"""
+
+
+from __future__ import print_function
+import os
+import hashlib
+import numpy as np
+from . import nfwmodeltools as tools
+from . import pdzfile_utils
+from . import voigtcall
+
+
+LOGLIKE_FLOOR = -1e300
+
+
+def gauss_shape(sigma):
+    """Gaussian shape distribution of width `sigma`."""
+    def shape_like(delta):
+        return np.exp(-0.5 * (delta / sigma)**2) / (np.sqrt(2 * np.pi) * sigma)
+    return shape_like
+
+
+def voigt_shape(sigma, gamma):
+    """Voigt shape distribution, as used by nfwmodeltools.bentvoigt_like."""
+    def shape_like(delta):
+        delta = np.asarray(delta, dtype=np.float64)
+        flat = np.ascontiguousarray(delta.ravel())
+        return voigtcall.voigtcall(flat, sigma, gamma).reshape(delta.shape)
+    return shape_like
+
+
+def nfw_profiles(mdelta, cdelta, r_mpc, rho_c, rho_c_over_sigma_c, massdelta):
+    """Shear and convergence (for a source at infinity) of an NFW halo at radii `r_mpc`."""
+    if mdelta == 0:
+        return np.zeros(len(r_mpc)), np.zeros(len(r_mpc))
+    rdelta = (3 * abs(mdelta) / (4 * massdelta * np.pi * rho_c))**(1. / 3.)
+    rscale = rdelta / cdelta
+    gamma_inf = tools.NFWShear(r_mpc, cdelta, rscale, rho_c_over_sigma_c, delta=massdelta)
+    kappa_inf = tools.NFWKappa(r_mpc, cdelta, rscale, rho_c_over_sigma_c, delta=massdelta)
+    if mdelta < 0.:
+        gamma_inf = -gamma_inf
+    return gamma_inf, kappa_inf
+
+
+def galaxy_loglike(mdelta, cdelta, r_mpc, ghats, zs, betas, pz, m, c, shape_like,
+                   rho_c, rho_c_over_sigma_c, massdelta, chunksize=10000):
+    """Log-likelihood of each galaxy, as summed by nfwmodeltools.gauss_like/bentvoigt_like.
+
+    :param pz: Pdzs of the galaxies, dense array of shape (ngal, nz), or a
+     pdzfile_utils.DeltaPDZ
+    :param m: Multiplicative shear calibration of each galaxy (array)
+    :param c: Additive shear calibration of each galaxy (array)
+    :param shape_like: Shape distribution, function of the shear residuals (see
+     `gauss_shape` and `voigt_shape`)
+    :param int chunksize: Number of galaxies integrated at once over the dense pdzs
+    :return: array of shape (ngal,)
+    """
+    gamma_inf, kappa_inf = nfw_profiles(mdelta, cdelta, r_mpc, rho_c, rho_c_over_sigma_c,
+                                        massdelta)
+    m = np.broadcast_to(m, len(r_mpc))
+    c = np.broadcast_to(c, len(r_mpc))
+
+    if isinstance(pz, pdzfile_utils.DeltaPDZ):
+        # one beta per galaxy: the integral reduces to the integrand in the bin of the galaxy
+        beta = betas[pz.bins]
+        g = beta * gamma_inf / (1 - beta * kappa_inf)
+        galProb = np.where(pz.weights > 1e-6,
+                           pz.integrals() * shape_like(ghats - (1 + m) * g - c), 0.)
+    else:
+        galProb = np.empty(len(r_mpc))
+        for start in range(0, len(r_mpc), chunksize):
+            chunk = slice(start, start + chunksize)
+            g = betas * gamma_inf[chunk, None] / (1 - betas * kappa_inf[chunk, None])
+            delta = ghats[chunk, None] - (1 + m[chunk, None]) * g - c[chunk, None]
+            integrand = np.where(pz[chunk] > 1e-6, pz[chunk] * shape_like(delta), 0.)
+            galProb[chunk] = pdzfile_utils.trapz_pdz(integrand, zs)
+
+    with np.errstate(divide='ignore'):
+        return np.log(galProb)
+
+
+def node_value(node):
+    """Value of a (pymc) model node, or the node itself for plain numbers and arrays."""
+    return getattr(node, 'value', node)
+
+
+def center_stochastics(stochastics, exclude=()):
+    """Set (pymc) stochastic variables to the center of their prior.
+
+    Normal-like priors are set to their mean ('mu'), uniform priors to the middle of their
+    range. Used to fix the nuisance parameters of the model when tabulating the likelihood.
+
+    :param stochastics: Stochastic variables (objects with `parents` and `value`)
+    :param exclude: Names of the variables to leave untouched
+    """
+    for stochastic in stochastics:
+        if stochastic.__name__ in exclude:
+            continue
+        parents = stochastic.parents
+        if 'mu' in parents:
+            stochastic.value = np.array(node_value(parents['mu']), dtype=float)
+        elif 'lower' in parents and 'upper' in parents:
+            stochastic.value = 0.5 * (node_value(parents['lower']) +
+                                      node_value(parents['upper']))
+
+
+def columns_key(columns, *arrays, **settings):
+    """Hash (hex digest) of a dictionary of columns, of some extra arrays and of settings.
+
+    The settings (keyword arguments) are hashed through their repr.
+    """
+    sha = hashlib.sha1()
+    for name in sorted(columns):
+        sha.update(name.encode())
+        sha.update(np.ascontiguousarray(columns[name], dtype=np.float64).tobytes())
+    for array in arrays:
+        sha.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    for name in sorted(settings):
+        sha.update(('%s=%r' % (name, settings[name])).encode())
+    return sha.hexdigest()
+
+
+class LikelihoodGrid(object):
+    """Per-galaxy log-likelihoods on a grid of masses (and concentrations).
+
+    Along with the table, the quantities used to select the galaxies (radius, photoz, ...)
+    are kept as `columns`, so that new cuts can be applied without the input catalog.
+    """
+
+    def __init__(self, masses, loglike, columns=None, concentrations=None, key=''):
+        """Create the grid.
+
+        :param masses: Mass grid, of shape (nmass,)
+        :param loglike: Log-likelihoods, of shape (nmass, ngal), or (nmass, nconc, ngal)
+         when `concentrations` are given
+        :param dict columns: Per-galaxy quantities, each of shape (ngal,)
+        :param concentrations: Concentration grid, of shape (nconc,)
+        :param str key: Identifier of the data and settings the grid was computed for
+        """
+        self.masses = np.asarray(masses, dtype=np.float64)
+        self.concentrations = None if concentrations is None else \
+            np.asarray(concentrations, dtype=np.float64)
+        # galaxies of null likelihood get a finite floor, so that masking them out is a
+        # product by zero
+        self.loglike = np.maximum(np.ascontiguousarray(loglike, dtype=np.float64),
+                                  LOGLIKE_FLOOR)
+        self.columns = {} if columns is None else dict(columns)
+        self.key = key
+        expected = (len(self.masses),) + \
+            (() if self.concentrations is None else (len(self.concentrations),))
+        if self.loglike.shape[:-1] != expected:
+            raise ValueError("Log-likelihood grid of shape %s does not match the mass/"
+                             "concentration grid %s" % (self.loglike.shape, expected))
+
+    def __len__(self):
+        return self.loglike.shape[-1]
+
+    def total(self, mask=None):
+        """Log-likelihood of a selection of galaxies, on the grid.
+
+        :param mask: Boolean array of the galaxies to keep (all of them by default)
+        :return: array of shape (nmass,) or (nmass, nconc)
+        """
+        if mask is None:
+            return self.loglike.sum(axis=-1)
+        return np.dot(self.loglike, np.asarray(mask, dtype=bool).astype(np.float64))
+
+    def totals(self, weights):
+        """Log-likelihoods of several weightings of the galaxies (e.g. resamples), on the grid.
+
+        :param weights: Weights of the galaxies, of shape (nweights, ngal), e.g. the number
+         of times each galaxy is drawn in a bootstrap resample
+        :return: array of shape (nweights, nmass) or (nweights, nmass, nconc)
+        """
+        weights = np.asarray(weights, dtype=np.float64)
+        return np.moveaxis(np.dot(self.loglike, weights.T), -1, 0)
+
+    def mass_logpost(self, mask=None, mass_logprior=None, conc_logprior=None, totals=None):
+        """Log-posterior of the mass, marginalized over the concentration if needed.
+
+        :param mask: Boolean array of the galaxies to keep
+        :param mass_logprior: Log-prior on the mass grid (flat by default)
+        :param conc_logprior: Log-prior on the concentration grid, as a density in
+         log10(c) (flat by default). The marginalization is a sum over the concentration
+         grid, weighted by its spacing in log10(c).
+        :param totals: Log-likelihoods already summed over the galaxies, used instead of
+         `mask`. Several of them (see `totals`) give one log-posterior each.
+        :return: log-posterior(s) on the mass grid, with a maximum of 0
+        """
+        logpost = self.total(mask) if totals is None else totals
+        if self.concentrations is not None:
+            log10c = np.log10(self.concentrations)
+            weights = np.gradient(log10c) if len(log10c) > 1 else np.ones(1)
+            if conc_logprior is not None:
+                logpost = logpost + conc_logprior
+            top = logpost.max(axis=-1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                logpost = top + np.log(np.sum(np.exp(logpost - top[..., None]) * weights,
+                                              axis=-1))
+        if mass_logprior is not None:
+            logpost = logpost + mass_logprior
+        return logpost - logpost.max(axis=-1, keepdims=True)
+
+    def save(self, filename):
+        """Save the grid in a numpy (npz) file."""
+        concentrations = np.zeros(0) if self.concentrations is None else self.concentrations
+        columns = dict(('col_' + name, value) for name, value in self.columns.items())
+        with open(filename, 'wb') as output:  # keep the file name as given (no .npz added)
+            np.savez(output, masses=self.masses, concentrations=concentrations,
+                     loglike=self.loglike, key=self.key, **columns)
+
+    @classmethod
+    def load(cls, filename, key=None):
+        """Load a grid saved with `save`.
+
+        :param str filename: Name of the npz file
+        :param str key: If given, None is returned when the saved grid was computed for
+         another key
+        """
+        saved = np.load(filename)
+        if key is not None and str(saved['key']) != key:
+            return None
+        concentrations = saved['concentrations'] if len(saved['concentrations']) else None
+        columns = dict((name[4:], saved[name]) for name in saved.files
+                       if name.startswith('col_'))
+        return cls(saved['masses'], saved['loglike'], columns=columns,
+                   concentrations=concentrations, key=str(saved['key']))
+
+    def _estimates(self, totals, mass_logprior, conc_logprior, statistic):
+        """Mass estimates of batches of summed log-likelihoods."""
+        masses = [posterior_masses(self.mass_logpost(mass_logprior=mass_logprior,
+                                                     conc_logprior=conc_logprior,
+                                                     totals=batch),
+                                   self.masses, statistic=statistic)
+                  for batch in totals]
+        return np.concatenate(masses) if masses else np.zeros(0)
+
+    def bootstrap(self, weights, mass_logprior=None, conc_logprior=None, statistic='median'):
+        """Mass estimate of each bootstrap resample of the galaxies.
+
+        :param weights: Batches of weights of the galaxies, each of shape (batch, ngal)
+         (see `bootstrap_weights`). Each batch is summed with one matrix product.
+        :param mass_logprior: Log-prior on the mass grid
+        :param conc_logprior: Log-prior on the concentration grid
+        :param str statistic: Mass estimate of each posterior (see `posterior_masses`)
+        :return: array of shape (nresamples,)
+        """
+        return self._estimates((self.totals(batch) for batch in weights),
+                               mass_logprior, conc_logprior, statistic)
+
+    def jackknife(self, mask, labels=None, mass_logprior=None, conc_logprior=None,
+                  statistic='median', batchsize=100):
+        """Mass estimate of each jackknife resample of the selected galaxies.
+
+        The log-likelihood of a resample is the one of the whole selection minus the one of
+        the patch left out.
+
+        :param mask: Boolean array of the selected galaxies
+        :param labels: Patch number of each galaxy (see `patch_labels`): each resample leaves
+         out one patch. By default, one galaxy is left out at a time.
+        :param mass_logprior: Log-prior on the mass grid
+        :param conc_logprior: Log-prior on the concentration grid
+        :param str statistic: Mass estimate of each posterior (see `posterior_masses`)
+        :param int batchsize: Number of resamples computed at once
+        :return: array of shape (npatches,)
+        """
+        mask = np.asarray(mask, dtype=bool)
+        full = self.total(mask)
+        if labels is None:
+            selected = np.flatnonzero(mask)
+            leftout = (np.moveaxis(self.loglike[..., selected[start:start + batchsize]], -1, 0)
+                       for start in range(0, len(selected), batchsize))
+        else:
+            patches = np.unique(labels[mask])
+            leftout = (self.totals(mask & (labels == patches[start:start + batchsize, None]))
+                       for start in range(0, len(patches), batchsize))
+        return self._estimates((full - batch for batch in leftout),
+                               mass_logprior, conc_logprior, statistic)
+
+
+def posterior_masses(logpost, masses, statistic='median'):
+    """Point estimate of the mass from log-posterior(s) on a mass grid.
+
+    :param logpost: Log-posterior(s), of shape (nmass,) or (nposteriors, nmass)
+    :param masses: Mass grid
+    :param str statistic: 'median' (interpolated on the cumulative distribution), 'mean',
+     or 'maxlike' (grid point of highest posterior)
+    """
+    pdf = np.exp(logpost - np.max(logpost, axis=-1, keepdims=True))
+    pdf /= pdf.sum(axis=-1, keepdims=True)
+    if statistic == 'maxlike':
+        return masses[np.argmax(pdf, axis=-1)]
+    if statistic == 'mean':
+        return np.dot(pdf, masses)
+    if statistic != 'median':
+        raise ValueError("Unknown statistic %s (median, mean or maxlike)" % statistic)
+    # linear interpolation of the cumulative distribution at 0.5, as np.interp does
+    cdf = np.cumsum(pdf, axis=-1)
+    upper = np.minimum(np.sum(cdf < 0.5, axis=-1), len(masses) - 1)[..., None]
+    lower = np.maximum(upper - 1, 0)
+    cdf0 = np.take_along_axis(cdf, lower, axis=-1)[..., 0]
+    cdf1 = np.take_along_axis(cdf, upper, axis=-1)[..., 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.clip(np.where(cdf1 > cdf0, (0.5 - cdf0) / (cdf1 - cdf0), 1.), 0., 1.)
+    return masses[lower[..., 0]] + frac * (masses[upper[..., 0]] - masses[lower[..., 0]])
+
+
+def bootstrap_weights(mask, nresamples, batchsize=100, seed=None):
+    """Bootstrap resamples of the selected galaxies, as batches of weights.
+
+    :param mask: Boolean array of the selected galaxies
+    :param int nresamples: Number of resamples
+    :param int batchsize: Number of resamples per batch
+    :param seed: Seed of the random generator
+    :return: generator of arrays of shape (batch, ngal), the number of times each galaxy is
+     drawn (0 for galaxies not selected)
+    """
+    selected = np.flatnonzero(mask)
+    rng = np.random.RandomState(seed)
+    for start in range(0, nresamples, batchsize):
+        nbatch = min(batchsize, nresamples - start)
+        weights = np.zeros((nbatch, len(mask)))
+        for weight in weights:
+            weight[selected] = np.bincount(rng.randint(len(selected), size=len(selected)),
+                                           minlength=len(selected))
+        yield weights
+
+
+def patch_labels(ra, dec, npatches):
+    """Split galaxies into spatial patches of (nearly) equal numbers of galaxies.
+
+    The galaxies are cut into strips of right ascension, then each strip in declination.
+
+    :param ra: right ascensions, in degrees
+    :param dec: declinations, in degrees
+    :param int npatches: Number of patches (rounded to nx * ny, with nx close to the
+     square root)
+    :return: patch number of each galaxy
+    """
+    ra, dec = np.asarray(ra, dtype=np.float64), np.asarray(dec, dtype=np.float64)
+    nx = max(1, int(round(np.sqrt(npatches))))
+    ny = max(1, npatches // nx)
+    x = (ra - np.median(ra) + 180.) % 360. * np.cos(np.radians(np.median(dec)))
+    strips = np.minimum((np.argsort(np.argsort(x)) * nx) // len(x), nx - 1)
+    labels = np.empty(len(x), dtype=np.int64)
+    for strip in range(nx):
+        inside = np.flatnonzero(strips == strip)
+        ranks = np.argsort(np.argsort(dec[inside]))
+        labels[inside] = strip * ny + np.minimum((ranks * ny) // max(len(inside), 1), ny - 1)
+    return labels
+
+
+def jackknife_spread(values):
+    """Rescale jackknife estimates so that their spread is the jackknife uncertainty.
+
+    The standard deviation of the returned values is the jackknife standard error,
+    sqrt((n - 1) / n * sum((values - mean)**2)).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    mean = values.mean()
+    return mean + np.sqrt(len(values) - 1.) * (values - mean)
+
+
+def get_grid(compute, filename=None, key=None):
+    """Return a `LikelihoodGrid`, optionally persisted in a file.
+
+    :param compute: Function computing the grid, called when needed
+    :param str filename: If given, the grid is loaded from this file when it matches `key`,
+     and computed then saved in this file otherwise
+    :param str key: Identifier of the data and settings of the grid
+    """
+    if filename is not None and os.path.exists(filename):
+        grid = LikelihoodGrid.load(filename, key)
+        if grid is not None:
+            print("INFO: Likelihood grid loaded from", filename)
+            return grid
+    grid = compute()
+    if filename is not None:
+        grid.save(filename)
+        print("INFO: Likelihood grid saved in", filename)
+    return grid
@@ -0,0 +1,167 @@
+"""Summary statistics of mass chains, from a single sort of the samples.
+
+pymc_mymcmc_adapter.dumpMasses summarizes the mass samples of the chains (mean, standard
+deviation, quantiles, highest posterior density intervals, and the mode of the histogram
+with the shortest 68% interval around it, for the masses and their logarithm). All of them
+are computed here from the sorted samples:
+
+- the quantiles (as pymc.utils.quantiles) are indexed in the sorted array;
+- the histograms of the candidate binnings of `optimal_bins` (as
+  confidenceinterval.optimalHistogram) are counted by a search of their edges in the sorted
+  array, with the edges and the bin conventions of numpy.histogram;
+- the shortest intervals (as pymc.utils.hpd and confidenceinterval.maxDensityConfidenceRegion)
+  are the minimum of the vectorized differences of the sorted samples spaced by the number of
+  samples of the interval.
+
+The sorted log10 masses are the log10 of the sorted masses, so that a chain is sorted once.
+"""
+
+
+from __future__ import print_function
+import numpy as np
+
+
+QUANTILES = [2.5, 15.8, 25, 50, 75, 84.1, 97.5]
+
+# Candidate numbers of bins and Dirichlet prior concentrations of `optimal_bins`
+HISTOGRAM_BINS = np.array([25, 50, 100, 200, 400, 800, 1600])
+HISTOGRAM_ALPHAS = np.array([10, 1, 0.1, 0.01])
+
+
+def sorted_quantiles(sx, qlist=QUANTILES):
+    """Quantiles (in percent) of sorted samples, as pymc.utils.quantiles: the sample of
+    index int(n q / 100)."""
+    return dict((q, sx[int(len(sx) * q / 100.0)]) for q in qlist)
+
+
+def sorted_hpd(sx, alpha):
+    """Shortest interval containing a fraction 1 - alpha of sorted samples, as
+    pymc.utils.hpd (array of its two bounds)."""
+    n = len(sx)
+    ninterval = int(np.floor((1.0 - alpha) * n))
+    widths = sx[ninterval:] - sx[:n - ninterval]
+    if len(widths) == 0:
+        print('Too few elements for interval calculation')
+        return np.array([None, None])
+    start = np.argmin(widths)
+    return np.array([sx[start], sx[start + ninterval]])
+
+
+def histogram_edges(sx, nbins, range=None):
+    """Bin edges of numpy.histogram(samples, nbins, range), for sorted samples."""
+    if range is not None:
+        first, last = range
+    else:
+        first, last = sx[0], sx[-1]
+    if first == last:
+        first, last = first - 0.5, last + 0.5
+    return np.linspace(first, last, nbins + 1)
+
+
+def sorted_histogram(sx, nbins, range=None):
+    """Counts and edges of numpy.histogram(samples, nbins, range), for sorted samples.
+
+    The bins include their lower edge, and the last one its upper edge too.
+    """
+    edges = histogram_edges(sx, nbins, range)
+    index = np.searchsorted(sx, edges, side='left')
+    index[-1] = np.searchsorted(sx, edges[-1], side='right')
+    return np.diff(index), edges
+
+
+def optimal_bins(sx, bins=HISTOGRAM_BINS, alphas=HISTOGRAM_ALPHAS):
+    """Number of bins of confidenceinterval.optimalHistogram, for sorted samples.
+
+    Each binning is marginalized over the concentration of a Dirichlet prior on the bin
+    probabilities (`alphas`), and the most probable one is returned.
+    """
+    bins = np.asarray(bins)
+    alphas = np.asarray(alphas, dtype=np.float64)
+    logprobs = np.zeros((len(bins), len(alphas)))
+    for i, nbins in enumerate(bins):
+        counts, edges = sorted_histogram(sx, nbins)
+        widths = (edges[1:] - edges[:-1])[counts > 0]
+        counts = counts[counts > 0]
+        total = np.sum(counts) + nbins * alphas[:, None] - 1
+        logprobs[i] = np.sum(counts * (np.log(counts + alphas[:, None] - 1) -
+                                       np.log(widths * total)), axis=1)
+    probs = np.exp(logprobs - np.max(logprobs))
+    binprobs = np.sum(probs, axis=1) / np.sum(probs)
+    return bins[np.argmax(binprobs)]
+
+
+def max_density_region(sx, interval=.68, bins=None, range=None):
+    """Mode of the histogram of sorted samples, and the shortest interval containing a
+    fraction `interval` of the samples and the mode, as
+    confidenceinterval.maxDensityConfidenceRegion.
+
+    :return: the mode, and the array of the distances from the mode to the lower and upper
+     bounds of the interval
+    """
+    if bins is None:
+        bins = optimal_bins(sx)
+        print('Using %d bins' % bins)
+
+    counts, edges = sorted_histogram(sx, bins, range)
+    center = (edges[0:-1] + edges[1:]) / 2.
+    maxl = float(np.mean(center[counts == np.max(counts)]))
+
+    n = len(sx)
+    ninterval = int(n * interval)
+    if ninterval >= n:
+        print('Too few elements for interval calculation')
+        raise IndexError
+    lows, highs = sx[:n - ninterval], sx[ninterval:]
+    widths = np.where((lows <= maxl) & (maxl <= highs), highs - lows, np.inf)
+    start = np.argmin(widths)
+    if widths[start] == np.inf:
+        # no interval contains the mode
+        raise TypeError("No interval of %d samples contains the mode %e" % (ninterval, maxl))
+
+    return maxl, np.array([maxl - lows[start], highs[start] - maxl])
+
+
+def summarize(masses):
+    """Summary statistics of dumpMasses, from a single sort of the masses.
+
+    :return: dictionary with the mean, the standard deviation (`stddev`), the `quantiles` (see
+     `sorted_quantiles`), the 68% and 95% highest posterior density intervals (`hpd68`,
+     `hpd95`), and the modes with their 68% intervals of the masses (`maxlike`) and of their
+     log10 (`log10maxlike`), as (mode, (distance to the lower bound, distance to the upper
+     bound))
+    """
+    masses = np.asarray(masses)
+    sx = np.sort(masses, axis=None)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        logsx = np.log10(sx)
+    if np.isnan(logsx[0]):
+        # negative masses: their nan logarithms go last, as numpy sorts them
+        logsx = np.sort(logsx)
+
+    ml, (m, p) = max_density_region(sx)
+    lml, (lm, lp) = max_density_region(logsx)
+    return {'mean': np.mean(masses),
+            'stddev': np.std(masses),
+            'quantiles': sorted_quantiles(sx),
+            'hpd68': sorted_hpd(sx, 0.32),
+            'hpd95': sorted_hpd(sx, 0.05),
+            'maxlike': (ml, (m, p)),
+            'log10maxlike': (lml, (lm, lp))}
+
+
+def summary_lines(stats):
+    """Lines of the text summary (*.mass.summary.txt) of the statistics of `summarize`."""
+    quantiles = stats['quantiles']
+    ml, (m, p) = stats['maxlike']
+    lml, (lm, lp) = stats['log10maxlike']
+    return ['mean\t%e' % stats['mean'],
+            'stddev\t%e' % stats['stddev'],
+            'Q2.5\t%e' % quantiles[2.5],
+            'Q25\t%e' % quantiles[25],
+            'Q50\t%e' % quantiles[50],
+            'Q75\t%e' % quantiles[75],
+            'Q97.5\t%e' % quantiles[97.5],
+            'HPD68\t%e\t%e' % tuple(stats['hpd68']),
+            'HPD95\t%e\t%e' % tuple(stats['hpd95']),
+            'MaxLike\t%e\t%e\t%e' % (ml, m, p),
+            'Log10 Maxlike\t%e\t%e\t%e' % (lml, lm, lp)]
@@ -6,7 +6,12 @@ Correction is flat at large sizes, and linear at small sizes.
 import numpy as np
 import pymc
 from . import maxlike_masses as mm
+from . import pdzfile_utils
 from . import nfwmodeltools as nfwtools
+from . import likelihood_grid
+from . import likelihood_gradient
+from . import flat_posterior
+from . import voigt_table
 from .nfwutils import global_cosmology as gc
 
 
@@ -19,12 +24,17 @@ class BentVoigtShapedistro(mm.LensingModel):
         parser.add_option('--steppsf', dest='steppsf',
                           help='Which STEP PSF to use, A,C,D,interp?',
                           default='interp')
+        parser.add_option('--voigttol', dest='voigttol', type='float',
+                          help='Relative error of the tabulated Voigt profile (0: exact)',
+                          default=voigt_table.TOLERANCE)
 
-    def createOptions(self, steppsf='interp', *args, **keywords):
+    def createOptions(self, steppsf='interp', voigttol=voigt_table.TOLERANCE,
+                      *args, **keywords):
 
         options, args = super(BentVoigtShapedistro,
                               self).createOptions(*args, **keywords)
         options.steppsf = steppsf
+        options.voigttol = voigttol
         return options, args
 
     def psfDependence(self, steppsf, psfSize):
@@ -99,23 +109,86 @@ class BentVoigtShapedistro(mm.LensingModel):
         parts.sigma = pymc.Uniform('sigma', 0.15, 0.5)  # sigma
         parts.gamma = pymc.Uniform('gamma', 0.003, 0.1)  # gamma
 
+    def gridShapeLike(self, parts):
+
+        sigma = likelihood_grid.node_value(parts.sigma)
+        gamma = likelihood_grid.node_value(parts.gamma)
+        if getattr(parts, 'voigt_table', None) is None:
+            return likelihood_grid.voigt_shape(sigma, gamma)
+        return parts.voigt_table.shape(sigma, gamma)
+
     def sampler_callback(self, mcmc):
 
         mcmc.use_step_method(pymc.AdaptiveMetropolis,
                              [mcmc.sigma, mcmc.gamma],
                              shrink_if_necessary=True)
 
-    def makeLikelihood(self, datamanager, parts):
+    def makeFlatShapePrior(self, data, flat):
+
+        inputcat = data.inputcat
+
+        if data.wtg_shearcal:  # use WTG STEP2 shear calibration
+            m_slope, m_b, m_cov, c = self.psfDependence(data.options.steppsf, data.psfsize)
+            m_prior = flat.add_block('step_m_prior', [m_b, m_slope],
+                                     flat_posterior.mvnormal_logp([m_b, m_slope], m_cov))
+            c_prior = flat.add_parameter('step_c_prior', c,
+                                         flat_posterior.normal_logp(c, 0.0004))
+
+            # m = m_b above a size of 2, m_b + m_slope * (size - 2) below
+            size = np.asarray(inputcat['size'], dtype=np.float64)
+            lever = np.ascontiguousarray(np.where(size < 2.0, size - 2.0, 0.))
+            ones = np.ones(len(size))
+
+            def shearcal(theta):
+                m_b, m_slope = theta[m_prior]
+                return m_b + m_slope * lever, theta[c_prior] * ones
+
+            def shearcal_grad(theta, dm, dc):
+                grad = np.zeros(len(theta))
+                grad[m_prior] = np.sum(dm), np.dot(dm, lever)
+                grad[c_prior] = np.sum(dc)
+                return grad
+
+        else:  # No shear calibration
+            zeros = np.zeros(len(inputcat))
+
+            def shearcal(theta):
+                return zeros, zeros
+
+            def shearcal_grad(theta, dm, dc):
+                return np.zeros(len(theta))
+
+        isigma = flat.add_parameter('sigma', 0.325, flat_posterior.uniform_logp(0.15, 0.5))
+        igamma = flat.add_parameter('gamma', 0.0515, flat_posterior.uniform_logp(0.003, 0.1))
+
+        def shape(theta):
+            m, c = shearcal(theta)
+            return m, c, (theta[isigma], theta[igamma])
+
+        def shape_grad(theta, dshape, dm, dc):
+            grad = shearcal_grad(theta, dm, dc)
+            grad[isigma], grad[igamma] = dshape
+            return grad
+        shape.grad = shape_grad
+        return shape
+
+    def shapeLikeGrad(self):
+
+        return likelihood_gradient.voigt_shape_grad
+
+    def makeLikelihoodData(self, datamanager, parts):
 
         inputcat = datamanager.inputcat
 
         pz = datamanager.pz
 
-        parts.r_mpc = np.ascontiguousarray(
-            inputcat['r_mpc'].astype(np.float64))
-        parts.ghats = np.ascontiguousarray(
-            inputcat['ghats'].astype(np.float64))
-        parts.pz = np.ascontiguousarray(pz.astype(np.float64))
+        parts.r_mpc = np.ascontiguousarray(inputcat['r_mpc'], dtype=np.float64)
+        parts.ghats = np.ascontiguousarray(inputcat['ghats'], dtype=np.float64)
+        if isinstance(pz, pdzfile_utils.DeltaPDZ):
+            # true redshifts: kept sparse for the tabulated likelihood (see below)
+            parts.pz = pz
+        else:
+            parts.pz = np.ascontiguousarray(pz, dtype=np.float64)
         parts.zs = np.ascontiguousarray(
             np.array(datamanager.pdzrange).astype(np.float64))
         parts.betas = np.ascontiguousarray(
@@ -124,6 +197,21 @@ class BentVoigtShapedistro(mm.LensingModel):
         parts.rho_c = gc.rho_crit(parts.zcluster)
         parts.rho_c_over_sigma_c = 1.5 * gc.angulardist(parts.zcluster) * gc.beta(
             [1e6], parts.zcluster)[0] * gc.hubble2(parts.zcluster) / gc.v_c**2
+
+        # Voigt profile interpolated in a table for the current (sigma, gamma)
+        voigttol = getattr(datamanager.options, 'voigttol', voigt_table.TOLERANCE)
+        if not voigttol:
+            parts.voigt_table = None
+            if isinstance(parts.pz, pdzfile_utils.DeltaPDZ):
+                # the exact likelihood integrates dense pdzs
+                parts.pz = parts.pz.dense()
+            return nfwtools.bentvoigt_like
+        parts.voigt_table = voigt_table.VoigtTable(voigttol)
+        return voigt_table.tabulated_bentvoigt_like(parts.voigt_table)
+
+    def makeLikelihood(self, datamanager, parts):
+
+        likelihood = self.makeLikelihoodData(datamanager, parts)
         parts.data = None
         for i in range(10):
             try:
@@ -143,9 +231,9 @@ class BentVoigtShapedistro(mm.LensingModel):
                          rho_c_over_sigma_c=parts.rho_c_over_sigma_c,
                          massdelta=parts.massdelta):
 
-                    return nfwtools.bentvoigt_like(mdelta, cdelta, r_mpc, value, zs, betas,
-                                                   pz, shearcal_m, shearcal_c, sigma, gamma,
-                                                   rho_c, rho_c_over_sigma_c, massdelta)
+                    return likelihood(mdelta, cdelta, r_mpc, value, zs, betas, pz,
+                                      shearcal_m, shearcal_c, sigma, gamma,
+                                      rho_c, rho_c_over_sigma_c, massdelta)
 
                 parts.data = data
                 break
@@ -230,3 +318,32 @@ class BentVoigt3Shapedistro(BentVoigtShapedistro):
         parts.shearcal_c = shearcal_c
         parts.sigma = pymc.Uniform('sigma', 0.15, 0.5)  # sigma
         parts.gamma = pymc.Uniform('gamma', 0.003, 0.1)  # gamma
+
+    def makeFlatShapePrior(self, data, flat):
+
+        inputcat = data.inputcat
+        pivot, m_slope, m_b, m_cov, c = bentvoigt3PsfDependence(
+            data.options.steppsf, data.psfsize)
+        m_prior = flat.add_block('step_m_prior', [pivot, m_b, m_slope],
+                                 flat_posterior.mvnormal_logp([pivot, m_b, m_slope], m_cov))
+        c_prior = flat.add_parameter('step_c_prior', c, flat_posterior.normal_logp(c, 0.0004))
+        size = np.asarray(inputcat['size'], dtype=np.float64)
+        ones = np.ones(len(size))
+        isigma = flat.add_parameter('sigma', 0.325, flat_posterior.uniform_logp(0.15, 0.5))
+        igamma = flat.add_parameter('gamma', 0.0515, flat_posterior.uniform_logp(0.003, 0.1))
+
+        def shape(theta):
+            pivot, m_b, m_slope = theta[m_prior]
+            m = m_b + m_slope * np.minimum(size - pivot, 0.)
+            return m, theta[c_prior] * ones, (theta[isigma], theta[igamma])
+
+        def shape_grad(theta, dshape, dm, dc):
+            pivot, m_b, m_slope = theta[m_prior]
+            lever = np.minimum(size - pivot, 0.)
+            grad = np.zeros(len(theta))
+            grad[m_prior] = -m_slope * np.sum(dm[size < pivot]), np.sum(dm), np.dot(dm, lever)
+            grad[c_prior] = np.sum(dc)
+            grad[isigma], grad[igamma] = dshape
+            return grad
+        shape.grad = shape_grad
+        return shape
@@ -98,7 +98,12 @@ Configured With:
 
         return options, args
 
-    def load(self, options=None, args=None):
+    def load(self, options=None, args=None, modelcuts=True):
+        """Read the data, apply the cuts and build the model.
+
+        With `modelcuts=False`, the cuts of the model builder are not applied (e.g. to
+        apply them later on a likelihood grid), only those of the file handler.
+        """
 
         if options is not None:
             self.replace('options', options)
@@ -113,13 +118,17 @@ Configured With:
 
         self.filehandler.readData(self)
 
+        toUpdate = {'inputcat': 'filter', 'pz': '__getitem__'}
+        if 'pz_cdf' in self:
+            toUpdate['pz_cdf'] = '__getitem__'
+
         if hasattr(self.filehandler, 'cuts'):
             for cut in self.filehandler.cuts:
-                self.update(cut, {'inputcat': 'filter', 'pz': '__getitem__'})
+                self.update(cut, toUpdate)
 
-        if hasattr(self.modelbuilder, 'cuts'):
+        if modelcuts and hasattr(self.modelbuilder, 'cuts'):
             for cut in self.modelbuilder.cuts:
-                self.update(cut, {'inputcat': 'filter', 'pz': '__getitem__'})
+                self.update(cut, toUpdate)
 
         self.model = self.modelbuilder.createModel(self)
 
@@ -12,6 +12,12 @@ import astropy.io.fits as pyfits
 from . import ldac
 from . import nfwutils
 from . import util
+from . import pdzfile_utils
+from . import likelihood_grid
+from . import likelihood_gradient
+from . import flat_posterior
+from . import laplace
+from . import reweight
 from . import nfwmodeltools as tools
 from . import pymc_mymcmc_adapter as pma
 
@@ -42,6 +48,18 @@ class ModelInitException(Exception):
 massscale = 1e14
 
 
+def delta_gauss_like(mdelta, cdelta, r_mpc, ghats, zs, betas, pz, m, c, sigma,
+                     rho_c, rho_c_over_sigma_c, massdelta):
+    """Log-likelihood of nfwmodeltools.gauss_like, for delta pdzs (see pdzfile_utils.DeltaPDZ).
+
+    Each galaxy has a single beta, so that the integral over the pdz reduces to the value
+    of the integrand in the bin of the galaxy times the integral of its pdz.
+    """
+    return np.sum(likelihood_grid.galaxy_loglike(mdelta, cdelta, r_mpc, ghats, zs, betas, pz,
+                                                 m, c, likelihood_grid.gauss_shape(sigma),
+                                                 rho_c, rho_c_over_sigma_c, massdelta))
+
+
 class LensingModel(object):
 
     def __init__(self):
@@ -83,6 +101,9 @@ class LensingModel(object):
         parser.add_option('--logprior', dest='logprior',
                           help='Turn on log10 mass prior',
                           default=False, action='store_true')
+        parser.add_option('--concwidth', dest='concwidth',
+                          help='Width of the log10 concentration prior',
+                          default=0.116, type='float')
         
     #######################################################
 
@@ -90,7 +111,7 @@ class LensingModel(object):
                       zcut=0.1, masslow=1e13, masshigh=1e16,
                       ztypecut=False, radlow=0.75, radhigh=3.0,  # radlow=0.75 default
                       concentration=None, delta=200.,
-                      options=None, args=None, logprior=False):
+                      options=None, args=None, logprior=False, concwidth=0.116):
 
         if options is None:
             options = util.VarContainer()
@@ -107,56 +128,62 @@ class LensingModel(object):
         options.concentration = concentration
         options.delta = delta
         options.logprior = logprior
+        options.concwidth = concwidth
         
         return options, None
 
     #######################################################
 
-    def modelCut(self, manager, minMPC=0.5, maxMPC=3.):
-
-        options = manager.options
+    def selectionColumns(self, manager):
+        """Per-galaxy quantities entering the cuts of `selection` (and positions, if known)."""
         inputcat = manager.inputcat
 
-        
+        # width of the pdzs, from their cumulative distributions
+        if 'pz_cdf' in manager:
+            cdf = manager.pz_cdf
+        else:
+            cdf = pdzfile_utils.cumulative_pdz(manager.pz, manager.pdzrange)
+
+        columns = {'r_mpc': np.asarray(inputcat['r_mpc']),
+                   'z_b': np.asarray(inputcat['z_b']),
+                   'ghats': np.asarray(inputcat['ghats']),
+                   'deltaz95': pdzfile_utils.deltaz95(cdf, manager.pdzrange)}
+        for name in ['z_t', 'ra', 'dec']:
+            if name in inputcat:
+                columns[name] = np.asarray(inputcat[name])
+        return columns
+
+    def selection(self, columns, options, zcluster):
+        """Galaxies kept for the fit, from the quantities given by `selectionColumns`."""
+
 #        if 'r500' in manager:
  #           manager.comment('Using r500')
         minMPC = options.radlow  # *manager.r500
         maxMPC = options.radhigh  # *manager.r500
 
         goodObjs = np.logical_and(
-            np.logical_and(np.logical_and(manager.inputcat['r_mpc'] > minMPC,
-                                          manager.inputcat['r_mpc'] < maxMPC),
-                           np.logical_and(manager.inputcat['z_b'] > 0,
-                                          manager.inputcat['z_b'] < options.zbhigh)),
-            np.abs(manager.inputcat['ghats']) < 5)
-
-# Definition of pdz is changing, need to change this.
-#        pdz = manager.pz # used to be manager.pdz (name change in astropytable_filehandler)
-#        pdzrange = manager.pdzrange
-#        delta95Z = np.zeros(len(pdz))
-#
-#        for i in range(len(delta95Z)):
-#
-#            cumpdz = pdz[i].cumsum() / pdz[i].cumsum()[-1]
-#
-#            delta95Z[i] = pdzrange[cumpdz >= 0.95][0] - pdzrange[cumpdz >= 0.05][0]
-#
-#        deltaZcut = np.logical_and(options.deltaz95low <= delta95Z,
-#                                   delta95Z < options.deltaz95high)
-##
-####
+            np.logical_and(np.logical_and(columns['r_mpc'] > minMPC,
+                                          columns['r_mpc'] < maxMPC),
+                           np.logical_and(columns['z_b'] > 0,
+                                          columns['z_b'] < options.zbhigh)),
+            np.abs(columns['ghats']) < 5)
+
+        delta95Z = columns['deltaz95']
+        deltaZcut = np.logical_and(options.deltaz95low <= delta95Z,
+                                   delta95Z < options.deltaz95high)
+
         if options.zcut is None:
 
-            zcut = np.ones(len(manager.inputcat)) == 1
+            zcut = np.ones(len(columns['z_b'])) == 1
 
         else:
 
-            zcut = manager.inputcat['z_b'] > (manager.zcluster + options.zcut)
+            zcut = columns['z_b'] > (zcluster + options.zcut)
 
-        ztypecut = np.ones(len(inputcat)) == 1
+        ztypecut = np.ones(len(columns['z_b'])) == 1
         if options.ztypecut:
-            zt = inputcat['z_t']
-            zb = inputcat['z_b']
+            zt = columns['z_t']
+            zb = columns['z_b']
 
             type1 = np.logical_and(zt >= 1, zt < 2)
             ztypecut[type1] = np.logical_and(type1, zb < 1.15)
@@ -176,11 +203,14 @@ class LensingModel(object):
             type5 = np.logical_and(zt >= 5, zt < 6)
             ztypecut[type5] = False
 
-        # basic_cuts = reduce(np.logical_and, [goodObjs, deltaZcut, zcut, ztypecut])
-        basic_cuts = reduce(np.logical_and, [goodObjs, zcut, ztypecut])
+        basic_cuts = reduce(np.logical_and, [goodObjs, deltaZcut, zcut, ztypecut])
 
         return basic_cuts
 
+    def modelCut(self, manager):
+
+        return self.selection(self.selectionColumns(manager), manager.options, manager.zcluster)
+
     ########################################################################################
 
     def makeModelPrior(self, manager, parts):
@@ -188,7 +218,8 @@ class LensingModel(object):
         options = manager.options
 
         if options.concentration is None:
-            parts.log10concentration = pymc.TruncatedNormal('log10concentration', 0.6, 1. / 0.116**2,
+            parts.log10concentration = pymc.TruncatedNormal('log10concentration', 0.6,
+                                                            1. / options.concwidth**2,
                                                             np.log10(1.), np.log10(10.))  # tau!
 
             @pymc.deterministic
@@ -237,17 +268,22 @@ class LensingModel(object):
     # Likelihood
     ###########
 
-    def makeLikelihood(self, datamanager, parts):
+    def makeLikelihoodData(self, datamanager, parts):
+        """Store the constant arrays of the likelihood in `parts`; return the likelihood."""
 
         inputcat = datamanager.inputcat
 
         pz = datamanager.pz
 
-        parts.r_mpc = np.ascontiguousarray(
-            inputcat['r_mpc'].astype(np.float64))
-        parts.ghats = np.ascontiguousarray(
-            inputcat['ghats'].astype(np.float64))
-        parts.pz = np.ascontiguousarray(pz.astype(np.float64))
+        parts.r_mpc = np.ascontiguousarray(inputcat['r_mpc'], dtype=np.float64)
+        parts.ghats = np.ascontiguousarray(inputcat['ghats'], dtype=np.float64)
+        if isinstance(pz, pdzfile_utils.DeltaPDZ):
+            # true redshifts: one beta per galaxy, no integral over the pdz
+            parts.pz = pz
+            likelihood = delta_gauss_like
+        else:
+            parts.pz = np.ascontiguousarray(pz, dtype=np.float64)
+            likelihood = tools.gauss_like
 
         parts.zs = np.ascontiguousarray(
             np.array(datamanager.pdzrange).astype(np.float64))
@@ -262,6 +298,12 @@ class LensingModel(object):
             nfwutils.global_cosmology.hubble2(parts.zcluster) / \
             nfwutils.global_cosmology.v_c**2
 
+        return likelihood
+
+    def makeLikelihood(self, datamanager, parts):
+
+        likelihood = self.makeLikelihoodData(datamanager, parts)
+
         parts.data = None
         for i in range(20):
             try:
@@ -280,19 +322,19 @@ class LensingModel(object):
                          rho_c_over_sigma_c=parts.rho_c_over_sigma_c,
                          massdelta=parts.massdelta):
 
-                    return tools.gauss_like(mdelta,
-                                            cdelta,
-                                            r_mpc,
-                                            value,
-                                            zs,
-                                            betas,
-                                            pz,
-                                            shearcal_m,
-                                            shearcal_c,
-                                            sigma,
-                                            rho_c,
-                                            rho_c_over_sigma_c,
-                                            massdelta)
+                    return likelihood(mdelta,
+                                      cdelta,
+                                      r_mpc,
+                                      value,
+                                      zs,
+                                      betas,
+                                      pz,
+                                      shearcal_m,
+                                      shearcal_c,
+                                      sigma,
+                                      rho_c,
+                                      rho_c_over_sigma_c,
+                                      massdelta)
 
                 parts.data = data
                 break
@@ -329,6 +371,190 @@ class LensingModel(object):
         parts = self.makeModelParts(datamanager)
         return pymc.Model(parts)
 
+    #############
+    # Flat posterior
+    ################
+
+    def makeFlatModelPrior(self, manager, flat):
+        """Mass and concentration priors of `makeModelPrior`, added to a FlatPosterior.
+
+        Sets `flat.mdelta` and `flat.cdelta`, functions of the parameter array, and
+        `flat.model_grad`, the gradient with respect to the parameter array of a function of
+        (mdelta, cdelta) given its two derivatives.
+        """
+        options = manager.options
+
+        if options.concentration is None:
+            ic = flat.add_parameter('log10concentration', 0.6,
+                                    flat_posterior.truncated_normal_logp(
+                                        0.6, options.concwidth, np.log10(1.), np.log10(10.)))
+            flat.cdelta = lambda theta: 10**theta[ic]
+            flat.add_derived('cdelta', flat.cdelta)
+        else:
+            ic = None
+            flat.cdelta = lambda theta: options.concentration
+
+        manager.massdelta = options.delta
+        flat.massdelta = options.delta
+
+        if options.logprior:
+            low, high = np.log10(options.masslow), np.log10(options.masshigh)
+            im = flat.add_parameter('log10mdelta', 0.5 * (low + high),
+                                    flat_posterior.uniform_logp(low, high))
+            flat.mdelta = lambda theta: 10**theta[im]
+            dmdelta = lambda theta: np.log(10.) * 10**theta[im]
+        else:
+            low, high = options.masslow / massscale, options.masshigh / massscale
+            im = flat.add_parameter('scaledmdelta', 0.5 * (low + high),
+                                    flat_posterior.uniform_logp(low, high))
+            flat.mdelta = lambda theta: massscale * theta[im]
+            dmdelta = lambda theta: massscale
+        flat.add_derived('mdelta', flat.mdelta)
+
+        def model_grad(theta, dlogl_dmdelta, dlogl_dcdelta):
+            grad = np.zeros(len(theta))
+            grad[im] = dlogl_dmdelta * dmdelta(theta)
+            if ic is not None:
+                grad[ic] = dlogl_dcdelta * np.log(10.) * 10**theta[ic]
+            return grad
+        flat.model_grad = model_grad
+
+    def makeFlatShapePrior(self, datamanager, flat):
+        """Shape priors of `makeShapePrior`, added to a FlatPosterior.
+
+        :return: function of the parameter array giving the shear calibration arrays m and
+         c, and the tuple of the parameters of the shape distribution. Its `grad` attribute
+         gives the gradient with respect to the parameter array from the derivatives with
+         respect to the shape parameters, m and c.
+        """
+        zeros = np.zeros(len(datamanager.inputcat))
+
+        def shape(theta):
+            return zeros, zeros, (0.005,)
+        shape.grad = lambda theta, dshape, dm, dc: np.zeros(len(theta))
+        return shape
+
+    def makeFlatPosterior(self, datamanager):
+        """The model of `createModel`, as a flat_posterior.FlatPosterior (no pymc nodes)."""
+        datamanager.ngalaxies = len(datamanager.inputcat)
+        flat = flat_posterior.FlatPosterior()
+        self.makeFlatModelPrior(datamanager, flat)
+        shape = self.makeFlatShapePrior(datamanager, flat)
+
+        data = util.VarContainer(zcluster=datamanager.zcluster)
+        likelihood = self.makeLikelihoodData(datamanager, data)
+        r_mpc, ghats, zs, betas, pz = data.r_mpc, data.ghats, data.zs, data.betas, data.pz
+        rho_c, rho_c_over_sigma_c = data.rho_c, data.rho_c_over_sigma_c
+        mdelta, cdelta, massdelta = flat.mdelta, flat.cdelta, flat.massdelta
+
+        def log_like(theta):
+            m, c, shapeparams = shape(theta)
+            return likelihood(mdelta(theta), cdelta(theta), r_mpc, ghats, zs, betas, pz, m, c,
+                              *(shapeparams + (rho_c, rho_c_over_sigma_c, massdelta)))
+
+        flat.log_like = log_like
+
+        shape_grad = self.shapeLikeGrad()
+        if shape_grad is not None and hasattr(shape, 'grad'):
+
+            def log_like_grad(theta):
+                m, c, shapeparams = shape(theta)
+                logl, grad, dm, dc = likelihood_gradient.loglike_grad(
+                    mdelta(theta), cdelta(theta), r_mpc, ghats, zs, betas, pz, m, c,
+                    shape_grad(*shapeparams), rho_c, rho_c_over_sigma_c, massdelta)
+                return logl, (flat.model_grad(theta, grad[0], grad[1]) +
+                              shape.grad(theta, grad[2:], dm, dc))
+
+            flat.log_like_grad = log_like_grad
+
+        return flat
+
+    def shapeLikeGrad(self):
+        """Shape distribution with its derivatives, as used by `makeLikelihoodData` (see
+        likelihood_gradient.gauss_shape_grad), for the gradient of the flat posterior."""
+        return likelihood_gradient.gauss_shape_grad
+
+    #############
+    # Likelihood grid
+    #################
+
+    def gridShapeLike(self, parts):
+        """Shape distribution used to tabulate the likelihood (see `likelihoodGrid`)."""
+        return likelihood_grid.gauss_shape(likelihood_grid.node_value(parts.sigma))
+
+    def likelihoodGrid(self, manager, masses, concentrations=None, key=''):
+        """Tabulate the log-likelihood of each galaxy on a mass (and concentration) grid.
+
+        The nuisance parameters of the model (shape distribution, shear calibration) are
+        fixed at the center of their prior. Without a concentration grid, the concentration
+        is the one of the options (or the center of its prior).
+
+        :return: a likelihood_grid.LikelihoodGrid, with the `selectionColumns` of the galaxies
+        """
+        model = manager.model
+        likelihood_grid.center_stochastics(model.stochastics,
+                                           exclude=['scaledmdelta', 'log10mdelta'])
+        shape_like = self.gridShapeLike(model)
+        shearcal_m = np.asarray(likelihood_grid.node_value(model.shearcal_m), dtype=np.float64)
+        shearcal_c = np.asarray(likelihood_grid.node_value(model.shearcal_c), dtype=np.float64)
+        cgrid = [likelihood_grid.node_value(model.cdelta)] if concentrations is None \
+            else concentrations
+
+        loglike = np.array([[likelihood_grid.galaxy_loglike(mdelta, cdelta, model.r_mpc,
+                                                            model.ghats, model.zs, model.betas,
+                                                            model.pz, shearcal_m, shearcal_c,
+                                                            shape_like, model.rho_c,
+                                                            model.rho_c_over_sigma_c,
+                                                            model.massdelta)
+                             for cdelta in cgrid] for mdelta in masses])
+        if concentrations is None:
+            loglike = loglike[:, 0]
+
+        return likelihood_grid.LikelihoodGrid(masses, loglike,
+                                              columns=self.selectionColumns(manager),
+                                              concentrations=concentrations, key=key)
+
+    def gridLogPriors(self, options, masses, concentrations=None):
+        """Log-priors on the mass and concentration grids, as in `makeModelPrior`.
+
+        :return: log-prior on the masses, and on log10 of the concentrations (None without
+         concentration grid)
+        """
+        with np.errstate(divide='ignore'):
+            mass_logprior = np.log((masses >= options.masslow) & (masses <= options.masshigh))
+        if options.logprior:
+            mass_logprior = mass_logprior - np.log(masses)
+
+        if concentrations is None:
+            return mass_logprior, None
+        log10c = np.log10(concentrations)
+        with np.errstate(divide='ignore'):
+            conc_logprior = -0.5 * ((log10c - 0.6) / options.concwidth)**2 + \
+                np.log((log10c >= np.log10(1.)) & (log10c <= np.log10(10.)))
+        return mass_logprior, conc_logprior
+
+
+def scan_starting_point(flat, npoints=50):
+    """Set the mass of a FlatPosterior to the best mass of a coarse scan (log spaced between
+    the bounds of the mass prior), the other parameters at their initial values.
+
+    Used as starting point of the maximization (MAPModelToFile) and of the NUTS chains
+    (SampleModelToFile), which need a finite posterior.
+    """
+    name = 'log10mdelta' if 'log10mdelta' in flat.names else 'scaledmdelta'
+    index = flat.index(name)
+    lower, upper = flat.bounds()
+    grid = np.linspace(lower[index], upper[index], npoints + 2)[1:-1]
+    if name == 'scaledmdelta':
+        grid = np.logspace(np.log10(lower[index]), np.log10(upper[index]), npoints + 2)[1:-1]
+    logps = []
+    for value in grid:
+        flat.theta[index] = value
+        logps.append(flat.log_post(flat.theta))
+    if not np.isfinite(np.max(logps)):
+        raise ModelInitException("No mass of finite posterior probability")
+    flat.theta[index] = grid[np.argmax(logps)]
+
 
 #########################################################################
 #########################################################################
@@ -368,6 +594,14 @@ class ScanModelToFile(object):
             except pymc.ZeroProbability:
                 scan[i] = pymc.PyMCObjects.d_neg_inf
 
+        self.saveScan(manager, mass, scan)
+
+#        self.calcMasses(manager)
+
+    ##########
+
+    def saveScan(self, manager, mass, scan):
+
         cols = [pyfits.Column(name='Mass', format='E', array=mass),
                 pyfits.Column(name='prob', format='E', array=scan)]
         manager.cat = ldac.LDACCat(
@@ -377,8 +611,6 @@ class ScanModelToFile(object):
         manager.cat.saveas('{}.m{}.scan.fits'.format(manager.options.outputFile,
                                                      int(manager.model.massdelta)))
 
-#        self.calcMasses(manager)
-
     ##########
 
     def calcMasses(self, manager):
@@ -424,6 +656,135 @@ class ScanModelToFile(object):
 ################################################
 
 
+class GridModelToFile(ScanModelToFile):
+    """Scan the mass posterior through a per-galaxy likelihood grid (see likelihood_grid).
+
+    The grid is computed once for all the loaded galaxies, and saved in `gridFile`. The cuts
+    of the options (radius, photoz, ...) are then applied as a mask on the saved grid, so
+    that changing them only costs a sum. The data should thus be loaded without the model
+    cuts (`Controller.load(..., modelcuts=False)`).
+    """
+
+    def createOptions(self,
+                      outputFile,
+                      gridFile=None,
+                      gridmasses=None,
+                      gridconcentrations=None,
+                      options=None, args=None):
+
+        options, args = super(GridModelToFile, self).createOptions(outputFile, options=options,
+                                                                   args=args)
+        options.gridFile = gridFile
+        options.gridmasses = None if gridmasses is None \
+            else np.asarray(gridmasses, dtype=np.float64)
+        options.gridconcentrations = np.logspace(0, 1, 21) if gridconcentrations is None \
+            else np.asarray(gridconcentrations, dtype=np.float64)
+        return options, args
+
+    ##########
+
+    def run(self, manager):
+
+        options = manager.options
+        builder = manager.modelbuilder
+        masses = options.gridmasses
+        if masses is None:  # 2000 masses over the range of the mass prior
+            masses = np.linspace(options.masslow, options.masshigh, 2000)
+        concentrations = None if options.concentration is not None \
+            else options.gridconcentrations
+
+        # the grid depends on the pdzs and on the shear calibration and shape settings
+        columns = builder.selectionColumns(manager)
+        pz = [manager.pz.bins, manager.pz.weights] \
+            if isinstance(manager.pz, pdzfile_utils.DeltaPDZ) else [manager.pz]
+        key = builder.__class__.__name__ + ':' + likelihood_grid.columns_key(
+            columns, masses, [] if concentrations is None else concentrations,
+            [options.delta, manager.zcluster], manager.pdzrange, *pz,
+            wtg_shearcal=getattr(options, 'wtg_shearcal', False),
+            psfsize=getattr(options, 'psfsize', None),
+            steppsf=getattr(options, 'steppsf', None),
+            voigttol=getattr(options, 'voigttol', None))
+        manager.grid = likelihood_grid.get_grid(
+            lambda: builder.likelihoodGrid(manager, masses, concentrations, key=key),
+            options.gridFile, key)
+
+        mask = builder.selection(manager.grid.columns, options, manager.zcluster)
+        manager.comment('Likelihood grid: %d galaxies kept out of %d' %
+                        (np.sum(mask), len(manager.grid)))
+        mass_logprior, conc_logprior = builder.gridLogPriors(options, manager.grid.masses,
+                                                             manager.grid.concentrations)
+        scan = manager.grid.mass_logpost(mask, mass_logprior, conc_logprior)
+        self.saveScan(manager, manager.grid.masses, scan)
+
+        manager.gridmask = mask
+        manager.gridpriors = (mass_logprior, conc_logprior)
+
+################################################
+
+
+class ResampleGridToFile(GridModelToFile):
+    """Bootstrap or jackknife mass uncertainties from a per-galaxy likelihood grid.
+
+    The posterior of each resample is a weighted sum of the rows of the grid (see
+    `GridModelToFile`), and its median mass is kept. The resampled masses are summarized
+    as MCMC samples would be (see pymc_mymcmc_adapter.dumpMasses). For the jackknife, they
+    are rescaled (likelihood_grid.jackknife_spread) so that their spread is the jackknife
+    uncertainty.
+    """
+
+    def createOptions(self,
+                      outputFile,
+                      resampling='bootstrap',
+                      nresamples=500,
+                      npatches=None,
+                      seed=None,
+                      options=None, args=None, **keywords):
+
+        if resampling not in ['bootstrap', 'jackknife']:
+            raise ValueError("Unknown resampling %s (bootstrap or jackknife)" % resampling)
+        options, args = super(ResampleGridToFile, self).createOptions(outputFile,
+                                                                      options=options,
+                                                                      args=args, **keywords)
+        options.resampling = resampling
+        options.nresamples = nresamples
+        options.npatches = npatches
+        options.seed = seed
+        return options, args
+
+    ##########
+
+    def run(self, manager):
+
+        super(ResampleGridToFile, self).run(manager)
+
+        options = manager.options
+        grid, mask = manager.grid, manager.gridmask
+        mass_logprior, conc_logprior = manager.gridpriors
+
+        if options.resampling == 'bootstrap':
+            weights = likelihood_grid.bootstrap_weights(mask, options.nresamples,
+                                                        seed=options.seed)
+            manager.masses = grid.bootstrap(weights, mass_logprior, conc_logprior)
+        else:
+            labels = None
+            if options.npatches is not None:
+                labels = likelihood_grid.patch_labels(grid.columns['ra'],
+                                                      grid.columns['dec'], options.npatches)
+            manager.masses = likelihood_grid.jackknife_spread(
+                grid.jackknife(mask, labels, mass_logprior, conc_logprior))
+        manager.comment('%s: %d resamples' % (options.resampling, len(manager.masses)))
+
+    ##########
+
+    def dump(self, manager):
+
+        pma.dumpMasses(manager.masses, '%s.m%d.%s' % (manager.options.outputFile,
+                                                      manager.options.delta,
+                                                      manager.options.resampling))
+
+################################################
+
+
 class SampleModelToFile(object):
 
     def run(self, manager):
@@ -442,7 +803,13 @@ class SampleModelToFile(object):
         mcmc_options.adapt_every = 100
         mcmc_options.adapt_after = 100
         mcmc_options.nsamples = nsamples
+        mcmc_options.sampler = manager.options.get('sampler', 'slice')
+        mcmc_options.adapt_steps = burn  # the NUTS adaptation steps are burnt
         mcmc_manager.model = model
+        if manager.options.get('flat', False) or mcmc_options.sampler == 'nuts':
+            mcmc_manager.model = manager.modelbuilder.makeFlatPosterior(manager)
+        if mcmc_options.sampler == 'nuts':
+            scan_starting_point(mcmc_manager.model)
 
         runner = pma.MyMCMemRunner()
         runner.run(mcmc_manager)
@@ -454,7 +821,8 @@ class SampleModelToFile(object):
 
         raise NotImplementedError
 
-    def createOptions(self, outputFile, nsamples=2000, burn=500, options=None, args=None):
+    def createOptions(self, outputFile, nsamples=2000, burn=500, flat=False, sampler='slice',
+                      options=None, args=None):
 
         if options is None:
             options = util.VarContainer()
@@ -462,6 +830,8 @@ class SampleModelToFile(object):
         options.outputFile = outputFile
         options.nsamples = nsamples
         options.burn = burn
+        options.flat = flat
+        options.sampler = sampler
         return options, args
 
     def dump(self, manager):
@@ -476,3 +846,155 @@ class SampleModelToFile(object):
 
     def finalize(self, manager):
         pass
+
+
+class ReweightChainToFile(object):
+    """Masses of an existing chain (see SampleModelToFile.dump), reweighted by importance
+    sampling to the priors and likelihood of the current model (see reweight.reweight_chain),
+    instead of a new MCMC run.
+
+    The weighted mass summary is written with the effective sample size of the weights, and
+    the chain resampled with these weights is summarized as a chain (see pma.dumpMasses).
+    """
+
+    def run(self, manager):
+
+        options = manager.options
+        chain = reweight.load_chain(options.chainFile, options.burn)
+        flat = manager.modelbuilder.makeFlatPosterior(manager)
+
+        result = reweight.reweight_chain(chain, flat, massscale=massscale,
+                                         min_ess=options.min_ess)
+        print("INFO: Chain reweighted (%s): effective sample size %.1f of %d samples" %
+              ('likelihood re-evaluated' if result['likelihood_changed'] else 'new priors',
+               result['ess'], len(result['weights'])))
+
+        manager.chain = chain
+        manager.reweighting = result
+
+    def addCLOps(self, parser):
+
+        raise NotImplementedError
+
+    def createOptions(self, outputFile, chainFile, burn=2000, min_ess=100, seed=None,
+                      options=None, args=None):
+
+        if options is None:
+            options = util.VarContainer()
+
+        options.outputFile = outputFile
+        options.chainFile = chainFile
+        options.burn = burn
+        options.min_ess = min_ess
+        options.seed = seed
+        return options, args
+
+    def dump(self, manager):
+
+        outputFile = '%s.m%d.reweighted' % (manager.options.outputFile, manager.massdelta)
+        masses = manager.chain['mdelta']
+        weights = manager.reweighting['weights']
+
+        with open('%s.weights.pkl' % outputFile, 'wb') as output:
+            pickle.dump(manager.reweighting, output)
+
+        summary = reweight.weighted_summary(masses, weights)
+        with open('%s.weighted.summary.txt' % outputFile, 'w') as output:
+            output.write('ESS\t%f\n' % summary['ess'])
+            output.write('mean\t%e\n' % summary['mean'])
+            output.write('stddev\t%e\n' % summary['stddev'])
+            for q in reweight.QUANTILES:
+                output.write('Q%g\t%e\n' % (q, summary['quantiles'][q]))
+
+        random_state = np.random.RandomState(manager.options.seed)
+        pma.dumpMasses(masses[random_state.choice(len(masses), len(masses), p=weights)],
+                       outputFile)
+
+    def finalize(self, manager):
+        pass
+
+
+class MAPModelToFile(object):
+    """Quick-look masses, without a MCMC chain: maximum of the flat posterior and its Laplace
+    (gaussian) approximation, in the unconstrained coordinates of the parameters (see
+    laplace.LaplaceApproximation).
+
+    The samples of the approximation are summarized as a chain (see pma.dumpMasses), and the
+    approximation is checked by importance sampling on `ndiagnostic` of them.
+    """
+
+    def run(self, manager):
+
+        options = manager.options
+        flat = manager.modelbuilder.makeFlatPosterior(manager)
+        scan_starting_point(flat)
+        space, trace = pma.wrapFlatModel(flat)
+        uspace = laplace.unconstrained_space(space)
+
+        result = uspace.maximize(None)
+        approx = laplace.LaplaceApproximation(result.x, uspace.hessian(None),
+                                              names=[p.name for p in space],
+                                              constrain=uspace.constrain)
+        usamples = approx.sample(options.nsamples, options.seed)
+        samples = uspace.constrain(usamples)
+
+        # full parameter arrays of the samples, for the derived quantities
+        thetas = np.tile(flat.theta, (len(samples), 1))
+        thetas[:, [p.index for p in space]] = samples
+
+        chain = {}
+        for i, p in enumerate(space):
+            chain[p.name] = samples[:, i]
+        for name, function in flat.derived:
+            chain[name] = np.array([function(theta) for theta in thetas])
+
+        def log_post(y):
+            for p, yi in zip(uspace, y):
+                p.set(yi)
+            return uspace.log_posterior(None)
+
+        diagnostic = approx.diagnose(log_post, usamples[:options.ndiagnostic])
+        print("INFO: Maximum of the posterior found in %d evaluations" % result.nfev)
+        if not result.success:
+            diagnostic['flags'].append('maximize')
+            diagnostic['good'] = False
+        if not diagnostic['good']:
+            print("WARNING: Poor Laplace approximation of the posterior (%s); run the MCMC "
+                  "for this cluster" % ', '.join(diagnostic['flags']))
+
+        manager.chain = chain
+        manager.laplace = approx
+        manager.laplace_samples = usamples
+        manager.laplace_diagnostic = diagnostic
+
+    def addCLOps(self, parser):
+
+        raise NotImplementedError
+
+    def createOptions(self, outputFile, nsamples=10000, ndiagnostic=100, seed=None,
+                      options=None, args=None):
+
+        if options is None:
+            options = util.VarContainer()
+
+        options.outputFile = outputFile
+        options.nsamples = nsamples
+        options.ndiagnostic = ndiagnostic
+        options.seed = seed
+        return options, args
+
+    def dump(self, manager):
+
+        outputFile = '%s.m%d.laplace' % (manager.options.outputFile, manager.massdelta)
+
+        with open('%s.chain.pkl' % outputFile, 'wb') as output:
+            pickle.dump(manager.chain, output)
+
+        with open('%s.txt' % outputFile, 'w') as output:
+            output.write(manager.laplace.report(manager.laplace_diagnostic,
+                                                manager.laplace_samples))
+
+        pma.dumpMasses(np.array(manager.chain['mdelta']), outputFile)
+
+    def finalize(self, manager):
+        pass
@@ -61,7 +61,7 @@ It's probably worth reading the docstrings for:
  - Parameter
  - ParameterSpace
  - Updater, CartesianSequentialUpdater, CartesianPermutationUpdater, MultiDimSequentialUpdater, 
-   MultiDimPermutationUpdater, emceeUpdater
+   MultiDimPermutationUpdater, NUTSUpdater, emceeUpdater
  - Slice, Metropolis 
  - randNormalExp, randChiExp
  - textBackend, stdoutBackend, dictBackend
@@ -76,6 +76,8 @@ Here is a quick overview of the class structure:
    MultiDim updaters perform block updates to all parameters in their ParameterSpace at the same time.
    emceeUpdater is an interface to the emcee package, and is somewhat different than described below;
     see its docstring.
+   NUTSUpdater moves all the parameters at once along trajectories following the gradient of the
+    log-posterior, which the ParameterSpace must provide (grad_log_posterior); see its docstring.
   Each of these comes in Sequential and Permutation flavors, corresponding to sampling each direction
     in the ParameterSpace in fixed or random order. There is also a Rotation version of the MultiDim
     updater, which proposes along completely random directions in the multi-dimension parameter space,
@@ -142,6 +144,9 @@ Crude non-MCMC functionality:
 2. Updater.set_covariance_from_hessian uses finite differencing to estimate an appropriate
  cartesian width in each direction. This will fail if the state is not in a local minimum,
  or just because.
+3. ParameterSpace.maximize finds the maximum of the posterior within the bounds of the Parameters
+ (scipy.optimize L-BFGS-B, using grad_log_posterior if set), and ParameterSpace.hessian
+ differentiates the log-posterior there, e.g. for a Laplace approximation of the posterior.
 """)
 
 
@@ -153,6 +158,8 @@ class Parameter(object):
      1. width: initial guess for step lengths. Adaptive CartesianUpdaters change this value.
      2. (): return the current parameter value.
      3. set( ): set the parameter to a new value.
+    Optional attributes lower and upper give the bounds of the support of the parameter (used by
+    NUTSUpdater).
     """
 
     def __init__(self, value=0.0, width=1.0, name=''):
@@ -185,6 +192,52 @@ class DerivedParameter(Parameter):
         raise Exception('Attempt to set() value of a DerivedParameter.')
 
 
+def unconstrain(x, lower, upper):
+    """
+    Unconstrained coordinates of parameter values x within bounds lower and upper (arrays, infinite
+    where unbounded): logit transform for parameters bounded on both sides, log of the distance to
+    the bound for parameters bounded on one side. x may also be an array of shape (n, npar).
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.array(x)
+    both = np.isfinite(lower) & np.isfinite(upper)
+    low = np.isfinite(lower) & ~both
+    up = np.isfinite(upper) & ~both
+    with np.errstate(divide='ignore'):
+        u = (x[..., both] - lower[both]) / (upper[both] - lower[both])
+        y[..., both] = np.log(u) - np.log1p(-u)
+        y[..., low] = np.log(x[..., low] - lower[low])
+        y[..., up] = np.log(upper[up] - x[..., up])
+    return y
+
+
+def constrain(y, lower, upper):
+    """
+    Inverse of unconstrain: parameter values at unconstrained coordinates y, their derivatives
+    dx/dy, the log-Jacobian of the transform and its gradient with respect to y.
+    """
+    y = np.asarray(y, dtype=float)
+    x = np.array(y)
+    dxdy = np.ones(y.shape)
+    dlogj = np.zeros(y.shape)
+    both = np.isfinite(lower) & np.isfinite(upper)
+    low = np.isfinite(lower) & ~both
+    up = np.isfinite(upper) & ~both
+    s = 1.0 / (1.0 + np.exp(-y[..., both]))
+    x[..., both] = lower[both] + (upper[both] - lower[both]) * s
+    dxdy[..., both] = (upper[both] - lower[both]) * s * (1.0 - s)
+    dlogj[..., both] = 1.0 - 2.0 * s
+    x[..., low] = lower[low] + np.exp(y[..., low])
+    dxdy[..., low] = np.exp(y[..., low])
+    dlogj[..., low] = 1.0
+    x[..., up] = upper[up] - np.exp(y[..., up])
+    dxdy[..., up] = -np.exp(y[..., up])
+    dlogj[..., up] = 1.0
+    with np.errstate(divide='ignore'):
+        logj = np.sum(np.log(np.abs(dxdy)), axis=-1)
+    return x, dxdy, logj, dlogj
+
+
 class postgetter(object):
     # needs space and struct to be defined
     # actually returns -2*loglike
@@ -212,13 +265,17 @@ class ParameterSpace(list):
     To sample the parameter space, attribute log_posterior must be set to a function of one argument
     that evaluates the *complete* posterior likelihood, including priors and parameters not in
     this ParameterSpace.
+    Gradient based updaters (NUTSUpdater) also need attribute grad_log_posterior: a function of one
+    argument returning the log-posterior and its gradient with respect to the parameters of this
+    ParameterSpace (array, in the same order).
     """
 
-    def __init__(self, parameterList=None, log_posterior=None):
+    def __init__(self, parameterList=None, log_posterior=None, grad_log_posterior=None):
         if parameterList is None:
             parameterList = []
         list.__init__(self, parameterList)
         self.log_posterior = log_posterior
+        self.grad_log_posterior = grad_log_posterior
 
     def __str__(self):
         st = ''
@@ -250,6 +307,124 @@ class ParameterSpace(list):
         # print(m[2])
         return ret
 
+    def bounds(self):
+        """Lower and upper bounds of the parameters (arrays; their lower and upper attributes,
+        infinite if missing)."""
+        lower = np.array([getattr(p, 'lower', -np.inf) for p in self], dtype=np.float64)
+        upper = np.array([getattr(p, 'upper', np.inf) for p in self], dtype=np.float64)
+        return lower, upper
+
+    def maximize(self, struct, maxiter=500, gtol=1e-6):
+        """
+        Maximize the posterior with a bounded quasi-Newton method (scipy.optimize L-BFGS-B),
+        starting from the current parameter values, which must have a finite posterior.
+        The bounds come from the lower and upper attributes of the Parameters, and the
+        gradient from grad_log_posterior if it is set (finite differences otherwise). The
+        parameters are rescaled by the curvature of the log-posterior at the starting point
+        (or by their widths where it is not negative). They are set to the maximum, and the
+        scipy.optimize.OptimizeResult is returned (its fun is minus the log-posterior).
+        """
+        if not have_scipy:
+            print("ParameterSpace.maximize requires the scipy package -- aborting.")
+            return None
+        origin = np.array([p() for p in self], dtype=np.float64)
+        # unit steps of the first iteration are Newton steps along each parameter
+        scale = np.array([p.width if p.width else 1.0 for p in self], dtype=np.float64)
+        curvature = -np.diag(self.hessian(struct))
+        newton = np.isfinite(curvature) & (curvature > 0)
+        scale[newton] = 1.0 / np.sqrt(curvature[newton])
+        lower, upper = self.bounds()
+        bounds = [(None if np.isinf(lo) else (lo - x0) / s, None if np.isinf(up) else (up - x0) / s)
+                  for x0, s, lo, up in zip(origin, scale, lower, upper)]
+
+        def setpars(z):
+            for p, x in zip(self, origin + scale * z):
+                p.set(x)
+
+        # relative to the starting point, for the relative tolerance of L-BFGS-B
+        logP0 = self.log_posterior(struct)
+
+        def minus_logp(z):
+            setpars(z)
+            logP = self.log_posterior(struct)
+            return 1e300 if not np.isfinite(logP) else logP0 - logP
+
+        def minus_logp_grad(z):
+            setpars(z)
+            logP, grad = self.grad_log_posterior(struct)
+            if not np.isfinite(logP):
+                return 1e300, np.zeros(len(z))
+            return logP0 - logP, -scale * grad
+
+        if self.grad_log_posterior is not None:
+            m = scipy.optimize.minimize(minus_logp_grad, np.zeros(len(self)), jac=True,
+                                        method='L-BFGS-B', bounds=bounds,
+                                        options={'maxiter': maxiter, 'gtol': gtol})
+        else:
+            m = scipy.optimize.minimize(minus_logp, np.zeros(len(self)), method='L-BFGS-B',
+                                        bounds=bounds, options={'maxiter': maxiter, 'gtol': gtol})
+        if not m.success:
+            print("ParameterSpace.maximize: warning -- %s" % m.message)
+        setpars(m.x)
+        m.x = origin + scale * m.x
+        m.fun -= logP0
+        return m
+
+    def hessian(self, struct, h=1e-3):
+        """
+        Hessian matrix of the log-posterior at the current parameter values, by central finite
+        differences: of grad_log_posterior if it is set, of log_posterior otherwise. The steps
+        are h times the widths of the Parameters, and one-sided next to their bounds. The
+        parameters are left unchanged.
+        """
+        origin = np.array([p() for p in self], dtype=np.float64)
+        steps = h * np.array([p.width if p.width else 1.0 for p in self], dtype=np.float64)
+        lower, upper = self.bounds()
+        n = len(self)
+
+        def setpars(x):
+            for p, xi in zip(self, x):
+                p.set(xi)
+
+        def offsets(i):
+            # two points around the origin along parameter i, inside the bounds
+            lo = -steps[i] if origin[i] - steps[i] >= lower[i] else 0.
+            up = steps[i] if origin[i] + steps[i] <= upper[i] else 0.
+            return lo, up
+
+        H = np.zeros((n, n))
+        if self.grad_log_posterior is not None:
+            for i in range(n):
+                lo, up = offsets(i)
+                grads = []
+                for d in (lo, up):
+                    x = origin.copy()
+                    x[i] += d
+                    setpars(x)
+                    grads.append(self.grad_log_posterior(struct)[1])
+                H[i] = (grads[1] - grads[0]) / (up - lo)
+        else:
+            def logp(di, dj):
+                x = origin.copy()
+                x[i] += di
+                x[j] += dj
+                setpars(x)
+                return self.log_posterior(struct)
+            for i in range(n):
+                for j in range(i + 1):
+                    loi, upi = offsets(i)
+                    loj, upj = offsets(j)
+                    if i == j:
+                        mid = 0.5 * (loi + upi)
+                        H[i, i] = (logp(upi, 0.) - 2. * logp(mid, 0.) + logp(loi, 0.)) / \
+                            (0.5 * (upi - loi))**2
+                    else:
+                        H[i, j] = (logp(upi, upj) - logp(upi, loj) - logp(loi, upj) +
+                                   logp(loi, loj)) / ((upi - loi) * (upj - loj))
+                        H[j, i] = H[i, j]
+        setpars(origin)
+        return 0.5 * (H + H.T)
+
 
 class Updater(object):
     """
@@ -924,6 +1099,255 @@ class MultiDimRotationUpdater(MultiDimUpdater, MDRotationUpdater):
         MDRotationUpdater.__init__(self)
 
 
+class NUTSUpdater(Updater):
+    """
+    Updater using the No-U-Turn Sampler (http://arxiv.org/abs/1111.4246, algorithm 6), a
+    Hamiltonian Monte Carlo method: all the parameters move at once along a trajectory integrated
+    from the gradient of the log-posterior, which is extended until it turns back on itself.
+    Successive samples are much less correlated than with the one-direction-at-a-time updaters,
+    for a few gradient evaluations.
+    The ParameterSpace must have a grad_log_posterior attribute (see ParameterSpace).
+    Parameters with lower and/or upper attributes (bounds of their support) are sampled in
+    unconstrained coordinates (logit or log transforms, with their Jacobian), so that trajectories
+    never leave the support even when the posterior piles up against a bound.
+    During the first adapt_steps steps, the step size of the trajectories is tuned by dual averaging
+    to reach the target acceptance probability, and the (dense) mass matrix is estimated from the
+    covariance of the samples in windows of increasing lengths. These steps should be discarded.
+    Constructor arguments:
+     1* ParameterSpace to update. It must be the only updater of these parameters.
+     2  Number of adaptation steps.
+     3  Target mean acceptance probability of the trajectories.
+     4  Maximum depth of the trajectory trees (at most 2**max_depth gradient evaluations per step).
+    The initial mass matrix is set from the .width attributes of the Parameters. The number of
+    gradient evaluations is counted in the nevaluations attribute.
+    """
+
+    def __init__(self, space, adapt_steps=1000, target_accept=0.8, max_depth=10):
+        Updater.__init__(self, space, None, 0, 0, None, None)
+        self.adapt_steps = adapt_steps
+        self.target_accept = target_accept
+        self.max_depth = max_depth
+        self.lower, self.upper = space.bounds()
+        x = np.array([p() for p in space], dtype=float)
+        widths = np.array([p.width for p in space], dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            widths = widths / np.abs(self.constrain(self.unconstrain(x))[1])
+        self.set_inv_metric(np.diag(np.where((widths > 0.0) & np.isfinite(widths), widths, 1.0)**2))
+        self.windows = self.adaptation_windows(adapt_steps)
+        self.stepsize = None
+        self.x = None
+        self.logP = None
+        self.grad = None
+        self.nevaluations = 0
+        self.reset_variance()
+
+    @staticmethod
+    def adaptation_windows(adapt_steps, init_buffer=75, term_buffer=50, base_window=25):
+        """(start, end) steps of the windows over which the mass matrix is estimated."""
+        if adapt_steps <= 0:
+            return []
+        if init_buffer + term_buffer + base_window > adapt_steps:
+            init_buffer = int(0.15 * adapt_steps)
+            term_buffer = int(0.1 * adapt_steps)
+            base_window = adapt_steps - init_buffer - term_buffer
+        last = adapt_steps - term_buffer
+        windows = []
+        start, window = init_buffer, base_window
+        while start < last:
+            if start + 3 * window > last:  # the next (doubled) window would not fit
+                window = last - start
+            windows.append((start, start + window))
+            start += window
+            window *= 2
+        return windows
+
+    def unconstrain(self, x):
+        return unconstrain(x, self.lower, self.upper)
+
+    def constrain(self, y):
+        # parameter values, their derivatives and the log-Jacobian of the transform (and its
+        # gradient) at unconstrained coordinates y
+        return constrain(y, self.lower, self.upper)
+
+    def __call__(self, struct):
+        x = np.array([p() for p in self.space], dtype=float)
+        if self.grad is None or not np.array_equal(x, self.x):
+            self.y = self.unconstrain(x)
+            self.logP, self.grad = self.evaluate(self.y, struct)
+            if not (np.isfinite(self.logP) and np.all(np.isfinite(self.grad))):
+                # trajectories (and the step size search) need a finite starting point
+                start = dict(zip([p.name for p in self.space], x.tolist()))
+                raise ValueError("NUTS cannot start from %s: the log-posterior or its gradient "
+                                 "is not finite" % start)
+        if self.stepsize is None:
+            self.stepsize = self.find_stepsize(self.y, struct)
+            self.start_dual_averaging()
+
+        r0 = np.dot(self.metric_chol, np.random.randn(len(x)))
+        joint0 = self.hamiltonian(self.logP, r0)
+        logu = joint0 - np.random.exponential()  # log level of the slice
+        minus = plus = (self.y, r0, self.grad)
+        proposal = (self.y, self.logP, self.grad)
+        n, depth, alpha, nalpha = 1, 0, 0.0, 1
+        go_on = True
+        while go_on and depth < self.max_depth:
+            direction = 1 if np.random.random_sample() < 0.5 else -1
+            if direction == -1:
+                minus, _, new, nnew, snew, alpha, nalpha = self.build_tree(
+                    minus, logu, direction, depth, joint0, struct)
+            else:
+                _, plus, new, nnew, snew, alpha, nalpha = self.build_tree(
+                    plus, logu, direction, depth, joint0, struct)
+            if snew and np.random.random_sample() < float(nnew) / n:
+                proposal = new
+            n += nnew
+            go_on = snew and self.no_uturn(minus, plus)
+            depth += 1
+
+        self.y, self.logP, self.grad = proposal
+        self.x, dxdy, logj, dlogj = self.constrain(self.y)
+        for p, xi in zip(self.space, self.x):
+            p.set(xi)
+        self.engine.current_logP = self.logP - logj
+        if self.count < self.adapt_steps:
+            self.do_adapt(alpha / nalpha, struct)
+        self.count += 1
+
+    def evaluate(self, y, struct):
+        # log-posterior density of the unconstrained coordinates, and its gradient
+        x, dxdy, logj, dlogj = self.constrain(y)
+        for p, xi in zip(self.space, x):
+            p.set(xi)
+        self.nevaluations += 1
+        logP, grad = self.space.grad_log_posterior(struct)
+        return logP + logj, np.asarray(grad, dtype=float) * dxdy + dlogj
+
+    def set_inv_metric(self, inv_metric):
+        # momenta are drawn from N(0, inv_metric^-1)
+        self.inv_metric = inv_metric
+        self.metric_chol = np.linalg.cholesky(np.linalg.inv(inv_metric))
+
+    def hamiltonian(self, logP, r):
+        joint = logP - 0.5 * np.dot(r, np.dot(self.inv_metric, r))
+        return -np.inf if np.isnan(joint) else joint
+
+    def leapfrog(self, y, r, grad, stepsize, struct):
+        r = r + 0.5 * stepsize * grad
+        y = y + stepsize * np.dot(self.inv_metric, r)
+        logP, grad = self.evaluate(y, struct)
+        r = r + 0.5 * stepsize * grad
+        return y, r, logP, grad
+
+    def no_uturn(self, minus, plus):
+        dy = plus[0] - minus[0]
+        return np.dot(dy, np.dot(self.inv_metric, minus[1])) >= 0.0 and \
+            np.dot(dy, np.dot(self.inv_metric, plus[1])) >= 0.0
+
+    def build_tree(self, edge, logu, direction, depth, joint0, struct):
+        # returns the two edges (y, r, grad) of the subtree, a proposal (y, logP, grad) drawn
+        # uniformly from its points inside the slice, the number of those points, whether the
+        # subtree can be extended, and the sum and number of acceptance probabilities
+        if depth == 0:
+            y, r, logP, grad = self.leapfrog(edge[0], edge[1], edge[2], direction * self.stepsize,
+                                             struct)
+            joint = self.hamiltonian(logP, r)
+            edge = (y, r, grad)
+            return (edge, edge, (y, logP, grad), int(logu <= joint), logu < joint + 1000.0,
+                    np.exp(min(0.0, joint - joint0)), 1)
+        minus, plus, proposal, n, go_on, alpha, nalpha = self.build_tree(
+            edge, logu, direction, depth - 1, joint0, struct)
+        if go_on:
+            if direction == -1:
+                minus, _, new, nnew, snew, anew, nanew = self.build_tree(
+                    minus, logu, direction, depth - 1, joint0, struct)
+            else:
+                _, plus, new, nnew, snew, anew, nanew = self.build_tree(
+                    plus, logu, direction, depth - 1, joint0, struct)
+            if nnew > 0 and np.random.random_sample() < float(nnew) / (n + nnew):
+                proposal = new
+            n += nnew
+            alpha += anew
+            nalpha += nanew
+            go_on = snew and self.no_uturn(minus, plus)
+        return minus, plus, proposal, n, go_on, alpha, nalpha
+
+    def find_stepsize(self, y, struct):
+        """Heuristic initial step size (algorithm 4 of the NUTS paper)."""
+        r = np.dot(self.metric_chol, np.random.randn(len(y)))
+        joint0 = self.hamiltonian(self.logP, r)
+
+        def log_ratio(stepsize):
+            ynew, rnew, logP, grad = self.leapfrog(y, r, self.grad, stepsize, struct)
+            return self.hamiltonian(logP, rnew) - joint0
+
+        stepsize = 1.0
+        a = 1 if log_ratio(stepsize) > np.log(0.5) else -1
+        for i in range(100):
+            if not a * log_ratio(stepsize) > -a * np.log(2.0):
+                break
+            stepsize *= 2.0**a
+        for p, xi in zip(self.space, self.constrain(y)[0]):
+            p.set(xi)
+        return stepsize
+
+    def start_dual_averaging(self):
+        self.mu = np.log(10.0 * self.stepsize)
+        self.hbar = 0.0
+        self.log_stepsize_bar = 0.0
+        self.adapt_count = 0
+
+    def reset_variance(self):
+        self.nvariance = 0
+        self.means = np.zeros(len(self.space))
+        self.covariances = np.zeros((len(self.space), len(self.space)))
+
+    def do_adapt(self, accept, struct):
+        # dual averaging of the step size (gamma=0.05, t0=10, kappa=0.75 as in the paper)
+        self.adapt_count += 1
+        eta = 1.0 / (self.adapt_count + 10)
+        self.hbar = (1.0 - eta) * self.hbar + eta * (self.target_accept - accept)
+        log_stepsize = self.mu - np.sqrt(self.adapt_count) / 0.05 * self.hbar
+        weight = self.adapt_count**-0.75
+        self.log_stepsize_bar = weight * log_stepsize + (1.0 - weight) * self.log_stepsize_bar
+        self.stepsize = np.exp(log_stepsize)
+
+        for start, end in self.windows:
+            if start <= self.count < end:
+                # Welford one-pass covariance, (n-1) times the covariance
+                self.nvariance += 1
+                d = self.y - self.means
+                self.means += d / self.nvariance
+                self.covariances += np.outer(d, self.y - self.means)
+                if self.count == end - 1 and self.nvariance > 1:
+                    n = self.nvariance
+                    covariances = self.covariances / (n - 1)
+                    # shrink towards the previous variances for short windows
+                    self.set_inv_metric((n * covariances + 5e-3 * np.diag(
+                        np.diag(self.inv_metric))) / (n + 5.0))
+                    self.reset_variance()
+                    self.stepsize = self.find_stepsize(self.y, struct)
+                    self.start_dual_averaging()
+                break
+
+        if self.count == self.adapt_steps - 1:
+            self.stepsize = np.exp(self.log_stepsize_bar)
+
+    def restoreBits(self, s):
+        if s['type'] == 'NUTS':
+            self.count = s['count']
+            self.stepsize = s['stepsize']
+            self.set_inv_metric(s['inv_metric'])
+            if self.stepsize is not None:
+                self.start_dual_averaging()
+        else:
+            raise Exception(
+                'NUTSUpdater.restoreBits: incompatible updater type')
+
+    def saveBits(self):
+        return {'type': 'NUTS', 'count': self.count, 'stepsize': self.stepsize,
+                'inv_metric': self.inv_metric}
+
+
 try:
     import emcee
 
@@ -2,40 +2,131 @@
 
 
 from __future__ import print_function
+import os
 import copy
+import collections
+import threading
 import numpy as np
-import scipy.optimize
 from scipy.integrate import quad
+from scipy.interpolate import CubicSpline
 
 
 std_G = 4.3e-9  # Newton's const   in Mpc (km/s)^2 M_sol^{-1
 v_c = 299792.458  # km/s
 
 
-class ComovingDistMemoization(object):
+class ComovingDistTable(object):
+    """Comoving distance of a cosmology tabulated on a dense redshift grid.
 
-    def __init__(self, cosmology, memotable=None):
+    The distance is integrated once, interval by interval (Gauss-Legendre), on a grid
+    regular in ln(1+z), then interpolated with a cubic spline. The grid is refined
+    until the spline matches the direct integration to a relative accuracy `rtol` at
+    the middle of every interval.
+    """
+
+    zmax = 1e6
+    rtol = 1e-10
 
-        if memotable is None:
-            memotable = {}
+    def __init__(self, cosmology, npoints=1024, maxpoints=2**17):
 
-        self.memotable = memotable
         self.cosmology = cosmology
+        umax = np.log1p(self.zmax)
+        while True:
+            self.u = np.linspace(0., umax, npoints)
+            self.dist = np.concatenate([[0.], np.cumsum(self._integrate(self.u[:-1],
+                                                                        self.u[1:]))])
+            slopes = self._integrand(self.u[[0, -1]])
+            self.spline = CubicSpline(self.u, self.dist,
+                                      bc_type=((1, slopes[0]), (1, slopes[1])))
+            umid = 0.5 * (self.u[:-1] + self.u[1:])
+            exact = self.dist[:-1] + self._integrate(self.u[:-1], umid)
+            error = np.abs(self.spline(umid) - exact) / exact
+            if error.max() < self.rtol or npoints >= maxpoints:
+                break
+            npoints *= 2
+
+    def _integrand(self, u):
+        """dD/dln(1+z) = c (1+z) / H(z)."""
+        inv_a = np.exp(u)
+        return self.cosmology.v_c * inv_a / np.sqrt(self.cosmology.hubble2(inv_a - 1.))
+
+    def _integrate(self, umin, umax, order=10):
+        nodes, weights = np.polynomial.legendre.leggauss(order)
+        half = 0.5 * (umax - umin)
+        u = (umin + half)[:, None] + half[:, None] * nodes
+        return half * np.sum(weights * self._integrand(u), axis=1)
 
     def __call__(self, z):
 
-        if z in self.memotable:
-            return self.memotable[z]
+        z = np.asarray(z, dtype='float64')
+        dist = self.spline(np.log1p(np.clip(z, 0., self.zmax)))
+        outside = (z < 0) | (z > self.zmax)
+        if outside.any():
+            dist = np.array(dist, ndmin=1)
+            dist[outside.ravel()] = [self._quad(zi) for zi in np.ravel(z)[outside.ravel()]]
+            dist = dist.reshape(z.shape)
+        return dist[()] if z.ndim == 0 else dist
 
-        def integrand(z):
+    def _quad(self, z):
+        """Direct integration, outside of the tabulated range."""
 
+        def integrand(z):
             return 1. / np.sqrt(self.cosmology.hubble2(z))
 
+        if z > self.zmax:
+            y, err = quad(integrand, self.zmax, z)
+            return self.dist[-1] + self.cosmology.v_c * y
+
         y, err = quad(integrand, 0, z)
-        dist = self.cosmology.v_c * y  # to get proper units, ie to put in the hubble length
-        self.memotable[z] = dist
+        return self.cosmology.v_c * y
+
+
+class ComovingDistMemoization(object):
+    """Comoving distance of a cosmology, accepting scalars or arrays.
+
+    The `ComovingDistTable` of each cosmology is kept in a cache shared by all
+    instances, with LRU eviction (see `_comovingdist_table`).
+    """
+
+    def __init__(self, cosmology, memotable=None):
+
+        self.cosmology = cosmology
+
+    def __call__(self, z):
+
+        return _comovingdist_table(self.cosmology)(z)
 
-        return dist
+
+_TABLES = collections.OrderedDict()
+_TABLES_MAXSIZE = 16
+_TABLES_LOCK = threading.Lock()
+
+
+def _reset_tables_lock():
+    global _TABLES_LOCK
+    _TABLES_LOCK = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    # a forked process must not inherit a lock held by another thread
+    os.register_at_fork(after_in_child=_reset_tables_lock)
+
+
+def _comovingdist_table(cosmology):
+    """Return the (cached) comoving distance table of a cosmology."""
+    key = (cosmology.omega_m, cosmology.omega_l, cosmology.omega_r,
+           cosmology.h, cosmology.w, cosmology.v_c)
+    with _TABLES_LOCK:
+        if key in _TABLES:
+            _TABLES.move_to_end(key)
+            return _TABLES[key]
+    table = ComovingDistTable(copy.copy(cosmology))
+    with _TABLES_LOCK:
+        _TABLES[key] = table
+        _TABLES.move_to_end(key)
+        while len(_TABLES) > _TABLES_MAXSIZE:
+            _TABLES.popitem(last=False)
+    return table
 
 
 class Cosmology(object):
@@ -96,19 +187,22 @@ class Cosmology(object):
 
     def rho_crit(self, z):
 
-        return 3. * self.hubble2(z) / (8 * np.pi * self.G)
+        return 3. * self.hubble2(np.asarray(z, dtype='float64')) / (8 * np.pi * self.G)
 
     def angulardist(self, z, z2=None):
 
+        z = np.asarray(z, dtype='float64')
         if z2 is None:
             return self.comovingdist(z) / (1 + z)
 
+        z2 = np.asarray(z2, dtype='float64')
         return (self.comovingdist(z2) - self.comovingdist(z)) / (1 + z2)
 
     def beta(self, z, zcluster):
 
-        Ds = np.array([self.angulardist(zi) for zi in z])
-        Dls = np.array([self.angulardist(zcluster, zi) for zi in z])
+        z = np.atleast_1d(np.asarray(z, dtype='float64'))
+        Ds = self.angulardist(z)
+        Dls = self.angulardist(zcluster, z)
 
         Dls_over_Ds = np.zeros_like(Dls)
         Dls_over_Ds[Ds > 0] = Dls[Ds > 0] / Ds[Ds > 0]
@@ -161,10 +255,54 @@ global_cosmology = CosmologySingleton()
 
 def deltaC(c, delta=200.):
 
-    c = float(c)
+    c = np.asarray(c, dtype=np.float64)
     return (delta / 3.) * c**3 / (np.log(1 + c) - (c / (1 + c)))
 
 
+# Series of mu(x) = log(1 + x) - x / (1 + x) = sum_k (-1)**k (k - 1) x**k / k, below
+# NFW_MU_SERIES_RANGE, where the closed form cancels
+NFW_MU_SERIES_RANGE = 1e-2
+NFW_MU_SERIES_ORDER = 8
+
+# Convergence of the Newton iterations of meanDensityRadius on log(x)
+NEWTON_TOLERANCE = 1e-12
+NEWTON_MAXITER = 100
+
+
+def nfwMu(x):
+    """Dimensionless NFW mass profile mu(x) = log(1 + x) - x / (1 + x): the mass inside
+    x = r / rs is 4 pi delta_c rho_c rs**3 mu(x)."""
+    x = np.asarray(x, dtype=np.float64)
+    mu = np.empty(x.shape)
+    small = x < NFW_MU_SERIES_RANGE
+    k = np.arange(NFW_MU_SERIES_ORDER, 1, -1)
+    mu[small] = x[small]**2 * np.polyval((-1.)**k * (k - 1) / k, x[small])
+    mu[~small] = np.log1p(x[~small]) - x[~small] / (1 + x[~small])
+    return mu
+
+
+def meanDensityRadius(q):
+    """Radius x = r / rs inside which the dimensionless mean density mu(x) / x**3 of an NFW
+    halo is `q` (array), to NEWTON_TOLERANCE.
+
+    phi(u) = log(mu(x) / x**3) - log(q) decreases monotonically in u = log(x), with a slope
+    x**2 / ((1 + x)**2 mu(x)) - 3 between -3 and -1, so that the Newton iterations on u
+    (with steps limited to 1) converge from the asymptotic solution min(1 / 2q, q**(-1/3))
+    in a few iterations for all q.
+    """
+    q = np.asarray(q, dtype=np.float64)
+    logq = np.log(q)
+    u = np.log(np.minimum(0.5 / q, q**(-1. / 3.)))
+    for _ in range(NEWTON_MAXITER):
+        x = np.exp(u)
+        mu = nfwMu(x)
+        step = np.clip(-(np.log(mu) - 3 * u - logq) / (x**2 / ((1 + x)**2 * mu) - 3), -1, 1)
+        u = u + step
+        if not np.any(np.abs(step) > NEWTON_TOLERANCE):
+            break
+    return np.exp(u)
+
+
 def density(r, rs, c, z, cosmology=global_cosmology):
 
     x = r / rs
@@ -199,18 +337,10 @@ def RsMassInsideR(mass, c, z, R, cosmology=global_cosmology):
     delta_c = deltaC(c)
     rho_c = cosmology.rho_crit(z)
 
-    def f(x):
-        xp = R / x
-        return (np.log(1 + xp) - (xp / (1 + xp))) * 4 * np.pi * delta_c * rho_c * x**3 - mass
+    # the mass inside R is 4 pi delta_c rho_c R**3 mu(x) / x**3, with x = R / rs
+    x = meanDensityRadius(mass / (4 * np.pi * delta_c * rho_c * R**3))
 
-    try:
-        rs = scipy.optimize.brenth(f, 0.01, 10.)
-    except ValueError as e:
-        print('!!!!!!!!!!!')
-        print(mass, c, f(0.01), f(10.))
-        raise e
-
-    return rs
+    return R / x
 
 
 def massInsideR_amp(rs, amp, z, R, cosmology=global_cosmology):
@@ -230,30 +360,21 @@ def massInsideR_amp(rs, amp, z, R, cosmology=global_cosmology):
 ###################################
 
 
-def rdelta2rs(rdelta, c, delta):
+def rdeltaOverRs(c, delta):
+    """x = r_delta / rs of an NFW halo of concentration c (c200), where the mean density is
+    delta times the critical density: 3 delta_c mu(x) / x**3 = delta."""
 
-    delta_c = deltaC(c)
+    return meanDensityRadius(delta / (3 * deltaC(c)))
 
-    # x = r_delta / rs
-    def f(x):
-        return 3 * delta_c * (np.log(1 + x) - (x / (1 + x))) / x**3 - delta
 
-    x0 = scipy.optimize.brenth(f, 0.1, 20)
+def rdelta2rs(rdelta, c, delta):
 
-    return rdelta / x0
+    return rdelta / rdeltaOverRs(c, delta)
 
 
 def rdelta(rs, c, delta):
 
-    delta_c = deltaC(c)
-
-    # x = r_delta / rs
-    def f(x):
-        return 3 * delta_c * (np.log(1 + x) - (x / (1 + x))) / x**3 - delta
-
-    x0 = scipy.optimize.brenth(f, 0.1, 20)
-
-    return x0 * rs
+    return rdeltaOverRs(c, delta) * rs
 
 
 def Mdelta(rs, c, z, delta, cosmology=global_cosmology):
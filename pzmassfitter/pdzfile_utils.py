@@ -6,6 +6,8 @@ import re
 import numpy as np
 import astropy.io.fits as pyfits
 from . import ldac
+from . import join
+from . import util
 
 
 class PDZManager(object):
@@ -27,16 +29,17 @@ class PDZManager(object):
         returns pdz array
         index maps ID to element number
         """
-        if self.index is None or key not in self.index:
+        if self.index is None:
+            raise IndexError
+        row = self.index.lookup([key])[0]
+        if row < 0:
             raise IndexError
 
-        return self.pdzcat[self.index[key]][1]
+        return self.pdzcat[int(row)][1]
 
     def _buildIndex(self):
 
-        self.index = {}
-        for i, iid in enumerate(self.pdzcat['SeqNr']):
-            self.index[iid] = i
+        self.index = join.SortedIndex(self.pdzcat['SeqNr'])
 
     def _buildPDZRange(self):
 
@@ -50,11 +53,11 @@ class PDZManager(object):
 
     def associatePDZ(self, z_ids):
 
-        arrangedPDZ = []
-        for cid in z_ids:
-            arrangedPDZ.append(self[cid])
+        rows = self.index.lookup(z_ids)
+        if (rows < 0).any():
+            raise IndexError
 
-        finalPDZs = np.column_stack(arrangedPDZ).transpose()
+        finalPDZs = np.asarray(self.pdzcat['pdz'])[rows]
 
         return self.pdzrange, finalPDZs
 
@@ -62,36 +65,27 @@ class PDZManager(object):
     def parsePDZ(cls, pdzfile):
         """parses text output from BPZ."""
 
-        inputf = open(pdzfile)
-
-        headerline = inputf.readline()
+        with open(pdzfile) as inputf:
+            headerline = inputf.readline()
         match = re.search(r'z=arange\((.+)\)', headerline)
         assert match is not None
         minPDZ, maxPDZ, pdzstep = map(float, match.group(1).split(','))
 
-        ids = []
-        pdzs = []
-        for line in inputf.readlines():
-            if re.match('^#', line):
-                continue
-            tokens = line.split()
-            cid = int(tokens[0])
-            pdz = map(float, tokens[1:])
-
-            ids.append(cid)
-            pdzs.append(pdz)
+        table = util.read_numeric_table(pdzfile)
+        ids = table[:, 0].astype(int)
+        pdzs = table[:, 1:]
 
         npdzs = len(np.arange(minPDZ, maxPDZ, pdzstep))
 
         cols = [pyfits.Column(name='SeqNr', format='J', array=np.array(ids)),
-                pyfits.Column(name='pdz', format='%dE' % npdzs, array=np.array(pdzs))]
+                pyfits.Column(name='pdz', format='%dE' % npdzs, array=pdzs)]
 
         pdzs = ldac.LDACCat(
             pyfits.BinTableHDU.from_columns(pyfits.ColDefs(cols)))
 
-        pdzs.hdu.header.update('MINPDZ', minPDZ)
-        pdzs.hdu.header.update('MAXPDZ', maxPDZ)
-        pdzs.hdu.header.update('PDZSTEP', pdzstep)
+        pdzs.hdu.header['MINPDZ'] = minPDZ
+        pdzs.hdu.header['MAXPDZ'] = maxPDZ
+        pdzs.hdu.header['PDZSTEP'] = pdzstep
 
         return cls(pdzs)
 
@@ -136,3 +130,249 @@ if __name__ == '__main__':
     outfile = sys.argv[2]
 
     parseRawPDZ(infile, outfile)
+
+
+###############################
+# Compact pdz storage in tables
+###############################
+
+PDZ_FORMATS = ['float64', 'float32', 'uint16']
+UINT16_MAX = 65535.
+
+
+def trapz_pdz(pdz, zbins):
+    """Trapezoidal integral of pdz(s) over the redshift bins (last axis)."""
+    pdz = np.asarray(pdz, dtype='float64')
+    return np.sum(0.5 * (pdz[..., 1:] + pdz[..., :-1]) * np.diff(zbins), axis=-1)
+
+
+def normalize_pdz(pdz, zbins):
+    """Return the pdzs (one per row) normalized to an integral of 1 over the redshift bins."""
+    pdz = np.asarray(pdz, dtype='float64')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return pdz / trapz_pdz(pdz, zbins)[..., None]
+
+
+class DeltaPDZ(object):
+    """Delta-function pdzs (one-hot on the redshift grid), e.g. for true redshifts.
+
+    Only the bin index and the value of the pdz in this bin are kept for each object;
+    `dense` builds the (nobjects, nbins) array on demand, and has to be called
+    explicitly where a pdz array is expected (`astype` raises a TypeError, so that no
+    code path silently turns the pdzs dense).
+    `cumulative_pdz`, `prob_below`, `pdz_quantiles` and `deltaz95` work directly on
+    this form, with the same results as on the dense pdzs.
+    """
+
+    def __init__(self, zbins, bins, weights):
+        """Store the delta pdzs.
+
+        :param zbins: redshift grid, of length nbins
+        :param bins: bin index of each object
+        :param weights: value of the pdz of each object in its bin
+        """
+        self.zbins = np.asarray(zbins, dtype='float64')
+        self.bins = np.asarray(bins, dtype='int64')
+        self.weights = np.asarray(weights, dtype='float64')
+        # trapezoidal weights of each grid point, below and above it
+        dz = np.diff(self.zbins) / 2.
+        self.lower = np.concatenate([[0.], dz])
+        self.upper = np.concatenate([dz, [0.]])
+
+    @classmethod
+    def from_redshifts(cls, z, zbins):
+        """Delta pdzs, normalized to 1, from redshifts (bins as given by numpy.digitize)."""
+        zbins = np.asarray(zbins, dtype='float64')
+        bins = np.digitize(z, zbins)
+        if np.any(bins >= len(zbins)):
+            raise ValueError("Some redshifts are beyond the redshift grid (zmax=%f)"
+                             % zbins[-1])
+        zphot = cls(zbins, bins, np.ones(len(bins)))
+        zphot.weights = 1. / zphot.integrals()
+        return zphot
+
+    def __len__(self):
+        return len(self.bins)
+
+    def __getitem__(self, rows):
+        return DeltaPDZ(self.zbins, self.bins[rows], self.weights[rows])
+
+    def integrals(self):
+        """Trapezoidal integral of each pdz over the redshift grid."""
+        return self.weights * (self.lower + self.upper)[self.bins]
+
+    def dense(self, dtype='float64'):
+        """The (nobjects, nbins) pdz array."""
+        pdz = np.zeros((len(self.bins), len(self.zbins)), dtype=dtype)
+        pdz[np.arange(len(self.bins)), self.bins] = self.weights
+        return pdz
+
+    def astype(self, dtype):
+        raise TypeError("Delta pdzs are not converted implicitly to a pdz array: "
+                        "use DeltaPDZ.dense(dtype)")
+
+    def cdf_at(self, ibin):
+        """Cumulative pdz of each object at the grid point ibin."""
+        cdf = (self.bins < ibin).astype('float64')
+        at = self.bins == ibin
+        if np.any(at):
+            bins = self.bins[at]
+            cdf[at] = self.lower[bins] / (self.lower + self.upper)[bins]
+        return cdf
+
+    def quantiles(self, q):
+        """Redshift quantile q of each object (first grid point where the cdf reaches q)."""
+        below = self.lower[self.bins] / (self.lower + self.upper)[self.bins] < q
+        return self.zbins[np.minimum(self.bins + below, len(self.zbins) - 1)]
+
+
+def cumulative_pdz(pdz, zbins):
+    """Cumulative distribution(s) of pdz(s) on the redshift grid.
+
+    cdf[:, i] is the trapezoidal integral of the pdz from zbins[0] to zbins[i], divided
+    by the integral over the whole grid.
+
+    :param pdz: pdzs, of shape (nobjects, nbins)
+    :param zbins: redshift grid, of length nbins
+    :return: cdf, of shape (nobjects, nbins). A `DeltaPDZ` is its own cumulative pdz.
+    """
+    if isinstance(pdz, DeltaPDZ):
+        return pdz
+    pdz = np.asarray(pdz, dtype='float64')
+    cdf = np.zeros(pdz.shape)
+    np.cumsum(0.5 * (pdz[..., 1:] + pdz[..., :-1]) * np.diff(zbins), axis=-1,
+              out=cdf[..., 1:])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return cdf / cdf[..., -1:]
+
+
+def prob_below(cdf, zbins, z0):
+    """Probability for each object to be located below z0.
+
+    As for the integral of the pdz over zbins < z0, the cdf is taken at the last grid
+    point below z0 (0 if there is none): one column lookup for all the objects.
+
+    :param cdf: cumulative pdzs (see `cumulative_pdz`), of shape (nobjects, nbins)
+    :param zbins: redshift grid
+    :param float z0: redshift
+    """
+    ibin = np.searchsorted(zbins, z0, side='left') - 1
+    if isinstance(cdf, DeltaPDZ):
+        return cdf.cdf_at(ibin)
+    if ibin < 0:
+        return np.zeros(len(cdf))
+    return np.asarray(cdf[:, ibin], dtype='float64')
+
+
+def pdz_quantiles(cdf, zbins, q):
+    """Redshift quantile(s) of each object.
+
+    The quantile q is the first grid point where the cdf reaches q.
+
+    :param cdf: cumulative pdzs (see `cumulative_pdz`), of shape (nobjects, nbins)
+    :param zbins: redshift grid
+    :param q: a quantile (float), or a list of quantiles
+    :return: array of shape (nobjects,) for a single quantile, (nobjects, nq) otherwise
+    """
+    zbins = np.asarray(zbins)
+    if isinstance(cdf, DeltaPDZ):
+        quantiles = np.stack([cdf.quantiles(qi) for qi in np.atleast_1d(q)], axis=-1)
+    else:
+        quantiles = np.stack([zbins[np.argmax(cdf >= qi, axis=1)]
+                              for qi in np.atleast_1d(q)], axis=-1)
+    return quantiles[:, 0] if np.ndim(q) == 0 else quantiles
+
+
+def deltaz95(cdf, zbins):
+    """Width of the pdzs, between their 5% and 95% quantiles."""
+    quantiles = pdz_quantiles(cdf, zbins, [0.05, 0.95])
+    return quantiles[:, 1] - quantiles[:, 0]
+
+
+def pdz_columns(pdz, zbins, pdz_format='float32', cdf=False):
+    """Build the columns and metadata storing pdzs in a table.
+
+    The redshift grid is stored once, as metadata ('zbins'), and the pdzs either as
+    float64, float32, or as uint16 scaled to the maximum of each pdz (the scale being
+    stored in a 'pdz_scale' column). Use `read_pdz` to get them back.
+
+    With `cdf`, the cumulative pdzs are also stored, in a 'pdz_cdf' column of uint16
+    scaled to [0, 1] whatever `pdz_format` (a resolution of 1.5e-5), see `read_pdz_cdf`.
+    Without it, `read_pdz_cdf` computes them from the pdzs.
+
+    A `DeltaPDZ` is stored as a bin index ('pdz_bin') and a value ('pdz_weight') per
+    object, whatever `pdz_format` and `cdf`.
+
+    :param pdz: pdzs, of shape (nobjects, nbins), or a `DeltaPDZ`
+    :param zbins: redshift grid, of length nbins
+    :param str pdz_format: float64, float32 or uint16
+    :param bool cdf: Also store the cumulative pdzs
+    :return: a dictionnary of columns, and a dictionnary of metadata
+    """
+    if pdz_format not in PDZ_FORMATS:
+        raise ValueError("pdz_format must be one of %s" % PDZ_FORMATS)
+    meta = {'zbins': [float(z) for z in zbins], 'pdz_format': pdz_format}
+    if isinstance(pdz, DeltaPDZ):
+        meta['pdz_format'] = 'delta'
+        return {'pdz_bin': pdz.bins.astype('int32'), 'pdz_weight': pdz.weights}, meta
+    pdz = np.asarray(pdz, dtype='float64')
+    if pdz_format != 'uint16':
+        columns = {'pdz': pdz.astype(pdz_format)}
+    else:
+        scale = np.max(pdz, axis=1) / UINT16_MAX
+        scale[scale <= 0] = 1.
+        quantized = np.rint(pdz / scale[:, None])
+        columns = {'pdz': np.clip(quantized, 0, UINT16_MAX).astype('uint16'),
+                   'pdz_scale': scale}
+    if cdf:
+        quantized = np.rint(np.nan_to_num(cumulative_pdz(pdz, zbins)) * UINT16_MAX)
+        columns['pdz_cdf'] = np.clip(quantized, 0, UINT16_MAX).astype('uint16')
+    return columns, meta
+
+
+def read_zbins(table):
+    """Get the redshift grid of the pdzs stored in a table (see `read_pdz`)."""
+    if 'zbins' in table.meta:
+        return np.asarray(table.meta['zbins'], dtype='float64')
+    return np.asarray(table['zbins'][0], dtype='float64')  # all objects have same zbins
+
+
+def read_pdz(table, dense=True):
+    """Get the redshift grid and the float64 pdzs from a table.
+
+    Handles the compact format of `pdz_columns` (grid in the metadata, float32 or
+    scaled uint16 pdzs, or delta pdzs), as well as the former one (a 'zbins' column
+    repeating the redshift grid for each object).
+
+    :param table: astropy table with a 'pdz' column (or 'pdz_bin' and 'pdz_weight' ones)
+    :param bool dense: If False, delta pdzs are returned as a `DeltaPDZ`
+    :return: zbins (nbins,) and pdz (nobjects, nbins) arrays, as float64
+    """
+    zbins = read_zbins(table)
+    if 'pdz_bin' in table.colnames:
+        pdz = DeltaPDZ(zbins, table['pdz_bin'], table['pdz_weight'])
+        return zbins, pdz.dense() if dense else pdz
+    pdz = np.asarray(table['pdz'])
+    if 'pdz_scale' in table.colnames:
+        pdz = pdz * np.asarray(table['pdz_scale'], dtype='float64')[:, None]
+    return zbins, pdz.astype('float64', copy=False)
+
+
+def read_pdz_cdf(table):
+    """Get the redshift grid and the cumulative pdzs from a table.
+
+    Uses the 'pdz_cdf' column if there is one (see `pdz_columns`), and computes the
+    cumulative pdzs from the pdzs otherwise. For delta pdzs, the `DeltaPDZ` is returned
+    (see `cumulative_pdz`).
+
+    :param table: astropy table with a 'pdz' column
+    :return: zbins (nbins,) and cdf (nobjects, nbins) arrays, as float64
+    """
+    if 'pdz_cdf' not in table.colnames:
+        zbins, pdz = read_pdz(table, dense=False)
+        return zbins, cumulative_pdz(pdz, zbins)
+    zbins = read_zbins(table)
+    cdf = np.asarray(table['pdz_cdf'])
+    if cdf.dtype == np.uint16:
+        return zbins, cdf / UINT16_MAX
+    return zbins, cdf.astype('float64', copy=False)  # float cdf columns of former files
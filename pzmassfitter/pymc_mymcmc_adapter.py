@@ -19,7 +19,8 @@ except ImportError:
     pass
 from . import mymc
 from . import util
-from . import confidenceinterval as ci
+from . import mass_summary
+from . import flat_posterior
 
 
 class CompositeParameter(mymc.Parameter):
@@ -107,8 +108,62 @@ class DerivedFunction(mymc.DerivedParameter):
 #################################
 
 
+class FlatParameter(mymc.Parameter):
+    """One entry of the parameter array of a flat_posterior.FlatPosterior."""
+
+    def __init__(self, flat, index, width=0.1):
+        self.flat = flat
+        self.index = index
+        self.name = flat.names[index]
+        lower, upper = flat.bounds()
+        self.lower, self.upper = lower[index], upper[index]
+
+        self.width = width * np.abs(self())
+
+    def get_value(self):
+        return self.flat.theta[self.index]
+
+    def set(self, value):
+        self.flat.theta[self.index] = value
+
+    value = property(get_value, set)
+
+
+def wrapFlatModel(flat):
+    """Parameter space and trace of a flat_posterior.FlatPosterior, as `wrapModel` gives."""
+
+    parameters = sorted([FlatParameter(flat, i) for i in range(len(flat))],
+                        key=operator.attrgetter('name'))
+
+    deterministics = [DerivedFunction(function, name, flat.theta)
+                      for name, function in flat.derived]
+    deterministics = sorted(deterministics, key=operator.attrgetter('name'))
+    deterministics.append(DerivedFunction(flat.log_like, 'likelihood', flat.theta))
+    deterministics.append(DerivedFunction(flat.log_post, 'posterior', flat.theta))
+
+    def posterior(thing):
+        return flat.log_post(flat.theta)
+
+    grad_posterior = None
+    if flat.log_like_grad is not None:
+        order = [parameter.index for parameter in parameters]
+
+        def grad_posterior(thing):
+            logp, grad = flat.log_post_grad(flat.theta)
+            return logp, grad[order]
+
+    space = mymc.ParameterSpace(parameters, posterior, grad_posterior)
+
+    trace = mymc.ParameterSpace(deterministics + parameters)
+
+    return space, trace
+
+
 def wrapModel(model):
 
+    if isinstance(model, flat_posterior.FlatPosterior):
+        return wrapFlatModel(model)
+
     parameters = []
     deterministics = []
 
@@ -284,7 +339,12 @@ class MyMCMemRunner(object):
 
         step = mymc.Slice()
 
-        if len(space) == 1:
+        if options.get('sampler', 'slice') == 'nuts':
+            if space.grad_log_posterior is None:
+                raise ValueError("The NUTS sampler needs the gradient of the log-posterior "
+                                 "(flat model with likelihood_gradient support)")
+            updater = mymc.NUTSUpdater(space, adapt_steps=options.get('adapt_steps', 1000))
+        elif len(space) == 1:
             updater = mymc.CartesianSequentialUpdater(space, step, options.adapt_every,
                                                       options.adapt_after, parallel=parallel)
         else:
@@ -336,48 +396,17 @@ def dumpMasses(masses, outputFile):
     with open('%s.mass.pkl' % outputFile, 'wb') as output:
         pickle.dump(masses, output)
 
-    mean = np.mean(masses)
-    stddev = np.std(masses)
-    quantiles = pymc.utils.quantiles(
-        masses, qlist=[2.5, 15.8, 25, 50, 75, 84.1, 97.5])
-    hpd68 = pymc.utils.hpd(masses, 0.32)
-    hpd95 = pymc.utils.hpd(masses, 0.05)
-    ml, (m, p) = ci.maxDensityConfidenceRegion(masses)
-    lml, (lm, lp) = ci.maxDensityConfidenceRegion(np.log10(masses))
+    # all the statistics from a single sort of the masses
+    stats = mass_summary.summarize(masses)
+    lines = mass_summary.summary_lines(stats)
 
     with open('%s.mass.summary.txt' % outputFile, 'w') as output:
-        output.write('mean\t%e\n' % mean)
-        output.write('stddev\t%e\n' % stddev)
-        output.write('Q2.5\t%e\n' % quantiles[2.5])
-        output.write('Q25\t%e\n' % quantiles[25])
-        output.write('Q50\t%e\n' % quantiles[50])
-        output.write('Q75\t%e\n' % quantiles[75])
-        output.write('Q97.5\t%e\n' % quantiles[97.5])
-        output.write('HPD68\t%e\t%e\n' % (hpd68[0], hpd68[1]))
-        output.write('HPD95\t%e\t%e\n' % (hpd95[0], hpd95[1]))
-        output.write('MaxLike\t%e\t%e\t%e\n' % (ml, m, p))
-        output.write('Log10 Maxlike\t%e\t%e\t%e\n' % (lml, lm, lp))
-        output.close()
+        output.write(''.join('%s\n' % line for line in lines))
 
     with open('%s.mass.summary.pkl' % outputFile, 'wb') as output:
-        stats = {'mean': mean,
-                 'stddev': stddev,
-                 'quantiles': quantiles,
-                 'hpd68': hpd68,
-                 'hpd95': hpd95,
-                 'maxlike': (ml, (m, p)),
-                 'log10maxlike': (lml, (lm, lp))}
         pickle.dump(stats, output)
-        output.close()
-
-    print('mean\t%e' % mean)
-    print('stddev\t%e' % stddev)
-    print('Q2.5\t%e' % quantiles[2.5])
-    print('Q25\t%e' % quantiles[25])
-    print('Q50\t%e' % quantiles[50])
-    print('Q75\t%e' % quantiles[75])
-    print('Q97.5\t%e' % quantiles[97.5])
-    print('HPD68\t%e\t%e' % (hpd68[0], hpd68[1]))
-    print('HPD95\t%e\t%e' % (hpd95[0], hpd95[1]))
-    print('MaxLike\t%e\t%e\t%e\n' % (ml, m, p))
-    print('Log10 Maxlike\t%e\t%e\t%e\n' % (lml, lm, lp))
+
+    for line in lines[:-2]:
+        print(line)
+    for line in lines[-2:]:
+        print('%s\n' % line)
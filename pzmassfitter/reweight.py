@@ -0,0 +1,167 @@
+"""Importance sampling reweighting of mass chains to a new prior or likelihood.
+
+A chain sampled from a posterior p_old (saved by maxlike_masses.SampleModelToFile.dump,
+with its `likelihood` and `posterior` columns) is a weighted sample of any other posterior
+p_new of the same parameters, with weights p_new / p_old. Changing the mass or
+concentration priors, or the shear calibration model, then does not need a new MCMC run, as
+long as p_new is not too different from p_old: the effective sample size of the weights
+tells how many independent samples are left (see `reweight_chain`).
+
+Only the terms that changed are evaluated: the priors of the new model are evaluated on all
+the samples at once (FlatPosterior.log_prior_samples), and its likelihood is only evaluated
+(once per distinct sample) if it differs from the one of the chain.
+"""
+
+
+from __future__ import print_function
+try:
+    import cPickle as pickle  # python 2
+except ImportError:
+    import pickle  # python 3
+import numpy as np
+from .laplace import importance_weights, effective_sample_size
+
+
+# Columns of the chains which are not sampled parameters
+DERIVED = ('mdelta', 'cdelta', 'likelihood', 'posterior')
+
+# Parameters of the mass, log10mdelta or mdelta / massscale (see maxlike_masses)
+MASS_PARAMETERS = ('scaledmdelta', 'log10mdelta')
+
+QUANTILES = [2.5, 15.8, 25, 50, 75, 84.1, 97.5]
+
+
+class ReweightingError(ValueError):
+    """The chain cannot be reweighted to the new model."""
+    pass
+
+
+def load_chain(filename, burn=0):
+    """Chain saved by SampleModelToFile.dump, as a dictionary of arrays, without the first
+    `burn` samples."""
+    with open(filename, 'rb') as chainfile:
+        chain = pickle.load(chainfile)
+    return dict((name, np.asarray(values, dtype=np.float64)[burn:])
+                for name, values in chain.items())
+
+
+def mass_parameter(mdelta, name, massscale):
+    """Value of a mass parameter, and log |d mdelta / d parameter|, for masses `mdelta`."""
+    if name == 'log10mdelta':
+        return np.log10(mdelta), np.log(np.log(10.) * mdelta)
+    return mdelta / massscale, np.full(len(mdelta), np.log(massscale))
+
+
+def chain_parameters(chain, flat, massscale=1e14):
+    """Parameter arrays of a FlatPosterior at the samples of a chain.
+
+    The mass parameter of the chain and of `flat` may differ (linear or log10 prior). Both
+    densities are then compared per unit of the mass parameter of the chain, with the
+    log-Jacobian returned here.
+
+    :return: array of shape (nsamples, npar), and the log-Jacobian log |d new / d old| of
+     the change of mass parameter (array)
+    :raise ReweightingError: if the sampled parameters of the chain and of `flat` differ
+    """
+    nsamples = len(chain['posterior'])
+    thetas = np.tile(flat.theta, (nsamples, 1))
+    logjac = np.zeros(nsamples)
+    old = [name for name in MASS_PARAMETERS if name in chain]
+
+    missing = []
+    for i, name in enumerate(flat.names):
+        if name in MASS_PARAMETERS and old:
+            thetas[:, i], dlognew = mass_parameter(chain['mdelta'], name, massscale)
+            logjac += mass_parameter(chain['mdelta'], old[0], massscale)[1] - dlognew
+        elif name in chain:
+            thetas[:, i] = chain[name]
+        else:
+            missing.append(name)
+    extra = [name for name in chain if name not in DERIVED + MASS_PARAMETERS and
+             name not in flat.names]
+    if missing or extra:
+        raise ReweightingError("The chain and the new model do not sample the same parameters "
+                               "(missing from the chain: %s; missing from the model: %s)" %
+                               (', '.join(missing) or 'none', ', '.join(extra) or 'none'))
+    return thetas, logjac
+
+
+def log_like_samples(flat, thetas):
+    """Log-likelihood of a FlatPosterior at each of the parameter arrays of `thetas`,
+    evaluated once per distinct parameter array (repeated states of the chain)."""
+    unique, inverse = np.unique(thetas, axis=0, return_inverse=True)
+    loglike = np.array([flat.log_like(theta) for theta in unique])
+    return loglike[np.ravel(inverse)]
+
+
+def reweight_chain(chain, flat, massscale=1e14, min_ess=100, nchecks=5):
+    """Importance weights of the samples of a chain for the posterior of a FlatPosterior.
+
+    The log-likelihood of `flat` is first evaluated on `nchecks` samples. If it matches the
+    `likelihood` column of the chain (only the priors changed), the likelihood of the
+    chain is reused; otherwise it is evaluated on all the samples.
+
+    :param chain: dictionary of arrays (see `load_chain`)
+    :param flat: flat_posterior.FlatPosterior of the new model
+    :param float massscale: Scale of the `scaledmdelta` parameter (maxlike_masses.massscale)
+    :param int min_ess: Minimum effective sample size of the weights
+    :param int nchecks: Number of samples on which the likelihood is compared
+    :return: dictionary with the normalized weights (`weights`), their logarithm (`logw`),
+     the effective sample size (`ess`), the maximum normalized weight (`max_weight`) and
+     whether the likelihood was re-evaluated (`likelihood_changed`)
+    :raise ReweightingError: if the parameters of the chain and of the model differ, or if
+     the weights are degenerate (effective sample size below `min_ess`)
+    """
+    for name in ('likelihood', 'posterior', 'mdelta'):
+        if name not in chain:
+            raise ReweightingError("The chain has no '%s' column" % name)
+    thetas, logjac = chain_parameters(chain, flat, massscale)
+    nsamples = len(thetas)
+
+    checks = np.linspace(0, nsamples - 1, min(nchecks, nsamples)).astype(int)
+    checked = np.array([flat.log_like(thetas[i]) for i in checks])
+    changed = not np.allclose(checked, chain['likelihood'][checks], rtol=1e-8, atol=1e-6)
+    loglike = log_like_samples(flat, thetas) if changed else chain['likelihood']
+
+    with np.errstate(invalid='ignore'):
+        logw = flat.log_prior_samples(thetas) + loglike + logjac - chain['posterior']
+    logw[np.isnan(logw)] = -np.inf
+    weights = importance_weights(logw)
+    ess = effective_sample_size(weights)
+
+    if ess < min_ess:
+        if not np.any(weights):
+            reason = "no sample of the chain has a finite probability in the new model"
+        else:
+            reason = "effective sample size %.1f of %d samples (largest weight %.3f)" % \
+                (ess, nsamples, np.max(weights))
+        raise ReweightingError("Degenerate importance weights: %s. The new posterior is too "
+                               "different from the one of the chain; run the MCMC instead."
+                               % reason)
+
+    return {'weights': weights,
+            'logw': logw,
+            'ess': ess,
+            'max_weight': np.max(weights),
+            'likelihood_changed': changed}
+
+
+def weighted_quantiles(values, weights, qlist=QUANTILES):
+    """Quantiles (in percent) of weighted samples, interpolated between the midpoints of the
+    cumulative weights of the sorted samples."""
+    order = np.argsort(values)
+    values, weights = np.asarray(values)[order], np.asarray(weights)[order]
+    cumulative = np.cumsum(weights) - 0.5 * weights
+    cumulative /= np.sum(weights)
+    return dict((q, np.interp(q / 100., cumulative, values)) for q in qlist)
+
+
+def weighted_summary(values, weights):
+    """Mean, standard deviation and quantiles of weighted samples, with the effective sample
+    size of the weights."""
+    weights = np.asarray(weights, dtype=np.float64) / np.sum(weights)
+    mean = np.sum(weights * values)
+    return {'mean': mean,
+            'stddev': np.sqrt(np.sum(weights * (values - mean)**2)),
+            'quantiles': weighted_quantiles(values, weights),
+            'ess': effective_sample_size(weights)}
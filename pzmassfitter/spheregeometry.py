@@ -0,0 +1,183 @@
+"""Spherical geometry kernels used to project shears around cluster centers, and to
+match catalogs on the sky."""
+
+
+from __future__ import print_function
+import os
+import hashlib
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+def shear_kernel(ra, dec, center_ra, center_dec):
+    """Angular separation and orientation of galaxies around one or several centers.
+
+    Equivalent to the astropy computation::
+
+        coord_gal = SkyCoord(ra, dec, unit='deg')
+        coord_cl = SkyCoord(center_ra, center_dec, unit='deg')
+        posangle = -((pi / 2.) - coord_gal.position_angle(coord_cl).rad)
+        r = coord_gal.separation(coord_cl).rad
+        cos2phi, sin2phi = cos(2 * posangle), sin(2 * posangle)
+
+    but computed directly on the float64 arrays: cos(2phi) and sin(2phi) are built
+    from the two components of the position angle, without any intermediate angle.
+
+    :param ra: right ascensions of the galaxies, in degrees (array like)
+    :param dec: declinations of the galaxies, in degrees (array like)
+    :param center_ra: right ascension(s) of the center(s), in degrees. A scalar, or
+     an array of several centers.
+    :param center_dec: declination(s) of the center(s), in degrees
+    :return: r (in radians), cos2phi and sin2phi. Arrays of shape (ngal,) for a single
+     center, or (ncenter, ngal) for an array of centers.
+    """
+    ra = np.radians(np.asarray(ra, dtype='float64'))
+    dec = np.radians(np.asarray(dec, dtype='float64'))
+    center_ra = np.radians(np.asarray(center_ra, dtype='float64'))
+    center_dec = np.radians(np.asarray(center_dec, dtype='float64'))
+    if center_ra.ndim:
+        center_ra, center_dec = center_ra[:, None], center_dec[:, None]
+
+    sindec, cosdec = np.sin(dec), np.cos(dec)
+    sindec0, cosdec0 = np.sin(center_dec), np.cos(center_dec)
+    dra = center_ra - ra
+    cosdra = np.cos(dra)
+
+    # Position angle of the center seen from the galaxy: atan2(y, x)
+    y = np.sin(dra) * cosdec0
+    x = cosdec * sindec0 - sindec * cosdec0 * cosdra
+    norm2 = x**2 + y**2
+
+    # Vincenty formula, as in astropy
+    r = np.arctan2(np.sqrt(norm2), sindec * sindec0 + cosdec * cosdec0 * cosdra)
+
+    # phi = PA - pi/2, so cos(2phi) = -cos(2PA) and sin(2phi) = -sin(2PA)
+    # (PA = 0 at zero separation, as atan2(0, 0) does)
+    null = norm2 == 0
+    norm2 = np.where(null, 1., norm2)
+    cos2phi = np.where(null, -1., (y**2 - x**2) / norm2)
+    sin2phi = np.where(null, 0., -2. * x * y / norm2)
+
+    return r, cos2phi, sin2phi
+
+
+def tangential_shear(e1, e2, cos2phi, sin2phi):
+    """Return the tangential (E) and cross (B) shears."""
+    E = -(e1 * cos2phi + e2 * sin2phi)
+    B = e1 * sin2phi - e2 * cos2phi
+    return E, B
+
+
+def unit_vectors(ra, dec):
+    """Cartesian unit vectors, of shape (n, 3), of sky coordinates given in degrees."""
+    ra = np.radians(np.asarray(ra, dtype='float64'))
+    dec = np.radians(np.asarray(dec, dtype='float64'))
+    cosdec = np.cos(dec)
+    return np.column_stack([cosdec * np.cos(ra), cosdec * np.sin(ra), np.sin(dec)])
+
+
+def coords_key(*arrays):
+    """Hash (hex digest) of the content of several coordinate arrays."""
+    sha = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(np.asarray(array, dtype='float64'))
+        sha.update(str(len(array)).encode())
+        sha.update(array.tobytes())
+    return sha.hexdigest()
+
+
+class SkyIndex(object):
+    """Nearest neighbour index (KD-tree on unit vectors) over the positions of a catalog.
+
+    Gives the same matches as astropy's `SkyCoord.match_to_catalog_sky`, but the tree is
+    built once and can be queried several times.
+    """
+
+    def __init__(self, ra, dec):
+        """Build the index.
+
+        :param ra: right ascensions of the catalog, in degrees
+        :param dec: declinations of the catalog, in degrees
+        """
+        self.ra = np.asarray(ra, dtype='float64')
+        self.dec = np.asarray(dec, dtype='float64')
+        self.tree = cKDTree(unit_vectors(self.ra, self.dec))
+        self._key = None
+
+    def __len__(self):
+        return len(self.ra)
+
+    @property
+    def key(self):
+        """Hash of the coordinates of the catalog."""
+        if self._key is None:
+            self._key = coords_key(self.ra, self.dec)
+        return self._key
+
+    def match(self, ra, dec):
+        """Find the closest entry of the catalog to each of the given positions.
+
+        :return: indices into the catalog, on-sky separations (in degrees) and 3D
+         (chord) distances on the unit sphere
+        """
+        d3d, idx = self.tree.query(unit_vectors(ra, dec))
+        d2d = np.degrees(2. * np.arcsin(np.minimum(d3d / 2., 1.)))
+        return idx.astype('int64'), d2d, d3d
+
+    def pairs(self, radius):
+        """Find all the pairs of entries of the catalog closer than a given separation.
+
+        :param float radius: on-sky separation, in degrees
+        :return: an int64 array of shape (npairs, 2), with i < j in each pair (i, j)
+        """
+        chord = 2. * np.sin(np.radians(min(radius, 180.)) / 2.)
+        return self.tree.query_pairs(chord, output_type='ndarray').astype('int64')
+
+
+def duplicate_groups(ra, dec, precision=1e-3):
+    """Group the entries of a catalog whose positions are the same up to a precision.
+
+    Entries closer than `precision` are linked, and each group of linked entries gets
+    one label: close positions are grouped wherever they are on the sky, including on
+    either side of RA = 0/360. Used to find duplicated entries in a catalog.
+
+    :param ra: right ascensions, in degrees
+    :param dec: declinations, in degrees
+    :param float precision: Separation below which entries are duplicates, in arcsec
+    :return: int64 labels, numbered from 0 in order of first occurrence
+    """
+    index = SkyIndex(ra, dec)
+    pairs = index.pairs(precision / 3600.)
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                       shape=(len(index), len(index)))
+    labels = connected_components(graph, directed=False)[1]
+    _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype='int64')
+    rank[np.argsort(first)] = np.arange(len(first))
+    return rank[inverse.ravel()]
+
+
+def sky_match(index, ra, dec, match_file=None):
+    """Match positions to a catalog, optionally caching the result in a file.
+
+    :param SkyIndex index: Index of the catalog to match to
+    :param ra: right ascensions of the positions to match, in degrees
+    :param dec: declinations of the positions to match, in degrees
+    :param str match_file: If given, the match is loaded from this numpy (npz) file
+     when it was computed for the same catalog and positions, and computed then saved
+     in this file otherwise.
+    :return: indices, on-sky separations (in degrees) and 3D distances (see
+     `SkyIndex.match`)
+    """
+    key = index.key + coords_key(ra, dec)
+    if match_file is not None and os.path.exists(match_file):
+        saved = np.load(match_file)
+        if str(saved['key']) == key:
+            print("INFO: Sky match loaded from", match_file)
+            return saved['idx'], saved['d2d'], saved['d3d']
+    idx, d2d, d3d = index.match(ra, dec)
+    if match_file is not None:
+        np.savez(match_file, key=key, idx=idx, d2d=d2d, d3d=d3d)
+    return idx, d2d, d3d
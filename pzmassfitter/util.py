@@ -2,8 +2,12 @@
 
 
 from __future__ import print_function
+import os
 import re
+import hashlib
+import itertools
 import numpy as np
+from . import join
 
 
 class VarContainer(dict):
@@ -51,6 +55,56 @@ def readtxtfile(filename):
         return rows
 
 
+def _file_stamp(filename, nbytes=1048576):
+    """Identify the content of a file by its size, date, and a hash of its two ends."""
+    stat = os.stat(filename)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as infile:
+        digest.update(infile.read(nbytes))
+        infile.seek(max(0, stat.st_size - nbytes))
+        digest.update(infile.read(nbytes))
+    return "%i %i %s" % (stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+
+
+def read_numeric_table(filename, usecols=None, sidecar=True, chunksize=200000):
+    """Read a whitespace-separated numeric text file ('#' comments) as a float64 array.
+
+    The file is parsed by chunks of lines with the C parser of numpy. The result is
+    then saved in a binary sidecar file (filename + '.npy'), which is memory-mapped
+    instead of parsing the text again, as long as the text file did not change (its
+    size, date and content are checked against a stamp file, filename + '.npy.stamp').
+
+    :param str filename: Name of the text file
+    :param list usecols: Only return these columns
+    :param bool sidecar: Use (and create) the binary sidecar file
+    :param int chunksize: Number of lines parsed at once
+    :return: A 2D array of shape (nrows, ncolumns)
+    """
+    npyfile, stampfile = filename + '.npy', filename + '.npy.stamp'
+    stamp = _file_stamp(filename) if sidecar else None
+    if sidecar and os.path.exists(npyfile) and os.path.exists(stampfile) and \
+       open(stampfile).read() == stamp:
+        table = np.load(npyfile, mmap_mode='r')
+    else:
+        chunks = []
+        with open(filename) as infile:
+            while True:
+                lines = list(itertools.islice(infile, chunksize))
+                if not len(lines):
+                    break
+                chunk = np.loadtxt(lines, ndmin=2)
+                if chunk.size:
+                    chunks.append(chunk)
+        table = np.concatenate(chunks) if len(chunks) else np.zeros((0, 0))
+        if sidecar:
+            tmp = npyfile + '.%i.tmp.npy' % os.getpid()
+            np.save(tmp, table)
+            os.replace(tmp, npyfile)
+            with open(stampfile, 'w') as output:
+                output.write(stamp)
+    return table if usecols is None else table[:, usecols]
+
+
 def loadchains(chainfilenames, trim=False):
     """Load Output chains from MyMC."""
     chainfiles = [readtxtfile(x) for x in chainfilenames]
@@ -73,18 +127,10 @@ def loadchains(chainfilenames, trim=False):
     return chain
 
 
-def matchById(firstcat, othercat, otherid='SeqNr', selfid='SeqNr'):
-    """Returns a subset of the first catalog, that matches the order of the second catalog."""
-    order = {}
-    for i, fid in enumerate(firstcat[selfid]):
-        order[fid] = i
-
-    keeporder = []
-    for oid in othercat[otherid]:
-        if oid in order:
-            keeporder.append(order[oid])
+def matchById(firstcat, othercat, otherid='SeqNr', selfid='SeqNr', index_file=None):
+    """Returns a subset of the first catalog, that matches the order of the second catalog.
 
-    keep = np.array(keeporder)
-    matched = firstcat[keep]
-    print("INFO: %i matched galaxies kept" % len(matched))
-    return matched
+    :param str index_file: Optional file in which the sorted index of the first catalog
+     IDs is persisted (see `join.get_index`)
+    """
+    return join.gather(firstcat, firstcat[selfid], othercat[otherid], index_file=index_file)
@@ -0,0 +1,164 @@
+"""Tabulated Voigt profile, for the likelihood of the voigt shape distribution.
+
+nfwmodeltools.bentvoigt_like evaluates the Voigt profile of voigt.c for each galaxy and
+redshift bin at every call of the likelihood, while the profile only depends on the two
+parameters (sigma, gamma) of the shape distribution. A `VoigtTable` tabulates the (even)
+profile on a uniform grid of |delta| for the current (sigma, gamma), and interpolates it
+linearly. The table is only rebuilt when sigma or gamma change: the mass and shear
+calibration updates of the sampler, and the mass grids of likelihood_grid, reuse it.
+
+The profile is computed from the Faddeeva function (scipy.special.wofz). The spacing of the
+grid is chosen so that the relative error of the interpolation is below `tolerance`: it is
+checked against the exact profile at the midpoints of the grid intervals, where the error of
+a linear interpolation is largest, and the grid is refined until it passes. The default
+tolerance is ten times smaller than the relative accuracy (1e-4) of the approximation of
+voigt.c. Residuals beyond the range of the table are evaluated exactly.
+
+`benchmark` compares the timings and the accuracy of the table and of the exact profile.
+"""
+
+
+from __future__ import print_function
+import time
+import numpy as np
+from scipy.special import wofz
+from . import likelihood_grid
+
+
+SQRT2 = np.sqrt(2.)
+SQRT2PI = np.sqrt(2 * np.pi)
+
+# Default maximum relative error of the interpolation
+TOLERANCE = 1e-5
+
+# Default range |delta| < XMAX of the table (as voigtcall.interpvoigtcall)
+XMAX = 5.
+
+# Limit of the number of intervals of a table
+MAXINTERVALS = 2**22
+
+
+def voigt_profile(delta, sigma, gamma):
+    """Voigt profile of voigt.c (gaussian width sigma, lorentzian full width gamma), as the
+    real part of the Faddeeva function, Re[w(z)] / (sigma sqrt(2 pi)) with
+    z = (delta + i gamma / 2) / (sigma sqrt(2))."""
+    z = (np.asarray(delta, dtype=np.float64) + 0.5j * gamma) / (sigma * SQRT2)
+    return wofz(z).real / (sigma * SQRT2PI)
+
+
+class VoigtTable(object):
+    """Voigt profile interpolated in a table, rebuilt when (sigma, gamma) change.
+
+    Calling the table, ``table(delta, sigma, gamma)``, returns the profile at the residuals
+    `delta` (array), as voigtcall.voigtcall.
+    """
+
+    def __init__(self, tolerance=TOLERANCE, xmax=XMAX):
+        """
+        :param float tolerance: Maximum relative error of the interpolation
+        :param float xmax: Range |delta| < xmax of the table
+        """
+        self.tolerance = tolerance
+        self.xmax = xmax
+        self.sigma = self.gamma = None
+        self.nbuilds = 0
+
+    def build(self, sigma, gamma):
+        """Tabulate the profile for (sigma, gamma), unless it already is.
+
+        The initial spacing sigma sqrt(8 tolerance) / 3 bounds the relative error
+        h**2 / 8 |f''| / f of the gaussian core up to 3 sigma. The relative error at the
+        midpoints of the intervals is then measured, and the spacing is reduced as
+        sqrt(tolerance / error) until it is below the tolerance. The error reached is kept
+        in `error`.
+        """
+        if sigma == self.sigma and gamma == self.gamma:
+            return
+        nintervals = int(np.ceil(3 * self.xmax / (sigma * np.sqrt(8 * self.tolerance))))
+        while True:
+            # nodes at the even points of the fine grid, midpoints at the odd ones
+            fine = voigt_profile(np.linspace(0, self.xmax, 2 * nintervals + 1), sigma, gamma)
+            values = fine[::2]
+            error = np.max(np.abs(0.5 * (values[1:] + values[:-1]) - fine[1::2]) / fine[1::2])
+            if error <= self.tolerance or nintervals >= MAXINTERVALS:
+                break
+            nintervals = min(int(np.ceil(1.05 * nintervals * np.sqrt(error / self.tolerance))),
+                             MAXINTERVALS)
+        if error > self.tolerance:
+            print("WARNING: Voigt table for sigma=%g, gamma=%g has a relative error of %g"
+                  % (sigma, gamma, error))
+
+        self.values = values
+        self.slopes = np.diff(values)
+        self.step = self.xmax / nintervals
+        self.error = error
+        self.sigma, self.gamma = sigma, gamma
+        self.nbuilds += 1
+
+    def __call__(self, delta, sigma, gamma):
+        self.build(sigma, gamma)
+        absdelta = np.abs(np.asarray(delta, dtype=np.float64))
+        inside = absdelta < self.xmax
+        position = np.where(inside, absdelta, 0.) / self.step
+        index = position.astype(np.intp)
+        prob = self.values[index] + (position - index) * self.slopes[index]
+        if not np.all(inside):
+            prob[~inside] = voigt_profile(absdelta[~inside], sigma, gamma)
+        return prob
+
+    def shape(self, sigma, gamma):
+        """Shape distribution for (sigma, gamma), function of the residuals (see
+        likelihood_grid.voigt_shape)."""
+        def shape_like(delta):
+            return self(delta, sigma, gamma)
+        return shape_like
+
+
+def tabulated_bentvoigt_like(table):
+    """Log-likelihood of nfwmodeltools.bentvoigt_like, with the profile of a VoigtTable.
+
+    The returned function takes the arguments of bentvoigt_like; its pdzs may also be a
+    pdzfile_utils.DeltaPDZ.
+    """
+    def like(mdelta, cdelta, r_mpc, ghats, zs, betas, pz, m, c, sigma, gamma,
+             rho_c, rho_c_over_sigma_c, massdelta):
+        return np.sum(likelihood_grid.galaxy_loglike(mdelta, cdelta, r_mpc, ghats, zs, betas,
+                                                     pz, m, c, table.shape(sigma, gamma),
+                                                     rho_c, rho_c_over_sigma_c, massdelta))
+    return like
+
+
+def benchmark(nresiduals=10**6, sigma=0.325, gamma=0.0515, tolerance=TOLERANCE,
+              scatter=0.3, seed=None):
+    """Timings of the exact and tabulated profiles, and error of the table.
+
+    :param int nresiduals: Number of residuals, drawn from a gaussian of width `scatter`
+    :return: dictionary with the time of the exact evaluation (`exact`), of the table build
+     (`build`) and of its interpolation (`interpolation`), in seconds, and the maximum
+     relative error of the table on the residuals (`error`)
+    """
+    delta = np.random.RandomState(seed).normal(0., scatter, nresiduals)
+    table = VoigtTable(tolerance)
+
+    start = time.time()
+    exact = voigt_profile(delta, sigma, gamma)
+    timings = {'exact': time.time() - start}
+    start = time.time()
+    table.build(sigma, gamma)
+    timings['build'] = time.time() - start
+    start = time.time()
+    interpolated = table(delta, sigma, gamma)
+    timings['interpolation'] = time.time() - start
+    timings['error'] = np.max(np.abs(interpolated - exact) / exact)
+    return timings
+
+
+if __name__ == '__main__':
+
+    for sig, gam in [(0.15, 0.003), (0.325, 0.0515), (0.5, 0.1)]:
+        result = benchmark(sigma=sig, gamma=gam, seed=0)
+        print("sigma=%.3f gamma=%.4f: exact %.4f s, table build %.4f s + interpolation "
+              "%.4f s (speedup %.1f), max relative error %.2e" %
+              (sig, gam, result['exact'], result['build'], result['interpolation'],
+               result['exact'] / (result['build'] + result['interpolation']),
+               result['error']))
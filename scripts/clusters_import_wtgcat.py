@@ -9,6 +9,7 @@ import astropy.table as table
 import numpy as np
 import pyfits
 from pzmassfitter import util
+from pzmassfitter import pdzfile_utils
 
 
 input_dir = '/Users/combet/RECHERCHE/LSST/RTF/WtG_catalogues/'
@@ -51,7 +52,6 @@ pdz = cat_pdz_wtg[1].data['pdz']/cat_pdz_wtg[1].header['PDZSTEP']
 zrange = np.arange(cat_pdz_wtg[1].header['MINPDZ'],
                    cat_pdz_wtg[1].header['MAXPDZ'],
                    cat_pdz_wtg[1].header['PDZSTEP'])
-zbinsgrid = np.vstack(len(id1) * [zrange])
 
 good_bpz = util.matchById(cat_bpz_wtg[1].data,cat_wtg[4].data, otherid='SeqNr', selfid='SeqNr')
 good_pdz = util.matchById(cat_pdz_wtg[1].data,cat_wtg[4].data, otherid='SeqNr', selfid='SeqNr')
@@ -67,9 +67,9 @@ good_pdz = util.matchById(cat_pdz_wtg[1].data,cat_wtg[4].data, otherid='SeqNr',
 z_cl = 0.447
 #flag_hard = (good_bpz['BPZ_Z_B'] > z_cl + 0.1) & (good_bpz['BPZ_Z_B'] < 1.25)
 flag_hard = (good_bpz['BPZ_Z_B'] > -0.1) & (good_bpz['BPZ_Z_B'] < 99)
-cut = zrange < z_cl + 0.1
 thresh = 1  # threshold probability for the galaxy to be located below z_cl + 0.1
-flag_pdz = np.array([np.trapz(pdzi[cut], zrange[cut]) * 100. < thresh for pdzi in good_pdz['pdz']])
+cdf = pdzfile_utils.cumulative_pdz(good_pdz['pdz'], zrange)
+flag_pdz = pdzfile_utils.prob_below(cdf, zrange, z_cl + 0.1) * 100. < thresh
 
 # size and snratio, required when running pzmassfitter with STEP2 shear calibration
 size = cat_wtg[4].data['rh']
@@ -81,13 +81,16 @@ deepCoadd_meas = table.Table([id1, ra, dec, e1, e2, size, snratio],
                                     'ext_shapeHSM_HsmShapeRegauss_e1',
                                     'ext_shapeHSM_HsmShapeRegauss_e2',
                                     'rh', 'snratio_scaled1'))
-pdz_values = table.Table([id1, good_bpz['BPZ_Z_B'],good_pdz['pdz'], zbinsgrid],
-                         names=('objectId', 'Z_BEST', 'pdz', 'zbins'))
+pdz_columns, pdz_meta = pdzfile_utils.pdz_columns(good_pdz['pdz'], zrange, cdf=True)
+pdz_values = table.Table([id1, good_bpz['BPZ_Z_B']], names=('objectId', 'Z_BEST'))
+for name in sorted(pdz_columns):
+    pdz_values[name] = pdz_columns[name]
+pdz_values.meta.update(pdz_meta)
 flag = table.Table([id1, flag_hard,flag_pdz],
                    names=('objectId','flag_z_hard','flag_z_pdz'))
 
 deepCoadd_meas.write(catfile, path='deepCoadd_meas', overwrite=True)
-pdz_values.write(catfile, path='zphot_ref',append=True)
+pdz_values.write(catfile, path='zphot_ref', append=True, serialize_meta=True)
 flag.write(catfile, path='flag_zphot_ref',append=True)
 
 
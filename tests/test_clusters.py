@@ -1,7 +1,16 @@
 """Test the reddening module."""
 
 import os
+import sys
+import stat
+import shutil
+import tempfile
+import numpy as np
+from astropy.table import Table
 from clusters.mains import data, extinction, zphot
+from clusters import zphot as czphot
+from clusters import utils as cutils
+from clusters import background as cbackground
 
 CONFIG = "testdata/travis_test.yaml"
 DATAFILE = "travis_test_data.hdf5"
@@ -59,3 +68,521 @@ def test_main(config=CONFIG, datafile=DATAFILE):
     extinction.extinction([config, filtered_data, "--overwrite"])
     zphot.photometric_redshift([config, filtered_data, "--overwrite"])
 #    main.getbackground([config, filtered_data, "--overwrite"])    
+
+
+# Test the photoz wrappers with a stand-in for zphota
+
+FAKE_ZPHOTA = """#!%s
+import os, sys
+import numpy as np
+args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+open('calls', 'a').write(args['-CAT_IN'] + '\\n')
+if 'shard1' in args['-CAT_IN'] and os.path.exists('fail_once'):
+    os.remove('fail_once')
+    sys.exit(1)
+cat = np.loadtxt(args['-CAT_IN'], ndmin=2)
+zbins = np.arange(0, 3, 0.1)
+zbest = cat[:, 1] / 10.
+np.savetxt(args['-CAT_OUT'], np.column_stack([cat[:, 0], zbest]), header='fake zphota')
+np.savetxt(args['-PDZ_OUT'] + '.zph', zbins)
+np.savetxt(args['-PDZ_OUT'] + '.pdz', np.exp(-0.5 * ((zbins - zbest[:, None]) / 0.1)**2))
+"""
+
+
+def setup_fake_lephare(tmpdir):
+    """Set up a LEPHARE environment using a stand-in executable in tmpdir."""
+    os.environ['LEPHAREDIR'] = tmpdir
+    os.mkdir('config')
+    with open('config/zphot_output.para', 'w') as para:
+        para.write("IDENT\nZ_BEST\n")
+    with open('zphota', 'w') as exe:
+        exe.write(FAKE_ZPHOTA % sys.executable)
+    os.chmod('zphota', os.stat('zphota').st_mode | stat.S_IEXEC)
+    czphot.LEPHARE.executable = os.path.join(tmpdir, 'zphota')
+
+    rng = np.random.RandomState(31)
+    ngals = 101
+    mags = [rng.uniform(10, 25, ngals) for f in 'gri']
+    errs = [rng.uniform(0.01, 0.1, ngals) for f in 'gri']
+    kwargs = {'filters': ['g', 'r', 'i'], 'id': np.arange(ngals) + 1000,
+              'ra': rng.uniform(0, 1, ngals), 'dec': rng.uniform(0, 1, ngals)}
+    return mags, errs, kwargs
+
+
+def test_lephare_sharded():
+    """Run LEPHARE by shards (stand-in executable) and compare with a single run."""
+    tmpdir = tempfile.mkdtemp()
+    cwd, lepharedir = os.getcwd(), os.environ.get('LEPHAREDIR')
+    try:
+        os.chdir(tmpdir)
+        mags, errs, kwargs = setup_fake_lephare(tmpdir)
+        open('fail_once', 'w').close()
+
+        single = czphot.LEPHARE(mags, errs, zpara='config/zphot_output.para',
+                                basename='single', **kwargs)
+        single.run()
+        sharded = czphot.LEPHARE(mags, errs, zpara='config/zphot_output.para',
+                                 basename='sharded', **kwargs)
+        sharded.run(jobs=4, retries=1)
+
+        assert not os.path.exists('fail_once')  # the failed shard was run again
+        for key in single.data_out.data_dict:
+            assert np.allclose(single.data_out.data_dict[key], sharded.data_out.data_dict[key])
+        assert np.allclose(single.data_out.pdz_val, sharded.data_out.pdz_val)
+        assert (sharded.data_out.data_dict['IDENT'] == np.arange(len(mags[0]))).all()
+    finally:
+        czphot.LEPHARE.executable = 'zphota'
+        os.chdir(cwd)
+        if lepharedir is not None:
+            os.environ['LEPHAREDIR'] = lepharedir
+        shutil.rmtree(tmpdir)
+
+
+def test_lephare_cache():
+    """Run LEPHARE through the photoz cache: complete, then partial hits."""
+    tmpdir = tempfile.mkdtemp()
+    cwd, lepharedir = os.getcwd(), os.environ.get('LEPHAREDIR')
+    try:
+        os.chdir(tmpdir)
+        mags, errs, kwargs = setup_fake_lephare(tmpdir)
+        cache = czphot.ZPHOTCache(os.path.join(tmpdir, 'cache'))
+        zpara = 'config/zphot_output.para'
+
+        reference = czphot.run_cached(czphot.LEPHARE, mags, errs, None, zpara=zpara, **kwargs)
+
+        # Fill the cache with part of the catalog, then run on the whole (shuffled) catalog
+        half = {k: v[:50] if k != 'filters' else v for k, v in kwargs.items()}
+        czphot.run_cached(czphot.LEPHARE, [m[:50] for m in mags], [e[:50] for e in errs],
+                          cache, zpara=zpara, **half)
+        order = np.random.RandomState(32).permutation(len(mags[0]))
+        shuffled = {k: v[order] if k != 'filters' else v for k, v in kwargs.items()}
+        partial = czphot.run_cached(czphot.LEPHARE, [m[order] for m in mags],
+                                    [e[order] for e in errs], cache, zpara=zpara, **shuffled)
+        assert np.allclose(partial.data_dict['Z_BEST'], reference.data_dict['Z_BEST'][order])
+        assert np.allclose(partial.pdz_val, reference.pdz_val[:, order])
+
+        # Complete hit: the external code must not be called
+        ncalls = len(open('calls').readlines())
+        complete = czphot.run_cached(czphot.LEPHARE, mags, errs, cache, zpara=zpara, **kwargs)
+        assert len(open('calls').readlines()) == ncalls
+        assert np.allclose(complete.pdz_val, reference.pdz_val)
+        assert complete.data_dict['Z_BEST'].shape == reference.data_dict['Z_BEST'].shape
+
+        # Saving results of cached objects again replaces them
+        key = cache.config_key(czphot.LEPHARE, kwargs['filters'], [zpara, None])
+        cache.save(key, czphot.object_hashes(mags, errs), complete)
+        cached = cache.load(key)
+        assert len(cached['hashes']) == len(np.unique(cached['hashes'])) == len(mags[0])
+
+        # With a spectroz sample, results depend on the whole catalog: a sub-catalog of a
+        # cached catalog is run again
+        sfile = os.path.join(tmpdir, 'zspec.txt')
+        with open(sfile, 'w') as zspec:
+            for i in range(0, len(mags[0]), 10):
+                zspec.write("%i %.10f %.10f 0.5\n" % (i, kwargs['ra'][i], kwargs['dec'][i]))
+        czphot.run_cached(czphot.LEPHARE, mags, errs, cache, zpara=zpara,
+                          spectro_file=sfile, **kwargs)
+        ncalls = len(open('calls').readlines())
+        czphot.run_cached(czphot.LEPHARE, mags, errs, cache, zpara=zpara,
+                          spectro_file=sfile, **kwargs)
+        assert len(open('calls').readlines()) == ncalls
+        czphot.run_cached(czphot.LEPHARE, [m[:50] for m in mags], [e[:50] for e in errs],
+                          cache, zpara=zpara, spectro_file=sfile, **half)
+        assert len(open('calls').readlines()) == ncalls + 1
+    finally:
+        czphot.LEPHARE.executable = 'zphota'
+        os.chdir(cwd)
+        if lepharedir is not None:
+            os.environ['LEPHAREDIR'] = lepharedir
+        shutil.rmtree(tmpdir)
+
+
+def test_templatefit():
+    """Fit a template grid to galaxies drawn from it, and compare to a direct chi^2."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        zbins = np.arange(0, 3, 0.01)
+        wave = np.array([350., 480., 620., 760., 900.])  # nm
+        peaks = np.array([400., 550., 700.])  # rest frame peak of 3 templates
+        fluxes = np.exp(-0.5 * ((wave / (1 + zbins[:, None, None]) - peaks[:, None]) / 150.)**2)
+        fluxes = np.transpose(fluxes, (1, 0, 2)) + 0.05
+        gridfile = os.path.join(tmpdir, 'grid.npz')
+        np.savez(gridfile, zbins=zbins, fluxes=fluxes, filters=['u', 'g', 'r', 'i', 'z'])
+
+        rng = np.random.RandomState(37)
+        ngal = 500
+        ztrue = rng.randint(10, 250, ngal)
+        template = rng.randint(0, 3, ngal)
+        flux = 10**(-0.4 * 24) * fluxes[template, ztrue] / fluxes[template, ztrue, 2][:, None]
+        mags = -2.5 * np.log10(flux) + rng.normal(0, 0.01, flux.shape)
+        errs = np.full(mags.shape, 0.01)
+        mags[0, 1] = 99.  # missing band
+
+        kwargs = {'filters': ['z', 'i', 'r', 'g', 'u'], 'id': np.arange(ngal),
+                  'ra': np.zeros(ngal), 'dec': np.zeros(ngal)}
+        fit = czphot.TEMPLATEFIT(list(mags.T[::-1]), list(errs.T[::-1]), zpara=gridfile,
+                                 chunksize=64, **kwargs)
+        fit.run(jobs=3)
+        zphot = fit.data_out
+        assert np.median(np.abs(zphot.data_dict['Z_BEST'] - zbins[ztrue])) < 0.02
+        assert zphot.data_dict['NBAND_USED'][0] == 4
+        assert zphot.pdz_val.shape == (len(zbins), ngal)
+
+        # direct chi^2 of the first galaxy, with the best normalization of each template
+        flux, ivar = fit.fluxes()
+        model = fit.grid['fluxes']
+        norm = np.sum(ivar[0] * flux[0] * model, axis=-1) / np.sum(ivar[0] * model**2, axis=-1)
+        chi2 = np.sum(ivar[0] * (flux[0] - norm[..., None] * model)**2, axis=-1)
+        assert np.isclose(zphot.data_dict['CHI_BEST'][0], chi2.min(), rtol=1e-6, atol=1e-6)
+        assert zphot.data_dict['Z_BEST'][0] == zbins[np.argmin(chi2) % len(zbins)]
+        pdz = np.exp(-0.5 * (chi2 - chi2.min())).sum(axis=0)
+        assert np.allclose(zphot.pdz_val[:, 0], pdz)
+
+        # same results through the photoz cache, fitted by blocks of another size
+        cache = czphot.ZPHOTCache(os.path.join(tmpdir, 'cache'))
+        cached = czphot.run_cached(czphot.TEMPLATEFIT, list(mags.T[::-1]), list(errs.T[::-1]),
+                                   cache, zpara=gridfile, **kwargs)
+        assert np.allclose(cached.pdz_val, zphot.pdz_val)
+        assert np.allclose(cached.data_dict['Z_BEST'], zphot.data_dict['Z_BEST'])
+        for key in ['MOD_BEST', 'NBAND_USED']:
+            assert cached.data_dict[key].dtype == zphot.data_dict[key].dtype
+            assert np.array_equal(cached.data_dict[key], zphot.data_dict[key])
+
+        # the saved product stores the cumulative pdzs, unless asked not to
+        from pzmassfitter import pdzfile_utils
+        outfile = os.path.join(tmpdir, 'zphot.hdf5')
+        zphot.save_zphot(outfile, 'zphot_templatefit', pdz_format='uint16')
+        zphot.save_zphot(outfile, 'zphot_nocdf', cdf=False)
+        saved = Table.read(outfile, path='zphot_templatefit')
+        assert saved['pdz_cdf'].dtype == np.uint16
+        zbins_saved, cdf = pdzfile_utils.read_pdz_cdf(saved)
+        assert np.array_equal(zbins_saved, zbins)
+        assert np.array_equal(cdf, saved['pdz_cdf'] / 65535.)
+        reference = pdzfile_utils.cumulative_pdz(zphot.pdz_val.T, zbins)
+        assert np.abs(cdf - reference).max() < 1e-4
+        assert 'pdz_cdf' not in Table.read(outfile, path='zphot_nocdf').colnames
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_overwrite_or_append_parallel():
+    """Write several paths of the same file from parallel configurations."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'output.hdf5')
+
+        def write(zconfig, value=1):
+            table = Table([np.arange(100) * value], names=['id'])
+            table.meta['zconfig'] = zconfig
+            cutils.overwrite_or_append(filename, zconfig, table, overwrite=True)
+            return zconfig
+
+        zconfigs = ['zphot%i' % i for i in range(8)]
+        assert cutils.run_configs(write, zconfigs, workers=4) == zconfigs
+        write('zphot3', value=2)
+        tables = cutils.read_hdf5(filename)
+        assert sorted(tables) == zconfigs
+        assert all(tables[k].meta['zconfig'] == k for k in zconfigs)
+        assert np.all(tables['zphot3']['id'] == 2 * np.arange(100))
+        assert np.all(tables['zphot4']['id'] == np.arange(100))
+        assert os.listdir(tmpdir) == ['output.hdf5']
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_red_sequence_fit():
+    """Batched projections, histograms and fits of the red sequence."""
+    rng = np.random.RandomState(3)
+    rsmag = rng.uniform(19, 24, 4000)
+    mag = np.concatenate([rsmag, rng.uniform(18, 25, 20000)])
+    color = np.concatenate([1.6 - 0.05 * (rsmag - 20) + rng.normal(0, 0.05, 4000),
+                            rng.normal(0.8, 0.4, 20000)])
+    slopes = np.linspace(-0.08, -0.01, 15)
+    cut = (color > 1) & (color < 2) & (mag > 20) & (mag < 23.5)
+
+    projections = cbackground.project_colors(color[cut], mag[cut], slopes, 20., 1.5)
+    counts, edges = cbackground.histogram_rows(projections, 40)
+    for row, count, edge in zip(projections, counts, edges):
+        expected, expected_edges = np.histogram(row, bins=40)
+        assert np.all(count == expected)
+        assert np.allclose(edge, expected_edges)
+
+    x = 0.5 * (edges[:, 1:] + edges[:, :-1])
+    # all the slopes start from the fit of one of them, as in fit_red_sequence
+    p0 = cbackground.fit_emg(x[7], counts[7], [counts.max(), 0.2, 0.1, -3.0, 1., 1., 40.])[0]
+    params, cost = cbackground.fit_emg_batch(x, counts, p0)
+    for i in range(len(slopes)):
+        # the background parameters are degenerate here: MINPACK stops on maxfev
+        expected, expected_cost = cbackground.fit_emg(x[i], counts[i], p0)
+        assert np.allclose(params[i, :3], expected[:3], rtol=2e-3)
+        assert np.isclose(cost[i], expected_cost, rtol=2e-3)
+
+    # well-defined fits, from a distant starting point: same minimization path as MINPACK
+    from scipy import optimize
+    x = np.tile(np.linspace(-1, 0.6, 40), (8, 1))
+    rng = np.random.RandomState(42)
+    truth = np.column_stack([rng.uniform(100, 300, 8), rng.uniform(0.05, 0.25, 8),
+                             rng.uniform(0.05, 0.1, 8), rng.uniform(-0.9, -0.5, 8),
+                             rng.uniform(0.1, 0.2, 8), rng.uniform(2, 5, 8),
+                             rng.uniform(30, 80, 8)])
+    counts = rng.poisson(cbackground.emg_model(truth, x)).astype('float64')
+    p0 = np.array([200., 0.2, 0.1, -3.0, 1., 1., 40.])
+    params, cost = cbackground.fit_emg_batch(x, counts, p0)
+    nfev = []
+    for i in range(len(counts)):
+        expected, expected_cost = cbackground.fit_emg(x[i], counts[i], p0)
+        assert np.allclose(params[i], expected, rtol=1e-3)
+        assert np.isclose(cost[i], expected_cost, rtol=1e-6)
+        nfev.append(optimize.leastsq(cbackground.emg_residuals, p0, args=(x[i], counts[i]),
+                                     full_output=True)[2]['nfev'])
+    assert max(nfev) > 500  # one of the fits needs many iterations
+
+    params = cbackground.fit_red_sequence(color, mag)
+    assert abs(params[0][0] + 0.05) < 0.005
+    assert params[0][1] < 2.6 < params[1][1]
+
+
+def test_zspec_match():
+    """Merge the duplicated spectroz galaxies, and match (with cache) a photometric catalog."""
+    from astropy.coordinates import SkyCoord
+    tmpdir = tempfile.mkdtemp()
+    try:
+        rng = np.random.RandomState(3)
+        ra, dec = rng.uniform(10, 10.2, 50), rng.uniform(-5, -4.8, 50)
+        zs = rng.uniform(0.1, 1, 50)
+        sfile = os.path.join(tmpdir, 'zspec.txt')
+        with open(sfile, 'w') as f:
+            for n, i in enumerate(list(range(50)) + [4, 7, 4]):
+                f.write("%i %.10f %.10f %.4f\n" % (i, ra[i], dec[i], zs[i] + 0.01 * (n >= 50)))
+        zspec = czphot.ZSPEC(sfile, names=['object', 'ra', 'dec', 'zspec'])
+        assert len(zspec.data) == 50
+        assert np.array_equal(zspec.data['object'], np.arange(50))
+        assert np.isclose(zspec.data['zspec'][4], zs[4] + 0.01 * 2 / 3., atol=1e-4)
+        assert np.isclose(zspec.data['zspec'][7], zs[7] + 0.005, atol=1e-4)
+
+        # duplicates on either side of RA=0/360 or of a 1 mas grid cell are merged too,
+        # galaxies separated by more than the precision are not
+        mas = 1. / 3600e3
+        boundary = [(359.9999999, 1.), (0.0000001, 1.), (10. + 0.6 * mas, -3.),
+                    (10. + 1.4 * mas, -3.), (20., 2.), (20. + 2 * mas, 2.)]
+        bfile = os.path.join(tmpdir, 'zspec_boundary.txt')
+        with open(bfile, 'w') as f:
+            for i, (bra, bdec) in enumerate(boundary):
+                f.write("%i %.10f %.10f %.4f\n" % (i, bra, bdec, 0.5 + 0.01 * i))
+        merged = czphot.ZSPEC(bfile, names=['object', 'ra', 'dec', 'zspec'])
+        assert np.array_equal(merged.data['object'], [0, 2, 4, 5])
+        assert np.isclose((merged.data['ra'][0] + 180) % 360, 180, atol=1e-6)
+        assert np.isclose(merged.data['ra'][1], 10. + mas, atol=1e-9)
+        assert np.allclose(merged.data['zspec'], [0.505, 0.525, 0.54, 0.55])
+
+        pra, pdec = rng.uniform(10, 10.2, 300), rng.uniform(-5, -4.8, 300)
+        idx, d2d = zspec.match_catalog(pra, pdec)
+        ref_idx, ref_d2d, _ = SkyCoord(pra, pdec, unit='deg').match_to_catalog_sky(
+            SkyCoord(zspec.data['ra'], zspec.data['dec'], unit='deg'))
+        assert np.array_equal(idx, ref_idx)
+        assert np.allclose(d2d, ref_d2d.mas, rtol=1e-6)
+
+        match_file = os.path.join(tmpdir, 'match.npz')
+        zspec.match_catalog(pra, pdec, match_file=match_file)
+        assert os.path.exists(match_file)
+        assert np.array_equal(zspec.match_catalog(pra, pdec, match_file=match_file)[0], idx)
+        # A different catalog is matched again
+        assert np.array_equal(zspec.match_catalog(pra[::-1], pdec[::-1],
+                                                  match_file=match_file)[0], idx[::-1])
+
+        zspec.load_zphot(pra, pdec, rng.uniform(0, 1, 300))
+        ref_idx, ref_d2d, _ = zspec.skycoords.match_to_catalog_sky(zspec.skycoords_phot)
+        assert np.array_equal(zspec.match['idx'], ref_idx)
+        assert np.allclose(zspec.match['d2d'], ref_d2d.mas, rtol=1e-6)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_from_mass_to_mass():
+    """Convert a whole M200 chain to M500 and to the mass in a radius."""
+    from clusters import mass as cmass
+    from pzmassfitter import nfwutils
+
+    rng = np.random.RandomState(3)
+    chain = {'mdelta': rng.uniform(1e14, 2e15, 20000), 'cdelta': rng.uniform(2, 8, 20000)}
+    m500 = cmass.from_mass_to_mass(chain, {'redshift': 0.3}, delta=500)
+    assert m500.shape == (20000,) and np.all(m500 < chain['mdelta'])
+    for i in [0, 1000, 19999]:
+        rscale = nfwutils.rscaleConstM(chain['mdelta'][i], chain['cdelta'][i], 0.3, 200)
+        assert np.isclose(m500[i], nfwutils.Mdelta(rscale, chain['cdelta'][i], 0.3, 500),
+                          rtol=1e-12)
+    minside = cmass.from_mass_to_mass(chain, {'redshift': 0.3}, radius=1.)
+    m200back = cmass.from_mass_to_mass({'mdelta': m500, 'cdelta': chain['cdelta']},
+                                       {'redshift': 0.3}, delta=200, init_delta=500)
+    assert np.allclose(m200back, chain['mdelta'], rtol=1e-9)
+    assert np.all(minside > 0)
+
+
+def test_compute_shear_sky():
+    """Tangential and cross shears around one or several centers, against astropy."""
+    from astropy.coordinates import SkyCoord
+    from clusters import shear as cshear
+
+    rng = np.random.RandomState(5)
+    ngals = 2000
+    ra = rng.uniform(332.5, 333.3, ngals)
+    dec = rng.uniform(-9.9, -9.3, ngals)
+    e1, e2 = rng.normal(0, 0.3, ngals), rng.normal(0, 0.3, ngals)
+    center_ra, center_dec = np.array([332.9, 333.2]), np.array([-9.58, -9.4])
+
+    gamt, gamc, dist = cshear.compute_shear_sky(e1, e2, ra, dec, center_ra, center_dec)
+    assert gamt.shape == gamc.shape == dist.shape == (2, ngals)
+
+    coord_gal = SkyCoord(ra, dec, unit='deg')
+    for i in range(len(center_ra)):
+        coord_cl = SkyCoord(center_ra[i], center_dec[i], unit='deg')
+        posangle = -((np.pi / 2.) - coord_gal.position_angle(coord_cl).rad)
+        cos2phi, sin2phi = np.cos(2 * posangle), np.sin(2 * posangle)
+        assert np.allclose(gamt[i], -(e1 * cos2phi + e2 * sin2phi), rtol=0, atol=1e-10)
+        assert np.allclose(gamc[i], e1 * sin2phi - e2 * cos2phi, rtol=0, atol=1e-10)
+        assert np.allclose(dist[i], coord_gal.separation(coord_cl).arcmin, rtol=1e-10)
+
+        single = cshear.compute_shear_sky(e1, e2, ra, dec, center_ra[i], center_dec[i])
+        assert all((x == y[i]).all() for x, y in zip(single, (gamt, gamc, dist)))
+
+    # e1 > 0 (along the RA axis) is radial to the east of the center, tangential to the north
+    gamt, gamc, _ = cshear.compute_shear_sky(0.1, 0., [1., 0.], [0., 1.], 0., 0.)
+    assert np.allclose(gamt, [-0.1, 0.1]) and np.allclose(gamc, 0., atol=1e-12)
+
+
+def test_ebv_cache():
+    """E(B-V) of a local dust map through the on-disk cache, against the direct query."""
+    import healpy
+    from astropy.coordinates import SkyCoord
+    from extinctions import reddening
+    from clusters import extinction as cextinction
+
+    rng = np.random.RandomState(26)
+    ra, dec = rng.uniform(0, 360, 50), rng.uniform(-60, 60, 50)
+    ura, udec, inverse = cextinction.unique_positions(np.tile(ra, 3), np.tile(dec, 3))
+    assert len(ura) == 50 and np.array_equal(ura[inverse], np.tile(ra, 3))
+    assert np.array_equal(udec[inverse], np.tile(dec, 3))
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        mapfile = os.path.join(tmpdir, 'lambda_sfd_ebv.fits')
+
+        def write_map(values, mtime):
+            healpy.write_map(mapfile, values, overwrite=True, dtype=np.float64)
+            os.utime(mapfile, (mtime, mtime))
+            return values
+
+        def fake_reddening(ra, dec, values):
+            # a Reddening object on the local map, without its maps.yaml
+            red = reddening.Reddening.__new__(reddening.Reddening)
+            coords = SkyCoord(ra, dec, unit='deg').galactic
+            red.theta, red.phi = np.radians(90. - coords.b.degree), coords.l.radian
+            red.map_dir = tmpdir
+            red.maps = {'sfd': {'url': 'http://example.org/lambda_sfd_ebv.fits'}}
+            red.loaded_maps = {'sfd': {'map': values}}
+            return red
+
+        values = write_map(rng.uniform(0, 1, healpy.nside2npix(16)), 1e9)
+        cache = cextinction.EBVCache(os.path.join(tmpdir, 'cache'))
+
+        # first half of the positions, then all of them: a partial hit
+        for i, nobj in enumerate([25, 50]):
+            red = fake_reddening(ra[:nobj], dec[:nobj], values)
+            reference = red.query_local_map(dustmap='sfd')
+            assert np.allclose(cextinction.query_local_map(red, 'sfd'), reference)
+            assert np.allclose(cextinction.query_local_map(red, 'sfd', cache), reference)
+            nside, pixels, cached = cache.load('sfd', mapfile)
+            needed = np.unique(healpy.get_interp_weights(16, red.theta, red.phi)[0])
+            assert np.all(np.isin(needed, pixels)) and np.allclose(cached, values[pixels])
+            if i == 0:
+                first = pixels
+        assert len(pixels) > len(first) and np.all(np.isin(first, pixels))
+
+        # complete hit: the map is not read
+        red = fake_reddening(ra, dec, None)
+        assert np.allclose(cextinction.query_local_map(red, 'sfd', cache), reference)
+
+        # a new map file is not served from the cache of the former one
+        values = write_map(rng.uniform(0, 1, healpy.nside2npix(16)), 2e9)
+        red = fake_reddening(ra, dec, values)
+        assert cache.load('sfd', mapfile) is None
+        assert np.allclose(cextinction.query_local_map(red, 'sfd', cache),
+                           red.query_local_map(dustmap='sfd'))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_radec_to_pixel():
+    """Compare the vectorized TAN projection (and its fallback) with SkyCoord.to_pixel."""
+    from astropy.wcs import WCS, Sip
+    from astropy.coordinates import SkyCoord
+    rng = np.random.RandomState(27)
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [359.9, -12.3]
+    wcs.wcs.crpix = [1500.5, 2200.5]
+    wcs.wcs.cd = [[-5.5e-5, 1e-6], [2e-6, 5.5e-5]]
+    wcs.wcs.set()
+    assert cutils.is_simple_tan(wcs)
+    npos = 1000
+    ra = np.radians(359.9 + rng.uniform(-0.15, 0.15, npos)) % (2 * np.pi)
+    dec = np.radians(-12.3 + rng.uniform(-0.15, 0.15, npos))
+
+    # Chunks smaller than the number of positions, with an incomplete last chunk
+    xpix, ypix = cutils.radec_to_pixel(ra, dec, wcs, nthreads=3, chunksize=npos // 3)
+    xref, yref = SkyCoord(ra, dec, unit='rad').to_pixel(wcs)
+    np.testing.assert_allclose(xpix, xref, rtol=0, atol=1e-6)
+    np.testing.assert_allclose(ypix, yref, rtol=0, atol=1e-6)
+
+    # FK5 frame and SIP distortion: not a simple TAN, must fall back on astropy
+    wcs_fk5 = wcs.deepcopy()
+    wcs_fk5.wcs.radesys = 'FK5'
+    wcs_fk5.wcs.equinox = 2000.
+    wcs_sip = WCS(naxis=2)
+    wcs_sip.wcs.ctype = ['RA---TAN-SIP', 'DEC--TAN-SIP']
+    wcs_sip.wcs.crval = wcs.wcs.crval
+    wcs_sip.wcs.crpix = wcs.wcs.crpix
+    wcs_sip.wcs.cd = wcs.wcs.cd
+    coeffs = np.zeros((3, 3))
+    coeffs[2, 0], coeffs[0, 2] = 1e-7, -2e-7
+    wcs_sip.sip = Sip(coeffs, coeffs.T, None, None, wcs.wcs.crpix)
+    wcs_sip.wcs.set()
+    for fallback in [wcs_fk5, wcs_sip]:
+        assert not cutils.is_simple_tan(fallback)
+        xpix, ypix = cutils.radec_to_pixel(ra, dec, fallback, chunksize=npos // 3)
+        xref, yref = SkyCoord(ra, dec, unit='rad').to_pixel(fallback)
+        np.testing.assert_allclose(xpix, xref, rtol=0, atol=1e-6)
+        np.testing.assert_allclose(ypix, yref, rtol=0, atol=1e-6)
+
+
+def test_get_magnitudes():
+    """The batched magnitudes must be the same as the per-filter ones."""
+    from clusters import data as cdata
+    rng = np.random.RandomState(27)
+    nrow = 50
+
+    def getmag(flux, sigma):
+        flux = np.asarray(flux)
+        return 27. - 2.5 * np.log10(flux), 1.0857 * np.asarray(sigma) / flux
+
+    table = Table()
+    for filt in 'gri':
+        table['base_%s_instFlux' % filt] = rng.uniform(10., 1e4, nrow)
+        table['base_%s_instFluxErr' % filt] = rng.uniform(0.1, 10., nrow)
+    # No error column: no magnitude; already computed magnitude: not recomputed
+    table['noerr_instFlux'] = rng.uniform(10., 1e4, nrow)
+    table['done_instFlux'] = rng.uniform(10., 1e4, nrow)
+    table['done_instFluxErr'] = rng.uniform(0.1, 10., nrow)
+    table['done_mag'] = np.zeros(nrow)
+    drp = cdata.DRPCatalogs.__new__(cdata.DRPCatalogs)
+    drp.catalogs = {'forced_src': table}
+    drp.from_butler = {'getmag': getmag, 'wcs': None}
+
+    columns = {col.name: col for col in drp._get_magnitudes('forced_src')}
+    assert sorted(columns) == sorted(['base_%s_%s' % (filt, k)
+                                      for filt in 'gri' for k in ['mag', 'magErr']])
+    for filt in 'gri':
+        mag, dmag = getmag(table['base_%s_instFlux' % filt], table['base_%s_instFluxErr' % filt])
+        np.testing.assert_array_equal(columns['base_%s_mag' % filt], mag)
+        np.testing.assert_array_equal(columns['base_%s_magErr' % filt], dmag)
+        assert columns['base_%s_mag' % filt].unit == 'mag'
@@ -1,6 +1,7 @@
 
 
 from __future__ import print_function
+import contextlib
 import numpy as np
 import pzmassfitter.nfwutils as nfwutils
 import pzmassfitter.nfwmodeltools as nfwmodeltools
@@ -10,6 +11,16 @@ import shutil
 import yaml
 from clusters.mains import mass
 import pzmassfitter.ldac as ldac
+import pzmassfitter.join as join
+import pzmassfitter.util as util
+import pzmassfitter.spheregeometry as spheregeometry
+import pzmassfitter.pdzfile_utils as pdzfile_utils
+import pzmassfitter.maxlike_masses as maxlike_masses
+import pzmassfitter.likelihood_grid as likelihood_grid
+import pzmassfitter.flat_posterior as flat_posterior
+import pzmassfitter.likelihood_gradient as likelihood_gradient
+from astropy.coordinates import SkyCoord
+from scipy.integrate import quad
 
 
 def setupNearPerfectData(m200 = 1e15):
@@ -102,6 +113,18 @@ def cleanuptest(tmpdir):
 
     shutil.rmtree(tmpdir)
 
+
+@contextlib.contextmanager
+def seeded_global_random(seed):
+    """Seed the global numpy generator (drawn from by the mymc updaters), and restore its
+    state afterwards."""
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        yield
+    finally:
+        np.random.set_state(state)
+
 ######
 
 
@@ -138,6 +161,1024 @@ def test_pzmassfitter():
 
 
 
+def test_join():
+
+    rng = np.random.RandomState(28)
+    ids = rng.permutation(np.arange(1000, dtype='uint64'))[:800]
+    ids[5] = ids[700]  # duplicated ID: the last occurrence wins, as with a dict
+    otherids = rng.permutation(np.arange(-100, 1100))
+
+    order = {iid: i for i, iid in enumerate(ids)}
+    expected = np.array([order[oid] for oid in otherids if oid in order])
+
+    rows, otherrows = join.inner_join(ids, otherids)
+    assert (rows == expected).all()
+    assert (ids[rows] == otherids[otherrows]).all()
+
+    tmpdir = tempfile.mkdtemp()
+    index_file = '{}/index.npz'.format(tmpdir)
+    assert (join.left_join(ids, otherids, index_file=index_file)[otherrows] == expected).all()
+    assert (join.left_join(ids, otherids, index_file=index_file)[otherrows] == expected).all()
+    assert join.SortedIndex.load(index_file, ids[::-1]) is None
+    assert (join.isin(otherids, ids) == np.isin(otherids, ids)).all()
+    cleanuptest(tmpdir)
+
+
+def test_shear_kernel():
+
+    rng = np.random.RandomState(29)
+    ngals = 5000
+    ra = rng.uniform(0., 360., ngals)
+    dec = np.degrees(np.arcsin(rng.uniform(-1., 1., ngals)))
+    center_ra = np.array([0., 150.3, 359.9])
+    center_dec = np.array([0., -2.1, 89.])
+
+    r, cos2phi, sin2phi = spheregeometry.shear_kernel(ra, dec, center_ra, center_dec)
+    assert r.shape == (3, ngals)
+
+    coord_gal = SkyCoord(ra, dec, unit='deg')
+    for i in range(len(center_ra)):
+        coord_cl = SkyCoord(center_ra[i], center_dec[i], unit='deg')
+        posangle = -((np.pi / 2.) - coord_gal.position_angle(coord_cl).rad)
+        dphi = np.angle(np.exp(2j * posangle) * (cos2phi[i] - 1j * sin2phi[i]))
+        assert np.abs(r[i] - coord_gal.separation(coord_cl).rad).max() < 1e-12
+        assert np.abs(dphi).max() < 1e-12
+
+        r1, cos2phi1, sin2phi1 = spheregeometry.shear_kernel(ra, dec, center_ra[i], center_dec[i])
+        assert (r1 == r[i]).all() and (cos2phi1 == cos2phi[i]).all()
+
+
+def test_comovingdist():
+
+    rng = np.random.RandomState(30)
+    cosmology = nfwutils.Cosmology(omega_m=0.27, omega_l=0.73, h=0.71)
+    z = np.concatenate([rng.uniform(0.001, 10., 50), [1e3, 1e6]])
+
+    def integrand(zi):
+        return 1. / np.sqrt(cosmology.hubble2(zi))
+
+    expected = np.array([cosmology.v_c *
+                         quad(integrand, 0, zi, epsabs=0, epsrel=1e-13, limit=200)[0]
+                         for zi in z])
+    assert np.abs(cosmology.comovingdist(z) / expected - 1).max() < 1e-9
+    assert np.abs(cosmology.angulardist(z[0]) - expected[0] / (1 + z[0])) < 1e-6
+
+    zcluster = 0.3
+    beta = cosmology.beta(z[:10], zcluster)
+    expected = np.array([max(0, (1 - cosmology.comovingdist(zcluster) / cosmology.comovingdist(zi)))
+                         for zi in z[:10]])
+    assert np.abs(beta - expected).max() < 1e-12
+
+
+def test_read_numeric_table():
+
+    rng = np.random.RandomState(33)
+    tmpdir = tempfile.mkdtemp()
+    txtfile = '{}/table.txt'.format(tmpdir)
+    data = rng.uniform(0, 1, (1000, 5))
+    np.savetxt(txtfile, data, header='a b c d e')
+
+    table = util.read_numeric_table(txtfile, chunksize=300)
+    assert np.allclose(table, data)
+    assert np.allclose(util.read_numeric_table(txtfile, usecols=[1, 3]), data[:, [1, 3]])
+
+    # the text file changed: the binary sidecar must not be used anymore
+    np.savetxt(txtfile, 2 * data)
+    assert np.allclose(util.read_numeric_table(txtfile), 2 * data)
+    cleanuptest(tmpdir)
+
+
+def test_pdz_columns():
+
+    rng = np.random.RandomState(34)
+    zbins = np.arange(0, 4, 0.01)
+    zbest = rng.uniform(0.1, 2, 200)
+    pdz = pdzfile_utils.normalize_pdz(np.exp(-0.5 * ((zbins - zbest[:, None]) / 0.05)**2), zbins)
+
+    tmpdir = tempfile.mkdtemp()
+    for pdz_format, rtol in [('float64', 1e-15), ('float32', 1e-6), ('uint16', 1. / 65535)]:
+        columns, meta = pdzfile_utils.pdz_columns(pdz, zbins, pdz_format=pdz_format)
+        tab = table.Table([np.arange(200)], names=['objectId'])
+        for name in columns:
+            tab[name] = columns[name]
+        tab.meta.update(meta)
+        tab.write('{}/pdz.hdf5'.format(tmpdir), path=pdz_format, append=True,
+                  serialize_meta=True)
+        tab = table.Table.read('{}/pdz.hdf5'.format(tmpdir), path=pdz_format)
+        readbins, readpdz = pdzfile_utils.read_pdz(tab[50:])
+        assert np.allclose(readbins, zbins)
+        assert np.all(np.abs(readpdz - pdz[50:]) <= rtol * pdz[50:].max(axis=1)[:, None])
+    cleanuptest(tmpdir)
+
+
+def test_pdz_cdf():
+
+    rng = np.random.RandomState(35)
+    zbins = np.arange(0, 4, 0.01)
+    zbest = rng.uniform(0.1, 2, 200)
+    pdz = pdzfile_utils.normalize_pdz(np.exp(-0.5 * ((zbins - zbest[:, None]) / 0.1)**2), zbins)
+    cdf = pdzfile_utils.cumulative_pdz(pdz, zbins)
+
+    # probability to be below z0, as the former per-galaxy integral
+    for z0 in [-1, 0.4, 0.555, 10]:
+        cut = zbins < z0
+        expected = np.array([np.sum(0.5 * (p[cut][1:] + p[cut][:-1]) * np.diff(zbins[cut]))
+                             for p in pdz])
+        assert np.allclose(pdzfile_utils.prob_below(cdf, zbins, z0), expected)
+
+    # quantiles and widths, as the former per-galaxy search
+    quantiles = pdzfile_utils.pdz_quantiles(cdf, zbins, [0.05, 0.5, 0.95])
+    for i in range(len(pdz)):
+        for j, q in enumerate([0.05, 0.5, 0.95]):
+            assert quantiles[i, j] == zbins[cdf[i] >= q][0]
+    assert np.abs(quantiles[:, 1] - zbest).max() < 0.03
+    assert np.allclose(pdzfile_utils.deltaz95(cdf, zbins), quantiles[:, 2] - quantiles[:, 0])
+
+    # cdf column, stored on request only, as uint16
+    for pdz_format in ['float32', 'uint16']:
+        columns, meta = pdzfile_utils.pdz_columns(pdz, zbins, pdz_format=pdz_format)
+        assert 'pdz_cdf' not in columns
+        tab = table.Table(columns)
+        tab.meta.update(meta)
+        assert np.abs(pdzfile_utils.read_pdz_cdf(tab)[1] - cdf).max() < 1e-4
+        columns, meta = pdzfile_utils.pdz_columns(pdz, zbins, pdz_format=pdz_format, cdf=True)
+        assert columns['pdz_cdf'].dtype == np.uint16
+        tab = table.Table(columns)
+        tab.meta.update(meta)
+        assert np.abs(pdzfile_utils.read_pdz_cdf(tab)[1] - cdf).max() < 1e-4
+
+
+def test_delta_pdz():
+
+    rng = np.random.RandomState(36)
+    zbins = np.arange(0, 4, 0.01)
+    ztrue = rng.uniform(0, 3.99, 1000)
+    delta = pdzfile_utils.DeltaPDZ.from_redshifts(ztrue, zbins)
+    pdz = delta.dense()
+    assert np.allclose(pdzfile_utils.trapz_pdz(pdz, zbins), 1)
+    try:
+        delta.astype(np.float64)
+        assert False
+    except TypeError:
+        pass
+
+    # same cuts and quantiles as on the dense pdzs
+    cdf = pdzfile_utils.cumulative_pdz(pdz, zbins)
+    for z0 in [0.3, 0.305, 2]:
+        assert np.allclose(pdzfile_utils.prob_below(delta, zbins, z0),
+                           pdzfile_utils.prob_below(cdf, zbins, z0))
+    assert np.allclose(pdzfile_utils.pdz_quantiles(delta, zbins, [0.05, 0.5, 0.95]),
+                       pdzfile_utils.pdz_quantiles(cdf, zbins, [0.05, 0.5, 0.95]))
+
+    # storage
+    columns, meta = pdzfile_utils.pdz_columns(delta, zbins)
+    tab = table.Table(columns)
+    tab.meta.update(meta)
+    assert np.allclose(pdzfile_utils.read_pdz(tab[100:])[1], pdz[100:])
+    assert np.all(pdzfile_utils.read_pdz_cdf(tab)[1][10:20].bins == delta.bins[10:20])
+
+    # likelihood, against the integral over the dense pdzs
+    r_mpc = rng.uniform(0.5, 3, 1000)
+    ghats = rng.normal(0.05, 0.2, 1000)
+    betas = nfwutils.global_cosmology.beta_s(zbins, 0.3)
+    shearcal = np.zeros(1000)
+    args = (1e15, 4., r_mpc, ghats, zbins, betas)
+    others = (shearcal, shearcal, 0.25, 1.3e11, 0.5, 200.)
+    loglike = maxlike_masses.delta_gauss_like(*(args + (delta,) + others))
+    rdelta = (3 * 1e15 / (4 * 200. * np.pi * 1.3e11))**(1. / 3.)
+    gamma = nfwmodeltools.NFWShear(r_mpc, 4., rdelta / 4., 0.5, delta=200.)
+    kappa = nfwmodeltools.NFWKappa(r_mpc, 4., rdelta / 4., 0.5, delta=200.)
+    g = betas * gamma[:, None] / (1 - betas * kappa[:, None])
+    integrand = pdz * np.exp(-0.5 * ((ghats[:, None] - g) / 0.25)**2) / (np.sqrt(2 * np.pi) * 0.25)
+    assert np.allclose(loglike, np.sum(np.log(pdzfile_utils.trapz_pdz(integrand, zbins))))
+
+
+def test_likelihood_grid():
+
+    rng = np.random.RandomState(41)
+    ngal, zcluster = 500, 0.3
+    zbins = np.arange(0.05, 3, 0.05)
+    z_b = rng.uniform(0.2, 1.5, ngal)
+    pz = pdzfile_utils.normalize_pdz(np.exp(-0.5 * ((zbins - z_b[:, None]) / 0.1)**2), zbins)
+    r_mpc = rng.uniform(0.2, 4, ngal)
+    ghats = rng.normal(0.02, 0.25, ngal)
+    betas = nfwutils.global_cosmology.beta_s(zbins, zcluster)
+    rho_c = nfwutils.global_cosmology.rho_crit(zcluster)
+    shearcal = np.zeros(ngal)
+    model = util.VarContainer(r_mpc=r_mpc, ghats=ghats, zs=zbins, betas=betas, pz=pz,
+                              shearcal_m=shearcal, shearcal_c=shearcal, sigma=0.25, cdelta=4.,
+                              rho_c=rho_c, rho_c_over_sigma_c=0.5, massdelta=200.,
+                              stochastics=[])
+    manager = util.VarContainer(model=model, inputcat={'r_mpc': r_mpc, 'z_b': z_b,
+                                                       'ghats': ghats},
+                                pz=pz, pdzrange=zbins, zcluster=zcluster)
+
+    builder = maxlike_masses.LensingModel()
+    masses = np.linspace(1e14, 3e15, 30)
+    grid = builder.likelihoodGrid(manager, masses, key='test')
+    assert grid.loglike.shape == (30, ngal)
+
+    # per-galaxy terms sum up to the direct integral over the pdzs
+    rdelta = (3 * masses[7] / (4 * 200. * np.pi * rho_c))**(1. / 3.)
+    gamma = nfwmodeltools.NFWShear(r_mpc, 4., rdelta / 4., 0.5, delta=200.)
+    kappa = nfwmodeltools.NFWKappa(r_mpc, 4., rdelta / 4., 0.5, delta=200.)
+    g = betas * gamma[:, None] / (1 - betas * kappa[:, None])
+    integrand = pz * np.exp(-0.5 * ((ghats[:, None] - g) / 0.25)**2) / (np.sqrt(2 * np.pi) * 0.25)
+    integrand[pz <= 1e-6] = 0
+    assert np.allclose(grid.loglike[7], np.log(pdzfile_utils.trapz_pdz(integrand, zbins)))
+
+    # any selection is a masked sum, equal to a grid computed on the selected galaxies only
+    options, _ = builder.createOptions(radlow=0.75, radhigh=3., zcut=0.1, zbhigh=1.25)
+    mask = builder.selection(grid.columns, options, zcluster)
+    assert 0 < mask.sum() < ngal
+    sub_model = util.VarContainer(model, r_mpc=r_mpc[mask], ghats=ghats[mask], pz=pz[mask],
+                                  shearcal_m=shearcal[mask], shearcal_c=shearcal[mask])
+    sub_manager = util.VarContainer(manager, model=sub_model, pz=pz[mask],
+                                    inputcat={k: v[mask] for k, v in manager.inputcat.items()})
+    sub_grid = builder.likelihoodGrid(sub_manager, masses)
+    assert np.allclose(grid.total(mask), sub_grid.total())
+
+    # mass posterior with the priors of the model, and persistence
+    mass_logprior, conc_logprior = builder.gridLogPriors(options, masses)
+    assert conc_logprior is None
+    logpost = grid.mass_logpost(mask, mass_logprior)
+    assert logpost.max() == 0
+    tmpdir = tempfile.mkdtemp()
+    try:
+        gridfile = '{}/grid.npz'.format(tmpdir)
+        grid.save(gridfile)
+        assert likelihood_grid.LikelihoodGrid.load(gridfile, key='other') is None
+        loaded = likelihood_grid.get_grid(lambda: None, gridfile, key='test')
+        assert np.allclose(loaded.mass_logpost(builder.selection(loaded.columns, options,
+                                                                 zcluster),
+                                               mass_logprior), logpost)
+    finally:
+        cleanuptest(tmpdir)
+
+    # grid run: default mass grid over the mass prior, computed again when the pdzs or the
+    # shear calibration and shape settings change
+    calls = []
+
+    class CountingLensingModel(maxlike_masses.LensingModel):
+        def likelihoodGrid(self, *args, **keywords):
+            calls.append(args[1])
+            return super(CountingLensingModel, self).likelihoodGrid(*args, **keywords)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        runner = maxlike_masses.GridModelToFile()
+        run_options, _ = builder.createOptions(masslow=1e14, masshigh=3e15, concentration=4.)
+        run_options, _ = runner.createOptions('{}/run'.format(tmpdir),
+                                              gridFile='{}/grid.npz'.format(tmpdir),
+                                              options=run_options)
+        run_manager = util.VarContainer(manager, options=run_options,
+                                        modelbuilder=CountingLensingModel(),
+                                        comment=lambda message: None)
+
+        nruns = [0]
+
+        def run():
+            # the scan files of the runs are not overwritten
+            nruns[0] += 1
+            run_options.outputFile = '{}/run{}'.format(tmpdir, nruns[0])
+            runner.run(run_manager)
+
+        run()
+        assert np.array_equal(calls[0], np.linspace(1e14, 3e15, 2000))
+        run()
+        assert len(calls) == 1
+        for name, value in [('voigttol', 0.), ('wtg_shearcal', True), ('psfsize', 2.),
+                            ('steppsf', 'a')]:
+            setattr(run_options, name, value)
+            run()
+            assert len(calls) == 2
+            calls.pop()
+        run_manager.pz = pz[::-1]
+        run()
+        assert len(calls) == 2
+    finally:
+        cleanuptest(tmpdir)
+
+    # concentration grid, marginalized over
+    concentrations = np.logspace(0, 1, 5)
+    cgrid = builder.likelihoodGrid(manager, masses[::10], concentrations)
+    assert cgrid.loglike.shape == (3, 5, ngal)
+    model.cdelta = concentrations[2]
+    assert np.allclose(cgrid.loglike[:, 2], builder.likelihoodGrid(manager, masses[::10]).loglike)
+    mass_logprior, conc_logprior = builder.gridLogPriors(options, masses[::10], concentrations)
+    assert np.isfinite(cgrid.mass_logpost(mask, mass_logprior, conc_logprior)).all()
+
+
+def test_grid_resampling():
+
+    rng = np.random.RandomState(42)
+
+    # galaxies with gaussian likelihoods: the posterior is centered on the mean of the centers
+    ngal = 400
+    centers = rng.normal(5., 2., ngal)
+    masses = np.linspace(0, 10, 2001)
+    grid = likelihood_grid.LikelihoodGrid(masses, -0.5 * (masses[:, None] - centers)**2,
+                                          columns={'ra': rng.uniform(0, 1, ngal),
+                                                   'dec': rng.uniform(0, 1, ngal)})
+    mask = rng.uniform(size=ngal) < 0.8
+    assert np.isclose(likelihood_grid.posterior_masses(grid.mass_logpost(mask), masses),
+                      centers[mask].mean(), atol=0.01)
+    error = centers[mask].std() / np.sqrt(mask.sum())
+
+    boot = grid.bootstrap(likelihood_grid.bootstrap_weights(mask, 300, batchsize=64, seed=1))
+    assert len(boot) == 300
+    assert np.isclose(boot.std(), error, rtol=0.2)
+
+    # delete-one jackknife, exact for the mean
+    jack = likelihood_grid.jackknife_spread(grid.jackknife(mask, batchsize=50))
+    assert len(jack) == mask.sum()
+    assert np.isclose(jack.std(), error * np.sqrt(mask.sum() / (mask.sum() - 1.)), rtol=0.02)
+
+    # spatial patches: same as recomputing the posterior without each patch
+    labels = likelihood_grid.patch_labels(grid.columns['ra'], grid.columns['dec'], 16)
+    assert len(np.unique(labels)) == 16
+    assert np.bincount(labels).min() >= ngal // 16 - 1
+    jack = grid.jackknife(mask, labels, statistic='mean', batchsize=5)
+    direct = [likelihood_grid.posterior_masses(grid.mass_logpost(mask & (labels != patch)),
+                                               masses, statistic='mean')
+              for patch in range(16)]
+    assert np.allclose(jack, direct)
+
+
+def test_flat_posterior():
+
+    import astropy.io.fits as pyfits
+    from scipy import stats
+    import pzmassfitter.mymc as mymc
+    import pzmassfitter.pymc_mymcmc_adapter as pma
+    import pzmassfitter.maxlike_bentstep_voigt as bentvoigt
+
+    rng = np.random.RandomState(43)
+
+    # galaxies at known redshifts around a 1e15 cluster
+    ngal, zcluster = 3000, 0.3
+    zbins = np.arange(0.01, 3, 0.01)
+    pz = pdzfile_utils.DeltaPDZ.from_redshifts(rng.uniform(0.6, 1.5, ngal), zbins)
+    r_mpc = rng.uniform(0.5, 3, ngal)
+    size = rng.uniform(1, 3, ngal)
+    betas = nfwutils.global_cosmology.beta_s(zbins, zcluster)
+    gc = nfwutils.global_cosmology
+    rho_c = gc.rho_crit(zcluster)
+    rho_c_over_sigma_c = 1.5 * gc.angulardist(zcluster) * gc.beta([1e6], zcluster)[0] * \
+        gc.hubble2(zcluster) / gc.v_c**2
+    gamma, kappa = likelihood_grid.nfw_profiles(1e15, 4., r_mpc, rho_c, rho_c_over_sigma_c, 200.)
+    beta = betas[pz.bins]
+    ghats = beta * gamma / (1 - beta * kappa) + rng.normal(0, 0.005, ngal)
+    inputcat = ldac.LDACCat(pyfits.BinTableHDU.from_columns(
+        [pyfits.Column(name=name, format='D', array=array)
+         for name, array in [('r_mpc', r_mpc), ('ghats', ghats), ('size', size)]]))
+
+    builder = maxlike_masses.LensingModel()
+    options, _ = builder.createOptions(concentration=4.)
+    manager = util.VarContainer(options=options, inputcat=inputcat, pz=pz, pdzrange=zbins,
+                                zcluster=zcluster)
+    flat = builder.makeFlatPosterior(manager)
+    assert flat.names == ['scaledmdelta']
+    theta = np.array([8.])
+    assert np.isclose(flat.log_post(theta), -np.log(1e16 / 1e14 - 1e13 / 1e14) +
+                      maxlike_masses.delta_gauss_like(8e14, 4., r_mpc, ghats, zbins, betas, pz,
+                                                      np.zeros(ngal), np.zeros(ngal), 0.005,
+                                                      rho_c, rho_c_over_sigma_c, 200.))
+    assert flat.log_post(np.array([200.])) == -np.inf
+
+    # sampled by mymc, as a pymc model would be (from a point of non-zero probability)
+    flat.theta[:] = [12.]
+    space, trace = pma.wrapModel(flat)
+    assert [p.name for p in space] == ['scaledmdelta']
+    engine = mymc.Engine([mymc.CartesianSequentialUpdater(space, mymc.Slice(), 50, 50)], trace)
+    chain = mymc.dictBackend()
+    with seeded_global_random(43):
+        engine(300, None, [chain])
+    assert np.abs(np.mean(chain['mdelta'][100:]) / 1e15 - 1) < 0.03
+    assert np.all(np.isfinite(chain['posterior']))
+
+    # free concentration, and the shear calibration priors of the voigt model
+    options, _ = builder.createOptions(logprior=True)
+    manager.options = options
+    flat = builder.makeFlatPosterior(manager)
+    assert flat.names == ['log10concentration', 'log10mdelta']
+    assert np.isclose(flat.priors[0][1](0.7),
+                      stats.truncnorm(-0.6 / 0.116, 0.4 / 0.116, 0.6, 0.116).logpdf(0.7))
+
+    voigt = bentvoigt.BentVoigtShapedistro()
+    options, _ = voigt.createOptions(concentration=4.)
+    manager = util.VarContainer(options=options, inputcat=inputcat, pz=pz, pdzrange=zbins,
+                                zcluster=zcluster, wtg_shearcal=True, psfsize=1.7)
+    flat = flat_posterior.FlatPosterior()
+    shape = voigt.makeFlatShapePrior(manager, flat)
+    assert flat.names == ['step_m_prior_0', 'step_m_prior_1', 'step_c_prior', 'sigma', 'gamma']
+    flat.theta[:3] = [0.01, 0.2, 0.001]
+    m, c, (sigma, gamma) = shape(flat.theta)
+    expected = np.where(size >= 2.0, 0.01, 0.2 * (size - 2.0) + 0.01)
+    assert np.allclose(m, expected) and np.allclose(c, 0.001)
+    m_slope, m_b, m_cov, c0 = voigt.psfDependence('interp', 1.7)
+    assert np.isclose(flat.log_prior(flat.theta),
+                      stats.multivariate_normal([m_b, m_slope], m_cov).logpdf([0.01, 0.2]) +
+                      stats.norm(c0, 0.0004).logpdf(0.001) - np.log(0.35) - np.log(0.097))
+
+
+def test_likelihood_gradient():
+
+    import astropy.io.fits as pyfits
+    import pzmassfitter.mymc as mymc
+    import pzmassfitter.maxlike_bentstep_voigt as bentvoigt
+
+    rng = np.random.RandomState(44)
+
+    # NFW profiles and their derivatives (across x = r / rs = 1)
+    r_mpc = np.linspace(0.05, 4, 500)
+    gamma, kappa, dgamma, dkappa = likelihood_gradient.nfw_profiles_grad(
+        7e14, 4., r_mpc, 1.3e11, 3e-4, 200.)
+    assert np.allclose((gamma, kappa),
+                       likelihood_grid.nfw_profiles(7e14, 4., r_mpc, 1.3e11, 3e-4, 200.),
+                       rtol=1e-10)
+    for i, h in enumerate([7e8, 4e-6]):
+        step = np.array([h, 0.]) if i == 0 else np.array([0., h])
+        plus = likelihood_grid.nfw_profiles(*(np.array([7e14, 4.]) + step), r_mpc=r_mpc,
+                                            rho_c=1.3e11, rho_c_over_sigma_c=3e-4,
+                                            massdelta=200.)
+        minus = likelihood_grid.nfw_profiles(*(np.array([7e14, 4.]) - step), r_mpc=r_mpc,
+                                             rho_c=1.3e11, rho_c_over_sigma_c=3e-4,
+                                             massdelta=200.)
+        assert np.allclose((plus[0] - minus[0]) / (2 * h), dgamma[i], rtol=1e-5, atol=0)
+        assert np.allclose((plus[1] - minus[1]) / (2 * h), dkappa[i], rtol=1e-5,
+                           atol=1e-6 * np.abs(dkappa[i]).max())
+
+    # likelihood of dense pdzs, and its gradient
+    ngal, zcluster = 200, 0.3
+    zbins = np.linspace(0.05, 3, 60)
+    pz = np.exp(-0.5 * ((zbins - rng.uniform(0.6, 1.5, ngal)[:, None]) / 0.2)**2)
+    r_mpc = rng.uniform(0.3, 3, ngal)
+    ghats = rng.normal(0.02, 0.25, ngal)
+    m, c = rng.normal(0, 0.03, ngal), rng.normal(0, 1e-3, ngal)
+    betas = nfwutils.global_cosmology.beta_s(zbins, zcluster)
+
+    def loglike(mdelta, cdelta, sigma, gamma):
+        return np.sum(likelihood_grid.galaxy_loglike(
+            mdelta, cdelta, r_mpc, ghats, zbins, betas, pz, m, c,
+            likelihood_grid.voigt_shape(sigma, gamma), 1.3e11, 3e-4, 200.))
+
+    point = np.array([8e14, 4., 0.3, 0.05])
+    logp, grad = likelihood_gradient.bentvoigt_like_grad(
+        point[0], point[1], r_mpc, ghats, zbins, betas, pz, m, c, point[2], point[3],
+        1.3e11, 3e-4, 200.)
+    assert np.isclose(logp, loglike(*point), rtol=1e-6)
+    for i, h in enumerate(point * 1e-5):
+        step = np.eye(4)[i] * h
+        numeric = (loglike(*(point + step)) - loglike(*(point - step))) / (2 * h)
+        assert np.isclose(grad[i], numeric, rtol=1e-4)
+    logp, grad = likelihood_gradient.gauss_like_grad(
+        8e14, 4., r_mpc, ghats, zbins, betas, pz, m, c, 0.3, 1.3e11, 3e-4, 200.)
+    assert np.isclose(logp, np.sum(likelihood_grid.galaxy_loglike(
+        8e14, 4., r_mpc, ghats, zbins, betas, pz, m, c, likelihood_grid.gauss_shape(0.3),
+        1.3e11, 3e-4, 200.)))
+    assert len(grad) == 3
+
+    # gradient of the flat posterior of the voigt model, with shear calibration
+    inputcat = ldac.LDACCat(pyfits.BinTableHDU.from_columns(
+        [pyfits.Column(name=name, format='D', array=array)
+         for name, array in [('r_mpc', r_mpc), ('ghats', ghats),
+                             ('size', rng.uniform(1, 3, ngal))]]))
+    voigt = bentvoigt.BentVoigtShapedistro()
+    options, _ = voigt.createOptions()
+    manager = util.VarContainer(options=options, inputcat=inputcat, pz=pz, pdzrange=zbins,
+                                zcluster=zcluster, wtg_shearcal=True, psfsize=1.7)
+    flat = voigt.makeFlatPosterior(manager)
+    theta = np.array([0.62, 8., 0.01, 0.1, 0.001, 0.3, 0.05])
+    assert flat.names == ['log10concentration', 'scaledmdelta', 'step_m_prior_0',
+                          'step_m_prior_1', 'step_c_prior', 'sigma', 'gamma']
+    logp, grad = flat.log_post_grad(theta)
+    for i, h in enumerate([1e-5, 1e-4, 1e-5, 1e-5, 1e-6, 1e-6, 1e-6]):
+        step = np.eye(len(theta))[i] * h
+        numeric = (flat.log_post_grad(theta + step)[0] -
+                   flat.log_post_grad(theta - step)[0]) / (2 * h)
+        assert np.isclose(grad[i], numeric, rtol=1e-4, atol=1e-3)
+    assert flat.log_post_grad(np.append(theta[:-1], 0.2))[0] == -np.inf
+
+    # the NUTS updater samples a correlated gaussian
+    cov = np.array([[1., 0.9], [0.9, 4.]])
+    icov = np.linalg.inv(cov)
+    space = mymc.ParameterSpace([mymc.Parameter(0., 1., 'x'), mymc.Parameter(0., 1., 'y')])
+
+    def grad_log_posterior(struct):
+        x = np.array([p() for p in space])
+        return -0.5 * np.dot(x, np.dot(icov, x)), -np.dot(icov, x)
+    space.log_posterior = lambda struct: grad_log_posterior(struct)[0]
+    space.grad_log_posterior = grad_log_posterior
+    updater = mymc.NUTSUpdater(space, adapt_steps=300)
+    chain = mymc.dictBackend()
+    with seeded_global_random(44):
+        mymc.Engine([updater], space)(2300, None, [chain])
+    samples = np.array([chain['x'][300:], chain['y'][300:]])
+    assert np.allclose(np.mean(samples, axis=1), 0., atol=0.25)
+    assert np.allclose(np.cov(samples), cov, rtol=0.25, atol=0.1)
+    assert updater.nevaluations < 2300 * 2**updater.max_depth
+
+    # no chain from a point of zero posterior probability
+    space.log_posterior = lambda struct: -np.inf
+    space.grad_log_posterior = lambda struct: (-np.inf, np.zeros(2))
+    try:
+        mymc.Engine([mymc.NUTSUpdater(space)], space)(10, None, [mymc.dictBackend()])
+        assert False
+    except ValueError as error:
+        assert 'not finite' in str(error)
+
+
+
+def test_laplace():
+
+    import astropy.io.fits as pyfits
+    import pzmassfitter.mymc as mymc
+    import pzmassfitter.laplace as laplace
+
+    rng = np.random.RandomState(45)
+
+    # maximum and Hessian of a correlated gaussian, with and without its gradient
+    cov = np.array([[1., 0.9], [0.9, 4.]])
+    icov = np.linalg.inv(cov)
+    mean = np.array([1., -2.])
+    space = mymc.ParameterSpace([mymc.Parameter(3., 1., 'x'), mymc.Parameter(1., 1., 'y')])
+
+    def grad_log_posterior(struct):
+        delta = np.array([p() for p in space]) - mean
+        return -0.5 * np.dot(delta, np.dot(icov, delta)), -np.dot(icov, delta)
+    space.log_posterior = lambda struct: grad_log_posterior(struct)[0]
+    for grad in [grad_log_posterior, None]:
+        space.grad_log_posterior = grad
+        space[0].set(3.)
+        result = space.maximize(None)
+        assert np.allclose(result.x, mean, atol=1e-4)
+        assert np.allclose([p() for p in space], result.x)
+        assert np.allclose(space.hessian(None), -icov, rtol=1e-3)
+
+    approx = laplace.LaplaceApproximation(mean, -icov, names=['x', 'y'])
+    samples = approx.sample(20000, 1)
+    assert np.allclose(np.cov(samples.T), cov, rtol=0.05, atol=0.02)
+    logp = lambda x: -0.5 * np.dot(x - mean, np.dot(icov, x - mean))
+    diagnostic = approx.diagnose(logp, samples[:200])
+    assert diagnostic['good'] and np.isclose(diagnostic['ess_fraction'], 1.)
+
+    # a skewed posterior is flagged, unless its unconstrained coordinates are close to gaussian
+    approx = laplace.LaplaceApproximation([3.], [[-1. / 3.]])
+    samples = approx.sample(500, 2)
+    logp = lambda x: 3 * np.log(x[0]) - x[0] if x[0] > 0 else -np.inf
+    assert approx.diagnose(logp, samples)['flags'] == ['ess']
+    space = mymc.ParameterSpace([mymc.Parameter(1., 1., 'x')])
+    space[0].lower = 0.
+    space.log_posterior = lambda struct: logp([space[0]()])
+    uspace = laplace.unconstrained_space(space)
+    result = uspace.maximize(None)
+    assert np.isclose(result.x[0], np.log(4.), atol=1e-4) and np.isclose(space[0](), 4., atol=1e-3)
+    approx = laplace.LaplaceApproximation(result.x, uspace.hessian(None),
+                                          constrain=uspace.constrain)
+    samples = approx.sample(500, 3)
+    assert np.all(uspace.constrain(samples) > 0)
+    assert approx.diagnose(lambda y: [p.set(yi) for p, yi in zip(uspace, y)] and
+                           uspace.log_posterior(None), samples)['good']
+    assert laplace.effective_sample_size(laplace.importance_weights([0., -np.inf])) == 1.
+
+    # quick-look masses, mass and concentration free
+    ngal, zcluster = 3000, 0.3
+    zbins = np.arange(0.01, 3, 0.01)
+    pz = pdzfile_utils.DeltaPDZ.from_redshifts(rng.uniform(0.6, 1.5, ngal), zbins)
+    r_mpc = rng.uniform(0.5, 3, ngal)
+    betas = nfwutils.global_cosmology.beta_s(zbins, zcluster)
+    gc = nfwutils.global_cosmology
+    gamma, kappa = likelihood_grid.nfw_profiles(
+        1e15, 4., r_mpc, gc.rho_crit(zcluster), 1.5 * gc.angulardist(zcluster) *
+        gc.beta([1e6], zcluster)[0] * gc.hubble2(zcluster) / gc.v_c**2, 200.)
+    beta = betas[pz.bins]
+    ghats = beta * gamma / (1 - beta * kappa) + rng.normal(0, 0.005, ngal)
+    inputcat = ldac.LDACCat(pyfits.BinTableHDU.from_columns(
+        [pyfits.Column(name=name, format='D', array=array)
+         for name, array in [('r_mpc', r_mpc), ('ghats', ghats)]]))
+    builder = maxlike_masses.LensingModel()
+    runmethod = maxlike_masses.MAPModelToFile()
+    options, _ = builder.createOptions()
+    options, _ = runmethod.createOptions('out', nsamples=5000, ndiagnostic=100, seed=1,
+                                         options=options)
+    manager = util.VarContainer(options=options, inputcat=inputcat, pz=pz, pdzrange=zbins,
+                                zcluster=zcluster, modelbuilder=builder)
+    runmethod.run(manager)
+    assert manager.laplace_diagnostic['good']
+    assert manager.laplace.names == ['log10concentration', 'scaledmdelta']
+    assert np.abs(np.median(manager.chain['mdelta']) / 1e15 - 1) < 0.05
+    assert np.allclose(manager.chain['cdelta'], 10**manager.chain['log10concentration'])
+    assert len(manager.chain['mdelta']) == 5000
+    lines = manager.laplace.report(manager.laplace_diagnostic,
+                                   manager.laplace_samples).splitlines()
+    assert lines[2].startswith('scaledmdelta') and lines[-1] == 'Laplace\tgood'
+
+
+def test_reweight():
+
+    import os
+    import pickle
+    import astropy.io.fits as pyfits
+    import pzmassfitter.reweight as reweight
+
+    # a chain of the mass and concentration of a cluster, with a linear mass prior
+    rng = np.random.RandomState(46)
+    ngal, zcluster = 2000, 0.3
+    zbins = np.arange(0.01, 3, 0.01)
+    pz = pdzfile_utils.DeltaPDZ.from_redshifts(rng.uniform(0.6, 1.5, ngal), zbins)
+    r_mpc = rng.uniform(0.5, 3, ngal)
+    betas = nfwutils.global_cosmology.beta_s(zbins, zcluster)
+    gc = nfwutils.global_cosmology
+    gamma, kappa = likelihood_grid.nfw_profiles(
+        1e15, 4., r_mpc, gc.rho_crit(zcluster), 1.5 * gc.angulardist(zcluster) *
+        gc.beta([1e6], zcluster)[0] * gc.hubble2(zcluster) / gc.v_c**2, 200.)
+    beta = betas[pz.bins]
+    ghats = beta * gamma / (1 - beta * kappa) + rng.normal(0, 0.005, ngal)
+    columns = [('r_mpc', r_mpc), ('ghats', ghats)]
+    inputcat = ldac.LDACCat(pyfits.BinTableHDU.from_columns(
+        [pyfits.Column(name=name, format='D', array=array) for name, array in columns]))
+    builder = maxlike_masses.LensingModel()
+    runmethod = maxlike_masses.SampleModelToFile()
+    tmpdir = tempfile.mkdtemp()
+    chainfile = os.path.join(tmpdir, 'out.chain.pkl')
+    options, _ = builder.createOptions()
+    options, _ = runmethod.createOptions(chainfile, nsamples=1500, burn=300, sampler='nuts',
+                                         options=options)
+    manager = util.VarContainer(options=options, inputcat=inputcat, pz=pz, pdzrange=zbins,
+                                zcluster=zcluster, modelbuilder=builder)
+    manager.model = builder.makeFlatPosterior(manager)
+    with seeded_global_random(46):
+        runmethod.run(manager)
+    with open(chainfile, 'wb') as output:
+        pickle.dump(manager.chain, output)
+    chain = reweight.load_chain(chainfile, burn=300)
+    assert len(chain['mdelta']) == 1200
+
+    # the NUTS chains start from the coarse mass scan, not from the (here excluded) middle
+    # of the mass prior
+    class CutLensingModel(maxlike_masses.LensingModel):
+        def makeFlatPosterior(self, datamanager):
+            flat = maxlike_masses.LensingModel.makeFlatPosterior(self, datamanager)
+            log_like, log_like_grad = flat.log_like, flat.log_like_grad
+
+            def cut(theta):
+                return flat.mdelta(theta) > 3e15
+            flat.log_like = lambda theta: -np.inf if cut(theta) else log_like(theta)
+            flat.log_like_grad = lambda theta: ((-np.inf, np.zeros(len(theta))) if cut(theta)
+                                                else log_like_grad(theta))
+            return flat
+
+    cutmanager = util.VarContainer(manager, modelbuilder=CutLensingModel())
+    cutflat = cutmanager.modelbuilder.makeFlatPosterior(cutmanager)
+    assert cutflat.log_post(cutflat.theta) == -np.inf
+    cutoptions, _ = runmethod.createOptions(os.path.join(tmpdir, 'cut.chain.pkl'),
+                                            nsamples=200, burn=100, sampler='nuts',
+                                            options=builder.createOptions()[0])
+    cutmanager.options = cutoptions
+    with seeded_global_random(47):
+        runmethod.run(cutmanager)
+    assert np.all(np.isfinite(cutmanager.chain['posterior']))
+    assert np.max(cutmanager.chain['mdelta']) <= 3e15
+
+    # log mass prior: weights 1 / mdelta, without evaluating the likelihood
+    options, _ = builder.createOptions(logprior=True)
+    manager.options = options
+    result = reweight.reweight_chain(chain, builder.makeFlatPosterior(manager))
+    assert not result['likelihood_changed']
+    logw = np.log(result['weights'])
+    assert np.allclose(logw - logw[0], -np.log(chain['mdelta'] / chain['mdelta'][0]))
+    assert result['ess'] > 1000
+    logprior_ess = result['ess']
+
+    # wider concentration prior
+    options, _ = builder.createOptions(concwidth=0.3)
+    manager.options = options
+    result = reweight.reweight_chain(chain, builder.makeFlatPosterior(manager))
+    logc = chain['log10concentration']
+    expected = 0.5 * ((logc - 0.6) / 0.116)**2 - 0.5 * ((logc - 0.6) / 0.3)**2
+    assert np.allclose(np.log(result['weights']), expected - np.log(np.sum(np.exp(expected))))
+
+    # new likelihood (galaxies cut), re-evaluated on the samples
+    options, _ = builder.createOptions()
+    manager.options = options
+    manager.inputcat = inputcat.filter(r_mpc < 2.9)
+    manager.pz = pz[r_mpc < 2.9]
+    flat = builder.makeFlatPosterior(manager)
+    result = reweight.reweight_chain(chain, flat, min_ess=0)
+    assert result['likelihood_changed']
+    theta = np.array([chain['log10concentration'][7], chain['scaledmdelta'][7]])
+    assert np.isclose(result['logw'][7], flat.log_post(theta) - chain['posterior'][7])
+
+    # weighted summaries
+    summary = reweight.weighted_summary(chain['mdelta'], np.ones(1200))
+    assert np.isclose(summary['quantiles'][50], np.median(chain['mdelta']), rtol=1e-3)
+    assert np.isclose(summary['mean'], np.mean(chain['mdelta']))
+    assert np.isclose(summary['ess'], 1200.)
+
+    # degenerate weights (no sample in the new mass prior, or an effective sample size
+    # necessarily below the required one), or different parameters, are refused
+    manager.inputcat, manager.pz = inputcat, pz
+    for kwargs, min_ess in [(dict(masslow=1.01 * chain['mdelta'].max()), 100),
+                            ({}, len(chain['mdelta']) + 1),
+                            (dict(concentration=4.), 100)]:
+        options, _ = builder.createOptions(**kwargs)
+        manager.options = options
+        try:
+            reweight.reweight_chain(chain, builder.makeFlatPosterior(manager), min_ess=min_ess)
+            assert False
+        except reweight.ReweightingError as error:
+            assert ('parameters' in str(error)) == ('concentration' in kwargs)
+            assert ('no sample' in str(error)) == ('masslow' in kwargs)
+
+    # the run method
+    runmethod = maxlike_masses.ReweightChainToFile()
+    options, _ = builder.createOptions(logprior=True)
+    options, _ = runmethod.createOptions(os.path.join(tmpdir, 'new'), chainfile, burn=300,
+                                         seed=46, options=options)
+    manager.options = options
+    runmethod.run(manager)
+    assert np.isclose(manager.reweighting['ess'], logprior_ess)
+    cleanuptest(tmpdir)
+
+
+def test_nfw_conversions():
+
+    import scipy.optimize
+
+    rng = np.random.RandomState(48)
+
+    # root finds of the mean density, as done for each sample before
+    def xdelta(c, delta):
+        delta_c = nfwutils.deltaC(c)
+        return scipy.optimize.brenth(lambda x: 3 * delta_c * (np.log(1 + x) - x / (1 + x)) /
+                                     x**3 - delta, 0.1, 20, xtol=1e-14)
+
+    c = rng.uniform(1, 15, 200)
+    rs = rng.uniform(0.1, 1., 200)
+    for delta in [100., 200., 500., 2500.]:
+        reference = np.array([xdelta(ci, delta) for ci in c])
+        assert np.allclose(nfwutils.rdeltaOverRs(c, delta), reference, rtol=1e-10)
+        assert np.allclose(nfwutils.rdelta(rs, c, delta), reference * rs, rtol=1e-10)
+        assert np.allclose(nfwutils.rdelta2rs(reference * rs, c, delta), rs, rtol=1e-10)
+    assert np.allclose(nfwutils.rdeltaOverRs(c, 200.), c, rtol=1e-10)
+    assert np.isclose(nfwutils.rdelta(0.3, 4., 500.), xdelta(4., 500.) * 0.3, rtol=1e-10)
+
+    # series of the mass profile at small radii, and its closed form
+    x = np.logspace(-6, 3, 1000)
+    assert np.allclose(nfwutils.nfwMu(x), [quad(lambda t: t / (1 + t)**2, 0, xi)[0]
+                                           for xi in x], rtol=1e-10, atol=0)
+
+    # masses inside a radius, and back to the scale radius
+    mass = nfwutils.massInsideR(rs, c, 0.3, 1.5)
+    assert np.allclose(mass, [nfwutils.massInsideR(rsi, ci, 0.3, 1.5)
+                              for rsi, ci in zip(rs, c)], rtol=1e-12)
+    assert np.allclose(nfwutils.RsMassInsideR(mass, c, 0.3, 1.5), rs, rtol=1e-10)
+
+    # M200 to M500 of a chain, in one call
+    m200 = rng.uniform(1e14, 2e15, 50000)
+    c200 = rng.uniform(2, 8, 50000)
+    rscale = nfwutils.rscaleConstM(m200, c200, 0.3, 200.)
+    assert np.allclose(nfwutils.Mdelta(rscale, c200, 0.3, 200.), m200, rtol=1e-10)
+    m500 = nfwutils.Mdelta(rscale, c200, 0.3, 500.)
+    assert np.all(m500 < m200)
+    rho_c = nfwutils.global_cosmology.rho_crit(0.3)
+    assert np.isclose(m500[0], 500 * rho_c * 4 * np.pi / 3 *
+                      (xdelta(c200[0], 500.) * rscale[0])**3, rtol=1e-10)
+
+
+def test_mass_summary():
+
+    import os
+    import pickle
+    import pzmassfitter.mass_summary as mass_summary
+    import pzmassfitter.confidenceinterval as ci
+    import pzmassfitter.pymc_mymcmc_adapter as pma
+
+    rng = np.random.RandomState(49)
+    masses = rng.gamma(4., 2e14, 5000)
+    sx = np.sort(masses)
+
+    # histograms of the sorted samples are the ones of numpy
+    for nbins, hrange in [(25, None), (1600, None), (50, (3e14, 9e14))]:
+        counts, edges = mass_summary.sorted_histogram(sx, nbins, hrange)
+        refcounts, refedges = np.histogram(masses, nbins, range=hrange)
+        assert np.array_equal(counts, refcounts) and np.array_equal(edges, refedges)
+    assert np.array_equal(mass_summary.sorted_histogram(np.ones(10), 4)[0],
+                          np.histogram(np.ones(10), 4)[0])
+
+    # shortest intervals, as the scan over the sorted samples
+    ninterval = int(np.floor((1 - 0.32) * len(sx)))
+    start = np.argmin([sx[i + ninterval] - sx[i] for i in range(len(sx) - ninterval)])
+    assert np.array_equal(mass_summary.sorted_hpd(sx, 0.32), [sx[start], sx[start + ninterval]])
+    ninterval = int(len(sx) * 0.68)
+    widths = [(sx[i + ninterval] - sx[i], i) for i in range(len(sx) - ninterval)]
+    maxl, err = ci.maxDensityConfidenceRegion(masses, bins=50)
+    counts, edges = np.histogram(masses, 50)
+    centers = 0.5 * (edges[1:] + edges[:-1])
+    assert np.isclose(maxl, np.mean(centers[counts == counts.max()]), rtol=1e-12)
+    start = min((w, i) for w, i in widths if sx[i] <= maxl <= sx[i + ninterval])[1]
+    assert np.allclose(err, [maxl - sx[start], sx[start + ninterval] - maxl], rtol=1e-12)
+    assert ci.optimalHistogram(masses) in mass_summary.HISTOGRAM_BINS
+
+    # summaries of dumpMasses, from the sorted samples
+    stats = mass_summary.summarize(masses)
+    assert stats['quantiles'][50] == sx[2500] and stats['quantiles'][2.5] == sx[125]
+    assert np.isclose(stats['mean'], np.mean(masses))
+    assert np.isclose(stats['stddev'], np.std(masses))
+    lml, (lm, lp) = stats['log10maxlike']
+    assert lml - lm < np.log10(stats['maxlike'][0]) < lml + lp
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        prefix = os.path.join(tmpdir, 'test.m200')
+        pma.dumpMasses(masses, prefix)
+        lines = open(prefix + '.mass.summary.txt').read().splitlines()
+        assert [line.split('\t')[0] for line in lines] == \
+            ['mean', 'stddev', 'Q2.5', 'Q25', 'Q50', 'Q75', 'Q97.5', 'HPD68', 'HPD95',
+             'MaxLike', 'Log10 Maxlike']
+        assert lines[4] == 'Q50\t%e' % sx[2500]
+        with open(prefix + '.mass.summary.pkl', 'rb') as summary:
+            saved = pickle.load(summary)
+        assert sorted(saved) == sorted(stats) and saved['maxlike'][0] == stats['maxlike'][0]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_column_cat():
+
+    import os
+    import astropy.io.fits as pyfits
+    import pzmassfitter.datamanager as datamanager
+    import pzmassfitter.astropytable_filehandler as atf
+
+    rng = np.random.RandomState(50)
+
+    # same interface as LDACCat, on the arrays themselves
+    ids = np.arange(30, dtype=np.int64) + 2**40
+    values = rng.normal(0, 1, 30)
+    cat = ldac.ColumnCat([('SeqNr', ids), ('x', values)])
+    ldaccat = ldac.LDACCat(pyfits.BinTableHDU.from_columns(
+        [pyfits.Column(name='SeqNr', format='K', array=ids),
+         pyfits.Column(name='x', format='D', array=values)]))
+    assert len(cat) == len(ldaccat) == 30
+    assert cat.keys() == ldaccat.keys() and 'x' in cat and not cat.has_key('y')
+    assert cat['x'] is values and cat['SeqNr'].dtype == np.int64
+    assert cat[3] == (ids[3], values[3]) and len(list(cat)) == 30
+    mask = values > 0
+    assert np.array_equal(cat.filter(mask)['x'], ldaccat.filter(mask)['x'])
+    assert np.array_equal(cat[5:10]['SeqNr'], ids[5:10])
+    other = ldac.ColumnCat({'SeqNr': ids[::-3]})
+    assert np.array_equal(cat.matchById(other)['SeqNr'], ids[::-3])
+    assert len(cat.append(cat)) == 60
+    try:
+        cat.append(other)
+        assert False
+    except ldac.MismatchedKeysException:
+        pass
+    try:
+        ldac.ColumnCat([('a', np.ones(3)), ('b', np.ones(4))])
+        assert False
+    except ValueError:
+        pass
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cat.saveas(os.path.join(tmpdir, 'cat.fits'))
+        saved = ldac.openObjectFile(os.path.join(tmpdir, 'cat.fits'))
+        assert np.array_equal(saved['SeqNr'], ids) and np.array_equal(saved['x'], values)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    # input catalog of the file handler: float64 columns, passed to the likelihood as they are
+    ngal, zcluster = 500, 0.3
+    zbins = np.linspace(0.05, 2.5, 50)
+    lensingcat = table.Table([np.arange(ngal), rng.uniform(-0.1, 0.1, ngal),
+                              rng.uniform(-0.1, 0.1, ngal),
+                              rng.normal(0, 0.3, ngal), rng.normal(0, 0.3, ngal)],
+                             names=('id', 'coord_ra_deg', 'coord_dec_deg',
+                                    'ext_shapeHSM_HsmShapeRegauss_e1',
+                                    'ext_shapeHSM_HsmShapeRegauss_e2'))
+    zbest = rng.uniform(0.5, 1.5, ngal)
+    pdz = np.exp(-0.5 * ((zbins - zbest[:, None]) / 0.1)**2)
+    zcat = table.Table([np.arange(ngal)[::-1], zbest[::-1], pdz[::-1],
+                        np.tile(zbins, (ngal, 1))],
+                       names=('objectId', 'Z_BEST', 'pdz', 'zbins'))
+
+    filehandler = atf.AstropyTableFilehandler()
+    builder = maxlike_masses.LensingModel()
+    options, args = builder.createOptions(radlow=0.3, radhigh=3.)
+    options, args = filehandler.createOptions(
+        cluster='test', zcluster=zcluster, cat={'deepCoadd_meas': lensingcat, 'zphot_ref': zcat},
+        mconfig={'zconfig': 'zphot_ref'}, cluster_ra=0., cluster_dec=0., options=options,
+        args=args)
+    manager = datamanager.DataManager()
+    manager.options = options
+    filehandler.readData(manager)
+    inputcat = manager.inputcat
+    assert isinstance(inputcat, ldac.ColumnCat)
+    assert inputcat.keys() == ['SeqNr', 'r_mpc', 'ra', 'dec', 'z_b', 'ghats', 'B']
+    assert inputcat['SeqNr'].dtype == lensingcat['id'].dtype
+    assert inputcat['r_mpc'].dtype == np.float64 and inputcat['ghats'].dtype == np.float64
+    assert np.array_equal(inputcat['z_b'], zbest)
+    r, cos2phi, sin2phi = spheregeometry.shear_kernel(
+        np.asarray(lensingcat['coord_ra_deg']), np.asarray(lensingcat['coord_dec_deg']), 0., 0.)
+    assert np.allclose(inputcat['r_mpc'], r * nfwutils.global_cosmology.angulardist(zcluster),
+                       rtol=1e-12, atol=0)
+
+    manager.update(builder.modelCut, {'inputcat': 'filter', 'pz': '__getitem__'})
+    assert 0 < len(manager.inputcat) < ngal
+    assert np.all((manager.inputcat['r_mpc'] > 0.3) & (manager.inputcat['r_mpc'] < 3.))
+    parts = util.VarContainer(zcluster=zcluster)
+    builder.makeLikelihoodData(manager, parts)
+    assert parts.r_mpc is manager.inputcat['r_mpc'] and parts.ghats is manager.inputcat['ghats']
+    assert parts.pz.shape == (len(manager.inputcat), len(zbins))
+
+
+def test_voigt_table():
+
+    import astropy.io.fits as pyfits
+    import pzmassfitter.voigtcall as voigtcall
+    import pzmassfitter.voigt_table as voigt_table
+    import pzmassfitter.maxlike_bentstep_voigt as bentvoigt
+
+    rng = np.random.RandomState(47)
+
+    # the exact profile is the one of voigt.c, to its 1e-4 accuracy
+    delta = np.linspace(-2, 2, 401)
+    assert np.allclose(voigt_table.voigt_profile(delta, 0.3, 0.05),
+                       voigtcall.voigtcall(delta, 0.3, 0.05), rtol=2e-4, atol=0)
+
+    # parity with the Faddeeva evaluation at the edges of the priors, beyond the table too
+    table = voigt_table.VoigtTable(tolerance=1e-5)
+    delta = rng.uniform(-7, 7, 100000)
+    for sigma, gamma in [(0.15, 0.003), (0.15, 0.1), (0.5, 0.003), (0.5, 0.1), (0.3, 0.05)]:
+        exact = voigt_table.voigt_profile(delta, sigma, gamma)
+        assert np.all(np.abs(table(delta, sigma, gamma) - exact) <= 1e-5 * exact)
+        assert table.error <= 1e-5
+    assert table.nbuilds == 5
+
+    # the table is only rebuilt when (sigma, gamma) change
+    shape_like = table.shape(0.3, 0.05)
+    shape_like(delta[:10])
+    table(np.zeros((3, 4)), 0.3, 0.05)
+    assert table.nbuilds == 5
+    assert table(np.zeros((3, 4)), 0.3, 0.06).shape == (3, 4)
+    assert table.nbuilds == 6
+    coarse = voigt_table.VoigtTable(tolerance=1e-3)
+    coarse.build(0.3, 0.05)
+    assert len(coarse.values) < len(table.values)
+
+    # likelihood of dense pdzs, with the tabulated and the exact profiles
+    ngal, zcluster = 200, 0.3
+    zbins = np.linspace(0.05, 3, 60)
+    pz = np.exp(-0.5 * ((zbins - rng.uniform(0.6, 1.5, ngal)[:, None]) / 0.2)**2)
+    r_mpc = rng.uniform(0.3, 3, ngal)
+    ghats = rng.normal(0.02, 0.25, ngal)
+    m, c = rng.normal(0, 0.03, ngal), rng.normal(0, 1e-3, ngal)
+    betas = nfwutils.global_cosmology.beta_s(zbins, zcluster)
+    like = voigt_table.tabulated_bentvoigt_like(table)
+    exact = np.sum(likelihood_grid.galaxy_loglike(
+        8e14, 4., r_mpc, ghats, zbins, betas, pz, m, c,
+        likelihood_grid.voigt_shape(0.3, 0.05), 1.3e11, 3e-4, 200.))
+    assert abs(like(8e14, 4., r_mpc, ghats, zbins, betas, pz, m, c, 0.3, 0.05,
+                    1.3e11, 3e-4, 200.) - exact) < ngal * 2e-4
+
+    # the voigt model uses the table, unless its tolerance is 0
+    inputcat = ldac.LDACCat(pyfits.BinTableHDU.from_columns(
+        [pyfits.Column(name=name, format='D', array=array)
+         for name, array in [('r_mpc', r_mpc), ('ghats', ghats),
+                             ('size', rng.uniform(1, 3, ngal))]]))
+    voigt = bentvoigt.BentVoigtShapedistro()
+    for voigttol in [1e-5, 0.]:
+        options, _ = voigt.createOptions(voigttol=voigttol)
+        manager = util.VarContainer(options=options, inputcat=inputcat, pz=pz,
+                                    pdzrange=zbins, zcluster=zcluster)
+        parts = util.VarContainer(zcluster=zcluster)
+        likelihood = voigt.makeLikelihoodData(manager, parts)
+        if voigttol:
+            assert parts.voigt_table.tolerance == voigttol
+        else:
+            assert parts.voigt_table is None and likelihood is nfwmodeltools.bentvoigt_like
+
+        # delta pdzs stay sparse, unless the exact likelihood integrates them
+        delta = pdzfile_utils.DeltaPDZ.from_redshifts(zbins[np.arange(ngal) % 50], zbins)
+        manager.pz = delta
+        voigt.makeLikelihoodData(manager, parts)
+        if voigttol:
+            assert parts.pz is delta
+        else:
+            assert np.array_equal(parts.pz, delta.dense())
+    parts.sigma, parts.gamma = 0.3, 0.05
+    residuals = np.linspace(-7, 7, 1001)
+    assert np.array_equal(voigt.gridShapeLike(parts)(residuals),
+                          likelihood_grid.voigt_shape(0.3, 0.05)(residuals))
+
+    # benchmark of the table
+    result = voigt_table.benchmark(nresiduals=10000, tolerance=1e-5, seed=1)
+    assert result['error'] <= 1e-5
+    assert set(result) == set(['exact', 'build', 'interpolation', 'error'])
+
+
 
 if __name__ == '__main__':
 